@@ -0,0 +1,131 @@
+"""
+Offline end-to-end throughput benchmark for AI document extraction
+
+Starts the local Gemini stand-in (benchmarks/mock_gemini_server.py), points
+the shared client at it and runs extract_with_model_routing over synthetic
+documents at several concurrency levels. No API key or network is needed.
+
+Usage:
+    python benchmarks/extraction_throughput.py [--requests 40] [--concurrency 1,4,8]
+        [--records 50] [--mock-config mock.json] [--base-url http://127.0.0.1:8765]
+
+--base-url uses an already running mock (or any compatible endpoint)
+instead of starting one in-process.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))  # Project root
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'services'))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from mock_gemini_server import start_mock_server, load_config
+
+TARGET_FIELDS = [
+    {"field_id": "f-name", "name": "Member Name", "description": "Full name of the scheme member", "is_identifier": True},
+    {"field_id": "f-dob", "name": "Date of Birth", "description": "Member date of birth", "is_identifier": False},
+    {"field_id": "f-salary", "name": "Pensionable Salary", "description": "Annual pensionable salary", "is_identifier": False},
+]
+
+
+def synthetic_response(record_count):
+    """AI_DOCUMENT_EXTRACTION-shaped records for TARGET_FIELDS"""
+    records = []
+    for index in range(record_count):
+        for field in TARGET_FIELDS:
+            records.append({
+                "validation_type": "collection_property",
+                "data_type": "TEXT",
+                "field_name": f"Members.{field['name']}[{index}]",
+                "collection_name": "Members",
+                "field_id": field['field_id'],
+                "extracted_value": f"{field['name']} {index}",
+                "confidence_score": 0.92,
+                "validation_status": "unverified",
+                "ai_reasoning": "Synthetic benchmark record",
+                "record_index": index,
+            })
+    return json.dumps(records, indent=2)
+
+
+def synthetic_documents(pages=20):
+    """A members schedule split into pages"""
+    lines = [f"Member {i}\tBorn 19{50 + i % 40}-01-01\tSalary {20000 + i * 37}" for i in range(pages * 40)]
+    pages_text = ["\n".join(lines[p * 40:(p + 1) * 40]) for p in range(pages)]
+    return [{"id": "doc-1", "file_name": "members.pdf", "mime_type": "application/pdf", "content": "\f".join(pages_text)}]
+
+
+def run_level(extract, documents, concurrency, total_requests):
+    """Run total_requests extractions with the given concurrency"""
+    latencies = []
+    record_counts = []
+
+    def one(_):
+        started = time.time()
+        result = extract(documents, TARGET_FIELDS, {"targeted": [], "global": []}, [], None)
+        latencies.append(time.time() - started)
+        record_counts.append(len(result) if isinstance(result, list) else 0)
+
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, range(total_requests)))
+    elapsed = time.time() - started
+
+    latencies.sort()
+    return {
+        "concurrency": concurrency,
+        "requests": total_requests,
+        "elapsed_s": round(elapsed, 2),
+        "requests_per_s": round(total_requests / elapsed, 2),
+        "records_per_s": round(sum(record_counts) / elapsed, 1),
+        "p50_s": round(statistics.median(latencies), 3),
+        "p95_s": round(latencies[max(0, int(len(latencies) * 0.95) - 1)], 3),
+        "failed": sum(1 for count in record_counts if count == 0),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=40)
+    parser.add_argument("--concurrency", default="1,4,8")
+    parser.add_argument("--records", type=int, default=50, help="Records per synthetic response")
+    parser.add_argument("--mock-config", help="Mock behaviour JSON; latency defaults to lognormal 800ms")
+    parser.add_argument("--base-url", help="Use a running endpoint instead of starting the mock")
+    args = parser.parse_args()
+
+    server = None
+    if args.base_url:
+        base_url = args.base_url
+    else:
+        config = load_config(args.mock_config) or {
+            "latency": {"distribution": "lognormal", "medianMs": 800, "sigma": 0.4},
+            "tokensPerSecond": 400,
+            "seed": 1,
+        }
+        config.setdefault("defaultText", synthetic_response(args.records))
+        server = start_mock_server(config)
+        base_url = f"http://127.0.0.1:{server.server_port}"
+
+    # The shared client reads GEMINI_BASE_URL when the config is first loaded
+    os.environ["GEMINI_BASE_URL"] = base_url
+    os.environ.setdefault("GEMINI_API_KEY", "local")
+    from ai_extraction_wizard import extract_with_model_routing
+
+    documents = synthetic_documents()
+    results = [run_level(extract_with_model_routing, documents, int(level), args.requests)
+               for level in args.concurrency.split(",")]
+    print(json.dumps(results, indent=2))
+
+    if server:
+        print(json.dumps(server.behaviour.stats), file=sys.stderr)
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+Identifier reference write benchmark
+
+Saves synthetic identifier references (records x fields, "Field[idx]" keys as
+load_merged_identifier_references_from_db returns them) for a scratch session
+with each write path and reports the time per size:
+
+- row:    the previous code, one INSERT per (record, field)
+- values: multi-row INSERTs via execute_values
+- copy:   one COPY FROM STDIN
+
+Sizes are reference rows (records x fields). The row-by-row path is skipped
+above --row-max, where it takes minutes against a remote database. Every
+run happens in one transaction that replaces the previous run's rows, like
+a rerun of the same extraction; the scratch rows are deleted at the end.
+
+Usage:
+    python benchmarks/identifier_reference_writes.py [--sizes 1000 10000 100000] [--fields 20] [--row-max 10000] [--runs 3]
+
+Requires DATABASE_URL.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+import uuid
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))  # Project root
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'services'))
+
+import psycopg2
+
+from extraction_wizardry import REFERENCE_INDEX_SUFFIX, write_identifier_references
+
+
+def make_references(records, fields):
+    """References shaped like load_merged_identifier_references_from_db output"""
+    return [{f"Field {field}[{idx}]": f"value {idx}-{field}" for field in range(fields)} for idx in range(records)]
+
+
+def write_row_by_row(conn, session_id, extraction_number, identifier_references):
+    """The write path save_identifier_references_to_db used before the bulk path"""
+    cursor = conn.cursor()
+    cursor.execute("""
+    DELETE FROM extraction_identifier_references
+    WHERE session_id = %s AND extraction_number = %s
+    """, (session_id, extraction_number))
+    written = 0
+    for idx, ref in enumerate(identifier_references):
+        for field_name, extracted_value in ref.items():
+            cursor.execute("""
+            INSERT INTO extraction_identifier_references
+            (session_id, extraction_number, record_index, field_name, extracted_value)
+            VALUES (%s, %s, %s, %s, %s)
+            """, (session_id, extraction_number, idx, REFERENCE_INDEX_SUFFIX.sub('', field_name), str(extracted_value)))
+            written += 1
+    conn.commit()
+    cursor.close()
+    return written
+
+
+def run_method(conn, method, session_id, references, runs):
+    timings = []
+    for _ in range(runs):
+        started = time.time()
+        if method == 'row':
+            written = write_row_by_row(conn, session_id, 0, references)
+        else:
+            written = write_identifier_references(conn, session_id, 0, references, method=method)
+        timings.append(time.time() - started)
+    mean = statistics.mean(timings)
+    return {
+        "method": method,
+        "rows": written,
+        "mean_s": round(mean, 3),
+        "min_s": round(min(timings), 3),
+        "rows_per_s": round(written / mean) if mean else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--fields', type=int, default=20)
+    parser.add_argument('--row-max', type=int, default=10000)
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    db_url = os.getenv('DATABASE_URL')
+    if not db_url:
+        print("DATABASE_URL is required", file=sys.stderr)
+        sys.exit(1)
+
+    session_id = f"benchmark-{uuid.uuid4()}"
+    conn = psycopg2.connect(db_url)
+    report = []
+    try:
+        for size in args.sizes:
+            references = make_references(max(1, size // args.fields), args.fields)
+            for method in ('row', 'values', 'copy'):
+                if method == 'row' and size > args.row_max:
+                    continue
+                result = run_method(conn, method, session_id, references, args.runs)
+                result["size"] = size
+                report.append(result)
+                print(f"{size:>7} rows  {method:<6} {result['mean_s']:.3f}s", file=sys.stderr, flush=True)
+    finally:
+        with conn, conn.cursor() as cursor:
+            cursor.execute("DELETE FROM extraction_identifier_references WHERE session_id = %s", (session_id,))
+        conn.close()
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
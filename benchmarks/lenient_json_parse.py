@@ -0,0 +1,190 @@
+"""
+Parse benchmark for utils/lenient_json.py against the previous repair code
+
+Takes the JSON blocks captured in logged prompts and responses
+(attached_assets/*.txt by default) and renders each one in the shapes model
+output arrives in:
+
+- clean:          pretty-printed inside a ```json fence
+- prose:          preceded and followed by explanatory text
+- trailing_comma: commas before every closing bracket
+- unquoted_keys:  identifier keys without quotes
+- truncated:      cut off at 70% of its length
+
+Each variant is parsed by the lenient parser and by the code it replaced:
+fence stripping plus json.loads, then find('{')/rfind('}') slicing, then the
+regex repair passes from the schema generator. The report counts
+successes (the original value, or for truncated variants a value whose
+records are all complete) and total time per parser.
+
+Usage:
+    python benchmarks/lenient_json_parse.py [paths ...] [--min-chars 200] [--repeat 3]
+"""
+
+import argparse
+import glob
+import json
+import os
+import re
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))  # Project root
+
+from utils.lenient_json import parse_lenient
+
+DEFAULT_GLOB = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'attached_assets', '*.txt')
+VARIANTS = ('clean', 'prose', 'trailing_comma', 'unquoted_keys', 'truncated')
+_IDENTIFIER = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+def find_json_blocks(text, min_chars):
+    """JSON arrays/objects that start a line and span at least min_chars"""
+    decoder = json.JSONDecoder()
+    blocks = []
+    pos = 0
+    while pos < len(text):
+        if (pos == 0 or text[pos - 1] == '\n') and text[pos] in '[{':
+            try:
+                value, end = decoder.raw_decode(text, pos)
+            except ValueError:
+                value, end = None, pos
+            if isinstance(value, (list, dict)) and end - pos >= min_chars:
+                blocks.append(value)
+                pos = end
+                continue
+        pos += 1
+    return blocks
+
+
+def render(value, trailing_comma=False, unquoted_keys=False, indent=0):
+    """Pretty-print like json.dumps(indent=2), optionally with the deviations models produce"""
+    pad = '  ' * (indent + 1)
+    close = '  ' * indent
+    tail = ',' if trailing_comma else ''
+    if isinstance(value, dict) and value:
+        items = []
+        for key, member in value.items():
+            name = key if unquoted_keys and _IDENTIFIER.match(key) else json.dumps(key)
+            items.append(f"{pad}{name}: {render(member, trailing_comma, unquoted_keys, indent + 1)}")
+        return "{\n" + ",\n".join(items) + tail + "\n" + close + "}"
+    if isinstance(value, list) and value:
+        items = [pad + render(member, trailing_comma, unquoted_keys, indent + 1) for member in value]
+        return "[\n" + ",\n".join(items) + tail + "\n" + close + "]"
+    return json.dumps(value)
+
+
+def make_variants(value):
+    pretty = json.dumps(value, indent=2)
+    return {
+        'clean': f"```json\n{pretty}\n```",
+        'prose': f"Here is the extracted data:\n\n{pretty}\n\nLet me know if you need anything else.",
+        'trailing_comma': render(value, trailing_comma=True),
+        'unquoted_keys': render(value, unquoted_keys=True),
+        'truncated': pretty[:int(len(pretty) * 0.7)],
+    }
+
+
+def legacy_parse(text):
+    """The fence-strip / slice / regex-repair sequence the services used before"""
+    cleaned = text.strip()
+    if cleaned.startswith('```json'):
+        cleaned = cleaned[7:]
+    elif cleaned.startswith('```'):
+        cleaned = cleaned[3:]
+    if cleaned.endswith('```'):
+        cleaned = cleaned[:-3]
+    cleaned = cleaned.strip()
+    try:
+        return json.loads(cleaned)
+    except ValueError:
+        pass
+
+    start, end = cleaned.find('{'), cleaned.rfind('}') + 1
+    if start >= 0 and end > start:
+        try:
+            return json.loads(cleaned[start:end])
+        except ValueError:
+            pass
+
+    fixed = cleaned
+    fixed = re.sub(r'(\w+):\s*"', r'"\1": "', fixed)
+    fixed = re.sub(r'(\w+):\s*(\d+)', r'"\1": \2', fixed)
+    fixed = re.sub(r'(\w+):\s*(true|false)', r'"\1": \2', fixed)
+    fixed = re.sub(r'(\w+):\s*\[', r'"\1": [', fixed)
+    fixed = re.sub(r'(\w+):\s*\{', r'"\1": {', fixed)
+    lines = []
+    for line in fixed.split('\n'):
+        if line.count('"') % 2 != 0:
+            if line.strip().endswith((',', '}', ']')):
+                line = re.sub(r'([^"])(\s*[,\}\]])$', r'\1"\2', line)
+            else:
+                line = line.rstrip() + '"'
+        lines.append(line)
+    return json.loads('\n'.join(lines))
+
+
+def lenient_parse(text):
+    return parse_lenient(text).value
+
+
+def correct(variant, parsed, expected):
+    """Exact value, or for truncated input a same-typed value holding only complete records"""
+    if variant != 'truncated':
+        return parsed == expected
+    if type(parsed) is not type(expected):
+        return False
+    if isinstance(expected, list):
+        return parsed == expected[:len(parsed)]
+    return all(key in expected for key in parsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="*", help="Captured prompt/response files (default attached_assets/*.txt)")
+    parser.add_argument("--min-chars", type=int, default=200, help="Ignore JSON blocks shorter than this")
+    parser.add_argument("--repeat", type=int, default=3, help="Timing repetitions per parse")
+    args = parser.parse_args()
+
+    blocks = []
+    paths = args.paths or sorted(glob.glob(DEFAULT_GLOB))
+    for path in paths:
+        try:
+            with open(path, 'r', encoding='utf-8', errors='replace') as f:
+                blocks.extend(find_json_blocks(f.read(), args.min_chars))
+        except OSError as e:
+            print(f"Skipping {path}: {e}", file=sys.stderr)
+
+    parsers = {"legacy": legacy_parse, "lenient": lenient_parse}
+    report = {name: {variant: {"ok": 0, "failed": 0, "seconds": 0.0} for variant in VARIANTS} for name in parsers}
+    characters = 0
+
+    for value in blocks:
+        for variant, text in make_variants(value).items():
+            characters += len(text)
+            for name, parse in parsers.items():
+                stats = report[name][variant]
+                started = time.perf_counter()
+                for _ in range(args.repeat):
+                    try:
+                        parsed = parse(text)
+                    except ValueError:
+                        parsed = ValueError
+                stats["seconds"] += (time.perf_counter() - started) / args.repeat
+                stats["ok" if parsed is not ValueError and correct(variant, parsed, value) else "failed"] += 1
+
+    for name in parsers:
+        for stats in report[name].values():
+            stats["seconds"] = round(stats["seconds"], 4)
+        report[name]["total"] = {
+            "ok": sum(report[name][variant]["ok"] for variant in VARIANTS),
+            "failed": sum(report[name][variant]["failed"] for variant in VARIANTS),
+            "seconds": round(sum(report[name][variant]["seconds"] for variant in VARIANTS), 4),
+        }
+
+    print(json.dumps({"files_scanned": len(paths), "json_blocks": len(blocks),
+                      "characters_parsed": characters, **report}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Map-reduce vs single-shot extraction latency benchmark
+
+Runs ai_document_extraction against the same session documents with the
+project's map-reduce mode and with a single-shot call over the full text,
+and reports latency and record counts for each.
+
+Usage:
+    python benchmarks/map_reduce_latency.py <session_id> <target_fields.json> <document_id> [<document_id> ...] [--runs N]
+
+target_fields.json holds the target_fields_data list passed by extraction_wizardry.py.
+Requires DATABASE_URL and GEMINI_API_KEY, and makes real Gemini calls.
+"""
+
+import os
+import sys
+import json
+import time
+import statistics
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))  # Project root
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'services'))
+
+from ai_extraction_wizard import ai_document_extraction
+from utils.config import get_config
+
+
+def run_mode(label, session_id, document_ids, target_fields, map_reduce, runs):
+    """Run one extraction mode several times and print latency statistics"""
+    timings = []
+    record_counts = []
+    errors = 0
+
+    for run in range(runs):
+        started = time.time()
+        result = ai_document_extraction(document_ids, session_id, target_fields, map_reduce=map_reduce)
+        timings.append(time.time() - started)
+
+        if isinstance(result, list):
+            record_counts.append(len(result))
+        else:
+            errors += 1
+        print(f"{label} run {run + 1}/{runs}: {timings[-1]:.2f}s", file=sys.stderr, flush=True)
+
+    return {
+        "mode": label,
+        "runs": runs,
+        "errors": errors,
+        "mean_s": round(statistics.mean(timings), 2),
+        "p50_s": round(statistics.median(timings), 2),
+        "max_s": round(max(timings), 2),
+        "records": record_counts,
+    }
+
+
+def main():
+    args = sys.argv[1:]
+    runs = 3
+    if '--runs' in args:
+        index = args.index('--runs')
+        runs = int(args[index + 1])
+        del args[index:index + 2]
+
+    if len(args) < 3:
+        print(__doc__)
+        sys.exit(1)
+
+    session_id, fields_path, document_ids = args[0], args[1], args[2:]
+    with open(fields_path, 'r') as f:
+        target_fields = json.load(f)
+
+    map_reduce = dict(get_config('extraction.mapReduce', {}) or {})
+    map_reduce['enabled'] = True
+
+    results = [
+        run_mode("single-shot", session_id, document_ids, target_fields, {"enabled": False}, runs),
+        run_mode("map-reduce", session_id, document_ids, target_fields, map_reduce, runs),
+    ]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
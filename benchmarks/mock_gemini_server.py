@@ -0,0 +1,455 @@
+"""
+Local Gemini stand-in for offline load and latency testing
+
+Implements the subset of the Gemini REST API the services use:
+
+- POST /v1beta/models/{model}:generateContent
+- POST /v1beta/models/{model}:streamGenerateContent?alt=sse
+- POST /v1beta/cachedContents, GET/DELETE /v1beta/cachedContents/{id}
+- GET  /stats, POST /reset    (mock-only: request counters)
+
+Text and inline_data (vision) parts are accepted. Latency, streaming speed,
+429/503 error rates and responses come from a JSON config:
+
+{
+  "latency": {"distribution": "lognormal", "medianMs": 800, "sigma": 0.5},
+  "tokensPerSecond": 150,
+  "errorRates": {"429": 0.02, "503": 0.01},
+  "models": {"gemini-2.5-pro": {"latency": {"distribution": "fixed", "ms": 2500}, "tokensPerSecond": 60}},
+  "responses": [{"contains": "EXCEL FUNCTION", "model": "gemini-2.5-flash", "text": "..."}],
+  "replayFile": "logs/gemini_recordings.jsonl",
+  "defaultText": "[]",
+  "seed": 1
+}
+
+Latency distributions: fixed (ms), uniform (minMs, maxMs), normal (meanMs,
+stdMs) and lognormal (medianMs, sigma). The sampled latency is the time to
+the first token; the rest of the response is paced by tokensPerSecond.
+With "prefillTokensPerSecond" set, uncached prompt tokens add input
+processing time before the first token, so explicit context caching
+(requests carrying "cachedContent") shows up as lower latency. Responses
+longer than the request's maxOutputTokens (or a "maxOutputTokens" model
+setting) are cut off with finish reason MAX_TOKENS.
+
+Responses are chosen in order: canned "responses" (first match on model and
+prompt substring), then replayed recordings keyed by prompt fingerprint
+(written by the shared client when GEMINI_RECORD_FILE is set), then
+"defaultText".
+
+Usage:
+    python benchmarks/mock_gemini_server.py [--port 8765] [--config mock.json]
+    GEMINI_BASE_URL=http://127.0.0.1:8765 GEMINI_API_KEY=local python services/...
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+CHARS_PER_TOKEN = 4
+IMAGE_TOKENS = 258          # Gemini's flat token cost per image part
+STREAM_CHUNK_TOKENS = 16    # Tokens per streamed chunk
+
+MODEL_PATH = re.compile(r'^/v1(?:beta|alpha)?/models/([^:/]+):(generateContent|streamGenerateContent)$')
+CACHES_PATH = re.compile(r'^/v1(?:beta|alpha)?/cachedContents(?:/([^/]+))?$')
+
+ERROR_STATUS = {
+    429: "RESOURCE_EXHAUSTED",
+    503: "UNAVAILABLE",
+}
+
+
+def request_fingerprint(model, contents_json):
+    """
+    Fingerprint a request from its REST JSON contents
+
+    Matches utils.gemini_client.prompt_fingerprint for the same prompt:
+    text parts are joined with newlines and inline data contributes its
+    MIME type and SHA-256.
+    """
+    pieces = []
+    for content in contents_json or []:
+        for part in content.get('parts', []):
+            if 'text' in part:
+                pieces.append(part['text'])
+            inline = part.get('inlineData') or part.get('inline_data')
+            if inline:
+                data = base64.b64decode(inline.get('data', ''))
+                pieces.append(f"<{inline.get('mimeType') or inline.get('mime_type')}:{hashlib.sha256(data).hexdigest()}>")
+    return hashlib.sha256("\n".join([model] + pieces).encode('utf-8')).hexdigest()
+
+
+def contents_text(contents_json):
+    """(joined text, inline part count) of REST JSON contents"""
+    texts = []
+    inline_parts = 0
+    for content in contents_json or []:
+        for part in content.get('parts', []):
+            if 'text' in part:
+                texts.append(part['text'])
+            if part.get('inlineData') or part.get('inline_data'):
+                inline_parts += 1
+    return "\n".join(texts), inline_parts
+
+
+def prompt_token_count(text, inline_parts):
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN + inline_parts * IMAGE_TOKENS
+
+
+def parse_duration(value, default=3600):
+    """Seconds from a protobuf duration string such as 3600s"""
+    try:
+        return float(str(value).rstrip('s'))
+    except (TypeError, ValueError):
+        return default
+
+
+def rfc3339(timestamp):
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(timestamp)) + f".{int(timestamp % 1 * 1e6):06d}Z"
+
+
+class MockBehaviour:
+    """Latency, error and response policy loaded from the mock config"""
+
+    def __init__(self, config):
+        self.config = config
+        self.random = random.Random(config.get('seed'))
+        self.random_lock = threading.Lock()
+        self.responses = config.get('responses', [])
+        self.default_text = config.get('defaultText', '[]')
+        self.replay = {}
+        replay_file = config.get('replayFile')
+        if replay_file and os.path.exists(replay_file):
+            with open(replay_file, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.replay[entry.get('fingerprint')] = entry.get('text', '')
+        self.caches = {}
+        self.caches_lock = threading.Lock()
+        self.stats_lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self.stats_lock:
+            self.stats = {"requests": 0, "streamed": 0, "errors": {}, "models": {}, "inline_parts": 0,
+                          "replayed": 0, "canned": 0, "default": 0,
+                          "caches_created": 0, "caches_deleted": 0, "cache_hits": 0, "cached_tokens": 0,
+                          "truncated": 0}
+
+    def bump(self, key, amount=1):
+        with self.stats_lock:
+            self.stats[key] += amount
+
+    def get_cache(self, name):
+        """Stored cache by resource name, or None if unknown or expired"""
+        with self.caches_lock:
+            cache = self.caches.get(name)
+            if cache and cache["expires_at"] <= time.time():
+                del self.caches[name]
+                cache = None
+            return cache
+
+    def count(self, model, streamed, inline_parts, source=None, error=None):
+        with self.stats_lock:
+            self.stats["requests"] += 1
+            self.stats["streamed"] += 1 if streamed else 0
+            self.stats["inline_parts"] += inline_parts
+            self.stats["models"][model] = self.stats["models"].get(model, 0) + 1
+            if error:
+                self.stats["errors"][str(error)] = self.stats["errors"].get(str(error), 0) + 1
+            if source:
+                self.stats[source] += 1
+
+    def model_setting(self, model, key, default=None):
+        return self.config.get('models', {}).get(model, {}).get(key, self.config.get(key, default))
+
+    def sample_latency(self, model):
+        """Time to first token in seconds"""
+        spec = self.model_setting(model, 'latency', {"distribution": "fixed", "ms": 0})
+        kind = spec.get('distribution', 'fixed')
+        with self.random_lock:
+            if kind == 'uniform':
+                ms = self.random.uniform(spec.get('minMs', 0), spec.get('maxMs', 0))
+            elif kind == 'normal':
+                ms = self.random.gauss(spec.get('meanMs', 0), spec.get('stdMs', 0))
+            elif kind == 'lognormal':
+                median = max(spec.get('medianMs', 1), 1e-3)
+                ms = self.random.lognormvariate(math.log(median), spec.get('sigma', 0.5))
+            else:
+                ms = spec.get('ms', 0)
+        return max(ms, 0) / 1000.0
+
+    def sample_error(self, model):
+        """HTTP status to fail with, or None"""
+        rates = self.model_setting(model, 'errorRates', {}) or {}
+        with self.random_lock:
+            roll = self.random.random()
+        threshold = 0.0
+        for status, rate in rates.items():
+            threshold += float(rate)
+            if roll < threshold:
+                return int(status)
+        return None
+
+    def pick_response(self, model, prompt_text, fingerprint):
+        """Return (text, source) for a request"""
+        for canned in self.responses:
+            if canned.get('model') and canned['model'] != model:
+                continue
+            if canned.get('contains') and canned['contains'] not in prompt_text:
+                continue
+            if canned.get('textFile'):
+                with open(canned['textFile'], 'r') as f:
+                    return f.read(), 'canned'
+            return canned.get('text', ''), 'canned'
+        if fingerprint in self.replay:
+            return self.replay[fingerprint], 'replayed'
+        return self.default_text, 'default'
+
+
+def response_payload(model, text, prompt_tokens, finish_reason="STOP", total_text=None, cached_tokens=0):
+    """Build a GenerateContentResponse JSON body"""
+    candidate_tokens = (len(total_text if total_text is not None else text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+    payload = {
+        "candidates": [{
+            "content": {"role": "model", "parts": [{"text": text}]},
+            "index": 0,
+        }],
+        "modelVersion": model,
+    }
+    if finish_reason:
+        payload["candidates"][0]["finishReason"] = finish_reason
+        payload["usageMetadata"] = {
+            "promptTokenCount": prompt_tokens,
+            "candidatesTokenCount": candidate_tokens,
+            "totalTokenCount": prompt_tokens + candidate_tokens,
+        }
+        if cached_tokens:
+            payload["usageMetadata"]["cachedContentTokenCount"] = cached_tokens
+    return payload
+
+
+class MockGeminiHandler(BaseHTTPRequestHandler):
+    """Request handler; behaviour is attached to the server instance"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _not_found(self, message="Not found"):
+        return self._send_json(404, {"error": {"code": 404, "message": message, "status": "NOT_FOUND"}})
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/stats':
+            with self.server.behaviour.stats_lock:
+                return self._send_json(200, self.server.behaviour.stats)
+        match = CACHES_PATH.match(path)
+        if match and match.group(1):
+            cache = self.server.behaviour.get_cache(f"cachedContents/{match.group(1)}")
+            return self._send_json(200, cache["resource"]) if cache else self._not_found("CachedContent not found")
+        self._not_found()
+
+    def do_DELETE(self):
+        match = CACHES_PATH.match(urlparse(self.path).path)
+        if not match or not match.group(1):
+            return self._not_found()
+        behaviour = self.server.behaviour
+        with behaviour.caches_lock:
+            cache = behaviour.caches.pop(f"cachedContents/{match.group(1)}", None)
+        if not cache:
+            return self._not_found("CachedContent not found")
+        behaviour.bump("caches_deleted")
+        self._send_json(200, {})
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b""
+
+        if path == '/reset':
+            self.server.behaviour.reset_stats()
+            return self._send_json(200, {"reset": True})
+
+        try:
+            body = json.loads(raw or b"{}")
+        except ValueError:
+            return self._send_json(400, {"error": {"code": 400, "message": "Invalid JSON payload", "status": "INVALID_ARGUMENT"}})
+
+        if CACHES_PATH.match(path):
+            return self.handle_create_cache(body)
+
+        match = MODEL_PATH.match(path)
+        if not match:
+            return self._not_found(f"Unknown path {path}")
+
+        model, method = match.group(1), match.group(2)
+        self.handle_generate(model, body, streamed=(method == 'streamGenerateContent'))
+
+    def handle_create_cache(self, body):
+        """Store contents under a new cachedContents/ name"""
+        behaviour = self.server.behaviour
+        model = (body.get('model') or '').split('/')[-1]
+        text, inline_parts = contents_text(body.get('contents', []))
+        now = time.time()
+        expires_at = now + parse_duration(body.get('ttl'))
+        name = f"cachedContents/{hashlib.sha256(f'{model}{text}{now}'.encode('utf-8')).hexdigest()[:16]}"
+        tokens = prompt_token_count(text, inline_parts)
+        resource = {
+            "name": name,
+            "model": f"models/{model}",
+            "displayName": body.get('displayName', ''),
+            "createTime": rfc3339(now),
+            "updateTime": rfc3339(now),
+            "expireTime": rfc3339(expires_at),
+            "usageMetadata": {"totalTokenCount": tokens},
+        }
+        with behaviour.caches_lock:
+            behaviour.caches[name] = {"model": model, "text": text, "tokens": tokens,
+                                      "expires_at": expires_at, "resource": resource}
+        behaviour.bump("caches_created")
+        self._send_json(200, resource)
+
+    def handle_generate(self, model, body, streamed):
+        behaviour = self.server.behaviour
+        contents = body.get('contents', [])
+        prompt_text, inline_parts = contents_text(contents)
+        uncached_tokens = prompt_token_count(prompt_text, inline_parts)
+        cached_tokens = 0
+
+        if body.get('cachedContent'):
+            cache = behaviour.get_cache(body['cachedContent'])
+            if not cache or cache["model"] != model:
+                return self._send_json(403, {"error": {"code": 403, "message": "CachedContent not found (or permission denied)",
+                                                       "status": "PERMISSION_DENIED"}})
+            behaviour.bump("cache_hits")
+            behaviour.bump("cached_tokens", cache["tokens"])
+            # Canned responses match on the whole prompt, cached prefix included
+            prompt_text = "\n".join([cache["text"], prompt_text])
+            cached_tokens = cache["tokens"]
+        prompt_tokens = uncached_tokens + cached_tokens
+
+        prefill_rate = float(behaviour.model_setting(model, 'prefillTokensPerSecond', 0) or 0)
+        time.sleep(behaviour.sample_latency(model) + (uncached_tokens / prefill_rate if prefill_rate else 0))
+
+        error = behaviour.sample_error(model)
+        if error:
+            behaviour.count(model, streamed, inline_parts, error=error)
+            return self._send_json(error, {"error": {
+                "code": error,
+                "message": "Resource has been exhausted (e.g. check quota)." if error == 429 else "The model is overloaded. Please try again later.",
+                "status": ERROR_STATUS.get(error, "UNKNOWN"),
+            }})
+
+        text, source = behaviour.pick_response(model, prompt_text, request_fingerprint(model, contents))
+        behaviour.count(model, streamed, inline_parts, source=source)
+        tokens_per_second = float(behaviour.model_setting(model, 'tokensPerSecond', 0) or 0)
+
+        # Cut the text off at the output token limit, as Gemini does
+        finish_reason = "STOP"
+        max_output_tokens = (body.get('generationConfig') or {}).get('maxOutputTokens') \
+            or behaviour.model_setting(model, 'maxOutputTokens')
+        if max_output_tokens and len(text) > int(max_output_tokens) * CHARS_PER_TOKEN:
+            text = text[:int(max_output_tokens) * CHARS_PER_TOKEN]
+            finish_reason = "MAX_TOKENS"
+            behaviour.bump("truncated")
+
+        if not streamed:
+            if tokens_per_second:
+                time.sleep(len(text) / CHARS_PER_TOKEN / tokens_per_second)
+            return self._send_json(200, response_payload(model, text, prompt_tokens, finish_reason, cached_tokens=cached_tokens))
+
+        # Server-sent events, one chunk per STREAM_CHUNK_TOKENS
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        chunk_chars = STREAM_CHUNK_TOKENS * CHARS_PER_TOKEN
+        pieces = [text[i:i + chunk_chars] for i in range(0, len(text), chunk_chars)] or [""]
+        for index, piece in enumerate(pieces):
+            if index and tokens_per_second:
+                time.sleep(STREAM_CHUNK_TOKENS / tokens_per_second)
+            last = index == len(pieces) - 1
+            payload = response_payload(model, piece, prompt_tokens, finish_reason if last else None, total_text=text,
+                                       cached_tokens=cached_tokens)
+            try:
+                self.wfile.write(f"data: {json.dumps(payload)}\r\n\r\n".encode('utf-8'))
+                self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                return
+
+
+def load_config(path=None):
+    """Load the mock config file, if any"""
+    if not path:
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def start_mock_server(config=None, host="127.0.0.1", port=0, verbose=False):
+    """
+    Start the mock server on a background thread
+
+    Parameters:
+        config (dict): Mock config (see module docstring)
+        host (str): Bind address
+        port (int): Port, 0 picks a free one
+        verbose (bool): Log every request
+
+    Returns:
+        ThreadingHTTPServer: Running server; base URL is http://host:server.server_port
+    """
+    server = ThreadingHTTPServer((host, port), MockGeminiHandler)
+    server.daemon_threads = True
+    server.behaviour = MockBehaviour(config or {})
+    server.verbose = verbose
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local Gemini stand-in for offline testing")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--config", help="Mock behaviour JSON (latency, errorRates, responses, replayFile)")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    server = start_mock_server(load_config(args.config), args.host, args.port, args.verbose)
+    print(f"Mock Gemini listening on http://{args.host}:{server.server_port}", file=sys.stderr, flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""
+Prompt token benchmark for the compact encodings in utils/prompt_encoding.py
+
+Scans logged prompts (attached_assets/*.txt by default) for embedded JSON
+blocks - identifier reference arrays, target fields, documents, extraction
+results - re-encodes each block as pretty, minified and columnar JSON, and
+reports the prompt size per style, both for the blocks alone and for the
+whole prompt with the blocks replaced in place.
+
+Sizes use utils.token_budget.estimate_tokens. With --count-tokens the
+totals are also measured with the Gemini countTokens endpoint (needs
+GEMINI_API_KEY or GEMINI_BASE_URL).
+
+Usage:
+    python benchmarks/prompt_encoding_tokens.py [paths ...] [--min-chars 200] [--count-tokens] [--model gemini-2.5-flash]
+"""
+
+import argparse
+import glob
+import json
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))  # Project root
+
+from utils.prompt_encoding import STYLES, PRETTY, encode_value, to_columnar
+from utils.token_budget import estimate_tokens
+
+DEFAULT_GLOB = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'attached_assets', '*.txt')
+
+
+def find_json_blocks(text, min_chars):
+    """(start, end, value) for JSON arrays/objects that start a line and span at least min_chars"""
+    decoder = json.JSONDecoder()
+    blocks = []
+    pos = 0
+    while pos < len(text):
+        line_start = pos == 0 or text[pos - 1] == '\n'
+        if line_start and text[pos] in '[{':
+            try:
+                value, end = decoder.raw_decode(text, pos)
+            except ValueError:
+                value, end = None, pos
+            if value is not None and end - pos >= min_chars and isinstance(value, (list, dict)):
+                blocks.append((pos, end, value))
+                pos = end
+                continue
+        pos += 1
+    return blocks
+
+
+def block_kind(value):
+    """Rough label for a JSON block"""
+    table = to_columnar(value)
+    if table and table["columns"] and table["columns"][0] == 'record_index':
+        return 'identifier_references'
+    if isinstance(value, list) and value and isinstance(value[0], dict):
+        keys = set(value[0])
+        if {'extractedValue', 'extracted_value'} & keys:
+            return 'extraction_results'
+        if {'content', 'file_name', 'fileName'} & keys:
+            return 'documents'
+        return 'record_list'
+    return 'object'
+
+
+def count_with_api(texts, model):
+    from utils.gemini_client import get_gemini_client
+    client = get_gemini_client()
+    return sum(client.models.count_tokens(model=model, contents=text).total_tokens for text in texts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="*", help="Prompt log files (default attached_assets/*.txt)")
+    parser.add_argument("--min-chars", type=int, default=200, help="Ignore JSON blocks shorter than this")
+    parser.add_argument("--count-tokens", action="store_true", help="Also count tokens with the Gemini API")
+    parser.add_argument("--model", default="gemini-2.5-flash")
+    args = parser.parse_args()
+
+    paths = args.paths or sorted(glob.glob(DEFAULT_GLOB))
+    by_kind = {}
+    prompts = {style: [] for style in STYLES}
+    files_with_blocks = 0
+
+    for path in paths:
+        try:
+            with open(path, 'r', encoding='utf-8', errors='replace') as f:
+                text = f.read()
+        except OSError as e:
+            print(f"Skipping {path}: {e}", file=sys.stderr)
+            continue
+        blocks = find_json_blocks(text, args.min_chars)
+        if not blocks:
+            continue
+        files_with_blocks += 1
+
+        for style in STYLES:
+            pieces = []
+            cursor = 0
+            for start, end, value in blocks:
+                pieces.append(text[cursor:start])
+                pieces.append(encode_value(value, style))
+                cursor = end
+            pieces.append(text[cursor:])
+            prompts[style].append("".join(pieces))
+
+        for _, _, value in blocks:
+            kind = by_kind.setdefault(block_kind(value), {"blocks": 0, **{style: 0 for style in STYLES}})
+            kind["blocks"] += 1
+            for style in STYLES:
+                kind[style] += estimate_tokens(encode_value(value, style))
+
+    baseline = sum(estimate_tokens(prompt) for prompt in prompts[PRETTY]) or 1
+    report = {
+        "files_scanned": len(paths),
+        "files_with_json": files_with_blocks,
+        "blocks_by_kind": {
+            kind: dict(counts, **{f"{style}_vs_pretty": round(counts[style] / counts[PRETTY], 3)
+                                  for style in STYLES if style != PRETTY and counts[PRETTY]})
+            for kind, counts in sorted(by_kind.items())
+        },
+        "whole_prompts_estimated_tokens": {
+            style: {"tokens": sum(estimate_tokens(prompt) for prompt in prompts[style]),
+                    "vs_pretty": round(sum(estimate_tokens(prompt) for prompt in prompts[style]) / baseline, 3)}
+            for style in STYLES
+        },
+    }
+    if args.count_tokens:
+        report["whole_prompts_api_tokens"] = {style: count_with_api(prompts[style], args.model) for style in STYLES}
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -26,13 +26,47 @@ Usage:
 """
 
 import os
+import re
+import sys
+import time
 import psycopg2
 import json
-from google import genai
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 from all_prompts import AI_DOCUMENT_EXTRACTION
 
-def ai_document_extraction(document_ids, session_id, target_fields_data, identifier_references=None):
-    """Extract data from documents using AI analysis based on field descriptions"""
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))  # Project root for utils
+from utils.token_budget import (
+    get_token_limit,
+    measure_prompt_sections,
+    format_prompt_budget,
+    chunk_documents,
+    pack_by_token_budget
+)
+from utils.config import get_project_extraction_config, get_ai_model
+from utils.rate_limiter import set_rate_limit_organization
+from utils.usage_tracker import set_usage_tags
+from utils.model_router import ModelRouter, REASON_HARD_FIELD, REASON_PARSE_FAILURE, REASON_LOW_CONFIDENCE, CONFIDENCE_FRACTION
+from utils.gemini_client import generate_content, is_streaming_enabled, stream_json_records, response_truncated
+from utils.continuation import continue_records, parse_records
+from utils.lenient_json import parse_lenient
+from utils.response_schemas import (
+    document_extraction_schema,
+    structured_config,
+    validate_response,
+    filter_valid_records,
+    record_parse_outcome
+)
+from utils.hedging import hedged_call
+from utils.prompt_encoding import encode_prompt_value
+
+def ai_document_extraction(document_ids, session_id, target_fields_data, identifier_references=None, map_reduce=None, on_record=None):
+    """Extract data from documents using AI analysis based on field descriptions
+    
+    map_reduce overrides the project's extraction.mapReduce config, e.g. {"enabled": False}
+    for a single-shot call over the full text. on_record receives records as they stream in
+    (single-call extractions only - map-reduce results are only final after merging).
+    """
     try:
         # Get database connection from environment
         database_url = os.getenv('DATABASE_URL')
@@ -43,14 +77,21 @@ def ai_document_extraction(document_ids, session_id, target_fields_data, identif
         conn = psycopg2.connect(database_url)
         cursor = conn.cursor()
         
-        # Get project ID from extraction_sessions
-        session_query = "SELECT project_id FROM extraction_sessions WHERE id = %s"
+        # Get project ID (and the organization billed for Gemini quota) from extraction_sessions
+        session_query = """
+        SELECT es.project_id, p.organization_id
+        FROM extraction_sessions es
+        JOIN projects p ON p.id = es.project_id
+        WHERE es.id = %s
+        """
         cursor.execute(session_query, (session_id,))
         session_result = cursor.fetchone()
         if not session_result:
             return {"error": "Session not found"}
         
         project_id = session_result[0]
+        set_rate_limit_organization(session_result[1])
+        set_usage_tags(session_id=session_id, project_id=project_id)
         
         # Get extraction rules for the project
         rules_query = """
@@ -82,15 +123,18 @@ def ai_document_extraction(document_ids, session_id, target_fields_data, identif
         cursor.close()
         conn.close()
         
-        # Format documents for prompt
+        token_limit = get_token_limit()
+        
+        # Format documents for prompt - oversized documents are split into token-sized chunks
         documents_content = []
         for doc_id, file_name, mime_type, extracted_content in documents_results:
             documents_content.append({
                 "id": str(doc_id),
                 "file_name": file_name,
                 "mime_type": mime_type,
-                "content": extracted_content[:2000] + "..." if len(extracted_content) > 2000 else extracted_content
+                "content": extracted_content or ""
             })
+        documents_content = chunk_documents(documents_content, token_limit)
         
         # Format extraction rules
         extraction_rules = {
@@ -116,32 +160,244 @@ def ai_document_extraction(document_ids, session_id, target_fields_data, identif
         for title, content, target_field in knowledge_results:
             knowledge_documents.append({
                 "title": title,
-                "content": content[:1000] + "..." if len(content) > 1000 else content,
+                "content": content or "",
                 "target_field": target_field or ""
             })
+        knowledge_documents = chunk_documents(knowledge_documents, token_limit)
         
-        # Generate AI extraction using Gemini
-        return perform_ai_extraction(documents_content, target_fields_data, extraction_rules, knowledge_documents, identifier_references)
+        # Single-shot or map-reduce over token-sized chunks, configurable per project
+        if map_reduce is None:
+            map_reduce = get_project_extraction_config(project_id).get('mapReduce', {})
+        
+        if not map_reduce.get('enabled', True):
+            return extract_with_model_routing(documents_content, target_fields_data, extraction_rules, knowledge_documents, identifier_references, on_record)
+        
+        return map_reduce_ai_extraction(documents_content, target_fields_data, extraction_rules, knowledge_documents,
+                                        identifier_references, token_limit, map_reduce.get('maxParallelChunks', 4), on_record)
         
     except Exception as e:
         print(f"Error in ai_document_extraction: {e}", file=sys.stderr, flush=True)
         return {"error": str(e)}
 
-def perform_ai_extraction(documents, target_fields_data, extraction_rules, knowledge_documents, identifier_references=None):
-    """Use Gemini AI to extract data from documents"""
+def map_reduce_ai_extraction(documents, target_fields_data, extraction_rules, knowledge_documents,
+                             identifier_references=None, token_limit=None, max_parallel_chunks=4, on_record=None):
+    """Extract from document chunks in parallel against the same target fields, then merge the results"""
+    # Map: pack chunks into batches that fit the budget - one Gemini call per batch
+    document_batches = pack_by_token_budget(documents, token_limit)
+    if len(document_batches) <= 1:
+        return extract_with_model_routing(documents, target_fields_data, extraction_rules, knowledge_documents, identifier_references, on_record)
+    
+    workers = max(1, min(int(max_parallel_chunks or 1), len(document_batches)))
+    print(f"MAP-REDUCE EXTRACTION: {len(documents)} chunks in {len(document_batches)} batches, {workers} in parallel", file=sys.stderr, flush=True)
+    
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        batch_results = list(executor.map(
+            # Each worker runs in a copy of this context so the rate-limit organization carries over
+            lambda batch: contextvars.copy_context().run(
+                extract_with_model_routing, batch, target_fields_data, extraction_rules, knowledge_documents, identifier_references),
+            document_batches
+        ))
+    print(f"MAP-REDUCE EXTRACTION: map phase finished in {time.time() - started:.2f}s", file=sys.stderr, flush=True)
+    
+    # Reduce: merge and de-duplicate by identifier
+    return merge_chunk_results(batch_results, target_fields_data, identifier_references)
+
+def _has_value(record):
+    """Check whether a validation record carries an extracted value"""
+    return record.get('extracted_value') not in (None, "")
+
+def _record_rank(record):
+    """Rank duplicate records - a found value beats null, then the higher confidence wins"""
+    return (_has_value(record), record.get('confidence_score') or 0)
+
+def _field_key(record):
+    """Field identity of a validation record without its [record_index] suffix"""
+    return record.get('field_id') or re.sub(r'\[\d+\]$', '', record.get('field_name', ''))
+
+def _row_identity(row, identifier_field_ids):
+    """Identifier values of a row, or None unless every identifier field has a value"""
+    identifiers = [record for record in row if record.get('field_id') in identifier_field_ids]
+    if not identifiers or not all(map(_has_value, identifiers)):
+        return None
+    return tuple(sorted((_field_key(record), str(record.get('extracted_value')).strip().lower()) for record in identifiers))
+
+def merge_chunk_results(batch_results, target_fields_data, identifier_references=None):
+    """Merge extraction results from several chunks and de-duplicate them by identifier"""
+    successful = [result for result in batch_results if isinstance(result, list)]
+    if not successful:
+        return batch_results[0] if batch_results else {"error": "No chunks were extracted"}
+    
+    failed_count = len(batch_results) - len(successful)
+    if failed_count:
+        print(f"⚠️ {failed_count} of {len(batch_results)} chunk batches failed - merging the remaining results", file=sys.stderr, flush=True)
+    
+    if identifier_references:
+        # Every chunk answers for the same identifiers - keep the best value per (field, record_index)
+        best = {}
+        for results in successful:
+            for record in results:
+                if not isinstance(record, dict):
+                    continue
+                key = (_field_key(record), record.get('record_index'))
+                if key not in best or _record_rank(record) > _record_rank(best[key]):
+                    best[key] = record
+        return sorted(best.values(), key=lambda record: (record.get('record_index') is None, record.get('record_index') or 0))
+    
+    # New records: group each chunk's records into rows. A row cut by a chunk boundary comes back from both
+    # neighbouring batches, so only rows with the same identifier values in adjacent batches are merged;
+    # rows without identifier values and repeats within one batch are kept as they are.
+    identifier_field_ids = {field.get('field_id') for field in target_fields_data or [] if field.get('is_identifier')}
+    merged_rows = []
+    previous_identities = {}
+    for results in batch_results:
+        if not isinstance(results, list):
+            # A failed batch leaves a gap - its neighbours are not adjacent
+            previous_identities = {}
+            continue
+        rows = {}
+        for record in results:
+            if isinstance(record, dict):
+                rows.setdefault(record.get('record_index'), []).append(record)
+        
+        identities = {}
+        claimed = set()
+        for row in rows.values():
+            identity = _row_identity(row, identifier_field_ids)
+            position = previous_identities.get(identity) if identity else None
+            if position is not None and position not in claimed:
+                claimed.add(position)
+                if sum(map(_has_value, row)) > sum(map(_has_value, merged_rows[position])):
+                    merged_rows[position] = row
+            else:
+                position = len(merged_rows)
+                merged_rows.append(row)
+            if identity:
+                identities.setdefault(identity, position)
+        previous_identities = identities
+    
+    merged = []
+    for record_index, row in enumerate(merged_rows):
+        for record in row:
+            record['record_index'] = record_index
+            if record.get('field_name'):
+                record['field_name'] = re.sub(r'\[\d+\]$', '', record['field_name']) + f"[{record_index}]"
+            merged.append(record)
+    
+    duplicate_count = sum(len(result) for result in successful) - len(merged)
+    print(f"MAP-REDUCE EXTRACTION: merged {len(merged)} records from {len(successful)} batches ({duplicate_count} duplicates removed)", file=sys.stderr, flush=True)
+    return merged
+
+def extract_with_model_routing(documents, target_fields_data, extraction_rules, knowledge_documents, identifier_references=None, on_record=None):
+    """Extract with the fast model first and escalate to the strong model only where needed
+    
+    Hard fields go straight to the strong model. The rest are extracted with the fast model
+    and escalated on parse failure or low confidence_score. With identifier references only
+    the affected fields are re-extracted and their records replaced per record_index; without
+    them rows of a new collection must stay aligned, so the whole call is escalated.
+    """
+    router = ModelRouter('ai_document_extraction', CONFIDENCE_FRACTION)
+    if not router.enabled:
+        return perform_ai_extraction(documents, target_fields_data, extraction_rules, knowledge_documents, identifier_references, on_record)
+    
+    fast_fields, hard_fields = router.split_fields(target_fields_data)
+    labels = {field.get('field_id'): field.get('name') or field.get('field_id') for field in target_fields_data}
+    
+    def run(fields, model, escalated, reason, record_callback=None):
+        started = time.time()
+        result = perform_ai_extraction(documents, fields, extraction_rules, knowledge_documents, identifier_references, record_callback, model=model)
+        latency = time.time() - started
+        records = result if isinstance(result, list) else None
+        for field in fields:
+            field_records = None if records is None else [r for r in records if isinstance(r, dict) and r.get('field_id') == field.get('field_id')]
+            router.record_call(labels.get(field.get('field_id')), model, latency, field_records, 'confidence_score', escalated, reason)
+        return result
+    
+    results = []
+    if hard_fields:
+        hard_result = run(hard_fields, router.strong_model, False, REASON_HARD_FIELD, on_record)
+        if not isinstance(hard_result, list):
+            return hard_result
+        results.extend(hard_result)
+    
+    if not fast_fields:
+        return results
+    
+    # Confident records can be handed on straight away when escalation is per field
+    def emit_confident(record):
+        if on_record and not router.is_low_confidence(record, 'confidence_score'):
+            on_record(record)
+    
+    fast_result = run(fast_fields, router.fast_model, False, None, emit_confident if identifier_references else None)
+    
+    if not isinstance(fast_result, list):
+        print(f"MODEL ROUTING: {router.fast_model} failed to return records - escalating {len(fast_fields)} fields to {router.strong_model}", file=sys.stderr, flush=True)
+        strong_result = run(fast_fields, router.strong_model, True, REASON_PARSE_FAILURE, on_record)
+        return results + strong_result if isinstance(strong_result, list) else strong_result
+    
+    low_records = [record for record in fast_result if router.is_low_confidence(record, 'confidence_score')]
+    if not low_records:
+        if on_record and not identifier_references:
+            for record in fast_result:
+                on_record(record)
+        return results + fast_result
+    
+    if not identifier_references:
+        print(f"MODEL ROUTING: {len(low_records)} low-confidence records - escalating the extraction to {router.strong_model}", file=sys.stderr, flush=True)
+        strong_result = run(fast_fields, router.strong_model, True, REASON_LOW_CONFIDENCE, on_record)
+        return results + (strong_result if isinstance(strong_result, list) else fast_result)
+    
+    # Re-extract only the fields with low-confidence records and replace those records
+    low_field_ids = {record.get('field_id') for record in low_records if isinstance(record, dict)}
+    escalate_fields = [field for field in fast_fields if field.get('field_id') in low_field_ids] or fast_fields
+    print(f"MODEL ROUTING: {len(low_records)} low-confidence records - escalating {len(escalate_fields)} fields to {router.strong_model}", file=sys.stderr, flush=True)
+    strong_result = run(escalate_fields, router.strong_model, True, REASON_LOW_CONFIDENCE)
+    
+    merged = {(_field_key(record), record.get('record_index')): record for record in fast_result if isinstance(record, dict)}
+    if isinstance(strong_result, list):
+        for record in strong_result:
+            if not isinstance(record, dict):
+                continue
+            key = (_field_key(record), record.get('record_index'))
+            if key not in merged or router.is_low_confidence(merged[key], 'confidence_score'):
+                merged[key] = record
+    
+    if on_record:
+        # Confident fast records were already emitted while streaming
+        fast_record_ids = {id(record) for record in fast_result}
+        for record in merged.values():
+            if id(record) not in fast_record_ids or router.is_low_confidence(record, 'confidence_score'):
+                on_record(record)
+    
+    return results + list(merged.values())
+
+def perform_ai_extraction(documents, target_fields_data, extraction_rules, knowledge_documents, identifier_references=None, on_record=None, model=None):
+    """Use Gemini AI to extract data from documents
+    
+    When ai.streaming.enabled is set, on_record is called with each record as soon as it is parsed.
+    model defaults to ai.models.extraction.
+    """
     max_retries = 3
+    model = model or get_ai_model('extraction')
+    
+    # Records must follow a schema derived from the target fields (ai.structuredOutput)
+    schema = document_extraction_schema(target_fields_data)
+    config = structured_config(schema)
+    structured = config is not None
+    
+    def conforms(record):
+        return not structured or not validate_response(record, schema['items'])
+    
+    emit = (lambda record: conforms(record) and on_record(record)) if on_record else None
     
     for attempt in range(max_retries):
         try:
-            # Initialize Gemini client
-            client = genai.Client(api_key=os.environ.get("GEMINI_API_KEY") or os.environ.get("GOOGLE_API_KEY"))
-            
-            # Format data for prompt
-            documents_json = json.dumps(documents, indent=2)
-            target_fields_json = json.dumps(target_fields_data, indent=2)
-            extraction_rules_json = json.dumps(extraction_rules, indent=2)
-            knowledge_documents_json = json.dumps(knowledge_documents, indent=2)
-            identifier_references_json = json.dumps(identifier_references or [], indent=2)
+            # Format data for prompt (style per section from ai.promptEncoding)
+            documents_json = encode_prompt_value('AI_DOCUMENT_EXTRACTION', 'documents', documents)
+            target_fields_json = encode_prompt_value('AI_DOCUMENT_EXTRACTION', 'target_fields', target_fields_data)
+            extraction_rules_json = encode_prompt_value('AI_DOCUMENT_EXTRACTION', 'extraction_rules', extraction_rules)
+            knowledge_documents_json = encode_prompt_value('AI_DOCUMENT_EXTRACTION', 'knowledge_documents', knowledge_documents)
+            identifier_references_json = encode_prompt_value('AI_DOCUMENT_EXTRACTION', 'identifier_references', identifier_references or [])
             
             # Generate the extraction using Gemini
             prompt = AI_DOCUMENT_EXTRACTION.format(
@@ -160,6 +416,15 @@ def perform_ai_extraction(documents, target_fields_data, extraction_rules, knowl
             print(f"Target fields: {len(target_fields_data)}", file=sys.stderr, flush=True)
             print(f"Extraction rules: {len(extraction_rules['global']) + len(extraction_rules['targeted'])}", file=sys.stderr, flush=True)
             print(f"Knowledge documents: {len(knowledge_documents)}", file=sys.stderr, flush=True)
+            print(f"Model: {model}", file=sys.stderr, flush=True)
+            prompt_sections = measure_prompt_sections({
+                "documents": documents_json,
+                "target_fields": target_fields_json,
+                "extraction_rules": extraction_rules_json,
+                "knowledge_documents": knowledge_documents_json,
+                "identifier_references": identifier_references_json
+            })
+            print(f"Prompt size: {format_prompt_budget(prompt_sections)}", file=sys.stderr, flush=True)
             
             # Log the complete AI extraction prompt
             print("\n" + "=" * 80, file=sys.stderr, flush=True)
@@ -168,34 +433,65 @@ def perform_ai_extraction(documents, target_fields_data, extraction_rules, knowl
             print(prompt, file=sys.stderr, flush=True)
             print("=" * 80, file=sys.stderr, flush=True)
             
-            response = client.models.generate_content(
-                model="gemini-2.5-pro",
-                contents=prompt
-            )
+            streaming = is_streaming_enabled()
             
-            extracted_data = response.text
+            def call_model(model_name, attempt):
+                if not streaming:
+                    return model_name, generate_content(model_name, prompt, config)
+                # Records are parsed and handed to on_record as they arrive; only the
+                # attempt that claims the call first may emit them when hedging
+                forward = (lambda record: attempt.claim() and emit(record)) if emit else None
+                return stream_json_records(model_name, prompt, config=config, on_record=forward, label="AI EXTRACTION")
             
-            # Clean and validate the response
-            if extracted_data:
-                extracted_data = extracted_data.strip()
-                # Remove markdown formatting if present
-                if extracted_data.startswith('```json'):
-                    extracted_data = extracted_data.replace('```json', '').strip()
-                if extracted_data.startswith('```'):
-                    extracted_data = extracted_data.replace('```', '').strip()
-                if extracted_data.endswith('```'):
-                    extracted_data = extracted_data.replace('```', '').strip()
+            def finish(records):
+                # Strict check on return: records that break the schema are dropped, not retried
+                errors = []
+                kept = records
+                if structured:
+                    kept, errors = filter_valid_records(records, schema)
+                    if errors:
+                        print(f"⚠️ Dropped {len(records) - len(kept)} records failing the response schema: {'; '.join(errors[:3])}", file=sys.stderr, flush=True)
+                record_parse_outcome("perform_ai_extraction", structured, True, attempt, len(errors), len(records) - len(kept), len(kept))
+                print(f"Successfully extracted {len(kept)} records", file=sys.stderr, flush=True)
+                return kept
+            
+            # Deadline, hedged duplicate after the model's latency percentile, circuit breaker with fallback
+            result = hedged_call("perform_ai_extraction", call_model, model,
+                                 accept=lambda answer: bool(answer.records or answer.text) if streaming else bool(answer[1].text))
+            
+            if streaming:
+                stream = result
+                if stream.records:
+                    records = stream.records
+                    if stream.truncated:
+                        # Resume after the last complete record instead of regenerating everything
+                        records, _ = continue_records(stream.model, prompt, records, config=config, on_record=emit, label="AI EXTRACTION")
+                    elif not stream.complete:
+                        print(f"⚠️ Response ended before the JSON array closed - keeping {len(records)} complete records", file=sys.stderr, flush=True)
+                    return finish(records)
+                extracted_data = stream.text
+            else:
+                model_used, response = result
+                extracted_data = response.text
+                if response_truncated(response, config):
+                    records = parse_records(extracted_data)[0]
+                    if records:
+                        records, _ = continue_records(model_used, prompt, records, config=config, label="AI EXTRACTION")
+                        return finish(records)
             
-            # Parse JSON response
+            # Parse JSON response (fences, trailing commas and cut-off tails are tolerated)
             try:
-                extraction_results = json.loads(extracted_data)
+                parsed = parse_lenient(extracted_data)
+                if parsed.repaired:
+                    print(f"Repaired malformed JSON response: {parsed.describe()}", file=sys.stderr, flush=True)
+                extraction_results = parsed.value
                 if isinstance(extraction_results, list):
-                    print(f"Successfully extracted {len(extraction_results)} records", file=sys.stderr, flush=True)
                     print("AI EXTRACTION RESPONSE:", file=sys.stderr, flush=True)
                     print(json.dumps(extraction_results[:2], indent=2), file=sys.stderr, flush=True)  # Show first 2 records
                     print("=" * 80, file=sys.stderr, flush=True)
-                    return extraction_results
+                    return finish(extraction_results)
                 else:
+                    record_parse_outcome("perform_ai_extraction", structured, False, attempt)
                     print(f"Invalid response format (attempt {attempt + 1}): Expected array, got {type(extraction_results)}", file=sys.stderr, flush=True)
                     if attempt < max_retries - 1:
                         continue
@@ -203,8 +499,9 @@ def perform_ai_extraction(documents, target_fields_data, extraction_rules, knowl
                         return {"error": "Invalid response format after all retries"}
                         
             except json.JSONDecodeError as json_error:
+                record_parse_outcome("perform_ai_extraction", structured, False, attempt)
                 print(f"JSON parsing error (attempt {attempt + 1}): {json_error}")
-                print(f"Raw response: {extracted_data[:200]}...")
+                print(f"Raw response: {(extracted_data or '')[:200]}...")
                 if attempt < max_retries - 1:
                     continue
                 else:
@@ -8,7 +8,6 @@ import json
 import sys
 sys.path.append('..')  # Add parent directory to path
 
-from google import genai
 from typing import Dict, List, Any, Optional, Tuple
 from prompts.all_prompts import AI_DOCUMENT_EXTRACTION
 from utils.database import DatabaseConnection
@@ -20,6 +19,12 @@ from utils.constants import (
     DEFAULT_CONFIDENCE_SCORE
 )
 from utils.config import get_api_key, get_ai_model
+from utils.token_budget import chunk_documents
+from utils.gemini_client import generate_content
+from utils.lenient_json import parse_lenient
+from utils.hedging import hedged_call
+from utils.prompt_encoding import encode_prompt_value
+from utils.usage_tracker import set_usage_tags
 
 # Set up logger
 logger = setup_logger(__name__)
@@ -160,17 +165,15 @@ class RulesFetcher:
         
         knowledge_documents = []
         for doc in results:
-            content = doc.get('content', '')
-            # Truncate content if too long
-            if len(content) > 1000:
-                content = content[:1000] + "..."
-            
             knowledge_documents.append({
                 "title": doc['display_name'],
-                "content": content,
+                "content": doc.get('content') or '',
                 "target_field": doc.get('target_field', '')
             })
         
+        # Split oversized documents into token-sized chunks instead of truncating
+        knowledge_documents = chunk_documents(knowledge_documents)
+        
         self.logger.info(f"Fetched {len(knowledge_documents)} knowledge documents for project {project_id}")
         return knowledge_documents
 
@@ -188,7 +191,6 @@ class AIExtractor:
         if not api_key:
             raise ValueError("No API key found for Gemini/Google AI")
         
-        self.client = genai.Client(api_key=api_key)
         self.model = get_ai_model('extraction')
     
     def extract(self, 
@@ -225,11 +227,11 @@ class AIExtractor:
                     identifier_references
                 )
                 
-                # Call Gemini API
-                response = self.client.models.generate_content(
-                    model=self.model,
-                    contents=prompt
-                )
+                # Call Gemini API (deadline, hedging and circuit breaker per ai.hedging)
+                response = hedged_call("AIExtractor.extract",
+                                       lambda model, attempt: generate_content(model, prompt),
+                                       self.model,
+                                       accept=lambda answer: bool(answer and answer.text))
                 
                 # Parse response
                 result = self._parse_response(response)
@@ -249,31 +251,27 @@ class AIExtractor:
     
     def _build_prompt(self, documents, target_fields, extraction_rules, 
                      knowledge_documents, identifier_references):
-        """Build the extraction prompt"""
+        """Build the extraction prompt (section styles from ai.promptEncoding)"""
+        def encode(section, value):
+            return encode_prompt_value('AI_DOCUMENT_EXTRACTION', section, value)
+        
         return AI_DOCUMENT_EXTRACTION.format(
-            documents=json.dumps(documents, indent=2),
-            target_fields=json.dumps(target_fields, indent=2),
-            extraction_rules=json.dumps(extraction_rules, indent=2),
-            knowledge_documents=json.dumps(knowledge_documents, indent=2),
-            identifier_references=json.dumps(identifier_references or [], indent=2),
+            documents=encode('documents', documents),
+            target_fields=encode('target_fields', target_fields),
+            extraction_rules=encode('extraction_rules', extraction_rules),
+            knowledge_documents=encode('knowledge_documents', knowledge_documents),
+            identifier_references=encode('identifier_references', identifier_references or []),
             extraction_number=0
         )
     
     def _parse_response(self, response) -> Optional[Dict]:
         """Parse AI response"""
         try:
-            response_text = response.text.strip()
-            
-            # Remove markdown code blocks if present
-            if response_text.startswith('```json'):
-                response_text = response_text[7:]
-            if response_text.startswith('```'):
-                response_text = response_text[3:]
-            if response_text.endswith('```'):
-                response_text = response_text[:-3]
-            
-            # Parse JSON
-            result = json.loads(response_text.strip())
+            # Parse JSON, tolerating code fences and malformed or cut-off tails
+            parsed = parse_lenient(response.text, expect=dict)
+            if parsed.repaired:
+                self.logger.warning(f"Repaired malformed AI response JSON: {parsed.describe()}")
+            result = parsed.value
             
             # Validate response structure
             if not isinstance(result, dict):
@@ -340,6 +338,7 @@ def ai_document_extraction(document_ids: List[str],
         if not project_id:
             logger.error(f"Session {session_id} not found")
             return {"error": "Session not found"}
+        set_usage_tags(session_id=session_id, project_id=project_id)
         
         # Initialize fetchers
         doc_fetcher = DocumentFetcher(db)
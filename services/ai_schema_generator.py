@@ -3,27 +3,35 @@
 import json
 import logging
 import os
-from google import genai
+import sys
 from google.genai import types
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))  # Project root for utils
+
+from utils.gemini_client import generate_content, is_streaming_enabled, stream_json_records, response_truncated
+from utils.continuation import continue_records, parse_records
+from utils.lenient_json import parse_lenient
+from utils.rate_limiter import set_rate_limit_organization_for_project
+from utils.usage_tracker import set_usage_tags
+
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Initialize Gemini client
-client = genai.Client(api_key=os.environ.get("GEMINI_API_KEY"))
-
-def generate_schema_from_query(user_query: str, project_id: str) -> dict:
+def generate_schema_from_query(user_query: str, project_id: str, on_record=None) -> dict:
     """
     Generate project schema structure from user's natural language query
     
     Args:
         user_query: User's description of what data they want to collect
         project_id: The project ID to associate with generated schema
+        on_record: Optional callback receiving each field/collection as it streams in
         
     Returns:
         Dictionary containing generated schema structure
     """
+    set_rate_limit_organization_for_project(project_id)
+    set_usage_tags(project_id=project_id)
     
     # Check if this is a CSP (Common Agricultural Policy Support) related query
     is_csp_query = any(keyword in user_query.lower() for keyword in ['csp', 'wheat', 'barley', 'maize', 'agriculture', 'malta', 'countrycode', 'intervention'])
@@ -250,141 +258,65 @@ Return ONLY a valid JSON object with proper double-quoted property names. Do NOT
 
 User Query: """
 
+    response_text = ""
     try:
-        response = client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=[
-                types.Content(role="user", parts=[types.Part(text=f"{system_prompt}{user_query}")])
-            ],
-            config=types.GenerateContentConfig(
-                max_output_tokens=100000,  # 100K tokens for schema generation
-                temperature=0.1,  # Lower temperature for more consistent JSON
-                response_mime_type="application/json",  # Force JSON output
-            ),
+        contents = [
+            types.Content(role="user", parts=[types.Part(text=f"{system_prompt}{user_query}")])
+        ]
+        generation_config = types.GenerateContentConfig(
+            max_output_tokens=100000,  # 100K tokens for schema generation
+            temperature=0.1,  # Lower temperature for more consistent JSON
+            response_mime_type="application/json",  # Force JSON output
         )
 
-        if not response.text:
+        streaming = is_streaming_enabled()
+        if streaming:
+            # Fields and collections are parsed one by one as they stream in
+            stream = stream_json_records(
+                "gemini-2.5-flash", contents, config=generation_config, record_depth=2,
+                on_record=on_record, label="SCHEMA GENERATION", keep_skeleton=True
+            )
+            records, parser, truncated = stream.records, stream.parser, stream.truncated
+            raw_text = stream.text
+        else:
+            response = generate_content("gemini-2.5-flash", contents, config=generation_config)
+            raw_text = response.text
+            truncated = response_truncated(response, generation_config)
+            records, parser = parse_records(raw_text, record_depth=2, keep_skeleton=True) if truncated else ([], None)
+
+        if records:
+            if truncated:
+                # Ask for the fields and collections after the last complete one instead of regenerating
+                records, _ = continue_records("gemini-2.5-flash", contents, records, config=generation_config,
+                                              record_depth=2, on_record=on_record if streaming else None,
+                                              label="SCHEMA GENERATION")
+            schema_data = parser.skeleton()
+            if not isinstance(schema_data, dict):
+                # Truncated response - keep every field and collection that arrived complete
+                logger.warning(f"Schema response ended early - keeping {len(records)} complete items")
+                schema_data = {"schema_fields": [], "collections": []}
+            for key, record in records:
+                schema_data.setdefault(key, []).append(record)
+
+            logger.info(f"Generated schema for project {project_id}: {len(schema_data.get('schema_fields', []))} fields, {len(schema_data.get('collections', []))} collections")
+            return {
+                "success": True,
+                "schema": schema_data
+            }
+
+        if not raw_text:
             raise Exception("Empty response from Gemini API")
 
-        # Extract JSON from response (handle potential markdown formatting)
-        response_text = response.text.strip()
-        
-        # Remove markdown code block formatting if present
-        if response_text.startswith("```json"):
-            response_text = response_text[7:]
-        elif response_text.startswith("```"):
-            response_text = response_text[3:]
-            
-        if response_text.endswith("```"):
-            response_text = response_text[:-3]
-            
-        response_text = response_text.strip()
+        response_text = raw_text
         
         # Log the raw response for debugging
-        logger.info(f"Raw AI response (first 500 chars): {response_text[:500]}...")
+        logger.info(f"Raw AI response (first 500 chars): {response_text.strip()[:500]}...")
         
-        # Try to parse JSON response with error recovery
-        try:
-            schema_data = json.loads(response_text)
-        except json.JSONDecodeError as json_error:
-            # Try comprehensive JSON repair for complex schemas
-            logger.warning(f"Initial JSON parse failed: {json_error}. Attempting comprehensive repair...")
-            
-            import re
-            fixed_text = response_text
-            
-            # Step 1: Fix basic JSON formatting issues
-            # Fix unquoted property names
-            fixed_text = re.sub(r'(\w+):\s*"', r'"\1": "', fixed_text)
-            fixed_text = re.sub(r'(\w+):\s*(\d+)', r'"\1": \2', fixed_text)
-            fixed_text = re.sub(r'(\w+):\s*(true|false)', r'"\1": \2', fixed_text)
-            fixed_text = re.sub(r'(\w+):\s*\[', r'"\1": [', fixed_text)
-            fixed_text = re.sub(r'(\w+):\s*\{', r'"\1": {', fixed_text)
-            
-            # Step 2: Fix unterminated strings by finding incomplete string values
-            # Look for strings that start with quote but don't end properly
-            lines = fixed_text.split('\n')
-            repaired_lines = []
-            
-            for line in lines:
-                # Check if line has unterminated string
-                if line.count('"') % 2 != 0:
-                    # Find the last quote and see if it needs closing
-                    if line.strip().endswith(',') or line.strip().endswith('}') or line.strip().endswith(']'):
-                        # Line probably fine, just missing quote before comma/brace
-                        line = re.sub(r'([^"])(\s*[,\}\]])$', r'\1"\2', line)
-                    else:
-                        # Add closing quote at end
-                        line = line.rstrip() + '"'
-                        
-                repaired_lines.append(line)
-            
-            fixed_text = '\n'.join(repaired_lines)
-            
-            # Step 3: Fix array formatting for knowledge_documents and extraction_rules
-            fixed_text = re.sub(r'"knowledge_documents":\s*"([^"]+)",\s*"([^"]+)"', r'"knowledge_documents": ["\1", "\2"]', fixed_text)
-            fixed_text = re.sub(r'"extraction_rules":\s*"([^"]+)",\s*"([^"]+)"', r'"extraction_rules": ["\1", "\2"]', fixed_text)
-            
-            # Step 4: Try parsing the repaired JSON
-            try:
-                schema_data = json.loads(fixed_text)
-                logger.info("Successfully repaired JSON formatting")
-            except json.JSONDecodeError:
-                # Step 5: Extract the largest valid JSON object from response
-                logger.warning("Advanced JSON repair needed - extracting valid JSON segments")
-                
-                # Find JSON object boundaries
-                brace_stack = []
-                json_start = -1
-                json_end = -1
-                
-                for i, char in enumerate(fixed_text):
-                    if char == '{':
-                        if json_start == -1:
-                            json_start = i
-                        brace_stack.append(i)
-                    elif char == '}':
-                        if brace_stack:
-                            brace_stack.pop()
-                            if not brace_stack and json_start != -1:
-                                json_end = i + 1
-                                break
-                
-                if json_start != -1 and json_end != -1:
-                    json_content = fixed_text[json_start:json_end]
-                    try:
-                        schema_data = json.loads(json_content)
-                        logger.info("Successfully extracted valid JSON segment")
-                    except json.JSONDecodeError:
-                        # Final fallback: create a simplified schema
-                        logger.error("All JSON repair attempts failed. Creating simplified schema.")
-                        schema_data = {
-                            "main_object_name": "CSP_Data",
-                            "schema_fields": [
-                                {
-                                    "field_name": "Country_Code",
-                                    "field_type": "TEXT",
-                                    "description": "Country code for the CSP data",
-                                    "auto_verification_confidence": 85
-                                },
-                                {
-                                    "field_name": "Intervention_Description", 
-                                    "field_type": "TEXT",
-                                    "description": "Description of the agricultural intervention",
-                                    "auto_verification_confidence": 80
-                                },
-                                {
-                                    "field_name": "Activity_Values",
-                                    "field_type": "TEXT", 
-                                    "description": "Binary string representing activity status for all agricultural categories",
-                                    "auto_verification_confidence": 90
-                                }
-                            ],
-                            "collections": []
-                        }
-                        logger.info("Created fallback simplified schema")
-                else:
-                    raise json_error
+        # One tolerant pass handles fences, trailing commas, unquoted keys and cut-off tails
+        parsed = parse_lenient(response_text, expect=dict)
+        if parsed.repaired:
+            logger.warning(f"Repaired malformed schema JSON: {parsed.describe()}")
+        schema_data = parsed.value
         
         logger.info(f"Generated schema for project {project_id}: {len(schema_data.get('schema_fields', []))} fields, {len(schema_data.get('collections', []))} collections")
         
@@ -8,10 +8,16 @@ import os
 import sys
 import json
 import psycopg2
-from google import genai
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))  # Project root for utils
+from utils.gemini_client import generate_content
+from utils.lenient_json import loads_lenient
+from utils.response_schemas import column_mapping_schema, structured_config, validate_response, record_parse_outcome
+from utils.usage_tracker import set_usage_tags
 
 def extract_column_mappings(session_id, document_id, collection_id):
     """Extract column mappings to create identifier references"""
+    set_usage_tags(session_id=session_id)
     
     try:
         database_url = os.getenv('DATABASE_URL')
@@ -56,11 +62,12 @@ def extract_column_mappings(session_id, document_id, collection_id):
         if not api_key:
             return {"error": "No API key found"}
         
-        client = genai.Client(api_key=api_key)
-        
         # Create column mappings for all sheets
         all_mappings = []
         mapping_id = 1
+        mapping_schema = column_mapping_schema()
+        mapping_config = structured_config(mapping_schema)
+        structured = mapping_config is not None
         
         for sheet_name, headers in sheets_data.items():
             for header in headers:
@@ -85,21 +92,18 @@ Respond with JSON in this exact format:
 """
                 
                 try:
-                    response = client.models.generate_content(
-                        model="gemini-2.5-flash",
-                        contents=prompt
-                    )
-                    
-                    result_text = response.text.strip()
-                    
-                    # Clean the response
-                    if result_text.startswith('```json'):
-                        result_text = result_text.replace('```json', '').replace('```', '').strip()
-                    elif result_text.startswith('```'):
-                        result_text = result_text.replace('```', '').strip()
+                    response = generate_content("gemini-2.5-flash", prompt, mapping_config)
                     
-                    # Parse JSON response
-                    mapping_data = json.loads(result_text)
+                    # Parse JSON response (fences and surrounding text are tolerated), then check it against the schema
+                    try:
+                        mapping_data = loads_lenient(response.text, expect=dict)
+                    except json.JSONDecodeError:
+                        record_parse_outcome("extract_column_mappings", structured, False)
+                        raise
+                    errors = validate_response(mapping_data, mapping_schema) if structured else []
+                    record_parse_outcome("extract_column_mappings", structured, not errors, validation_errors=len(errors))
+                    if errors:
+                        raise ValueError(f"Response does not match the schema: {errors[0]}")
                     
                     # Create the mapping entry
                     mapping_entry = {
@@ -12,6 +12,8 @@ import tempfile
 import os
 from typing import List, Dict, Any
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))  # Project root for utils
+
 # Document processing libraries
 try:
     import PyPDF2
@@ -118,19 +120,16 @@ def merge_header_rows(header_rows):
 def extract_with_gemini_vision(file_content: bytes, mime_type: str, file_name: str = "document") -> str:
     """Use Gemini AI to extract text from a document or image via vision."""
     try:
-        from google import genai
+        from google.genai import types
+        from utils.gemini_client import generate_content
         api_key = os.environ.get("GOOGLE_API_KEY") or os.environ.get("GEMINI_API_KEY")
         if not api_key:
             raise Exception("No Gemini API key available")
 
-        client = genai.Client(api_key=api_key)
-
-        content_b64 = base64.b64encode(file_content).decode('utf-8')
-
-        response = client.models.generate_content(
+        response = generate_content(
             model="gemini-2.0-flash",
             contents=[
-                genai.types.Part.from_bytes(data=file_content, mime_type=mime_type),
+                types.Part.from_bytes(data=file_content, mime_type=mime_type),
                 "Extract ALL text content from this document/image. Return only the raw text content, preserving the structure and formatting as closely as possible. Do not add any commentary or explanation."
             ]
         )
@@ -9,9 +9,27 @@ Implements efficient extraction routing based on field configuration:
 import json
 import sys
 import os
+import time
 import psycopg2
-from typing import Dict, List, Any, Optional
-from google import genai
+from typing import Dict, List, Any, Optional, Callable, Tuple
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))  # Project root for utils
+
+from utils.gemini_client import generate_content, is_streaming_enabled, stream_json_records, response_truncated
+from utils.continuation import continue_records, parse_records
+from utils.lenient_json import parse_lenient
+from utils.response_schemas import (
+    enhanced_extraction_schema,
+    structured_config,
+    is_structured_output_enabled,
+    validate_response,
+    filter_valid_records,
+    record_parse_outcome
+)
+from utils.rate_limiter import set_rate_limit_organization_for_project
+from utils.usage_tracker import set_usage_tags, usage_context
+from utils.context_cache import cached_prompt
+from utils.model_router import ModelRouter, field_label, REASON_HARD_FIELD, REASON_PARSE_FAILURE, REASON_LOW_CONFIDENCE, CONFIDENCE_PERCENT
 # from all_prompts import ENHANCED_AI_EXTRACTION_PROMPT  # Will use inline prompt for now
 
 def connect_to_database():
@@ -384,7 +402,8 @@ def execute_function_extraction(function_data: Dict[str, Any], documents: List[D
             function_data['function_code'],
             extracted_content,
             {'target_fields': [function_data]},
-            previous_extractions
+            previous_extractions,
+            function_data.get('id')
         )
         
         print(f"🔧 FUNCTION EXTRACTION: {function_data['function_name']} completed")
@@ -398,6 +417,16 @@ def execute_function_extraction(function_data: Dict[str, Any], documents: List[D
 def generate_dynamic_ai_prompt(tool_data: Dict[str, Any], value_data: Dict[str, Any], 
                              knowledge_docs: List[Dict[str, Any]], input_data: Dict[str, Any]) -> str:
     """Generate dynamic AI prompt using tool configuration and value inputs"""
+    return "\n\n".join(filter(None, build_dynamic_ai_prompt_parts(tool_data, value_data, knowledge_docs, input_data)))
+
+def build_dynamic_ai_prompt_parts(tool_data: Dict[str, Any], value_data: Dict[str, Any], 
+                                  knowledge_docs: List[Dict[str, Any]], input_data: Dict[str, Any]) -> Tuple[str, str]:
+    """Build the dynamic AI prompt as (stable prefix, per-field suffix)
+    
+    The prefix holds the system architecture text and the knowledge documents, which
+    are the same for every field of a project that uses the same documents, so it can
+    be served from an explicit context cache. Everything field-specific follows it.
+    """
     
     # Check if this is a create or update operation
     operation_type = tool_data.get('operationType', 'updateMultiple')  # Default to update for backward compatibility
@@ -445,7 +474,7 @@ INPUT PARAMETER TYPES:
 Your response must maintain the identifierId mapping for all processed items.
 ---"""
 
-    # 2. TOOL PROMPT - From tool configuration
+    # 2. TOOL PROMPT - From tool configuration (first part of the per-field suffix)
     tool_prompt = tool_data.get('aiPrompt', '') or tool_data.get('ai_prompt', '')
     if tool_prompt:
         tool_prompt = f"\nTOOL FUNCTION:\n{tool_prompt}\n"
@@ -511,7 +540,7 @@ Your response must maintain the identifierId mapping for all processed items.
     
     value_config += "\n"
     
-    # 4. KNOWLEDGE DOCUMENTS - Reference context
+    # KNOWLEDGE DOCUMENTS - Reference context (part of the stable prefix)
     knowledge_context = ""
     if knowledge_docs:
         knowledge_context = "\nREFERENCE DOCUMENTS:\n"
@@ -643,30 +672,34 @@ CRITICAL REQUIREMENTS FOR identifierId PRESERVATION:
 
 EXAMPLE: If input has identifierId "abc-123", your response MUST have identifierId "abc-123", NOT a new UUID"""
     
-    # Build the prompt with optional output requirements
-    prompt_parts = [system_prompt, tool_prompt, value_config, knowledge_context, input_summary, actual_input_data]
+    # Stable prefix first (system text, knowledge documents), then everything field-specific
+    prefix = "\n\n".join(filter(None, [system_prompt, knowledge_context]))
+    suffix_parts = [tool_prompt, value_config, input_summary, actual_input_data]
     
     if output_requirements:
-        prompt_parts.append(output_requirements)
-    
-    prompt_parts.append("EXECUTE THE TASK WITH THE PROVIDED INPUTS AND RETURN THE RESULT IN JSON FORMAT.")
+        suffix_parts.append(output_requirements)
     
-    compiled_prompt = "\n\n".join(filter(None, prompt_parts))
+    suffix_parts.append("EXECUTE THE TASK WITH THE PROVIDED INPUTS AND RETURN THE RESULT IN JSON FORMAT.")
     
-    return compiled_prompt
+    return prefix, "\n\n".join(filter(None, suffix_parts))
 
 def execute_ai_extraction(tool_data: Dict[str, Any], value_data: Dict[str, Any], 
-                        knowledge_docs: List[Dict[str, Any]], input_data: Dict[str, Any]) -> Dict[str, Any]:
-    """Execute AI extraction using tool and value configuration"""
+                        knowledge_docs: List[Dict[str, Any]], input_data: Dict[str, Any],
+                        on_record: Optional[Callable[[Any], None]] = None,
+                        cache_scope: Optional[str] = None) -> Dict[str, Any]:
+    """Execute AI extraction using tool and value configuration
+    
+    Array responses are streamed when ai.streaming.enabled is set; on_record is called
+    with each item as soon as it is parsed. With a cache_scope (e.g. "project:<id>") the
+    stable prompt prefix is served from an explicit context cache when ai.contextCache
+    is enabled.
+    """
     try:
         # Get API key
         api_key = os.getenv('GEMINI_API_KEY') or os.getenv('GOOGLE_API_KEY')
         if not api_key:
             return {"error": "No API key found"}
         
-        # Initialize Gemini client
-        client = genai.Client(api_key=api_key)
-        
         # Log incoming data structure
         value_name = value_data.get('valueName', '') or value_data.get('value_name', '')
         print(f"🤖 AI EXTRACTION: Processing {value_name}", file=sys.stderr, flush=True)
@@ -684,8 +717,19 @@ def execute_ai_extraction(tool_data: Dict[str, Any], value_data: Dict[str, Any],
         else:
             print(f"      No previous_data in input")
         
-        # Generate dynamic prompt using tool and value configuration
-        prompt = generate_dynamic_ai_prompt(tool_data, value_data, knowledge_docs, input_data)
+        # Generate dynamic prompt using tool and value configuration - stable prefix first
+        prefix, suffix = build_dynamic_ai_prompt_parts(tool_data, value_data, knowledge_docs, input_data)
+        prompt = "\n\n".join(filter(None, [prefix, suffix]))
+        
+        # UPDATE items must carry one of the input identifierIds; CREATE items are free-form records
+        is_update = isinstance(input_data.get('Input Data'), list)
+        input_ids = [item.get('identifierId') for item in input_data.get('Input Data') or []
+                     if isinstance(item, dict)] if is_update else None
+        schema = enhanced_extraction_schema(is_update, input_ids)
+        
+        def call_model(model_name, on_item=None, attempt=0):
+            return call_ai_extraction_model(suffix, model_name, on_item, prefix=prefix, cache_scope=cache_scope,
+                                            schema=schema, attempt=attempt)
         
         # Log knowledge documents summary
         if knowledge_docs:
@@ -699,49 +743,183 @@ def execute_ai_extraction(tool_data: Dict[str, Any], value_data: Dict[str, Any],
         
         print(f"📝 FULL AI PROMPT:\n{'-'*80}\n{prompt}\n{'-'*80}")
         
-        # Call Gemini API
-        response = client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=prompt
-        )
+        # Call Gemini API - fast model first, escalating to the strong model when routing is enabled
+        router = ModelRouter('enhanced_ai_extraction', CONFIDENCE_PERCENT)
+        if not router.enabled:
+            return call_model("gemini-2.5-flash", on_record)
         
-        response_text = response.text or ""
+        field = field_label(value_data)
+        hard = router.is_hard_field(value_data)
+        model = router.strong_model if hard else router.fast_model
         
-        # Parse JSON response
-        try:
-            # Clean response
-            cleaned_response = response_text.strip()
-            if cleaned_response.startswith('```json'):
-                cleaned_response = cleaned_response.replace('```json', '').replace('```', '').strip()
-            elif cleaned_response.startswith('```'):
-                cleaned_response = cleaned_response.replace('```', '').strip()
-            
-            result = json.loads(cleaned_response)
-            print(f"✅ AI EXTRACTION: Success - {result.get('extracted_value', 'N/A')}")
+        # Stream confident items straight away only when escalation can replace items by identifierId
+        def emit_confident(item):
+            if on_record and not router.is_low_confidence(item, 'confidenceScore'):
+                on_record(item)
+        
+        started = time.time()
+        result = call_model(model, on_record if hard else (emit_confident if is_update else None))
+        router.record_call(field, model, time.time() - started, result if isinstance(result, list) else None,
+                           'confidenceScore', False, REASON_HARD_FIELD if hard else None)
+        if hard:
+            return result
+        
+        if isinstance(result, list):
+            low_items = [item for item in result if router.is_low_confidence(item, 'confidenceScore')]
+            reason = REASON_LOW_CONFIDENCE if low_items else None
+        else:
+            low_items = []
+            reason = REASON_PARSE_FAILURE if result.get('error') else None
+        
+        if not reason:
+            if on_record and not is_update and isinstance(result, list):
+                for item in result:
+                    on_record(item)
             return result
-            
-        except json.JSONDecodeError:
-            # Try to extract JSON from response
-            start_idx = response_text.find('{')
-            end_idx = response_text.rfind('}') + 1
-            if start_idx >= 0 and end_idx > start_idx:
-                try:
-                    json_part = response_text[start_idx:end_idx]
-                    result = json.loads(json_part)
-                    return result
-                except:
-                    pass
-            
-            return {
-                "error": "Failed to parse AI response",
-                "raw_response": response_text
-            }
+        
+        print(f"🔀 MODEL ROUTING: {field} escalated to {router.strong_model} ({reason}, {len(low_items)} low-confidence items)")
+        started = time.time()
+        strong_result = call_model(router.strong_model, attempt=1 if reason == REASON_PARSE_FAILURE else 0)
+        router.record_call(field, router.strong_model, time.time() - started,
+                           strong_result if isinstance(strong_result, list) else None, 'confidenceScore', True, reason)
+        
+        if isinstance(strong_result, list) and isinstance(result, list) and is_update:
+            # Replace only the low-confidence items, matched by identifierId
+            strong_by_id = {item.get('identifierId'): item for item in strong_result if isinstance(item, dict)}
+            merged = []
+            for item in result:
+                replacement = strong_by_id.get(item.get('identifierId')) if isinstance(item, dict) else None
+                if replacement is not None and router.is_low_confidence(item, 'confidenceScore'):
+                    item = replacement
+                    if on_record:
+                        on_record(item)
+                elif on_record and router.is_low_confidence(item, 'confidenceScore'):
+                    on_record(item)
+                merged.append(item)
+            return merged
+        
+        if isinstance(strong_result, list) or not isinstance(result, list):
+            if on_record and isinstance(strong_result, list):
+                for item in strong_result:
+                    on_record(item)
+            return strong_result
+        
+        # Escalation failed - keep the fast model's items, emitting those not streamed yet
+        if on_record:
+            for item in result:
+                if not is_update or router.is_low_confidence(item, 'confidenceScore'):
+                    on_record(item)
+        return result
         
     except Exception as e:
         error_msg = f"AI extraction failed: {str(e)}"
         print(f"❌ AI ERROR: {error_msg}")
         return {"error": error_msg}
 
+def call_ai_extraction_model(prompt: str, model: str, on_record: Optional[Callable[[Any], None]] = None,
+                             prefix: str = "", cache_scope: Optional[str] = None,
+                             schema: Optional[Dict[str, Any]] = None, attempt: int = 0) -> Any:
+    """Send an extraction prompt to one model and parse the JSON response
+    
+    prompt follows prefix; with a cache_scope the prefix is referenced from a context cache.
+    With a schema the response is constrained to it and items that still break it are dropped.
+    attempt > 0 marks a retry after a parse failure in the structured output stats.
+    """
+    contents, config = cached_prompt(model, prefix, prompt, cache_scope)
+    if schema:
+        config = structured_config(schema, config)
+    structured = bool(schema) and is_structured_output_enabled()
+    
+    def finish(records):
+        errors = []
+        kept = records
+        if structured:
+            kept, errors = filter_valid_records(records, schema)
+            if errors:
+                print(f"⚠️ AI EXTRACTION: Dropped {len(records) - len(kept)} items failing the response schema: {'; '.join(errors[:3])}")
+        record_parse_outcome("execute_ai_extraction", structured, True, attempt, len(errors), len(records) - len(kept), len(kept))
+        print(f"✅ AI EXTRACTION: Success - {len(kept)} items ({model})")
+        return kept
+    
+    if is_streaming_enabled():
+        item_schema = schema.get('items') if structured else None
+        emit = on_record
+        if on_record and item_schema:
+            emit = lambda item: not validate_response(item, item_schema) and on_record(item)
+        stream = stream_json_records(model, contents, config=config, on_record=emit, label="AI EXTRACTION")
+        if stream.records:
+            records = stream.records
+            if stream.truncated:
+                # Large CREATE results hit the output limit - resume after the last complete item
+                records, _ = continue_records(model, contents, records, config=config, on_record=emit, label="AI EXTRACTION")
+            elif not stream.complete:
+                print(f"⚠️ AI EXTRACTION: Response ended early - keeping {len(records)} complete items")
+            return finish(records)
+        response_text = stream.text
+    else:
+        response = generate_content(model, contents, config)
+        response_text = response.text or ""
+        if response_truncated(response, config):
+            records = parse_records(response_text)[0]
+            if records:
+                records, _ = continue_records(model, contents, records, config=config, label="AI EXTRACTION")
+                return finish(records)
+    
+    # Parse JSON response (fences, surrounding text, trailing commas and cut-off tails are tolerated)
+    try:
+        parsed = parse_lenient(response_text)
+        if parsed.repaired:
+            print(f"⚠️ AI EXTRACTION: Repaired malformed JSON - {parsed.describe()}")
+        result = parsed.value
+        if isinstance(result, list):
+            return finish(result)
+        if structured:
+            # The schema asks for an array - anything else counts as a parse failure
+            raise json.JSONDecodeError(f"Expected a JSON array, got {type(result).__name__}", response_text, parsed.start)
+        record_parse_outcome("execute_ai_extraction", structured, True, attempt)
+        print(f"✅ AI EXTRACTION: Success - {result.get('extracted_value', 'N/A') if isinstance(result, dict) else result}")
+        return result
+        
+    except json.JSONDecodeError as e:
+        record_parse_outcome("execute_ai_extraction", structured, False, attempt)
+        print(f"❌ AI EXTRACTION: Unparseable response - {e.msg} at line {e.lineno} column {e.colno}")
+        return {
+            "error": "Failed to parse AI response",
+            "raw_response": response_text
+        }
+
+def ai_extraction_entries(result: Any, entry: Dict[str, Any], single: bool = False) -> List[Dict[str, Any]]:
+    """field_validations entries for an execute_ai_extraction result
+    
+    The array-shaped prompt answers with a list of items (extractedValue, confidenceScore,
+    aiReasoning, identifierId for UPDATE); each item becomes an entry with its record_index
+    and identifier_id. With single set, a one-element list is the field's value.
+    Older single-value answers ({extracted_value, confidence_score, reasoning}) give one entry.
+    """
+    if isinstance(result, dict):
+        if result.get('error'):
+            print(f"⚠️ AI EXTRACTION: {entry['field_name']} failed - {result['error']}")
+            return []
+        return [dict(entry, extracted_value=result.get('extracted_value'),
+                     confidence_score=result.get('confidence_score', 80),
+                     reasoning=result.get('reasoning', 'AI analysis'))]
+    if not isinstance(result, list):
+        return []
+    
+    entries = []
+    items = [item for item in result if isinstance(item, dict)]
+    for record_index, item in enumerate(items):
+        values = dict(entry,
+                      extracted_value=item.get('extractedValue', item.get('extracted_value')),
+                      confidence_score=item.get('confidenceScore', item.get('confidence_score', 80)),
+                      reasoning=item.get('aiReasoning') or item.get('reasoning') or 'AI analysis')
+        if not (single and len(items) == 1):
+            values['record_index'] = record_index
+            if item.get('identifierId') is not None:
+                values['identifier_id'] = item['identifierId']
+        entries.append(values)
+    return entries
+
 def process_enhanced_extraction(input_data: Dict[str, Any]) -> Dict[str, Any]:
     """Main enhanced extraction processor"""
     try:
@@ -750,6 +928,8 @@ def process_enhanced_extraction(input_data: Dict[str, Any]) -> Dict[str, Any]:
         documents = input_data.get('documents', [])
         
         print(f"🚀 ENHANCED EXTRACTION: Starting for project {project_id}")
+        set_rate_limit_organization_for_project(project_id)
+        set_usage_tags(session_id=session_id, project_id=project_id)
         
         # Get field configurations
         collection_properties = get_collection_properties_with_metadata(project_id)
@@ -837,18 +1017,17 @@ def process_enhanced_extraction(input_data: Dict[str, Any]) -> Dict[str, Any]:
                 else:
                     print(f"   ⚠️ No previous data added to input")
                 
-                result = execute_ai_extraction(tool_data, value_data, knowledge_docs, input_data)
+                with usage_context(field=f"{prop['collection_name']}.{prop['property_name']}",
+                                   call_site='execute_ai_extraction'):
+                    result = execute_ai_extraction(tool_data, value_data, knowledge_docs, input_data,
+                                                   cache_scope=f"project:{project_id}")
                 
-                if not result.get('error'):
-                    results.append({
-                        'field_id': field_id,
-                        'field_name': f"{prop['collection_name']}.{prop['property_name']}",
-                        'collection_name': prop['collection_name'],
-                        'extraction_type': 'AI',
-                        'extracted_value': result.get('extracted_value'),
-                        'confidence_score': result.get('confidence_score', 80),
-                        'reasoning': result.get('reasoning', 'AI analysis')
-                    })
+                results.extend(ai_extraction_entries(result, {
+                    'field_id': field_id,
+                    'field_name': f"{prop['collection_name']}.{prop['property_name']}",
+                    'collection_name': prop['collection_name'],
+                    'extraction_type': 'AI'
+                }))
         
         # Process schema fields
         for field in schema_fields:
@@ -922,17 +1101,15 @@ def process_enhanced_extraction(input_data: Dict[str, Any]) -> Dict[str, Any]:
                 else:
                     print(f"   ⚠️ No previous data added to input")
                 
-                result = execute_ai_extraction(tool_data, value_data, knowledge_docs, input_data)
+                with usage_context(field=field['field_name'], call_site='execute_ai_extraction'):
+                    result = execute_ai_extraction(tool_data, value_data, knowledge_docs, input_data,
+                                                   cache_scope=f"project:{project_id}")
                 
-                if not result.get('error'):
-                    results.append({
-                        'field_id': field_id,
-                        'field_name': field['field_name'],
-                        'extraction_type': 'AI',
-                        'extracted_value': result.get('extracted_value'),
-                        'confidence_score': result.get('confidence_score', 80),
-                        'reasoning': result.get('reasoning', 'AI analysis')
-                    })
+                results.extend(ai_extraction_entries(result, {
+                    'field_id': field_id,
+                    'field_name': field['field_name'],
+                    'extraction_type': 'AI'
+                }, single=True))
         
         print(f"\n✅ ENHANCED EXTRACTION: Completed with {len(results)} results")
         
@@ -25,22 +25,25 @@ Usage:
 """
 
 import os
+import sys
 import psycopg2
 import json
 import pandas as pd
 from io import StringIO
-from google import genai
 from all_prompts import EXCEL_FUNCTION_GENERATOR
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))  # Project root for utils
+from utils.gemini_client import generate_content
+from utils.usage_tracker import set_usage_tags
+from utils.function_cache import EntryPointNotFound
+from utils.sandbox_pool import run_stored_function
+
 def generate_excel_extraction_function(target_fields_data):
     """Generate a custom Excel extraction function using Gemini based on field descriptions"""
     max_retries = 3
     
     for attempt in range(max_retries):
         try:
-            # Initialize Gemini client
-            client = genai.Client(api_key=os.environ.get("GEMINI_API_KEY") or os.environ.get("GOOGLE_API_KEY"))
-            
             # Format target fields for the prompt
             target_fields_json = json.dumps(target_fields_data, indent=2)
             
@@ -52,10 +55,7 @@ def generate_excel_extraction_function(target_fields_data):
             print("=" * 80)
             print("Target fields:", len(target_fields_data))
             
-            response = client.models.generate_content(
-                model="gemini-2.5-flash",
-                contents=prompt
-            )
+            response = generate_content("gemini-2.5-flash", prompt)
             
             generated_function = response.text
             
@@ -103,6 +103,7 @@ def generate_excel_extraction_function(target_fields_data):
 
 def excel_column_extraction(document_ids, session_id, target_fields_data):
     """Extract column data from Excel documents using AI-generated function"""
+    set_usage_tags(session_id=session_id)
     try:
         # Generate custom extraction function using Gemini
         generated_function = generate_excel_extraction_function(target_fields_data)
@@ -142,26 +143,16 @@ def excel_column_extraction(document_ids, session_id, target_fields_data):
                     print("=" * 80)
                     print(f"Processing document: {file_name}", file=sys.stderr, flush=True)
                     
-                    # Create a safe execution environment
-                    exec_globals = {
-                        'json': json,
-                        'pandas': pd,
-                        'StringIO': StringIO
-                    }
-                    
-                    # Execute the generated function code
-                    exec(generated_function, exec_globals)
-                    
-                    # Call the generated extract_excel_data function
-                    extraction_function = exec_globals.get('extract_excel_data')
-                    if extraction_function:
-                        document_results = extraction_function(extracted_content, target_fields_data)
+                    # Runs in a sandbox worker when extraction.sandbox enables the pandas environment (utils.sandbox_pool)
+                    try:
+                        document_results = run_stored_function('pandas', None, generated_function, ('extract_excel_data',),
+                                                               extracted_content, [target_fields_data])
                         if isinstance(document_results, list):
                             all_extraction_results.extend(document_results)
                             print(f"Extracted {len(document_results)} records from {file_name}")
                         else:
                             print(f"Function returned non-list result: {type(document_results)}")
-                    else:
+                    except EntryPointNotFound:
                         print("Generated function 'extract_excel_data' not found")
                         
                     print("=" * 80)
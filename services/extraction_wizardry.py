@@ -10,12 +10,13 @@ Key Features:
 - AI extraction via Google Gemini API
 - Excel function-based extraction with pandas
 - Identifier reference chaining between extraction steps
+- Dependency-ordered field scheduling: identifier fields first, the rest in parallel
 - Database persistence for extraction results and references
 - Progressive multi-step extraction workflows
 
 Architecture:
 - Coordinates between ai_extraction_wizard.py and excel_wizard.py
-- Manages identifier references across extraction steps
+- Manages identifier references across extraction steps (in memory per run, see utils.identifier_references)
 - Handles both single value and multiple value extractions
 - Provides comprehensive error handling and logging
 
@@ -27,17 +28,97 @@ Usage:
 """
 
 import json
+import re
 import sys
 import os
 import time
+import csv
+import io
 import psycopg2
-from google import genai
+from psycopg2.extras import execute_values
 from all_prompts import DOCUMENT_FORMAT_ANALYSIS, EXCEL_FUNCTION_GENERATOR
 from excel_wizard import excel_column_extraction
 from ai_extraction_wizard import ai_document_extraction
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))  # Project root for utils
+from utils.config import get_config
+from utils.gemini_client import generate_content, response_truncated
+from utils.continuation import continue_text
+from utils.lenient_json import parse_lenient, loads_lenient
+from utils.response_schemas import excel_function_schema, structured_config, validate_response, record_parse_outcome
+from utils.prompt_encoding import encode_prompt_value
+from utils.workbook_profile import profile_workbook, render_sample, summarize_profile
+from utils.usage_tracker import set_usage_tags
+from utils.field_scheduler import build_field_graph, critical_path_seconds, get_max_parallel_fields, run_field_graph
+from utils.tool_routing import get_tool_routing_cache
+from utils.identifier_references import IdentifierReferenceStore, IdentifierReferenceTable, key_results
+from utils.function_cache import EntryPointNotFound, get_function_cache
+from utils.function_catalogue import get_function_catalogue
+from utils.function_index import select_candidate_functions, workbook_header_signature
+from utils.sandbox_pool import run_stored_function
+from utils.token_budget import (
+    get_token_limit,
+    estimate_tokens,
+    measure_prompt_sections,
+    format_prompt_budget,
+    split_text_by_tokens
+)
+
+SPREADSHEET_MIME_TYPES = ('application/vnd.ms-excel', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'text/csv')
+REFERENCE_INDEX_SUFFIX = re.compile(r'\[\d+\]$')
+
+def _identifier_reference_rows(session_id, extraction_number, identifier_references):
+    """extraction_identifier_references rows: one per (record, field), index suffix removed from field names"""
+    if isinstance(identifier_references, IdentifierReferenceTable):
+        for idx, field_name, extracted_value in identifier_references.cells():
+            yield (session_id, extraction_number, idx, field_name, str(extracted_value))
+        return
+    for idx, ref in enumerate(identifier_references or []):
+        for field_name, extracted_value in ref.items():
+            yield (session_id, extraction_number, idx, REFERENCE_INDEX_SUFFIX.sub('', field_name), str(extracted_value))
+
+def write_identifier_references(conn, session_id, extraction_number, identifier_references, method=None, page_size=None):
+    """Replace the references of one extraction in a single transaction
+
+    method "copy" streams every row with one COPY FROM STDIN; "values" sends
+    multi-row INSERTs of page_size rows (psycopg2 execute_values).
+    Returns the number of rows written.
+    """
+    config = get_config('extraction.referenceWrites', {}) or {}
+    method = method or config.get('method', 'copy')
+    page_size = page_size or int(config.get('pageSize', 5000))
+    rows = _identifier_reference_rows(session_id, extraction_number, identifier_references)
+    written = 0
+    with conn, conn.cursor() as cursor:
+        # Clear any existing references for this session and extraction number
+        cursor.execute("""
+        DELETE FROM extraction_identifier_references 
+        WHERE session_id = %s AND extraction_number = %s
+        """, (session_id, extraction_number))
+        if method == 'copy':
+            buffer = io.StringIO()
+            # Quoted strings: an unquoted empty CSV field would load as NULL
+            writer = csv.writer(buffer, quoting=csv.QUOTE_NONNUMERIC, lineterminator='\n')
+            for row in rows:
+                writer.writerow(row)
+                written += 1
+            buffer.seek(0)
+            cursor.copy_expert(
+                "COPY extraction_identifier_references "
+                "(session_id, extraction_number, record_index, field_name, extracted_value) FROM STDIN WITH (FORMAT csv)",
+                buffer)
+        else:
+            rows = list(rows)
+            written = len(rows)
+            execute_values(cursor, """
+            INSERT INTO extraction_identifier_references 
+            (session_id, extraction_number, record_index, field_name, extracted_value)
+            VALUES %s
+            """, rows, page_size=page_size)
+    return written
+
 def save_identifier_references_to_db(session_id, extraction_number, identifier_references):
-    """Save identifier references to the database for future retrieval"""
+    """Save identifier references (list or IdentifierReferenceTable) to the database for future retrieval (one transaction, bulk insert)"""
     try:
         db_url = os.getenv('DATABASE_URL')
         if not db_url:
@@ -45,47 +126,28 @@ def save_identifier_references_to_db(session_id, extraction_number, identifier_r
             return False
             
         conn = psycopg2.connect(db_url)
-        cursor = conn.cursor()
-        
-        # Clear any existing references for this session and extraction number
-        delete_query = """
-        DELETE FROM extraction_identifier_references 
-        WHERE session_id = %s AND extraction_number = %s
-        """
-        cursor.execute(delete_query, (session_id, extraction_number))
-        
-        # Insert new references
-        if identifier_references:
-            for idx, ref in enumerate(identifier_references):
-                for field_name, extracted_value in ref.items():
-                    # Remove any index suffix from field_name when saving to database
-                    import re
-                    clean_field_name = re.sub(r'\[\d+\]$', '', field_name)
-                    insert_query = """
-                    INSERT INTO extraction_identifier_references 
-                    (session_id, extraction_number, record_index, field_name, extracted_value)
-                    VALUES (%s, %s, %s, %s, %s)
-                    """
-                    cursor.execute(insert_query, (session_id, extraction_number, idx, clean_field_name, str(extracted_value)))
-        
-        conn.commit()
-        cursor.close()
-        conn.close()
+        try:
+            started = time.time()
+            written = write_identifier_references(conn, session_id, extraction_number, identifier_references)
+        finally:
+            conn.close()
         
-        print(f"✅ Saved {len(identifier_references) if identifier_references else 0} identifier references to database", file=sys.stderr, flush=True)
+        print(f"✅ Saved {len(identifier_references) if identifier_references else 0} identifier references to database "
+              f"({written} rows in {time.time() - started:.2f}s)", file=sys.stderr, flush=True)
         return True
         
     except Exception as e:
         print(f"❌ Failed to save identifier references to database: {str(e)}", file=sys.stderr, flush=True)
         return False
 
-def load_merged_identifier_references_from_db(session_id, up_to_extraction_number):
-    """Load and merge identifier references from database for all extractions up to the specified number"""
+def load_identifier_reference_table_from_db(session_id, up_to_extraction_number):
+    """Load identifier references for all extractions up to the specified number, merged by record index"""
+    table = IdentifierReferenceTable()
     try:
         db_url = os.getenv('DATABASE_URL')
         if not db_url:
             print("⚠️ DATABASE_URL not found, returning empty references", file=sys.stderr, flush=True)
-            return []
+            return table
             
         conn = psycopg2.connect(db_url)
         cursor = conn.cursor()
@@ -98,41 +160,27 @@ def load_merged_identifier_references_from_db(session_id, up_to_extraction_numbe
         ORDER BY record_index, extraction_number, field_name
         """
         cursor.execute(query, (session_id, up_to_extraction_number))
-        results = cursor.fetchall()
+        
+        # Later extractions overwrite earlier values of the same field
+        for extraction_number, record_index, field_name, extracted_value in cursor:
+            table.set(record_index, field_name, extracted_value)
         
         cursor.close()
         conn.close()
         
-        # Group by record index and merge fields from all extractions
-        merged = {}
-        for extraction_number, record_index, field_name, extracted_value in results:
-            if record_index not in merged:
-                merged[record_index] = {}
-            # Store field values without the index suffix for proper merging
-            merged[record_index][field_name] = extracted_value
-        
-        # Convert to array format with proper indexing
-        merged_array = []
-        for record_index in sorted(merged.keys()):
-            # Create the final format: {Field1[index]: value, Field2[index]: value}
-            record_obj = {}
-            for field_name, value in merged[record_index].items():
-                record_obj[f"{field_name}[{record_index}]"] = value
-            merged_array.append(record_obj)
-        
-        print(f"✅ Loaded {len(merged_array)} merged identifier references from database", file=sys.stderr, flush=True)
-        
-        # Debug output: show first few merged records
-        if merged_array and len(merged_array) > 0:
-            print(f"🔍 DEBUG: First merged record: {merged_array[0]}", file=sys.stderr, flush=True)
-            if len(merged_array) > 1:
-                print(f"🔍 DEBUG: Second merged record: {merged_array[1]}", file=sys.stderr, flush=True)
-        
-        return merged_array
+        print(f"✅ Loaded {len(table)} merged identifier references from database ({', '.join(table.columns)})", file=sys.stderr, flush=True)
+        return table
         
     except Exception as e:
         print(f"❌ Failed to load identifier references from database: {str(e)}", file=sys.stderr, flush=True)
-        return []
+        return IdentifierReferenceTable()
+
+def load_merged_identifier_references_from_db(session_id, up_to_extraction_number):
+    """Load and merge identifier references from database for all extractions up to the specified number
+
+    Returns the list format with "Field[index]" keys; see load_identifier_reference_table_from_db.
+    """
+    return load_identifier_reference_table_from_db(session_id, up_to_extraction_number).to_references(indexed=True)
 
 def log_remaining_collection_fields(extracted_results, all_collection_properties):
     """Log which collection fields have been extracted and which remain to be processed"""
@@ -302,12 +350,9 @@ def analyze_document_format_with_gemini(documents, target_fields_data=None, max_
     if not api_key:
         return "ERROR: GEMINI_API_KEY not found"
     
-    # Initialize Gemini client
-    client = genai.Client(api_key=api_key)
-    
     # Use centralized prompt from all_prompts.py with both placeholders
-    documents_content = json.dumps(documents, indent=2)
-    target_fields_content = json.dumps(target_fields_data, indent=2) if target_fields_data and not isinstance(target_fields_data, dict) else "No target fields provided"
+    documents_content = encode_prompt_value('DOCUMENT_FORMAT_ANALYSIS', 'documents', documents)
+    target_fields_content = encode_prompt_value('DOCUMENT_FORMAT_ANALYSIS', 'target_fields', target_fields_data) if target_fields_data and not isinstance(target_fields_data, dict) else "No target fields provided"
     
     prompt = DOCUMENT_FORMAT_ANALYSIS.format(
         documents=documents_content,
@@ -327,10 +372,7 @@ def analyze_document_format_with_gemini(documents, target_fields_data=None, max_
     for attempt in range(max_retries):
         try:
             # Call Gemini API with selected model
-            response = client.models.generate_content(
-                model=model_to_use,
-                contents=prompt
-            )
+            response = generate_content(model_to_use, prompt)
             
             # Return raw response text if successful
             return response.text or "ERROR: Empty response from Gemini"
@@ -358,7 +400,7 @@ def clean_json_and_extract_identifiers(extraction_result, target_fields_data):
     try:
         # Parse the extraction result if it's a string
         if isinstance(extraction_result, str):
-            cleaned_result = json.loads(extraction_result)
+            cleaned_result = loads_lenient(extraction_result)
         else:
             cleaned_result = extraction_result
         
@@ -454,93 +496,26 @@ def get_all_collection_properties(collection_ids):
         return {"error": f"Collection properties query failed: {str(e)}"}
 
 def get_excel_wizardry_functions():
-    """Get all existing Excel wizardry functions from database"""
+    """Get the metadata of all existing Excel wizardry functions (no code; see get_excel_wizardry_function_by_id)"""
     try:
-        # Get database connection from environment
-        database_url = os.getenv('DATABASE_URL')
-        if not database_url:
-            return {"error": "DATABASE_URL not found"}
-        
-        # Connect to database
-        conn = psycopg2.connect(database_url)
-        cursor = conn.cursor()
-        
-        # Query excel_wizardry_functions table
-        query = """
-        SELECT id, name, description, tags, function_code, usage_count
-        FROM excel_wizardry_functions
-        ORDER BY usage_count DESC, created_at DESC
-        """
-        
-        cursor.execute(query)
-        results = cursor.fetchall()
-        
-        # Format results
-        functions = []
-        for row in results:
-            func_id, name, description, tags, function_code, usage_count = row
-            functions.append({
-                "id": str(func_id),
-                "name": name,
-                "description": description,
-                "tags": tags or [],
-                "function_code": function_code,
-                "usage_count": usage_count or 0
-            })
-        
-        cursor.close()
-        conn.close()
-        
-        return functions
+        return get_function_catalogue().list_functions()
         
     except Exception as e:
         return {"error": f"Excel wizardry functions query failed: {str(e)}"}
 
 def get_excel_wizardry_function_by_id(function_id):
-    """Get a specific Excel wizardry function by ID from the database"""
+    """Get a specific Excel wizardry function by ID, including its code (cached while unchanged)"""
     try:
-        # Get database connection from environment
-        database_url = os.getenv('DATABASE_URL')
-        if not database_url:
-            return {"error": "DATABASE_URL not found"}
-        
-        # Connect to database
-        conn = psycopg2.connect(database_url)
-        cursor = conn.cursor()
-        
-        # Query specific Excel wizardry function by ID
-        query = """
-        SELECT id, name, description, tags, function_code, usage_count
-        FROM excel_wizardry_functions
-        WHERE id = %s
-        """
-        
-        cursor.execute(query, (function_id,))
-        result = cursor.fetchone()
-        
-        if result:
-            func_id, name, description, tags, function_code, usage_count = result
-            function_data = {
-                "id": str(func_id),
-                "name": name,
-                "description": description,
-                "tags": tags or [],
-                "function_code": function_code,
-                "usage_count": usage_count or 0
-            }
-        else:
-            function_data = {"error": f"No function found with ID: {function_id}"}
-        
-        cursor.close()
-        conn.close()
-        
+        function_data = get_function_catalogue().get_function(function_id)
+        if function_data is None:
+            return {"error": f"No function found with ID: {function_id}"}
         return function_data
         
     except Exception as e:
         return {"error": f"Failed to retrieve Excel wizardry function: {str(e)}"}
 
-def create_excel_wizardry_function(name, description, tags, function_code):
-    """Create a new Excel wizardry function in database"""
+def create_excel_wizardry_function(name, description, tags, function_code, header_signature=None):
+    """Create a new Excel wizardry function in database (header_signature: sheet headers it was built for)"""
     try:
         # Get database connection from environment
         database_url = os.getenv('DATABASE_URL')
@@ -581,13 +556,14 @@ def create_excel_wizardry_function(name, description, tags, function_code):
         
         # Insert new function with proper schemas
         query = """
-        INSERT INTO excel_wizardry_functions (name, description, tags, function_code, input_schema, output_schema, usage_count)
-        VALUES (%s, %s, %s, %s, %s, %s, 0)
+        INSERT INTO excel_wizardry_functions (name, description, tags, function_code, input_schema, output_schema, metadata, usage_count)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, 0)
         RETURNING id
         """
         
         cursor.execute(query, (name, description, tags, function_code, 
-                             json.dumps(input_schema), json.dumps(output_schema)))
+                             json.dumps(input_schema), json.dumps(output_schema),
+                             json.dumps({"header_signature": header_signature or ""})))
         function_id = cursor.fetchone()[0]
         
         conn.commit()
@@ -660,6 +636,10 @@ def update_excel_wizardry_function(function_id, function_code, description=None)
         cursor.close()
         conn.close()
         
+        # Cached and compiled copies of the old code must not be reused
+        get_function_catalogue().invalidate(function_id)
+        get_function_cache().invalidate(function_id)
+        
         return {"message": "Excel wizardry function updated successfully"}
         
     except Exception as e:
@@ -667,6 +647,53 @@ def update_excel_wizardry_function(function_id, function_code, description=None)
 
 
 
+def budget_documents_for_function_generation(documents):
+    """Fit document content into the token budget for function generation
+    
+    The generated function only needs to see the workbook structure. Workbook
+    content is replaced by a structure profile: headers, per-column type
+    profiles and a stratified sample of rows per sheet, so the prompt size no
+    longer grows with the row count. Other content is split into token-sized
+    chunks and only the leading chunk is sent, together with the chunk count
+    and total size.
+    """
+    if not isinstance(documents, list):
+        return documents
+    
+    token_limit = get_token_limit()
+    budgeted = []
+    for doc in documents:
+        content = doc.get('contentPreview') or ""
+        content_tokens = estimate_tokens(content)
+        
+        profile = profile_workbook(content)
+        if profile is not None:
+            profiled_doc = dict(doc)
+            profiled_doc['contentPreview'] = render_sample(profile)
+            profiled_doc['workbookProfile'] = summarize_profile(profile)
+            profiled_doc['contentTokensTotal'] = content_tokens
+            budgeted.append(profiled_doc)
+            rows = sum(sheet['row_count'] for sheet in profile['sheets'])
+            print(f"Document {doc.get('name', doc.get('id'))}: sending structure profile of {len(profile['sheets'])} sheets / {rows} rows "
+                  f"(~{estimate_tokens(profiled_doc['contentPreview']) + estimate_tokens(profiled_doc['workbookProfile'])} of ~{content_tokens} tokens)",
+                  file=sys.stderr, flush=True)
+            continue
+        
+        if content_tokens <= token_limit:
+            budgeted.append(doc)
+            continue
+        
+        chunks = split_text_by_tokens(content, token_limit)
+        budgeted_doc = dict(doc)
+        budgeted_doc['contentPreview'] = chunks[0]
+        budgeted_doc['contentChunksSent'] = 1
+        budgeted_doc['contentChunksTotal'] = len(chunks)
+        budgeted_doc['contentTokensTotal'] = content_tokens
+        budgeted.append(budgeted_doc)
+        print(f"Document {doc.get('name', doc.get('id'))}: sending 1 of {len(chunks)} chunks (~{content_tokens} tokens total)", file=sys.stderr, flush=True)
+    
+    return budgeted
+
 def generate_excel_function_with_gemini(target_fields_data, documents, identifier_references=None, extraction_number=0, max_retries=3):
     """Generate a new Excel function using Gemini AI with optional identifier references"""
     # Get API key from environment
@@ -674,13 +701,17 @@ def generate_excel_function_with_gemini(target_fields_data, documents, identifie
     if not api_key:
         return {"error": "GEMINI_API_KEY not found"}
     
-    # Initialize Gemini client
-    client = genai.Client(api_key=api_key)
-    
     # Prepare prompt data
-    target_fields_content = json.dumps(target_fields_data, indent=2)
-    documents_content = json.dumps(documents, indent=2)
-    identifier_references_content = json.dumps(identifier_references, indent=2) if identifier_references else "None - First extraction"
+    target_fields_content = encode_prompt_value('EXCEL_FUNCTION_GENERATOR', 'target_fields', target_fields_data)
+    documents_content = encode_prompt_value('EXCEL_FUNCTION_GENERATOR', 'source_documents', budget_documents_for_function_generation(documents))
+    identifier_references_content = encode_prompt_value('EXCEL_FUNCTION_GENERATOR', 'identifier_references', identifier_references) if identifier_references else "None - First extraction"
+    
+    prompt_sections = measure_prompt_sections({
+        "target_fields": target_fields_content,
+        "source_documents": documents_content,
+        "identifier_references": identifier_references_content
+    })
+    print(f"Function generation prompt size: {format_prompt_budget(prompt_sections)}", file=sys.stderr, flush=True)
     
     prompt = EXCEL_FUNCTION_GENERATOR.format(
         target_fields=target_fields_content,
@@ -696,45 +727,39 @@ def generate_excel_function_with_gemini(target_fields_data, documents, identifie
     print(prompt)
     print("=" * 80)
     
+    # The response must be a function object (ai.structuredOutput)
+    schema = excel_function_schema()
+    config = structured_config(schema)
+    structured = config is not None
+    
     # Retry logic for Gemini API calls
     for attempt in range(max_retries):
         try:
-            response = client.models.generate_content(
-                model="gemini-2.5-flash",
-                contents=prompt
-            )
+            response = generate_content("gemini-2.5-flash", prompt, config)
             
             response_text = response.text or ""
+            if response_truncated(response, config):
+                # Continue the cut-off function rather than regenerating it
+                response_text, _ = continue_text("gemini-2.5-flash", prompt, response_text, config, label="FUNCTION GENERATION")
             
             # Log the raw response for debugging
             print(f"Raw Gemini response: {response_text}")
             
-            # Try to clean and parse the JSON response
+            # Parse the JSON object, tolerating fences, surrounding text and malformed tails
             try:
-                # Remove any markdown formatting if present
-                cleaned_response = response_text.strip()
-                if cleaned_response.startswith('```json'):
-                    cleaned_response = cleaned_response.replace('```json', '').replace('```', '').strip()
-                elif cleaned_response.startswith('```'):
-                    cleaned_response = cleaned_response.replace('```', '').strip()
-                
-                function_data = json.loads(cleaned_response)
-                return function_data
+                parsed = parse_lenient(response_text, expect=dict)
+                if parsed.repaired:
+                    print(f"Repaired malformed function JSON: {parsed.describe()}")
             except json.JSONDecodeError as parse_error:
-                # Try to extract JSON from the response if it's embedded in text
-                try:
-                    # Look for JSON-like content between { and }
-                    start_idx = response_text.find('{')
-                    end_idx = response_text.rfind('}') + 1
-                    if start_idx >= 0 and end_idx > start_idx:
-                        json_part = response_text[start_idx:end_idx]
-                        function_data = json.loads(json_part)
-                        return function_data
-                except:
-                    pass
-                
+                record_parse_outcome("generate_excel_function_with_gemini", structured, False, attempt)
                 return {"error": f"Failed to parse Gemini response as JSON: {str(parse_error)}", "raw_response": response_text}
             
+            errors = validate_response(parsed.value, schema) if structured else []
+            record_parse_outcome("generate_excel_function_with_gemini", structured, not errors, attempt, len(errors))
+            if errors:
+                return {"error": f"Generated function does not match the response schema: {'; '.join(errors)}", "raw_response": response_text}
+            return parsed.value
+            
         except Exception as e:
             error_msg = str(e)
             print(f"Gemini function generation attempt {attempt + 1} failed: {error_msg}")
@@ -777,72 +802,31 @@ def convert_code_result_to_field_validations(user_result, target_field, session_
             "error": f"Failed to convert Code result to field_validation format: {str(e)}"
         }
 
-def execute_code_tool_function(function_code, extracted_content, target_fields_data, identifier_references=None, session_id=None):
-    """Execute a CODE type tool and convert results to field_validations format"""
+def _function_args(target_fields_data, identifier_references):
+    """Arguments after the content: identifier references only when there are any"""
+    return [target_fields_data] if identifier_references is None else [target_fields_data, identifier_references]
+
+def execute_code_tool_function(function_code, extracted_content, target_fields_data, identifier_references=None, session_id=None, function_id=None):
+    """Execute a CODE type tool and convert results to field_validations format
+
+    Runs in a sandbox worker unless extraction.sandbox disables the restricted environment (utils.sandbox_pool).
+    The function gets as many of (content, fields, identifier references) as it declares.
+    """
     try:
-        # Create a safe execution environment with necessary imports
-        import re
-        exec_globals = {
-            'json': json,
-            're': re,
-            '__builtins__': {
-                'len': len,
-                'str': str,
-                'int': int,
-                'float': float,
-                'list': list,
-                'dict': dict,
-                'range': range,
-                'enumerate': enumerate,
-                'zip': zip,
-                'print': print,
-                '__import__': __import__,  # Allow imports
-                'abs': abs,
-                'any': any,
-                'all': all,
-                'bool': bool,
-                'max': max,
-                'min': min,
-                'sum': sum,
-                'sorted': sorted,
-                'reversed': reversed
-            }
-        }
-        
-        # Execute the function code
-        exec(function_code, exec_globals)
-        
-        # Get the function from the execution environment (assumes user function is named 'main' or 'extract_data')
-        main_function = None
-        for func_name in ['main', 'extract_data', 'process_data']:
-            if func_name in exec_globals:
-                main_function = exec_globals[func_name]
-                break
-        
-        if not main_function:
+        # User function is named 'main', 'extract_data' or 'process_data'
+        try:
+            user_results = run_stored_function('restricted', function_id, function_code,
+                                               ('main', 'extract_data', 'process_data'), extracted_content,
+                                               _function_args(target_fields_data, identifier_references))
+        except EntryPointNotFound:
             return {"error": "No main function found. Please define a function named 'main', 'extract_data', or 'process_data'"}
-        
-        # Execute function with appropriate parameters based on signature
-        import inspect
-        func_signature = inspect.signature(main_function)
-        param_count = len(func_signature.parameters)
-        
-        if param_count >= 3 and identifier_references is not None:
-            # Function signature with identifier_references
-            user_results = main_function(extracted_content, target_fields_data, identifier_references)
-        elif param_count >= 2:
-            # Function signature without identifier_references
-            user_results = main_function(extracted_content, target_fields_data)
-        else:
-            # Single parameter function
-            user_results = main_function(extracted_content)
-        
+
         print(f"🔧 CODE tool executed: returned result")
-        
+
         # Convert user results to field_validations format
         field_validations = []
         target_field = target_fields_data[0] if target_fields_data else {}
-        
+
         if isinstance(user_results, list):
             # Multiple results - create field_validation for each
             for i, result in enumerate(user_results):
@@ -854,68 +838,29 @@ def execute_code_tool_function(function_code, extracted_content, target_fields_d
             validation = convert_code_result_to_field_validations(user_results, target_field, session_id, 0)
             if "error" not in validation:
                 field_validations.append(validation)
-        
+
         return {"results": field_validations}
-        
+
     except Exception as e:
         return {"error": f"Failed to execute CODE tool function: {str(e)}"}
 
-def execute_excel_wizardry_function(function_code, extracted_content, target_fields_data, identifier_references=None):
-    """Execute an Excel wizardry function with the provided data and optional identifier references"""
+def execute_excel_wizardry_function(function_code, extracted_content, target_fields_data, identifier_references=None, function_id=None):
+    """Execute an Excel wizardry function with the provided data and optional identifier references
+
+    Runs in a sandbox worker unless extraction.sandbox disables the restricted environment (utils.sandbox_pool).
+    Legacy functions without an identifier_references parameter get (content, fields).
+    """
     try:
-        # Create a safe execution environment with necessary imports
-        import re
-        exec_globals = {
-            'json': json,
-            're': re,
-            '__builtins__': {
-                'len': len,
-                'str': str,
-                'int': int,
-                'float': float,
-                'list': list,
-                'dict': dict,
-                'range': range,
-                'enumerate': enumerate,
-                'zip': zip,
-                'print': print,
-                '__import__': __import__,  # Allow imports
-                'abs': abs,
-                'any': any,
-                'all': all,
-                'bool': bool,
-                'max': max,
-                'min': min,
-                'sum': sum,
-                'sorted': sorted,
-                'reversed': reversed
-            }
-        }
-        
-        # Execute the function code
-        exec(function_code, exec_globals)
-        
-        # Get the function from the execution environment
-        if 'extract_excel_data' not in exec_globals:
+        try:
+            results = run_stored_function('restricted', function_id, function_code, ('extract_excel_data',),
+                                          extracted_content, _function_args(target_fields_data, identifier_references))
+        except EntryPointNotFound:
             return {"error": "Function 'extract_excel_data' not found in the generated code"}
-        
-        extract_function = exec_globals['extract_excel_data']
-        
-        # Execute function with appropriate parameters
-        import inspect
-        func_signature = inspect.signature(extract_function)
-        
-        if len(func_signature.parameters) >= 3 and identifier_references is not None:
-            # New function signature with identifier_references
-            results = extract_function(extracted_content, target_fields_data, identifier_references)
-        else:
-            # Legacy function signature without identifier_references
-            results = extract_function(extracted_content, target_fields_data)
-        
+
         print(f"🔧 Function executed: returned {len(results) if results else 0} results")
-        
+
         return {"results": results}
-        
+
     except Exception as e:
         return {"error": f"Failed to execute Excel wizardry function: {str(e)}"}
 
@@ -926,9 +871,6 @@ def update_document_format_analysis_with_functions(documents, target_fields_data
     if not api_key:
         return "ERROR: GEMINI_API_KEY not found"
     
-    # Initialize Gemini client
-    client = genai.Client(api_key=api_key)
-    
     # Handle document content for analysis
     if documents == "NO DOCUMENTS SELECTED":
         documents_content = "NO DOCUMENTS SELECTED"
@@ -943,7 +885,7 @@ def update_document_format_analysis_with_functions(documents, target_fields_data
                 "size": len(doc.get("contentPreview", "")) if doc.get("contentPreview") else 0
             }
             documents_for_analysis.append(doc_summary)
-        documents_content = json.dumps(documents_for_analysis, indent=2)
+        documents_content = encode_prompt_value('DOCUMENT_FORMAT_ANALYSIS', 'documents', documents_for_analysis)
     
     # Filter existing functions to only include metadata, not full function code
     functions_for_analysis = []
@@ -957,11 +899,11 @@ def update_document_format_analysis_with_functions(documents, target_fields_data
         }
         functions_for_analysis.append(func_summary)
     
-    target_fields_content = json.dumps(target_fields_data, indent=2) if target_fields_data else "No target fields provided"
-    existing_functions_content = json.dumps(functions_for_analysis, indent=2) if functions_for_analysis else "No existing functions"
+    target_fields_content = encode_prompt_value('DOCUMENT_FORMAT_ANALYSIS', 'target_fields', target_fields_data) if target_fields_data else "No target fields provided"
+    existing_functions_content = encode_prompt_value('DOCUMENT_FORMAT_ANALYSIS', 'existing_functions', functions_for_analysis) if functions_for_analysis else "No existing functions"
     
     # Format identifier references
-    identifier_references_content = json.dumps(identifier_references, indent=2) if identifier_references else "None - First extraction"
+    identifier_references_content = encode_prompt_value('DOCUMENT_FORMAT_ANALYSIS', 'identifier_references', identifier_references) if identifier_references else "None - First extraction"
     
     prompt = DOCUMENT_FORMAT_ANALYSIS.format(
         documents=documents_content,
@@ -982,648 +924,340 @@ def update_document_format_analysis_with_functions(documents, target_fields_data
     print(f"   Model: {model_to_use}")
     
     try:
-        response = client.models.generate_content(
-            model=model_to_use,
-            contents=prompt
-        )
+        response = generate_content(model_to_use, prompt)
         
         return response.text or "ERROR: Empty response from Gemini"
         
     except Exception as e:
         return f"ERROR: Enhanced Gemini analysis failed: {str(e)}"
 
-def run_wizardry_with_gemini_analysis(data=None, extraction_number=0, llm_model=None):
-    """Main function that gets documents from DB and analyzes them with Gemini"""
-    
-    # Log extraction run information
-    print("\n" + "=" * 80)
-    print(f"EXTRACTION RUN {extraction_number + 1}")
+def result_reference_table(identifier_results, target, input_table=None, key_columns=()):
+    """Reference table for one field's validation results, joined to the input records by key (see key_results)
+
+    Identifier fields may add records; other fields only fill in existing ones.
+    """
+    table, report = key_results(identifier_results, input_table, key_columns, extend=bool(target.get('is_identifier')))
+    if report["unmatched"] or report["duplicates"] or report["missing"]:
+        print(f"🔑 RESULT MERGE: {report['matched']} matched, {report['unmatched']} unmatched, "
+              f"{report['duplicates']} duplicate, {report['missing']} input records without a value", file=sys.stderr, flush=True)
+    return table
+
+
+def _spreadsheet_content(documents):
+    """Extracted text of the first spreadsheet document, or "" """
+    if documents == "NO DOCUMENTS SELECTED":
+        return ""
+    for doc in documents or []:
+        if doc.get('type', '').lower() in SPREADSHEET_MIME_TYPES:
+            return doc.get('contentPreview', '')
+    return ""
+
+
+def _field_table_from_results(processed_results, label, target, input_table, shared):
+    """Log a field's cleaned results and turn them into a reference table"""
+    if 'error' in processed_results:
+        raise RuntimeError(f"Error processing {label} results: {processed_results['error']}")
+    record_count = len(processed_results['cleaned_results']) if isinstance(processed_results['cleaned_results'], list) else 0
+    print(f"\n✅ EXTRACTION RESULTS: {record_count} records extracted using {label}")
+    print(f"\n📋 COMPLETE VALIDATION RESULTS JSON:")
     print("=" * 80)
-    
-    if data and isinstance(data, dict):
-        document_ids = data.get('document_ids', [])
-        session_id = data.get('session_id')
-        target_fields = data.get('target_fields', [])
-        
-        # Variable to store identifier references from first extraction
-        first_run_identifier_references = []
-        
-        # Log key parameters concisely
-        print(f"Session: {session_id[:8]}..." if session_id else "No session")
-        print(f"Documents: {len(document_ids)} selected")
-        print(f"Target fields: {len(target_fields)} total")
-        
-        # Log identifier references if they exist
-        incoming_identifier_references = data.get('identifier_references', [])
-        if incoming_identifier_references:
-            print(f"Identifier references: {len(incoming_identifier_references)} records from previous extraction")
-        else:
-            print("Identifier references: None (first extraction)")
-        
-        # Log which property is being extracted
-        if target_fields and extraction_number < len(target_fields):
-            current_property = target_fields[extraction_number]
-            property_name = current_property.get('propertyName') or current_property.get('property_name', 'Unknown Property')
-            print(f"Current target: {property_name} (field {extraction_number + 1}/{len(target_fields)})")
-        print("=" * 80)
-        
-        if not session_id:
-            print(json.dumps({"error": "Missing session_id"}))
-            return
-        
-        # Handle document retrieval - if no documents selected, use placeholder
-        if not document_ids:
-            print("No documents selected - working with identifier references only")
-            documents = "NO DOCUMENTS SELECTED"
-        else:
-            # Get document properties from database
-            documents = get_document_properties_from_db(document_ids, session_id)
-            
-            if isinstance(documents, dict) and "error" in documents:
-                print(json.dumps(documents))
-                return
-        
-        # Extract complete field data from the target fields (no database query needed)
-        target_fields_data = []
-        if target_fields:
-            for field in target_fields:
-                field_data = {
-                    "field_id": field.get('id', ''),
-                    "name": field.get('propertyName') or field.get('fieldName', ''),
-                    "description": field.get('description', ''),
-                    "property_type": field.get('propertyType') or field.get('fieldType', ''),
-                    "auto_verification_confidence": field.get('autoVerificationConfidence', 80),
-                    "choice_options": field.get('choiceOptions', []),
-                    "is_identifier": field.get('isIdentifier', False),
-                    "order_index": field.get('orderIndex', 0),
-                    "collection_id": field.get('collectionId', ''),
-                    "type": "collection_property" if field.get('collectionId') else "schema_field",
-                    "extraction_type": field.get('extractionType', ''),
-                    "function_id": field.get('functionID', '') or field.get('functionId', '')
-                }
-                target_fields_data.append(field_data)
-        
-        # Filter targets based on extraction number - only process the current target property
-        if extraction_number < len(target_fields_data):
-            current_target = target_fields_data[extraction_number]
-            identifier_targets = [current_target]
-        else:
-            # If extraction_number exceeds available fields, use identifier fields as fallback
-            identifier_targets = [field for field in target_fields_data if field.get('is_identifier', False)]
-        
-        # CHECK FOR FUNCTION EXTRACTION TYPE - Bypass AI completely
-        if identifier_targets and identifier_targets[0].get('extraction_type') == 'FUNCTION':
-            function_id = identifier_targets[0].get('function_id')
-            if function_id:
-                print(f"\n🔧 FUNCTION EXTRACTION DETECTED!")
-                print(f"   Extraction Type: FUNCTION")
-                print(f"   Function ID: {function_id}")
-                print(f"   Extraction Number: {extraction_number}")
-                print(f"   Session ID: {session_id}")
-                print(f"   Bypassing AI analysis and going directly to function execution")
-                print("=" * 80)
-                
-                # Get function code from database
-                function_details = get_excel_wizardry_function_by_id(function_id)
-                if isinstance(function_details, dict) and "error" not in function_details:
-                    function_code = function_details.get('function_code', '')
-                    function_type = function_details.get('function_type', 'SCRIPT')
-                    print(f"✅ Function retrieved: {function_details.get('name', 'Unnamed Function')} (Type: {function_type})")
-                    
-                    # Get document content for function execution
-                    if documents != "NO DOCUMENTS SELECTED" and documents:
-                        for doc in documents:
-                            if doc.get('type', '').lower() in ['application/vnd.ms-excel', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'text/csv']:
-                                extracted_content = doc.get('contentPreview', '')
-                                
-                                # Load merged identifier references from database if extraction number > 0
-                                if extraction_number > 0:
-                                    print(f"🔄 Loading merged identifier references from database for extraction {extraction_number}")
-                                    function_identifier_references = load_merged_identifier_references_from_db(session_id, extraction_number - 1)
-                                else:
-                                    function_identifier_references = incoming_identifier_references
-                                
-                                # Add debugging for identifier references
-                                print(f"🔍 DEBUG: Function identifier references: {len(function_identifier_references) if function_identifier_references else 0}")
-                                if function_identifier_references and len(function_identifier_references) > 0:
-                                    print(f"🔍 DEBUG: First reference: {function_identifier_references[0]}")
-                                    print(f"🔍 DEBUG: Last reference: {function_identifier_references[-1]}")
-                                
-                                # Execute based on function type
-                                if function_type == 'CODE':
-                                    execution_result = execute_code_tool_function(
-                                        function_code, 
-                                        extracted_content, 
-                                        identifier_targets, 
-                                        function_identifier_references,
-                                        session_id
-                                    )
-                                else:
-                                    # Default to SCRIPT execution for backward compatibility
-                                    execution_result = execute_excel_wizardry_function(
-                                        function_code, 
-                                        extracted_content, 
-                                        identifier_targets, 
-                                        function_identifier_references
-                                    )
-                                
-                                if isinstance(execution_result, dict) and "error" not in execution_result:
-                                    print(f"✅ Function execution successful!")
-                                    # Format results in the expected format
-                                    processed_results = {
-                                        'identifier_results': execution_result.get('results', []),
-                                        'error': None
-                                    }
-                                    
-                                    # Continue with standard result processing
-                                    print(json.dumps(processed_results['identifier_results'], indent=2))
-                                    
-                                    # Create identifier references for next extraction
-                                    identifier_references = []
-                                    for result in processed_results['identifier_results']:
-                                        if 'extracted_value' in result and 'field_name' in result:
-                                            field_name_parts = result['field_name'].split('.')
-                                            field_name_only = field_name_parts[-1] if len(field_name_parts) > 1 else result['field_name']
-                                            identifier_references.append({field_name_only: result['extracted_value']})
-                                    
-                                    print(f"\n🔗 IDENTIFIER REFERENCES ARRAY:")
-                                    print("=" * 80)
-                                    print(json.dumps(identifier_references, indent=2))
-                                    print("=" * 80)
-                                    print(f"Created {len(identifier_references)} new references for next extraction")
-                                    
-                                    # Save identifier references to database
-                                    save_identifier_references_to_db(session_id, extraction_number, identifier_references)
-                                    
-                                    # Handle auto-rerun logic
-                                    next_extraction_number = extraction_number + 1
-                                    total_target_fields = len(target_fields) if target_fields else 0
-                                    
-                                    if next_extraction_number < total_target_fields:
-                                        print("\n" + "=" * 80)
-                                        print(f"AUTO-RERUN: Starting extraction run {next_extraction_number + 1} of {total_target_fields}")
-                                        print("=" * 80)
-                                        print(f"Next extraction number: {next_extraction_number}")
-                                        print(f"Target field: {target_fields[next_extraction_number].get('propertyName', 'Unknown') if target_fields else 'None'}")
-                                        print(f"Progress: {next_extraction_number}/{total_target_fields} fields processed", file=sys.stderr, flush=True)
-                                        
-                                        # Load merged identifier references from database for next run
-                                        merged_references = load_merged_identifier_references_from_db(session_id, extraction_number)
-                                        
-                                        rerun_data = {
-                                            "document_ids": document_ids,
-                                            "session_id": session_id,
-                                            "target_fields": target_fields,
-                                            "identifier_references": merged_references
-                                        }
-                                        
-                                        run_wizardry_with_gemini_analysis(rerun_data, next_extraction_number)
-                                    else:
-                                        print("\n" + "=" * 80)
-                                        print("EXTRACTION COMPLETE")
-                                        print("=" * 80)
-                                        print(f"All {total_target_fields} target fields have been processed")
-                                        print("Extraction sequence finished successfully")
-                                        
-                                        # Output final merged identifier references
-                                        print("\n🔗 FINAL MERGED IDENTIFIER REFERENCES:")
-                                        print("=" * 80)
-                                        final_merged_refs = load_merged_identifier_references_from_db(session_id, total_target_fields - 1)
-                                        print(json.dumps(final_merged_refs, indent=2))
-                                        print("=" * 80)
-                                        print(f"Final result: {len(final_merged_refs)} merged records with all field combinations")
-                                        print("=" * 80)
-                                    
-                                    return  # Exit function after successful function execution
-                                else:
-                                    print(f"❌ Function execution failed: {execution_result.get('error', 'Unknown error')}")
-                else:
-                    print(f"❌ Could not retrieve function: {function_details.get('error', 'Unknown error') if isinstance(function_details, dict) else 'Invalid response'}")
-            else:
-                print(f"❌ FUNCTION extraction type detected but no function ID provided")
-        
-        # Continue with normal Gemini analysis if not a FUNCTION extraction type
-        
-        # Get all collection properties for progress tracking
-        collection_ids = list(set([field.get('collection_id') for field in target_fields_data if field.get('collection_id')]))
-        all_collection_properties = []
-        if collection_ids:
-            all_properties_result = get_all_collection_properties(collection_ids)
-            if isinstance(all_properties_result, list):
-                all_collection_properties = all_properties_result
-        
-        # Print document and target summary
-        print("\n📄 DOCUMENTS:")
-        if documents == "NO DOCUMENTS SELECTED":
-            print("  Working with identifier references only")
-        else:
-            for doc in documents:
-                doc_name = doc.get('name', 'Unknown')[:50]
-                doc_type = doc.get('type', 'unknown')
-                print(f"  - {doc_name}... ({doc_type})")
-        
-        print(f"\n🎯 CURRENT TARGET: {identifier_targets[0].get('name', 'Unknown') if identifier_targets else 'None'}")
-        print(f"   Type: {identifier_targets[0].get('property_type', 'Unknown') if identifier_targets else 'Unknown'}")
-        print(f"   Description: {identifier_targets[0].get('description', 'No description')[:100] if identifier_targets else 'None'}...")
-        
-        # Get existing Excel wizardry functions
-        existing_functions = get_excel_wizardry_functions()
-        if isinstance(existing_functions, dict) and "error" in existing_functions:
-            print(f"Warning: Could not retrieve Excel functions: {existing_functions['error']}")
-            existing_functions = []
-        
-        # Print existing Excel functions summary
-        print(f"\n⚡ EXCEL FUNCTIONS: {len(existing_functions)} available")
-        for func in existing_functions[:3]:  # Show top 3 functions
-            print(f"   - {func.get('name', 'Unnamed')} (used {func.get('usage_count', 0)} times)")
-        if len(existing_functions) > 3:
-            print(f"   ... and {len(existing_functions) - 3} more functions")
-        
-        # Load merged identifier references from database if extraction number > 0
-        if extraction_number > 0:
-            print(f"🔄 Loading identifier references from database for extraction {extraction_number}")
-            identifier_references = load_merged_identifier_references_from_db(session_id, extraction_number - 1)
-        else:
-            # Use the incoming identifier references for the first extraction
-            identifier_references = incoming_identifier_references
-        
-        # Analyze document formats with Gemini using enhanced analysis that includes existing functions and identifier references
-        gemini_response = update_document_format_analysis_with_functions(documents, identifier_targets, existing_functions, identifier_references, extraction_number, llm_model)
-        
-        # Print Gemini analysis summary
-        print(f"\n🤖 GEMINI DECISION:")
-        if "Excel Wizardry Function" in gemini_response:
-            print("   Method: Excel Wizardry Function")
-        elif "AI Extraction" in gemini_response:
-            print("   Method: AI Extraction")
-        else:
-            print("   Method: No specific method recommended")
-        
-        # Show truncated response for debugging
+    print(json.dumps(processed_results['identifier_results'], indent=2))
+    print("=" * 80)
+    return result_reference_table(processed_results['identifier_results'], target, input_table, shared['identifier_columns'])
+
+
+def _run_stored_function(target, extraction_number, input_table, shared):
+    """Run the field's configured FUNCTION tool; None if it could not be run"""
+    function_id = target.get('function_id')
+    if not function_id:
+        print(f"❌ FUNCTION extraction type detected but no function ID provided")
+        return None
+
+    print(f"\n🔧 FUNCTION EXTRACTION DETECTED!")
+    print(f"   Function ID: {function_id}")
+    print(f"   Extraction Number: {extraction_number}")
+    print(f"   Bypassing AI analysis and going directly to function execution")
+
+    function_details = get_excel_wizardry_function_by_id(function_id)
+    if not isinstance(function_details, dict) or "error" in function_details:
+        print(f"❌ Could not retrieve function: {function_details.get('error', 'Unknown error') if isinstance(function_details, dict) else 'Invalid response'}")
+        return None
+    function_code = function_details.get('function_code', '')
+    function_type = function_details.get('function_type', 'SCRIPT')
+    print(f"✅ Function retrieved: {function_details.get('name', 'Unnamed Function')} (Type: {function_type})")
+
+    extracted_content = _spreadsheet_content(shared['documents'])
+    if not extracted_content:
+        return None
+
+    # Later fields see the merged references in the database format ("Field[i]")
+    references = input_table.to_references(indexed=extraction_number > 0)
+    print(f"🔍 DEBUG: Function identifier references: {len(references)}")
+    if function_type == 'CODE':
+        execution_result = execute_code_tool_function(function_code, extracted_content, [target], references, shared['session_id'], function_id)
+    else:
+        # Default to SCRIPT execution for backward compatibility
+        execution_result = execute_excel_wizardry_function(function_code, extracted_content, [target], references, function_id)
+
+    if not isinstance(execution_result, dict) or "error" in execution_result:
+        print(f"❌ Function execution failed: {execution_result.get('error', 'Unknown error')}")
+        return None
+    print(f"✅ Function execution successful!")
+    print(json.dumps(execution_result.get('results', []), indent=2))
+    return result_reference_table(execution_result.get('results', []), target, input_table, shared['identifier_columns'])
+
+
+def _run_excel_function(target, extraction_number, input_table, shared, gemini_response):
+    """Run the existing Excel function Gemini picked, or generate and save a new one"""
+    documents = shared['documents']
+    references = input_table.to_references(indexed=extraction_number > 0)
+    function_instruction = gemini_response.split("|")[-1].strip() if "|" in gemini_response else "CREATE_NEW"
+    print(f"Function instruction: {function_instruction}")
+    extracted_content = _spreadsheet_content(documents)
+
+    if function_instruction not in ("CREATE_NEW", ""):
+        existing_function = next((func for func in list(shared['functions']) if func['id'] == function_instruction), None)
+        if existing_function:
+            print(f"Using existing Excel function: {existing_function['name']}")
+            # Listed functions carry metadata only; the code is fetched by id
+            function_code = existing_function.get('function_code') or get_function_catalogue().get_code(function_instruction)
+            function_result = execute_excel_wizardry_function(function_code, extracted_content, [target], references,
+                                                              function_instruction)
+            if 'error' in function_result:
+                raise RuntimeError(f"Error executing function: {function_result['error']}")
+            increment_result = increment_function_usage(function_instruction)
+            if 'error' in increment_result:
+                print(f"Warning: Could not increment usage count: {increment_result['error']}")
+            processed_results = clean_json_and_extract_identifiers(function_result['results'], [target])
+            return _field_table_from_results(processed_results, "existing function", target, input_table, shared)
+        print(f"Function with ID {function_instruction} not found, creating new function instead")
+
+    print("\n🔧 CREATING NEW FUNCTION:")
+    function_data = generate_excel_function_with_gemini([target], documents, references, extraction_number)
+    if 'error' in function_data:
+        raise RuntimeError(f"Error generating function: {function_data['error']}")
+    print(f"   Generated: {function_data.get('function_name', 'Unnamed Function')}")
+
+    header_signature = workbook_header_signature(documents)
+    create_result = create_excel_wizardry_function(
+        function_data.get('function_name', 'Auto-generated Excel Function'),
+        function_data.get('description', 'Auto-generated function for Excel data extraction'),
+        function_data.get('tags', []),
+        function_data.get('function_code', ''),
+        header_signature
+    )
+    if 'error' in create_result:
+        raise RuntimeError(f"Error saving function: {create_result['error']}")
+    print(f"   Saved with ID: {create_result['id'][:8]}...")
+    # Fields that start later in this run can pick the new function
+    shared['functions'].append(dict(function_data, id=create_result['id'], name=function_data.get('function_name', ''),
+                                    header_signature=header_signature))
+
+    function_result = execute_excel_wizardry_function(function_data.get('function_code', ''), extracted_content, [target], references,
+                                                      create_result['id'])
+    if 'error' in function_result:
+        raise RuntimeError(f"Error executing new function: {function_result['error']}")
+    processed_results = clean_json_and_extract_identifiers(function_result['results'], [target])
+    return _field_table_from_results(processed_results, "new function", target, input_table, shared)
+
+
+def extract_wizardry_field(target, extraction_number, input_table, shared, llm_model=None):
+    """
+    Extract one target field against the identifier rows it depends on
+
+    Parameters:
+        target (dict): Target field data
+        extraction_number (int): Position of the field in the target list
+        input_table (IdentifierReferenceTable): References from the fields it depends on
+        shared (dict): session_id, documents, functions and collection properties loaded once per run
+        llm_model (str): Optional model override for the format analysis
+
+    Returns:
+        IdentifierReferenceTable: This field's values (the run's reference store saves them)
+
+    Raises:
+        RuntimeError: No extraction method worked for the field
+    """
+    session_id = shared['session_id']
+    documents = shared['documents']
+    set_usage_tags(field=target.get('name'))
+
+    print(f"\n🎯 CURRENT TARGET: {target.get('name', 'Unknown')} (field {extraction_number + 1})")
+    print(f"   Type: {target.get('property_type', 'Unknown')}")
+    print(f"   Description: {(target.get('description') or 'No description')[:100]}...")
+
+    field_table = None
+    # FUNCTION extraction type bypasses the AI analysis
+    if target.get('extraction_type') == 'FUNCTION':
+        field_table = _run_stored_function(target, extraction_number, input_table, shared)
+
+    if field_table is None:
+        references = input_table.to_references(indexed=extraction_number > 0)
+        functions = list(shared['functions'])
+        # Only the catalogue functions most similar to this field and workbook go to the analysis
+        candidates = select_candidate_functions(functions, documents, [target])
+        # Local rules (over the whole catalogue) and cached decisions save the format analysis call for most fields
+        gemini_response = get_tool_routing_cache().route(
+            documents, [target], functions, references, llm_model or "gemini-2.0-flash",
+            lambda: update_document_format_analysis_with_functions(documents, [target], candidates, references,
+                                                                   extraction_number, llm_model),
+            candidates=candidates)
         response_preview = gemini_response[:200].replace('\n', ' ')
-        print(f"   Analysis: {response_preview}...")
-        print("=" * 80)
-        
-        # Check if Gemini recommends Excel Wizardry Function
+        print(f"\n🤖 GEMINI DECISION: {response_preview}...")
+
         if "Excel Wizardry Function" in gemini_response:
-            print(f"\nGemini decided to use Excel Wizardry Function")
-            
-            # Parse the response to get function ID or CREATE_NEW
-            if "|" in gemini_response:
-                function_instruction = gemini_response.split("|")[-1].strip()
-            else:
-                function_instruction = "CREATE_NEW"
-            
-            print(f"Function instruction: {function_instruction}")
-            
-            # Handle document processing based on whether documents are selected
-            if documents == "NO DOCUMENTS SELECTED":
-                print("Working with identifier references only - no documents to process")
-                document_ids = []
-                extracted_content = ""
-            else:
-                # Get document IDs for processing (no need to read full content in tool selector)
-                document_ids = [doc['id'] for doc in documents]
-                extracted_content = ""
-                
-                # Only get content when actually executing functions, not for tool selection
-                # For now, just get a sample to determine document structure
-                for doc in documents:
-                    if doc.get('type', '').lower() in ['application/vnd.ms-excel', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'text/csv']:
-                        # Get content from database only when needed for function execution
-                        doc_content = get_document_properties_from_db([doc['id']], session_id)
-                        if doc_content and not isinstance(doc_content, dict):
-                            for doc_data in doc_content:
-                                if 'contentPreview' in doc_data:
-                                    extracted_content = doc_data['contentPreview']
-                                    break
-                        break
-            
-            if function_instruction != "CREATE_NEW" and function_instruction != "":
-                # Use existing function
-                print(f"Using existing Excel function with ID: {function_instruction}")
-                
-                # Find the function by ID
-                existing_function = None
-                for func in existing_functions:
-                    if func['id'] == function_instruction:
-                        existing_function = func
-                        break
-                
-                if existing_function:
-                    print(f"Found function: {existing_function['name']}")
-                    
-                    # Execute the existing function with identifier references
-                    function_result = execute_excel_wizardry_function(
-                        existing_function['function_code'],
-                        extracted_content,
-                        identifier_targets,
-                        identifier_references
-                    )
-                    
-                    if 'error' not in function_result:
-                        # Increment usage count
-                        increment_result = increment_function_usage(function_instruction)
-                        if 'error' in increment_result:
-                            print(f"Warning: Could not increment usage count: {increment_result['error']}")
-                        
-                        # Process results
-                        results = function_result['results']
-                        processed_results = clean_json_and_extract_identifiers(results, identifier_targets)
-                        
-                        if 'error' not in processed_results:
-                            record_count = len(processed_results['cleaned_results']) if isinstance(processed_results['cleaned_results'], list) else 0
-                            print(f"\n✅ EXTRACTION RESULTS: {record_count} records extracted using existing function")
-                            
-                            # Show complete validation results JSON
-                            print(f"\n📋 COMPLETE VALIDATION RESULTS JSON:")
-                            print("=" * 80)
-                            print(json.dumps(processed_results['identifier_results'], indent=2))
-                            print("=" * 80)
-                            
-                            # Create or update identifier references
-                            if extraction_number == 0:
-                                # First extraction - create new identifier references
-                                new_identifier_references = []
-                                for result in processed_results['identifier_results']:
-                                    if 'extracted_value' in result and 'field_name' in result:
-                                        field_name_parts = result['field_name'].split('.')
-                                        field_name_only = field_name_parts[-1] if len(field_name_parts) > 1 else result['field_name']
-                                        new_identifier_references.append({field_name_only: result['extracted_value']})
-                                
-                                # Store for auto-rerun
-                                first_run_identifier_references = new_identifier_references
-                                identifier_references = new_identifier_references
-                                print(f"\n🔗 IDENTIFIER REFERENCES ARRAY:")
-                                print("=" * 80)
-                                print(json.dumps(identifier_references, indent=2))
-                                print("=" * 80)
-                                print(f"Created {len(identifier_references)} new references for next extraction")
-                            else:
-                                # Subsequent extractions - append to existing identifier references by index
-                                merged_identifier_references = []
-                                existing_identifier_refs = identifier_references or []
-                                
-                                for i, result in enumerate(processed_results['identifier_results']):
-                                    if 'extracted_value' in result and 'field_name' in result:
-                                        field_name_parts = result['field_name'].split('.')
-                                        field_name_only = field_name_parts[-1] if len(field_name_parts) > 1 else result['field_name']
-                                        
-                                        # Get existing reference at this index or create new one
-                                        if i < len(existing_identifier_refs):
-                                            # Append to existing reference at same index
-                                            updated_ref = existing_identifier_refs[i].copy()
-                                            updated_ref[field_name_only] = result['extracted_value']
-                                            merged_identifier_references.append(updated_ref)
-                                        else:
-                                            # Create new reference if we have more results than existing references
-                                            merged_identifier_references.append({field_name_only: result['extracted_value']})
-                                
-                                identifier_references = merged_identifier_references
-                                print(f"\n🔗 IDENTIFIER REFERENCES ARRAY:")
-                                print("=" * 80)
-                                print(json.dumps(identifier_references, indent=2))
-                                print("=" * 80)
-                                print(f"Merged {len(identifier_references)} references with new field data")
-                            
-                            # Log extraction progress
-                            if all_collection_properties:
-                                extracted_field_names = set()
-                                for result in processed_results.get('identifier_results', []):
-                                    field_name = result.get('field_name', '')
-                                    if '.' in field_name:
-                                        property_name = field_name.split('.')[-1]
-                                        extracted_field_names.add(property_name)
-                                    else:
-                                        extracted_field_names.add(field_name)
-                                
-                                total_fields = len(all_collection_properties)
-                                extracted_count = sum(1 for prop in all_collection_properties if prop.get('property_name') in extracted_field_names)
-                                remaining_count = total_fields - extracted_count
-                                print(f"\n📊 PROGRESS: {extracted_count}/{total_fields} fields extracted, {remaining_count} remaining")
-                        else:
-                            print(f"Error processing function results: {processed_results['error']}")
-                    else:
-                        print(f"Error executing function: {function_result['error']}")
-                else:
-                    print(f"Function with ID {function_instruction} not found, creating new function instead")
-                    function_instruction = "CREATE_NEW"
-            
-            if function_instruction == "CREATE_NEW":
-                # Generate new function
-                print("\n🔧 CREATING NEW FUNCTION:")
-                
-                # Generate function with Gemini, including identifier references and extraction number
-                function_data = generate_excel_function_with_gemini(identifier_targets, documents, identifier_references, extraction_number)
-                
-                if 'error' not in function_data:
-                    print(f"   Generated: {function_data.get('function_name', 'Unnamed Function')}")
-                    
-                    # Save function to database
-                    create_result = create_excel_wizardry_function(
-                        function_data.get('function_name', 'Auto-generated Excel Function'),
-                        function_data.get('description', 'Auto-generated function for Excel data extraction'),
-                        function_data.get('tags', []),
-                        function_data.get('function_code', '')
-                    )
-                    
-                    if 'error' not in create_result:
-                        print(f"   Saved with ID: {create_result['id'][:8]}...")
-                        
-                        # Execute the new function with identifier references
-                        function_result = execute_excel_wizardry_function(
-                            function_data.get('function_code', ''),
-                            extracted_content,
-                            identifier_targets,
-                            identifier_references
-                        )
-                        
-                        if 'error' not in function_result:
-                            # Process results
-                            results = function_result['results']
-                            processed_results = clean_json_and_extract_identifiers(results, identifier_targets)
-                            
-                            if 'error' not in processed_results:
-                                record_count = len(processed_results['cleaned_results']) if isinstance(processed_results['cleaned_results'], list) else 0
-                                print(f"\n✅ EXTRACTION RESULTS: {record_count} records extracted using new function")
-                                
-                                # Show complete validation results JSON
-                                print(f"\n📋 COMPLETE VALIDATION RESULTS JSON:")
-                                print("=" * 80)
-                                print(json.dumps(processed_results['identifier_results'], indent=2))
-                                print("=" * 80)
-                                
-                                # Create or update identifier references
-                                if extraction_number == 0:
-                                    # First extraction - create new identifier references
-                                    new_identifier_references = []
-                                    for result in processed_results['identifier_results']:
-                                        if 'extracted_value' in result and 'field_name' in result:
-                                            field_name_parts = result['field_name'].split('.')
-                                            field_name_only = field_name_parts[-1] if len(field_name_parts) > 1 else result['field_name']
-                                            new_identifier_references.append({field_name_only: result['extracted_value']})
-                                    
-                                    # Store for auto-rerun
-                                    first_run_identifier_references = new_identifier_references
-                                    identifier_references = new_identifier_references
-                                else:
-                                    # Subsequent extractions - append to existing identifier references by index
-                                    merged_identifier_references = []
-                                    existing_identifier_refs = identifier_references or []
-                                    
-                                    for i, result in enumerate(processed_results['identifier_results']):
-                                        if 'extracted_value' in result and 'field_name' in result:
-                                            field_name_parts = result['field_name'].split('.')
-                                            field_name_only = field_name_parts[-1] if len(field_name_parts) > 1 else result['field_name']
-                                            
-                                            # Get existing reference at this index or create new one
-                                            if i < len(existing_identifier_refs):
-                                                # Append to existing reference at same index
-                                                updated_ref = existing_identifier_refs[i].copy()
-                                                updated_ref[field_name_only] = result['extracted_value']
-                                                merged_identifier_references.append(updated_ref)
-                                            else:
-                                                # Create new reference if we have more results than existing references
-                                                merged_identifier_references.append({field_name_only: result['extracted_value']})
-                                    
-                                    identifier_references = merged_identifier_references
-                                
-                                print("\n" + "=" * 80)
-                                print("IDENTIFIER REFERENCES")
-                                print("=" * 80)
-                                print(json.dumps(identifier_references, indent=2))
-                                
-                                # Log target property with orderIndex matching extraction number
-                                if all_collection_properties:
-                                    target_property = None
-                                    for prop in all_collection_properties:
-                                        if prop.get('order_index') == extraction_number:
-                                            target_property = prop
-                                            break
-                                    
-                                    if target_property:
-                                        print(f"\nTarget property with orderIndex {extraction_number}:")
-                                        print("=" * 80)
-                                        print(json.dumps(target_property, indent=2))
-                                        print("=" * 80)
-                                
-                                # Log remaining fields
-                                log_remaining_collection_fields(processed_results.get('identifier_results', []), all_collection_properties)
-                            else:
-                                print(f"Error processing new function results: {processed_results['error']}")
-                        else:
-                            print(f"Error executing new function: {function_result['error']}")
-                    else:
-                        print(f"Error saving function: {create_result['error']}")
-                else:
-                    print(f"Error generating function: {function_data['error']}")
-        
+            field_table = _run_excel_function(target, extraction_number, input_table, shared, gemini_response)
         elif "AI Extraction" in gemini_response:
             print(f"\n🧠 AI EXTRACTION:")
-            # Handle AI extraction based on document availability
             if documents == "NO DOCUMENTS SELECTED":
-                print("   Error: Cannot use AI extraction without documents")
-                ai_result = {"error": "No documents available for AI extraction"}
-            else:
-                # Get document IDs from the documents data
-                document_ids = [doc['id'] for doc in documents]
-                # Limit identifier references to first 50 records for AI tools to improve performance
-                limited_identifier_references = incoming_identifier_references[:50] if incoming_identifier_references else []
-                if len(incoming_identifier_references or []) > 50:
-                    print(f"🔧 Limited AI input from {len(incoming_identifier_references)} to 50 records for better performance")
-                # Pass document IDs and identifier targets to AI extraction
-                ai_result = ai_document_extraction(document_ids, session_id, identifier_targets, limited_identifier_references)
-            
-            # Clean JSON and extract identifiers
-            processed_results = clean_json_and_extract_identifiers(ai_result, identifier_targets)
-            if 'error' not in processed_results:
-                # Show record count and sample results
-                record_count = len(processed_results['cleaned_results']) if isinstance(processed_results['cleaned_results'], list) else 0
-                print(f"\n✅ EXTRACTION RESULTS: {record_count} records extracted using AI")
-                
-                # Show complete validation results JSON
-                print(f"\n📋 COMPLETE VALIDATION RESULTS JSON:")
-                print("=" * 80)
-                print(json.dumps(processed_results['identifier_results'], indent=2))
-                print("=" * 80)
-                
-                # Create and display IDENTIFIER REFERENCES array
-                identifier_references = []
-                for result in processed_results['identifier_results']:
-                    if 'extracted_value' in result and 'field_name' in result:
-                        # Split field_name on dot and take the part after the collection name
-                        field_name_parts = result['field_name'].split('.')
-                        field_name_only = field_name_parts[-1] if len(field_name_parts) > 1 else result['field_name']
-                        identifier_references.append({field_name_only: result['extracted_value']})
-                
-                # Store for auto-rerun
-                first_run_identifier_references = identifier_references
-                print(f"\n🔗 IDENTIFIER REFERENCES ARRAY:")
-                print("=" * 80)
-                print(json.dumps(identifier_references, indent=2))
-                print("=" * 80)
-                print(f"Created {len(identifier_references)} new references for next extraction")
-                
-                # Log extraction progress
-                if all_collection_properties:
-                    extracted_field_names = set()
-                    for result in processed_results.get('identifier_results', []):
-                        field_name = result.get('field_name', '')
-                        if '.' in field_name:
-                            property_name = field_name.split('.')[-1]
-                            extracted_field_names.add(property_name)
-                        else:
-                            extracted_field_names.add(field_name)
-                    
-                    total_fields = len(all_collection_properties)
-                    extracted_count = sum(1 for prop in all_collection_properties if prop.get('property_name') in extracted_field_names)
-                    remaining_count = total_fields - extracted_count
-                    print(f"\n📊 PROGRESS: {extracted_count}/{total_fields} fields extracted, {remaining_count} remaining")
-            else:
-                print(f"   Error processing AI extraction results: {processed_results['error']}")
+                raise RuntimeError("Cannot use AI extraction without documents")
+            # Limit identifier references to the first 50 records for AI tools to improve performance
+            if len(input_table) > 50:
+                print(f"🔧 Limited AI input from {len(input_table)} to 50 records for better performance")
+            ai_result = ai_document_extraction([doc['id'] for doc in documents], session_id, [target], references[:50])
+            processed_results = clean_json_and_extract_identifiers(ai_result, [target])
+            field_table = _field_table_from_results(processed_results, "AI", target, input_table, shared)
         else:
-            print(f"\n❌ NO EXTRACTION METHOD: Gemini did not recommend a specific extraction method")
-        print("=" * 80)
-        
-        # AUTO-RERUN LOGIC: Continue extraction until all target fields are processed
-        next_extraction_number = extraction_number + 1
-        total_target_fields = len(target_fields) if target_fields else 0
-        
-        if next_extraction_number < total_target_fields:
-            print("\n" + "=" * 80)
-            print(f"AUTO-RERUN: Starting extraction run {next_extraction_number + 1} of {total_target_fields}")
-            print("=" * 80)
-            print(f"Next extraction number: {next_extraction_number}")
-            print(f"Target field: {target_fields[next_extraction_number].get('propertyName', 'Unknown') if target_fields else 'None'}")
-            print(f"Progress: {next_extraction_number}/{total_target_fields} fields processed", file=sys.stderr, flush=True)
-            
-            # Create new data object with updated target fields and identifier references
-            rerun_data = {
-                "document_ids": document_ids,
-                "session_id": session_id,
-                "target_fields": target_fields,
-                "identifier_references": identifier_references if 'identifier_references' in locals() else first_run_identifier_references
-            }
-            
-            # Include llm_model in rerun data if it was provided
-            if llm_model:
-                rerun_data["llm_model"] = llm_model
-            
-            # Pass llm_model from the rerun_data if it exists
-            rerun_llm_model = rerun_data.get('llm_model')
-            
-            # Re-run the extraction with the new parameters
-            run_wizardry_with_gemini_analysis(rerun_data, next_extraction_number, rerun_llm_model)
-        else:
-            print("\n" + "=" * 80)
-            print("EXTRACTION COMPLETE")
-            print("=" * 80)
-            print(f"All {total_target_fields} target fields have been processed")
-            print("Extraction sequence finished successfully")
-            print("=" * 80)
-        
-    else:
+            raise RuntimeError("Gemini did not recommend a specific extraction method")
+
+    print(f"\n🔗 IDENTIFIER REFERENCES: {len(field_table)} values for {target.get('name')}")
+    return field_table
+
+
+def run_wizardry_with_gemini_analysis(data=None, extraction_number=0, llm_model=None, on_progress=None):
+    """
+    Extract every target field from extraction_number on, scheduled by dependency
+
+    Documents, Excel functions and collection properties are loaded once.
+    Identifier fields run first and build the identifier reference rows;
+    the remaining fields only depend on those rows and run in parallel
+    (extraction.fieldScheduling). on_progress receives a started /
+    completed / failed event per field.
+    """
+    print("\n" + "=" * 80)
+    print(f"EXTRACTION RUN {extraction_number + 1}")
+    print("=" * 80)
+
+    if not data or not isinstance(data, dict):
         print(json.dumps({"error": "Invalid data format. Expected object with document_ids and session_id"}))
+        return
+
+    document_ids = data.get('document_ids', [])
+    session_id = data.get('session_id')
+    target_fields = data.get('target_fields', [])
+    set_usage_tags(session_id=session_id)
+
+    print(f"Session: {session_id[:8]}..." if session_id else "No session")
+    print(f"Documents: {len(document_ids)} selected")
+    print(f"Target fields: {len(target_fields)} total")
+    if not session_id:
+        print(json.dumps({"error": "Missing session_id"}))
+        return
+
+    if not document_ids:
+        print("No documents selected - working with identifier references only")
+        documents = "NO DOCUMENTS SELECTED"
+    else:
+        documents = get_document_properties_from_db(document_ids, session_id)
+        if isinstance(documents, dict) and "error" in documents:
+            print(json.dumps(documents))
+            return
+
+    target_fields_data = [
+        {
+            "field_id": field.get('id', ''),
+            "name": field.get('propertyName') or field.get('fieldName', ''),
+            "description": field.get('description', ''),
+            "property_type": field.get('propertyType') or field.get('fieldType', ''),
+            "auto_verification_confidence": field.get('autoVerificationConfidence', 80),
+            "choice_options": field.get('choiceOptions', []),
+            "is_identifier": field.get('isIdentifier', False),
+            "order_index": field.get('orderIndex', 0),
+            "collection_id": field.get('collectionId', ''),
+            "type": "collection_property" if field.get('collectionId') else "schema_field",
+            "extraction_type": field.get('extractionType', ''),
+            "function_id": field.get('functionID', '') or field.get('functionId', ''),
+            # Names or ids of the earlier fields this one is computed from (None: the fields its description names)
+            "depends_on": field.get('dependsOn')
+        }
+        for field in target_fields
+    ]
+
+    # Fields before extraction_number were extracted by an earlier run; their references are in the database.
+    # From here on the store keeps them in memory and saves each completed field's column.
+    if extraction_number > 0:
+        print(f"🔄 Loading identifier references from database for extraction {extraction_number}")
+        store = IdentifierReferenceStore.resume(session_id, extraction_number - 1, load_identifier_reference_table_from_db,
+                                                persist=save_identifier_references_to_db)
+    else:
+        store = IdentifierReferenceStore(session_id, IdentifierReferenceTable.from_references(data.get('identifier_references', [])),
+                                         persist=save_identifier_references_to_db)
+    base_count = len(store)
+    print(f"Identifier references: {base_count} records" if base_count else "Identifier references: None (first extraction)")
+
+    positions = list(range(extraction_number, len(target_fields_data)))
+    if not positions:
+        # Past the last field: re-run the identifier fields
+        positions = [position for position, field in enumerate(target_fields_data) if field.get('is_identifier')]
+    if not positions:
+        print("No target fields to extract")
+        return
+
+    collection_ids = list(set([field.get('collection_id') for field in target_fields_data if field.get('collection_id')]))
+    all_collection_properties = get_all_collection_properties(collection_ids) if collection_ids else []
+    existing_functions = get_excel_wizardry_functions()
+    if isinstance(existing_functions, dict) and "error" in existing_functions:
+        print(f"Warning: Could not retrieve Excel functions: {existing_functions['error']}")
+        existing_functions = []
+    print(f"\n⚡ EXCEL FUNCTIONS: {len(existing_functions)} available")
+
+    shared = {
+        "session_id": session_id,
+        "documents": documents,
+        "functions": existing_functions,
+        # Identifier values key the join of later fields' results onto existing records
+        "identifier_columns": [field.get('name') for field in target_fields_data if field.get('is_identifier')],
+    }
+
+    relative_graph = build_field_graph([target_fields_data[position] for position in positions], creates_rows=not base_count)
+    graph = {positions[node]: [positions[dep] for dep in deps] for node, deps in relative_graph.items()}
+    labels = {position: target_fields_data[position].get('name') or f"field {position + 1}" for position in positions}
+    depth = int(critical_path_seconds(graph, {position: 1 for position in graph}))
+    print(f"📐 FIELD PLAN: {len(graph)} fields in {depth} dependent stages, up to {get_max_parallel_fields()} in parallel",
+          file=sys.stderr, flush=True)
+
+    def run_field(position, inputs):
+        # A field sees the columns of its dependencies and of everything they saw
+        visible = set().union(*inputs.values())
+        field_table = extract_wizardry_field(target_fields_data[position], position, store.table(visible), shared, llm_model)
+        store.add_field(position, field_table)
+        return visible | {position}
+
+    # Without its identifier rows a dependent field would run against the base rows only
+    identifier_positions = {position for position in graph if target_fields_data[position].get('is_identifier')}
+    if not base_count:
+        identifier_positions.add(positions[0])   # The first field creates the rows
+    results = run_field_graph(graph, run_field, labels=labels, on_progress=on_progress, stop_on_failure=identifier_positions)
+    routing_stats = get_tool_routing_cache().stats
+    print(f"🧭 TOOL ROUTING: {routing_stats['rules']} by rule, {routing_stats['hits']} cached, "
+          f"{routing_stats['misses']} analysed by Gemini", file=sys.stderr, flush=True)
+    store.log_summary()
+    final_table = store.table()
+
+    if all_collection_properties:
+        extracted = [{"field_name": field_name} for field_name in final_table.columns]
+        log_remaining_collection_fields(extracted, all_collection_properties)
+
+    print("\n" + "=" * 80)
+    print("EXTRACTION COMPLETE")
+    print("=" * 80)
+    print(f"{len(results)}/{len(graph)} target fields extracted")
+    print("\n🔗 FINAL MERGED IDENTIFIER REFERENCES:")
+    print("=" * 80)
+    print(json.dumps(final_table.to_references(indexed=True), indent=2))
+    print("=" * 80)
+    print(f"Final result: {len(final_table)} merged records with all field combinations")
+    print("=" * 80)
 
 def run_wizardry(data=None, extraction_number=0):
     # FIRST: Display all collection properties at the very beginning
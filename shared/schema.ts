@@ -28,7 +28,7 @@
  * - Zod schemas for form validation and API requests
  */
 
-import { pgTable, text, serial, integer, boolean, timestamp, uuid, jsonb, uniqueIndex } from "drizzle-orm/pg-core";
+import { pgTable, text, serial, integer, boolean, timestamp, uuid, jsonb, uniqueIndex, index, doublePrecision } from "drizzle-orm/pg-core";
 import { sql } from "drizzle-orm";
 import { createInsertSchema } from "drizzle-zod";
 import { z } from "zod";
@@ -621,6 +621,35 @@ export const auditLogs = pgTable("audit_logs", {
   createdAt: timestamp("created_at").defaultNow().notNull(),
 });
 
+// Shared Gemini control state (rate limiter buckets and queues, hedging latencies and circuit breakers), guarded by pg_advisory_xact_lock
+export const llmRateLimitState = pgTable("llm_rate_limit_state", {
+  key: text("key").primaryKey(),
+  state: jsonb("state").notNull(),
+  updatedAt: timestamp("updated_at").defaultNow().notNull(),
+});
+
+// Token usage, latency and estimated cost of every Gemini call, written in batches by utils/usage_tracker.py
+export const llmUsageRecords = pgTable("llm_usage_records", {
+  id: serial("id").primaryKey(),
+  sessionId: text("session_id"),
+  projectId: text("project_id"),
+  field: text("field"), // Target field/value name the call extracted, if any
+  callSite: text("call_site"), // e.g. 'execute_ai_extraction', 'extract_column_mappings'
+  model: text("model").notNull(),
+  inputTokens: integer("input_tokens").default(0).notNull(),
+  outputTokens: integer("output_tokens").default(0).notNull(), // Includes thinking tokens
+  cachedTokens: integer("cached_tokens").default(0).notNull(),
+  thinkingTokens: integer("thinking_tokens").default(0).notNull(),
+  latencyMs: integer("latency_ms").notNull(),
+  queuedMs: integer("queued_ms").default(0).notNull(), // Time waiting for rate limit quota
+  retries: integer("retries").default(0).notNull(), // 429 retries before the call succeeded
+  streamed: boolean("streamed").default(false).notNull(),
+  costUsd: doublePrecision("cost_usd"), // Null when the model has no pricing entry
+  createdAt: timestamp("created_at").defaultNow().notNull(),
+}, (table) => ({
+  sessionIdx: index("llm_usage_session_idx").on(table.sessionId),
+}));
+
 // Insert schemas
 export const insertOrganizationSchema = createInsertSchema(organizations).omit({
   id: true,
@@ -853,6 +882,8 @@ export type InsertApiDataSource = z.infer<typeof insertApiDataSourceSchema>;
 export type RefreshToken = typeof refreshTokens.$inferSelect;
 export type PasswordResetToken = typeof passwordResetTokens.$inferSelect;
 export type AuditLog = typeof auditLogs.$inferSelect;
+export type LlmRateLimitState = typeof llmRateLimitState.$inferSelect;
+export type LlmUsageRecord = typeof llmUsageRecords.$inferSelect;
 
 // Validation status types
 export type ValidationStatus = 'valid' | 'invalid' | 'pending' | 'manual' | 'verified' | 'unverified' | 'extracted';
@@ -0,0 +1,74 @@
+"""
+Target fields that do not refer to each other are extracted side by side
+
+Run from the project root:
+    python -m pytest tests
+"""
+
+import os
+import sys
+import threading
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))  # Project root for utils
+
+from utils.field_scheduler import build_field_graph, run_field_graph
+
+# Shaped like target_fields_data in extraction_wizardry, as the frontend sends them (no dependsOn)
+TARGET_FIELDS = [
+    {"field_id": "f1", "name": "Member ID", "description": "Unique member number", "is_identifier": True},
+    {"field_id": "f2", "name": "Age", "description": "Age of the member in years", "is_identifier": False},
+    {"field_id": "f3", "name": "Salary", "description": "Annual pensionable salary", "is_identifier": False},
+    {"field_id": "f4", "name": "Salary Band", "description": "Band of the Salary: low, mid or high",
+     "is_identifier": False},
+]
+
+
+def test_fields_without_references_depend_on_the_identifier_only():
+    assert build_field_graph(TARGET_FIELDS) == {0: [], 1: [0], 2: [0], 3: [0, 2]}
+
+
+def test_declared_dependencies_replace_the_inferred_ones():
+    fields = [dict(field) for field in TARGET_FIELDS]
+    fields[1]["depends_on"] = ["f3"]
+    fields[3]["depends_on"] = []
+    assert build_field_graph(fields) == {0: [], 1: [0], 2: [0], 3: [0]}
+
+
+def test_first_field_creates_the_rows_in_a_fresh_extraction():
+    fields = [dict(field, is_identifier=False) for field in TARGET_FIELDS]
+    assert build_field_graph(fields) == {0: [], 1: [0], 2: [0], 3: [0, 2]}
+    assert build_field_graph(fields, creates_rows=False) == {0: [], 1: [], 2: [], 3: [2]}
+
+
+def test_sibling_fields_start_concurrently():
+    graph = build_field_graph(TARGET_FIELDS)
+    siblings = threading.Barrier(2, timeout=5)
+    started = {}
+
+    def run(position, inputs):
+        started[position] = time.monotonic()
+        if position in (1, 2):
+            siblings.wait()     # Times out unless Age and Salary run at the same time
+        return set().union({position}, *inputs.values())
+
+    results = run_field_graph(graph, run, max_parallel=4)
+
+    assert set(results) == {0, 1, 2, 3}
+    assert started[0] < min(started[1], started[2])
+    assert results[3] == {0, 2, 3}
+
+
+def test_identifier_failure_skips_its_dependents():
+    events = []
+
+    def run(position, inputs):
+        if position == 0:
+            raise RuntimeError("no rows")
+        return position
+
+    results = run_field_graph(build_field_graph(TARGET_FIELDS), run, max_parallel=4,
+                              on_progress=events.append, stop_on_failure={0})
+
+    assert results == {}
+    assert sorted(event["node"] for event in events if event["status"] == "skipped") == [1, 2, 3]
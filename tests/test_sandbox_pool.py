@@ -0,0 +1,112 @@
+"""
+Stored functions run through the sandbox pool return what they return in-process
+
+Run from the project root:
+    python -m pytest tests
+"""
+
+import datetime
+import decimal
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))  # Project root for utils
+
+from utils.function_cache import FunctionCache
+import utils.sandbox_pool as sandbox_pool
+from utils.sandbox_pool import ENVIRONMENTS, SandboxError, SandboxPool, _call_entry, is_sandbox_enabled
+
+# Shaped like the column extraction functions EXCEL_FUNCTION_GENERATOR produces and the database stores
+STORED_PANDAS_FUNCTION = '''
+def extract_excel_data(extracted_content, target_fields_data):
+    results = []
+    for section in extracted_content.split('=== Sheet:')[1:]:
+        sheet_name, _, table = section.partition('\\n')
+        frame = pandas.read_csv(StringIO(table), sep='\\t')
+        for field in target_fields_data:
+            if field['name'] not in frame.columns:
+                continue
+            column = frame[field['name']]
+            for record_index, value in enumerate(column):
+                results.append({
+                    "field_name": f"{field['name']}[{record_index}]",
+                    "extracted_value": value,
+                    "confidence_score": 95,
+                    "validation_status": "valid",
+                    "ai_reasoning": f"Found in column {field['name']}",
+                    "document_source": f"Sheet: {sheet_name.strip(' =')}",
+                    "record_index": record_index,
+                })
+        results.append({"field_name": "summary", "extracted_value": column.describe(), "record_index": None})
+    return results
+'''
+
+EXCEL_CONTENT = "=== Sheet: Members ===\nMember ID\tAge\tSalary\nA1\t42\t1000.5\nB2\t37\t2000.25\n"
+TARGET_FIELDS = [{"name": "Member ID"}, {"name": "Age"}, {"name": "Salary"}]
+
+NATIVE_TYPES_FUNCTION = '''
+def extract_excel_data(extracted_content, target_fields_data):
+    return [(1, "a"), {1: "int key"}, {"nested": {"a", "b"}}]
+'''
+
+
+@pytest.fixture
+def pool():
+    pool = SandboxPool({"workers": 1, "cpuSeconds": 30, "timeoutSeconds": 60, "maxTasksPerWorker": 10})
+    yield pool
+    pool.shutdown()
+
+
+def run_in_process(environment, code, content, args):
+    compiled = FunctionCache().get(environment, None, code, ('extract_excel_data',), ENVIRONMENTS[environment])
+    return _call_entry(compiled, content, args)
+
+
+def test_stored_pandas_function_matches_in_process(pool):
+    pd = pytest.importorskip('pandas')
+    expected = run_in_process('pandas', STORED_PANDAS_FUNCTION, EXCEL_CONTENT, [TARGET_FIELDS])
+    results = pool.run('pandas', 'stored-function', STORED_PANDAS_FUNCTION, ('extract_excel_data',),
+                       EXCEL_CONTENT, [TARGET_FIELDS])
+
+    assert len(results) == len(expected)
+    for result, reference in zip(results[:-1], expected[:-1]):
+        assert result == reference
+        assert type(result["extracted_value"]) is type(reference["extracted_value"])
+    pd.testing.assert_series_equal(results[-1]["extracted_value"], expected[-1]["extracted_value"])
+
+
+def test_pandas_worker_memory_limit_fits_pandas(pool):
+    pytest.importorskip('pandas')
+    assert pool.memory_mb['pandas'] > pool.memory_mb['restricted']
+    assert pool.run('pandas', None, "def run(content):\n    return pandas.__version__\n", ('run',), "x")
+
+
+def test_native_result_types_survive_the_pool(pool):
+    code = NATIVE_TYPES_FUNCTION + '''
+import datetime, decimal
+def extract_dates(extracted_content):
+    return {"when": datetime.datetime(2024, 5, 1, 12, 30), "day": datetime.date(2024, 5, 1),
+            "amount": decimal.Decimal("10.50"), "raw": b"\\x00\\x01"}
+'''
+    assert pool.run('restricted', None, code, ('extract_excel_data',), "", [[]]) == [
+        (1, "a"), {1: "int key"}, {"nested": {"a", "b"}}]
+    assert pool.run('restricted', None, code, ('extract_dates',), "") == {
+        "when": datetime.datetime(2024, 5, 1, 12, 30), "day": datetime.date(2024, 5, 1),
+        "amount": decimal.Decimal("10.50"), "raw": b"\x00\x01"}
+
+
+def test_unsupported_result_type_fails_the_task(pool):
+    with pytest.raises(SandboxError, match="cannot be returned from the sandbox"):
+        pool.run('restricted', None, "def run(content):\n    return re.compile('x')\n", ('run',), "")
+
+
+def test_sandbox_is_on_for_restricted_functions_by_default(monkeypatch):
+    monkeypatch.setattr(sandbox_pool, 'get_sandbox_config', lambda: {})
+    assert is_sandbox_enabled('restricted')
+    assert not is_sandbox_enabled('pandas')
+    monkeypatch.setattr(sandbox_pool, 'get_sandbox_config', lambda: {"enabled": False})
+    assert not is_sandbox_enabled('restricted')
+    monkeypatch.setattr(sandbox_pool, 'get_sandbox_config', lambda: {"enabled": {"pandas": True}})
+    assert is_sandbox_enabled('restricted') and is_sandbox_enabled('pandas')
@@ -62,6 +62,11 @@ class Config:
                 self.config_data['ai'] = {}
             self.config_data['ai']['google_api_key'] = os.getenv('GOOGLE_API_KEY')
         
+        if os.getenv('GEMINI_BASE_URL'):
+            if 'ai' not in self.config_data:
+                self.config_data['ai'] = {}
+            self.config_data['ai']['baseUrl'] = os.getenv('GEMINI_BASE_URL')
+        
         # Server configuration
         if os.getenv('PORT'):
             if 'server' not in self.config_data:
@@ -144,6 +149,28 @@ class Config:
             'minConfidenceScore': 70
         })
     
+    def get_project_extraction_config(self, project_id: str = None) -> dict:
+        """
+        Get extraction configuration with per-project overrides applied
+        
+        Parameters:
+            project_id (str): Project UUID (overrides under extraction.projectOverrides)
+        
+        Returns:
+            dict: Extraction configuration for the project
+        """
+        extraction_config = dict(self.get_extraction_config())
+        overrides = extraction_config.pop('projectOverrides', {}) or {}
+        project_overrides = overrides.get(str(project_id), {}) if project_id else {}
+        
+        for key, value in project_overrides.items():
+            if isinstance(value, dict) and isinstance(extraction_config.get(key), dict):
+                extraction_config[key] = {**extraction_config[key], **value}
+            else:
+                extraction_config[key] = value
+        
+        return extraction_config
+    
     def get_logging_config(self) -> dict:
         """
         Get logging configuration
@@ -194,4 +221,8 @@ def get_api_key(service: str = 'gemini') -> str:
 
 def get_ai_model(model_type: str = 'default') -> str:
     """Get AI model name"""
-    return config.get_ai_model(model_type)
\ No newline at end of file
+    return config.get_ai_model(model_type)
+
+def get_project_extraction_config(project_id: str = None) -> dict:
+    """Get extraction configuration for a project"""
+    return config.get_project_extraction_config(project_id)
\ No newline at end of file
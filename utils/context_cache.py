@@ -0,0 +1,206 @@
+"""
+Explicit Gemini context caching for stable prompt prefixes
+
+Prompts whose large, stable part (system text and knowledge documents)
+comes first can have that prefix uploaded once with client.caches.create
+and referenced by handle on every later call, so only the per-field
+suffix is processed as new input.
+
+Handles are kept in a local registry shared by the service processes
+(a utils.state_store backend), keyed by scope (e.g. project) and model.
+Each entry records the SHA-256 of the prefix it was built from; when the
+knowledge documents change the hash changes, the stale cache is deleted
+upstream and a new one is created.
+"""
+
+import hashlib
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Optional, Tuple
+
+from utils.config import get_config
+from utils.state_store import build_state_store
+from utils.token_budget import estimate_tokens
+
+DEFAULT_STATE_DIR = 'logs/context_cache'
+EXPIRY_MARGIN_SECONDS = 60      # Replace caches this close to expiry instead of using them
+FAILURE_BACKOFF_SECONDS = 300   # Wait before retrying a prefix whose cache could not be created
+
+
+def get_context_cache_config() -> dict:
+    """
+    Get the context caching configuration
+
+    Returns:
+        dict: ai.contextCache from config.json
+    """
+    return get_config('ai.contextCache', {}) or {}
+
+
+def prefix_hash(prefix: str) -> str:
+    """SHA-256 of a prompt prefix"""
+    return hashlib.sha256(prefix.encode('utf-8')).hexdigest()
+
+
+def _expiry_timestamp(cache, ttl_seconds: int) -> float:
+    """Expiry of a created cache as a Unix timestamp"""
+    expire_time = getattr(cache, 'expire_time', None)
+    if isinstance(expire_time, datetime):
+        if expire_time.tzinfo is None:
+            expire_time = expire_time.replace(tzinfo=timezone.utc)
+        return expire_time.timestamp()
+    return time.time() + ttl_seconds
+
+
+class ContextCacheRegistry:
+    """
+    Registry of explicit context caches
+
+    Configured by ai.contextCache:
+        enabled:         Use explicit caching
+        ttlSeconds:      Lifetime of created caches
+        minPrefixTokens: Only cache prefixes at least this large (Gemini's minimum is
+                         1024 tokens for flash and 2048 for pro models)
+        backend / stateDir: Registry store (see utils.state_store)
+    """
+
+    def __init__(self, config: dict = None, store=None, client=None):
+        self.config = config if config is not None else get_context_cache_config()
+        self.enabled = bool(self.config.get('enabled', False))
+        self.ttl = int(self.config.get('ttlSeconds', 3600))
+        self.min_prefix_tokens = int(self.config.get('minPrefixTokens', 2048))
+        self.store = store or build_state_store(self.config.get('backend', 'file'),
+                                                self.config.get('stateDir', DEFAULT_STATE_DIR), 'context_cache')
+        self._client = client
+        self.stats = {"hits": 0, "created": 0, "invalidated": 0, "skipped": 0, "failed": 0}
+
+    @property
+    def client(self):
+        if self._client is None:
+            from utils.gemini_client import get_gemini_client
+            self._client = get_gemini_client()
+        return self._client
+
+    def get_handle(self, model: str, prefix: str, scope: str) -> Optional[str]:
+        """
+        Get a cache handle for a prompt prefix, creating the cache if needed
+
+        Parameters:
+            model (str): Gemini model name (caches are per model)
+            prefix (str): Stable prompt prefix
+            scope (str): Owner of the cache, e.g. "project:<id>"
+
+        Returns:
+            str: Cached content name, or None if caching is off, the prefix is
+                 too small, or creation failed
+        """
+        if not self.enabled or not prefix:
+            return None
+        if estimate_tokens(prefix) < self.min_prefix_tokens:
+            self.stats["skipped"] += 1
+            return None
+
+        digest = prefix_hash(prefix)
+        key = f"{scope}|{model}"
+        stale_name = None
+
+        # Creation happens inside the transaction so concurrent processes create one cache, not one each
+        with self.store.transaction() as state:
+            entries = state.setdefault('entries', {})
+            now = time.time()
+            for entry_key in [k for k, entry in entries.items() if entry.get('expires_at', 0) <= now]:
+                del entries[entry_key]
+
+            failure = state.setdefault('failures', {}).get(key)
+            if failure and failure['hash'] == digest and failure['until'] > now:
+                self.stats["skipped"] += 1
+                return None
+
+            entry = entries.get(key)
+            if entry and entry['hash'] == digest and entry['expires_at'] - now > EXPIRY_MARGIN_SECONDS:
+                self.stats["hits"] += 1
+                return entry['name']
+            if entry and entry['hash'] != digest:
+                stale_name = entry['name']
+                self.stats["invalidated"] += 1
+                print(f"🗄️ CONTEXT CACHE: prefix for {key} changed - replacing {stale_name}", file=sys.stderr, flush=True)
+
+            try:
+                from google.genai import types
+                cache = self.client.caches.create(
+                    model=model,
+                    config=types.CreateCachedContentConfig(
+                        contents=[prefix],
+                        display_name=f"{scope}:{digest[:12]}"[:128],
+                        ttl=f"{self.ttl}s",
+                    ),
+                )
+            except Exception as e:
+                # Don't retry the same prefix on every call while creation keeps failing
+                state['failures'][key] = {"hash": digest, "until": now + FAILURE_BACKOFF_SECONDS}
+                self.stats["failed"] += 1
+                print(f"⚠️ CONTEXT CACHE: could not create cache for {key} - sending the full prompt ({e})",
+                      file=sys.stderr, flush=True)
+                return None
+
+            state['failures'].pop(key, None)
+            entries[key] = {"name": cache.name, "hash": digest, "model": model,
+                            "expires_at": _expiry_timestamp(cache, self.ttl)}
+            self.stats["created"] += 1
+            print(f"🗄️ CONTEXT CACHE: created {cache.name} for {key} (~{estimate_tokens(prefix)} tokens)",
+                  file=sys.stderr, flush=True)
+
+        if stale_name:
+            self.delete(stale_name)
+        return cache.name
+
+    def invalidate(self, scope: str):
+        """Delete every cache registered for a scope (e.g. after knowledge documents change)"""
+        with self.store.transaction() as state:
+            entries = state.setdefault('entries', {})
+            names = [entries.pop(key)['name'] for key in list(entries) if key.startswith(f"{scope}|")]
+        for name in names:
+            self.delete(name)
+
+    def delete(self, name: str):
+        """Delete a cache upstream; it expires on its own if this fails"""
+        try:
+            self.client.caches.delete(name=name)
+        except Exception as e:
+            print(f"⚠️ CONTEXT CACHE: could not delete {name} ({e})", file=sys.stderr, flush=True)
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_context_cache() -> ContextCacheRegistry:
+    """Get the process-wide context cache registry"""
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = ContextCacheRegistry()
+    return _registry
+
+
+def cached_prompt(model: str, prefix: str, suffix: str, scope: str) -> Tuple[Any, Any]:
+    """
+    Build request contents and config for a prefix/suffix prompt
+
+    Parameters:
+        model (str): Gemini model name
+        prefix (str): Stable prompt prefix (system text, knowledge documents)
+        suffix (str): Per-call part of the prompt
+        scope (str): Cache owner, e.g. "project:<id>"
+
+    Returns:
+        tuple: (contents, config) - the suffix with a GenerateContentConfig
+               referencing the cached prefix, or the full prompt and None
+    """
+    name = get_context_cache().get_handle(model, prefix, scope) if scope else None
+    if not name:
+        return "\n\n".join(filter(None, [prefix, suffix])), None
+    from google.genai import types
+    return suffix, types.GenerateContentConfig(cached_content=name)
@@ -0,0 +1,286 @@
+"""
+Continuation of responses cut off by the output token limit
+
+A response that ends with finish reason MAX_TOKENS is incomplete. Sending
+the whole request again costs the full generation time and usually hits
+the same limit, so the request is instead repeated with the partial answer
+as the model's turn and an instruction to carry on:
+
+- array responses: the records that arrived complete are sent back and the
+  model returns only the records after them, which are appended
+- other text (e.g. a generated function as a JSON object): the model
+  continues from the last character and the pieces are concatenated
+
+Configured by ai.continuation:
+    enabled:          Continue truncated responses (otherwise callers keep what arrived)
+    maxContinuations: Continuation requests per response
+"""
+
+import json
+import sys
+from typing import Any, Callable, Optional, Tuple
+
+from utils.config import get_config
+from utils.gemini_client import generate_content, is_streaming_enabled, response_truncated, stream_json_records
+from utils.json_stream import IncrementalJsonArrayParser
+
+RECORDS_INSTRUCTION = (
+    "Your previous response was cut off by the output token limit. The {count} records above arrived complete. "
+    "Continue with the record that follows the last complete one. Return ONLY the remaining records as a JSON array, "
+    "in the same format - do not repeat records that were already written."
+)
+NESTED_RECORDS_INSTRUCTION = (
+    "Your previous response was cut off by the output token limit. The {count} items above arrived complete. "
+    "Return a JSON object with the same keys containing ONLY the array items that were not written yet, "
+    "in the same format - do not repeat items that were already written."
+)
+TEXT_INSTRUCTION = (
+    "Your previous response was cut off by the output token limit. Continue it from exactly where it stopped: "
+    "output only the remaining text, starting with the next character, without repeating anything and without "
+    "any preamble or markdown fence."
+)
+
+
+def is_continuation_enabled() -> bool:
+    """
+    Check whether truncated responses should be continued
+
+    Returns:
+        bool: Value of ai.continuation.enabled in config.json (default True)
+    """
+    return bool(get_config('ai.continuation.enabled', True))
+
+
+def _max_continuations() -> int:
+    return int(get_config('ai.continuation.maxContinuations', 3))
+
+
+def _as_turns(contents: Any) -> list:
+    """Request contents as a list of Content turns"""
+    from google.genai import types
+    if isinstance(contents, str):
+        return [types.Content(role="user", parts=[types.Part(text=contents)])]
+    items = contents if isinstance(contents, list) else [contents]
+    if all(isinstance(item, types.Content) for item in items):
+        return list(items)
+    parts = []
+    for item in items:
+        if isinstance(item, str):
+            parts.append(types.Part(text=item))
+        elif isinstance(item, types.Part):
+            parts.append(item)
+        elif getattr(item, 'uri', None):
+            # Uploaded files
+            parts.append(types.Part.from_uri(file_uri=item.uri, mime_type=item.mime_type))
+        else:
+            parts.append(item)
+    return [types.Content(role="user", parts=parts)]
+
+
+def continuation_contents(contents: Any, partial: str, instruction: str) -> list:
+    """
+    Build a continuation request: the original turns, the partial answer, the instruction
+
+    Parameters:
+        contents: Original request contents
+        partial (str): What the model produced so far
+        instruction (str): How to continue
+
+    Returns:
+        list: Content turns
+    """
+    from google.genai import types
+    return _as_turns(contents) + [
+        types.Content(role="model", parts=[types.Part(text=partial)]),
+        types.Content(role="user", parts=[types.Part(text=instruction)]),
+    ]
+
+
+def parse_records(text: str, record_depth: int = 1, keep_skeleton: bool = False) -> Tuple[list, IncrementalJsonArrayParser]:
+    """
+    Parse the complete records out of a (possibly truncated) response text
+
+    Parameters:
+        text (str): Response text
+        record_depth (int): Array depth holding the records (1 = top-level array)
+        keep_skeleton (bool): Keep the text around the records (see parser.skeleton())
+
+    Returns:
+        tuple: (records, parser) - records as (key, record) tuples when
+               record_depth > 1; parser.complete tells whether the document closed
+    """
+    parser = IncrementalJsonArrayParser(record_depth, keep_skeleton)
+    entries = parser.feed(text or "")
+    return (entries if record_depth > 1 else [record for _, record in entries]), parser
+
+
+def _record_identity(record: Any) -> str:
+    return json.dumps(record, sort_keys=True, default=str)
+
+
+class _RepeatedTail:
+    """
+    Drops the leading records of a continuation that repeat the tail of the records already received
+
+    Models often restart a few records before the cut. Only that leading run
+    is dropped - identical records elsewhere are real data (two line items
+    with the same values) and are kept. Records are held back while they could
+    still be part of such a run, then passed to emit in order.
+    """
+
+    def __init__(self, previous: list, emit: Callable[[Any], None]):
+        self.previous = previous
+        self.emit = emit
+        self.pending = []
+        self.resolved = False
+
+    def add(self, record: Any):
+        if self.resolved:
+            self.emit(record)
+            return
+        self.pending.append((_record_identity(record), record))
+        if not self._may_repeat_more():
+            self.finish()
+
+    def _may_repeat_more(self) -> bool:
+        # Whether the held records are the start of a longer run ending at the last received record
+        held = [identity for identity, _ in self.pending]
+        count = len(self.previous)
+        return any(self.previous[start:start + len(held)] == held
+                   for start in range(count - len(held)))
+
+    def finish(self):
+        """Drop the longest repeated run among the held records and emit the rest"""
+        if self.resolved:
+            return
+        self.resolved = True
+        held = [identity for identity, _ in self.pending]
+        repeated = max((length for length in range(1, min(len(held), len(self.previous)) + 1)
+                        if held[:length] == self.previous[-length:]), default=0)
+        for _, record in self.pending[repeated:]:
+            self.emit(record)
+        self.pending = []
+
+
+def _partial_records_text(records: list, record_depth: int) -> str:
+    """Records received so far, as the model's side of the continuation"""
+    if record_depth == 1:
+        return json.dumps(records, separators=(',', ':'), ensure_ascii=False, default=str)
+    grouped = {}
+    for key, record in records:
+        grouped.setdefault(key, []).append(record)
+    return json.dumps(grouped, separators=(',', ':'), ensure_ascii=False, default=str)
+
+
+def continue_records(model: str, contents: Any, records: list, config: Any = None, record_depth: int = 1,
+                     on_record: Optional[Callable[[Any], None]] = None, label: str = "AI") -> Tuple[list, bool]:
+    """
+    Continue a truncated array response after its last complete record
+
+    Parameters:
+        model (str): Gemini model name
+        contents: Original request contents
+        records (list): Complete records received so far ((key, record) tuples when record_depth > 1)
+        config: GenerateContentConfig of the original request
+        record_depth (int): Array depth holding the records
+        on_record (callable): Called with each new record as it arrives
+        label (str): Prefix for log lines
+
+    Returns:
+        tuple: (records, complete) - all records in order, and whether the
+               last continuation finished without being cut off
+    """
+    records = list(records)
+    if not is_continuation_enabled():
+        return records, False
+
+    instruction = RECORDS_INSTRUCTION if record_depth == 1 else NESTED_RECORDS_INSTRUCTION
+    limit = _max_continuations()
+
+    for round_number in range(1, limit + 1):
+        print(f"✂️ {label}: continuing after {len(records)} complete records ({round_number}/{limit})", file=sys.stderr, flush=True)
+        request = continuation_contents(contents, _partial_records_text(records, record_depth),
+                                        instruction.format(count=len(records)))
+        fresh = set()
+
+        def keep(record):
+            fresh.add(id(record))
+            if on_record:
+                on_record(record)
+
+        # Drop records the model repeats from before the cut
+        repeated_tail = _RepeatedTail([_record_identity(entry[1] if record_depth > 1 else entry) for entry in records], keep)
+
+        try:
+            if is_streaming_enabled():
+                stream = stream_json_records(model, request, config=config, record_depth=record_depth,
+                                             on_record=repeated_tail.add, label=f"{label} CONTINUATION")
+                entries, truncated = stream.records, stream.truncated
+            else:
+                response = generate_content(model, request, config)
+                entries = parse_records(response.text, record_depth)[0]
+                for entry in entries:
+                    repeated_tail.add(entry[1] if record_depth > 1 else entry)
+                truncated = response_truncated(response, config)
+            repeated_tail.finish()
+        except Exception as e:
+            print(f"⚠️ {label}: continuation failed ({e}) - keeping {len(records)} complete records", file=sys.stderr, flush=True)
+            return records, False
+
+        added = [entry for entry in entries if id(entry[1] if record_depth > 1 else entry) in fresh]
+        records.extend(added)
+        if not truncated:
+            print(f"✂️ {label}: continuation complete - {len(records)} records", file=sys.stderr, flush=True)
+            return records, True
+        if not added:
+            break
+
+    print(f"⚠️ {label}: still truncated after continuing - keeping {len(records)} complete records", file=sys.stderr, flush=True)
+    return records, False
+
+
+def _strip_leading_fence(text: str) -> str:
+    stripped = text.lstrip()
+    if stripped.startswith("```"):
+        newline = stripped.find("\n")
+        return stripped[newline + 1:] if newline >= 0 else ""
+    return text
+
+
+def continue_text(model: str, contents: Any, text: str, config: Any = None, label: str = "AI") -> Tuple[str, bool]:
+    """
+    Continue a truncated free-form response from its last character
+
+    Parameters:
+        model (str): Gemini model name
+        contents: Original request contents
+        text (str): Response text so far
+        config: GenerateContentConfig of the original request
+        label (str): Prefix for log lines
+
+    Returns:
+        tuple: (text, complete) - the joined text, and whether the last
+               continuation finished without being cut off
+    """
+    if not is_continuation_enabled():
+        return text, False
+
+    # A forced JSON mime type would make the model start a new document instead of continuing
+    if config is not None and getattr(config, 'response_mime_type', None):
+        config = config.model_copy(update={"response_mime_type": None, "response_schema": None})
+    limit = _max_continuations()
+
+    for round_number in range(1, limit + 1):
+        print(f"✂️ {label}: continuing after {len(text)} characters ({round_number}/{limit})", file=sys.stderr, flush=True)
+        try:
+            response = generate_content(model, continuation_contents(contents, text, TEXT_INSTRUCTION), config)
+        except Exception as e:
+            print(f"⚠️ {label}: continuation failed ({e})", file=sys.stderr, flush=True)
+            return text, False
+        piece = _strip_leading_fence(response.text or "")
+        text += piece
+        if not response_truncated(response, config):
+            return text, True
+        if not piece:
+            break
+    return text, False
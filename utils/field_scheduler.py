@@ -0,0 +1,248 @@
+"""
+Dependency-ordered, parallel scheduling of per-field extraction work
+
+Target fields are not independent: identifier fields produce the rows
+(identifier references) that every other field is extracted against, and
+a field may be computed from the columns of fields before it. Any other
+field needs only the identifier rows, so fields that do not refer to each
+other run side by side. A field's inputs are the fields it declares
+(depends_on) or, by default, the earlier fields its description names.
+
+build_field_graph() turns an ordered list of target fields into that
+dependency graph; run_field_graph() executes any graph with a bounded
+thread pool. A field starts as soon as all of its dependencies are done,
+so a collection takes roughly its critical path instead of the sum of
+all fields. When a node in stop_on_failure (an identifier field) fails,
+the nodes depending on it are skipped rather than run without its rows.
+
+Each field runs in a copy of the caller's context (rate limit organization,
+usage tags). Progress is reported per field as "started", "completed",
+"failed" or "skipped" events, passed to on_progress and logged to stderr.
+
+Configured by extraction.fieldScheduling:
+    enabled:           Run independent fields in parallel (otherwise one at a time, in order)
+    maxParallelFields: Fields extracted at the same time
+"""
+
+import contextvars
+import re
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Collection, Dict, Hashable, List, Optional
+
+from utils.config import get_config
+
+DEFAULT_MAX_PARALLEL_FIELDS = 4
+
+
+def get_max_parallel_fields() -> int:
+    """
+    Fields to run at the same time
+
+    Returns:
+        int: extraction.fieldScheduling.maxParallelFields, or 1 when scheduling is disabled
+    """
+    if not get_config('extraction.fieldScheduling.enabled', True):
+        return 1
+    return max(1, int(get_config('extraction.fieldScheduling.maxParallelFields', DEFAULT_MAX_PARALLEL_FIELDS)))
+
+
+def referenced_fields(field: Dict[str, Any], candidates: List[Dict[str, Any]]) -> List[str]:
+    """
+    Names of the candidate fields that a field's description mentions
+
+    Parameters:
+        field (dict): Target field dict
+        candidates (list): Target field dicts it may refer to
+
+    Returns:
+        list: Names mentioned as whole words, case-insensitively
+    """
+    description = field.get('description') or ''
+    names = [candidate.get('name') for candidate in candidates if candidate.get('name')]
+    return [name for name in names
+            if re.search(rf"(?<!\w){re.escape(name)}(?!\w)", description, re.IGNORECASE)]
+
+
+def build_field_graph(fields: List[Dict[str, Any]], creates_rows: bool = True) -> Dict[int, List[int]]:
+    """
+    Dependencies between target fields, by position in the list
+
+    Identifier fields run one after another in list order, each extending
+    the rows of the one before. Every other field depends on the last
+    identifier field before it and on the earlier fields it refers to:
+    those listed in depends_on (names or field ids; an empty list for
+    none) or, without depends_on, those whose name appears in its
+    description. In a fresh extraction (creates_rows) the first field
+    creates the rows even when it is not an identifier field; otherwise
+    the rows already exist. Every dependency points to an earlier
+    position, so the graph has no cycles.
+
+    Parameters:
+        fields (list): Target field dicts with is_identifier and optional depends_on
+        creates_rows (bool): No identifier rows exist yet
+
+    Returns:
+        dict: position -> positions it depends on
+    """
+    row_fields = {position for position, field in enumerate(fields) if field.get('is_identifier')}
+    if creates_rows and fields:
+        row_fields.add(0)
+
+    positions_by_reference = {}
+    for position, field in enumerate(fields):
+        for reference in (field.get('field_id'), field.get('name')):
+            if reference:
+                positions_by_reference.setdefault(reference, position)
+
+    graph = {}
+    last_row_field = None
+    for position, field in enumerate(fields):
+        declared = field.get('depends_on')
+        if declared is None:
+            declared = referenced_fields(field, fields[:position])
+        deps = [last_row_field] if last_row_field is not None else []
+        for reference in declared:
+            dep = positions_by_reference.get(reference)
+            if dep is not None and dep < position and dep not in deps:
+                deps.append(dep)
+        graph[position] = deps
+        if position in row_fields:
+            last_row_field = position
+    return graph
+
+
+def critical_path_seconds(graph: Dict[Hashable, List[Hashable]], durations: Dict[Hashable, float]) -> float:
+    """Longest chain of durations through the graph (the fastest possible total)"""
+    finish: Dict[Hashable, float] = {}
+
+    def finish_time(node):
+        if node not in finish:
+            finish[node] = durations.get(node, 0.0) + max((finish_time(dep) for dep in graph[node]), default=0.0)
+        return finish[node]
+
+    return max((finish_time(node) for node in graph), default=0.0)
+
+
+def _log_progress(event: Dict[str, Any]):
+    status = event['status']
+    icon = {'started': '▶️', 'completed': '✅', 'failed': '❌', 'skipped': '⏭️'}[status]
+    timing = f" in {event['seconds']:.1f}s" if 'seconds' in event else ""
+    print(f"{icon} FIELD {status.upper()}: {event['label']}{timing} ({event['done']}/{event['total']} done)",
+          file=sys.stderr, flush=True)
+
+
+def run_field_graph(graph: Dict[Hashable, List[Hashable]], run: Callable[[Hashable, Dict[Hashable, Any]], Any],
+                    max_parallel: Optional[int] = None, labels: Optional[Dict[Hashable, str]] = None,
+                    on_progress: Optional[Callable[[Dict[str, Any]], None]] = None,
+                    stop_on_failure: Collection[Hashable] = ()) -> Dict[Hashable, Any]:
+    """
+    Run every node of a dependency graph, independent nodes in parallel
+
+    A node whose run raised still counts as done: its dependents start with
+    the results that are available (the failed node has no entry), the same
+    way a sequential run carries on after a failed field. If the failed
+    node is in stop_on_failure, its dependents - and theirs - are skipped
+    instead.
+
+    Parameters:
+        graph (dict): node -> nodes it depends on
+        run (callable): run(node, {dependency: result}) -> result
+        max_parallel (int): Nodes running at the same time (default from config)
+        labels (dict): node -> name for progress events
+        on_progress (callable): Receives each progress event dict
+        stop_on_failure (collection): Nodes whose failure skips their dependents
+
+    Returns:
+        dict: node -> result for the nodes that succeeded
+
+    Raises:
+        ValueError: The graph has a cycle or an unknown dependency
+    """
+    for node, deps in graph.items():
+        missing = [dep for dep in deps if dep not in graph]
+        if missing:
+            raise ValueError(f"{node!r} depends on unknown nodes {missing!r}")
+
+    max_parallel = max_parallel or get_max_parallel_fields()
+    labels = labels or {}
+    order = list(graph)
+    waiting = {node: set(deps) for node, deps in graph.items()}
+    dependents: Dict[Hashable, List[Hashable]] = {node: [] for node in graph}
+    for node, deps in graph.items():
+        for dep in deps:
+            dependents[dep].append(node)
+
+    results: Dict[Hashable, Any] = {}
+    durations: Dict[Hashable, float] = {}
+    blocked = set()     # Failed nodes in stop_on_failure and the nodes skipped because of them
+    ready = [node for node in order if not waiting[node]]
+    running = {}
+    done = 0
+    started_at = time.time()
+
+    def report(node, status, **extra):
+        event = dict(extra, node=node, label=labels.get(node, str(node)), status=status, done=done, total=len(graph))
+        _log_progress(event)
+        if on_progress:
+            try:
+                on_progress(event)
+            except Exception as e:
+                print(f"⚠️ Progress callback failed: {e}", file=sys.stderr, flush=True)
+
+    def timed(node, inputs):
+        start = time.time()
+        try:
+            return run(node, inputs), time.time() - start
+        except Exception as e:
+            e.seconds = time.time() - start
+            raise
+
+    def release(node):
+        for dependent in dependents[node]:
+            waiting[dependent].discard(node)
+            if not waiting[dependent]:
+                ready.append(dependent)
+        ready.sort(key=order.index)
+
+    with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+        while ready or running:
+            while ready and len(running) < max_parallel:
+                node = ready.pop(0)
+                failed = [dep for dep in graph[node] if dep in blocked]
+                if failed:
+                    blocked.add(node)
+                    done += 1
+                    report(node, 'skipped', error=f"{labels.get(failed[0], str(failed[0]))} did not complete")
+                    release(node)
+                    continue
+                inputs = {dep: results[dep] for dep in graph[node] if dep in results}
+                report(node, 'started')
+                future = executor.submit(contextvars.copy_context().run, timed, node, inputs)
+                running[future] = node
+
+            if not running:
+                continue
+            finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in finished:
+                node = running.pop(future)
+                done += 1
+                try:
+                    results[node], durations[node] = future.result()
+                    report(node, 'completed', seconds=durations[node])
+                except Exception as e:
+                    durations[node] = getattr(e, 'seconds', 0.0)
+                    report(node, 'failed', seconds=durations[node], error=str(e))
+                    if node in stop_on_failure:
+                        blocked.add(node)
+                release(node)
+
+    if done < len(graph):
+        stuck = [labels.get(node, str(node)) for node in order if waiting[node]]
+        raise ValueError(f"Dependency cycle between {', '.join(stuck)}")
+
+    elapsed = time.time() - started_at
+    print(f"🏁 FIELDS: {done} done in {elapsed:.1f}s (critical path {critical_path_seconds(graph, durations):.1f}s, "
+          f"sequential {sum(durations.values()):.1f}s, {max_parallel} in parallel)", file=sys.stderr, flush=True)
+    return results
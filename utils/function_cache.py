@@ -0,0 +1,167 @@
+"""
+Cache of compiled wizardry functions and CODE tools
+
+Stored functions are source text. Running one means compiling it,
+executing the module body to define the function, finding the entry point
+and inspecting its signature - work that is identical every time the same
+code runs for another field or document. The cache keeps the result,
+keyed by execution environment, function id and SHA-256 of the code:
+
+    compiled = get_function_cache().get('code_tool', function_id, code,
+                                         ('main', 'extract_data'), make_globals)
+    compiled.entry(...)
+
+Entries are evicted least recently used first. A code change produces a
+new key on its own; invalidate(function_id) drops the old entries as soon
+as a function is updated.
+
+Configured by extraction.functionCache:
+    enabled:    Reuse compiled functions (otherwise every call compiles)
+    maxEntries: Compiled functions kept per process
+"""
+
+import hashlib
+import inspect
+import sys
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Sequence, Tuple
+
+from utils.config import get_config
+
+DEFAULT_MAX_ENTRIES = 128
+
+
+class EntryPointNotFound(LookupError):
+    """The code ran but defines none of the expected entry point names"""
+
+
+def code_hash(code: str) -> str:
+    """SHA-256 of function source"""
+    return hashlib.sha256((code or '').encode('utf-8')).hexdigest()
+
+
+class CompiledFunction:
+    """
+    A function definition ready to call
+
+    Attributes:
+        entry_name:      Name of the resolved entry point
+        entry:           The entry point callable
+        parameter_count: Number of parameters the entry point declares
+        namespace:       Globals the code was executed in
+    """
+
+    __slots__ = ('entry_name', 'entry', 'parameter_count', 'namespace')
+
+    def __init__(self, entry_name: str, entry: Callable, parameter_count: int, namespace: Dict[str, Any]):
+        self.entry_name = entry_name
+        self.entry = entry
+        self.parameter_count = parameter_count
+        self.namespace = namespace
+
+
+def compile_function(code: str, entry_names: Sequence[str], namespace: Dict[str, Any],
+                     filename: str = '<stored function>') -> CompiledFunction:
+    """
+    Compile and execute function source, then resolve its entry point
+
+    Parameters:
+        code (str): Function source
+        entry_names (sequence): Accepted entry point names, in order of preference
+        namespace (dict): Globals to execute the code in
+        filename (str): Name shown in tracebacks
+
+    Returns:
+        CompiledFunction
+
+    Raises:
+        SyntaxError: The code does not compile
+        EntryPointNotFound: None of entry_names is defined
+    """
+    exec(compile(code, filename, 'exec'), namespace)
+    for name in entry_names:
+        entry = namespace.get(name)
+        if callable(entry):
+            return CompiledFunction(name, entry, len(inspect.signature(entry).parameters), namespace)
+    raise EntryPointNotFound(f"None of {', '.join(repr(name) for name in entry_names)} is defined")
+
+
+class FunctionCache:
+    """LRU cache of CompiledFunction by (environment, function id, code hash, entry names)"""
+
+    def __init__(self, max_entries: int = None, enabled: bool = None):
+        config = get_config('extraction.functionCache', {}) or {}
+        self.max_entries = max_entries if max_entries is not None else int(config.get('maxEntries', DEFAULT_MAX_ENTRIES))
+        self.enabled = enabled if enabled is not None else bool(config.get('enabled', True))
+        self._entries: 'OrderedDict[Tuple[str, str, str, Tuple[str, ...]], CompiledFunction]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def get(self, environment: str, function_id: Optional[str], code: str, entry_names: Sequence[str],
+            make_namespace: Callable[[], Dict[str, Any]]) -> CompiledFunction:
+        """
+        Compiled function for some source, compiling it on a miss
+
+        Parameters:
+            environment (str): Execution environment name (different globals, different entry)
+            function_id (str): Stored function id, if any (used for invalidation)
+            code (str): Function source
+            entry_names (sequence): Accepted entry point names
+            make_namespace (callable): Returns fresh globals for executing the code
+
+        Returns:
+            CompiledFunction
+
+        Raises:
+            SyntaxError, EntryPointNotFound: As compile_function; failures are not cached
+        """
+        filename = f"<{environment}:{function_id or 'inline'}>"
+        if not self.enabled:
+            return compile_function(code, entry_names, make_namespace(), filename)
+
+        # The entry point is resolved from entry_names, so they are part of the key
+        key = (environment, str(function_id or ''), code_hash(code), tuple(entry_names))
+        with self._lock:
+            compiled = self._entries.get(key)
+            if compiled is not None:
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return compiled
+            self.stats["misses"] += 1
+
+        compiled = compile_function(code, entry_names, make_namespace(), filename)
+        with self._lock:
+            self._entries[key] = compiled
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+        return compiled
+
+    def invalidate(self, function_id: str):
+        """Drop every compiled version of a stored function"""
+        with self._lock:
+            stale = [key for key in self._entries if key[1] == str(function_id)]
+            for key in stale:
+                del self._entries[key]
+            self.stats["invalidations"] += len(stale)
+        if stale:
+            print(f"🧹 FUNCTION CACHE: dropped {len(stale)} compiled version(s) of {function_id}", file=sys.stderr, flush=True)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_function_cache() -> FunctionCache:
+    """Get the process-wide compiled function cache"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = FunctionCache()
+    return _cache
@@ -0,0 +1,189 @@
+"""
+Catalogue of Excel wizardry functions: metadata listing, code on demand
+
+Routing only needs each function's id, name, description, tags and the
+sheet headers it was built for (metadata.header_signature); the code is
+needed for the one function that runs. list_functions() selects
+metadata only - plus updated_at and an md5 of the code computed by the
+database - and get_code(function_id) fetches source by id.
+
+Fetched source is kept in the process, versioned by updated_at. When a
+listing or lookup shows a newer updated_at, the cached source is reused
+only if its md5 still matches (usage count updates also move updated_at);
+otherwise it is fetched again. invalidate(function_id) drops an entry
+after the function is changed from this process.
+
+Configured by extraction.functionCatalogue:
+    maxCodeEntries: Function sources kept per process
+"""
+
+import hashlib
+import os
+import sys
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from utils.config import get_config
+
+DEFAULT_MAX_CODE_ENTRIES = 256
+
+METADATA_QUERY = """
+SELECT id, name, description, tags, usage_count, updated_at, metadata->>'header_signature',
+       md5(COALESCE(function_code, ''))
+FROM excel_wizardry_functions
+ORDER BY usage_count DESC, created_at DESC
+"""
+
+FUNCTION_QUERY = """
+SELECT id, name, description, tags, usage_count, updated_at, metadata->>'header_signature', function_code
+FROM excel_wizardry_functions
+WHERE id = %s
+"""
+
+
+def _code_md5(code: Optional[str]) -> str:
+    return hashlib.md5((code or '').encode('utf-8')).hexdigest()
+
+
+def _metadata(row) -> Dict[str, Any]:
+    func_id, name, description, tags, usage_count, updated_at, header_signature = row[:7]
+    return {
+        "id": str(func_id),
+        "name": name,
+        "description": description,
+        "tags": tags or [],
+        "usage_count": usage_count or 0,
+        "updated_at": updated_at.isoformat() if hasattr(updated_at, 'isoformat') else updated_at,
+        "header_signature": header_signature or "",
+    }
+
+
+class FunctionCatalogue:
+    """Function metadata from the database, with source fetched by id and cached by version"""
+
+    def __init__(self, database_url: str = None, max_code_entries: int = None):
+        config = get_config('extraction.functionCatalogue', {}) or {}
+        self.database_url = database_url
+        self.max_code_entries = max_code_entries if max_code_entries is not None else int(
+            config.get('maxCodeEntries', DEFAULT_MAX_CODE_ENTRIES))
+        self._versions: Dict[str, Tuple[Any, str]] = {}     # id -> (updated_at, md5) from the latest listing
+        self._listed: Dict[str, Dict[str, Any]] = {}        # id -> metadata from the latest listing
+        self._code: 'OrderedDict[str, Tuple[Any, str, str]]' = OrderedDict()   # id -> (updated_at, md5, code)
+        self._lock = threading.Lock()
+        self.stats = {"listings": 0, "code_hits": 0, "code_fetches": 0}
+
+    def _connect(self):
+        import psycopg2
+        database_url = self.database_url or os.getenv('DATABASE_URL')
+        if not database_url:
+            raise RuntimeError("DATABASE_URL not found")
+        return psycopg2.connect(database_url)
+
+    def list_functions(self) -> List[Dict[str, Any]]:
+        """
+        Every function's metadata (id, name, description, tags, usage_count, updated_at, header_signature), most used first
+
+        Raises:
+            RuntimeError, psycopg2.Error: The database is not available
+        """
+        conn = self._connect()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(METADATA_QUERY)
+                rows = cursor.fetchall()
+        finally:
+            conn.close()
+        functions = []
+        with self._lock:
+            self.stats["listings"] += 1
+            for row in rows:
+                function = _metadata(row)
+                self._versions[function["id"]] = (function["updated_at"], row[7])
+                self._listed[function["id"]] = function
+                functions.append(function)
+        return functions
+
+    def _cached(self, function_id: str) -> Optional[str]:
+        with self._lock:
+            entry = self._code.get(function_id)
+            if entry is None:
+                return None
+            known = self._versions.get(function_id)
+            if known is not None and entry[0] != known[0] and entry[1] != known[1]:
+                del self._code[function_id]
+                return None
+            self._code.move_to_end(function_id)
+            self.stats["code_hits"] += 1
+            return entry[2]
+
+    def _remember(self, function_id: str, updated_at: Any, code: str):
+        with self._lock:
+            md5 = _code_md5(code)
+            self._versions[function_id] = (updated_at, md5)
+            self._code[function_id] = (updated_at, md5, code)
+            self._code.move_to_end(function_id)
+            while len(self._code) > self.max_code_entries:
+                self._code.popitem(last=False)
+
+    def get_function(self, function_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Metadata and function_code of one function, or None if there is no such function
+
+        Served from memory when the function was listed and its cached source is current.
+
+        Raises:
+            RuntimeError, psycopg2.Error: The database is not available
+        """
+        function_id = str(function_id)
+        with self._lock:
+            listed = self._listed.get(function_id)
+        if listed is not None:
+            code = self._cached(function_id)
+            if code is not None:
+                return dict(listed, function_code=code)
+        conn = self._connect()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(FUNCTION_QUERY, (function_id,))
+                row = cursor.fetchone()
+        finally:
+            conn.close()
+        if not row:
+            return None
+        function = _metadata(row)
+        self._remember(function["id"], function["updated_at"], row[7])
+        with self._lock:
+            self.stats["code_fetches"] += 1
+        return dict(function, function_code=row[7])
+
+    def get_code(self, function_id: str) -> Optional[str]:
+        """Source of one function, from the cache when its version is current"""
+        function_id = str(function_id)
+        code = self._cached(function_id)
+        if code is not None:
+            return code
+        function = self.get_function(function_id)
+        return function["function_code"] if function else None
+
+    def invalidate(self, function_id: str):
+        """Forget a function's cached source and version"""
+        with self._lock:
+            dropped = self._code.pop(str(function_id), None)
+            self._versions.pop(str(function_id), None)
+            self._listed.pop(str(function_id), None)
+        if dropped:
+            print(f"🧹 FUNCTION CATALOGUE: dropped cached source of {function_id}", file=sys.stderr, flush=True)
+
+
+_catalogue = None
+_catalogue_lock = threading.Lock()
+
+
+def get_function_catalogue() -> FunctionCatalogue:
+    """Get the process-wide function catalogue"""
+    global _catalogue
+    with _catalogue_lock:
+        if _catalogue is None:
+            _catalogue = FunctionCatalogue()
+    return _catalogue
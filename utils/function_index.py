@@ -0,0 +1,170 @@
+"""
+Local retrieval of candidate Excel wizardry functions
+
+DOCUMENT_FORMAT_ANALYSIS used to list the whole function catalogue, so
+its prompt grew with every generated function. A TF-IDF index over each
+function's name, tags, description and the sheet headers it was built for
+(header_signature in its metadata) ranks the catalogue against the field
+being extracted and the workbook's sheet headers; only the top-k
+candidates go into the prompt.
+
+    candidates = select_candidate_functions(functions, documents, [target])
+
+Indexes are built once per catalogue version and scored through an
+inverted index, so scoring touches only the functions that share a term
+with the query. Functions sharing no term with the query are left
+out; when no function shares a term, the most used functions are offered
+instead, so older functions with sparse metadata are still reused.
+
+Configured by extraction.functionIndex:
+    enabled:          Narrow the catalogue (otherwise every function is sent)
+    topK:             Candidates sent to the analysis
+    minCatalogueSize: Below this many functions the whole catalogue is sent
+"""
+
+import heapq
+import math
+import re
+import sys
+import threading
+from collections import Counter, defaultdict
+from typing import Any, Dict, List, Tuple
+
+from utils.config import get_config
+from utils.tool_routing import NO_DOCUMENTS, SPREADSHEET_MIME_TYPES, catalogue_version, sheet_headers
+
+DEFAULT_TOP_K = 8
+DEFAULT_MIN_CATALOGUE_SIZE = 12
+
+# Term weight per function attribute
+FIELD_WEIGHTS = (('name', 2.0), ('tags', 2.0), ('description', 1.0), ('header_signature', 1.0))
+
+_TOKEN = re.compile(r'[a-z0-9]+')
+_STOP_WORDS = frozenset(
+    'a an and are as at be by each for from in into is it its of on or that the this to with'.split())
+
+
+def tokenize(text: Any) -> List[str]:
+    """Lowercase word tokens without stop words, single characters or plural s"""
+    if isinstance(text, (list, tuple)):
+        text = ' '.join(str(item) for item in text)
+    tokens = []
+    for token in _TOKEN.findall(str(text or '').lower()):
+        if len(token) < 2 or token in _STOP_WORDS:
+            continue
+        if len(token) > 3 and token.endswith('s') and not token.endswith('ss'):
+            token = token[:-1]
+        tokens.append(token)
+    return tokens
+
+
+def workbook_header_signature(documents: Any) -> str:
+    """Sheet markers and header lines of the spreadsheet documents, one per line"""
+    if documents == NO_DOCUMENTS or not documents:
+        return ""
+    lines = []
+    for document in documents:
+        if (document.get('type') or '').lower() in SPREADSHEET_MIME_TYPES:
+            lines.extend(sheet_headers(document.get('contentPreview') or ''))
+    return "\n".join(lines)
+
+
+class FunctionIndex:
+    """TF-IDF index over function metadata"""
+
+    def __init__(self, functions: List[Dict[str, Any]]):
+        self.functions = list(functions)
+        term_weights = []
+        document_frequency = Counter()
+        for function in self.functions:
+            weights = Counter()
+            for attribute, weight in FIELD_WEIGHTS:
+                for token in tokenize(function.get(attribute)):
+                    weights[token] += weight
+            term_weights.append(weights)
+            document_frequency.update(weights.keys())
+
+        count = len(self.functions)
+        self.idf = {term: math.log((1 + count) / (1 + frequency)) + 1 for term, frequency in document_frequency.items()}
+        self.postings: Dict[str, List[Tuple[int, float]]] = defaultdict(list)
+        self.norms = []
+        for position, weights in enumerate(term_weights):
+            vector = {term: (1 + math.log(weight)) * self.idf[term] for term, weight in weights.items() if weight > 0}
+            self.norms.append(math.sqrt(sum(value * value for value in vector.values())) or 1.0)
+            for term, value in vector.items():
+                self.postings[term].append((position, value))
+
+    def search(self, query: str, top_k: int) -> List[Tuple[Dict[str, Any], float]]:
+        """
+        Functions most similar to the query text
+
+        Returns:
+            list: (function, cosine similarity) pairs, best first, similarity > 0 only
+        """
+        query_terms = Counter(token for token in tokenize(query) if token in self.idf)
+        if not query_terms:
+            return []
+        query_vector = {term: (1 + math.log(count)) * self.idf[term] for term, count in query_terms.items()}
+        query_norm = math.sqrt(sum(value * value for value in query_vector.values()))
+        scores = defaultdict(float)
+        for term, query_value in query_vector.items():
+            for position, value in self.postings[term]:
+                scores[position] += query_value * value
+        best = heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+        return [(self.functions[position], score / (self.norms[position] * query_norm)) for position, score in best]
+
+
+_indexes: Dict[str, FunctionIndex] = {}
+_indexes_lock = threading.Lock()
+
+
+def get_function_index(functions: List[Dict[str, Any]]) -> FunctionIndex:
+    """Index for a function catalogue, reused while the catalogue version is unchanged"""
+    version = catalogue_version(functions) + str(len(functions))
+    with _indexes_lock:
+        index = _indexes.get(version)
+        if index is None:
+            index = FunctionIndex(functions)
+            _indexes.clear()
+            _indexes[version] = index
+    return index
+
+
+def field_query(target_fields: List[Dict[str, Any]], documents: Any) -> str:
+    """Query text for a field: names, descriptions and choices of the target fields plus the workbook headers"""
+    parts = []
+    for field in target_fields or []:
+        parts.extend([field.get('name') or '', field.get('description') or ''])
+        parts.extend(str(option) for option in field.get('choice_options') or [])
+    parts.append(workbook_header_signature(documents))
+    return "\n".join(parts)
+
+
+def select_candidate_functions(functions: List[Dict[str, Any]], documents: Any,
+                               target_fields: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    The functions to offer DOCUMENT_FORMAT_ANALYSIS for a field
+
+    Parameters:
+        functions (list): Function catalogue metadata
+        documents: Document dicts (id, name, type, contentPreview) or "NO DOCUMENTS SELECTED"
+        target_fields (list): Target field data
+
+    Returns:
+        list: The top-k most similar functions (the top-k most used when none is similar),
+              or the whole catalogue when it is small or the index is disabled
+    """
+    config = get_config('extraction.functionIndex', {}) or {}
+    top_k = int(config.get('topK', DEFAULT_TOP_K))
+    if not config.get('enabled', True) or len(functions) < max(top_k, int(config.get('minCatalogueSize', DEFAULT_MIN_CATALOGUE_SIZE))):
+        return list(functions)
+
+    results = get_function_index(functions).search(field_query(target_fields, documents), top_k)
+    if not results:
+        most_used = sorted(functions, key=lambda function: function.get('usage_count') or 0, reverse=True)[:top_k]
+        print(f"🔎 FUNCTION INDEX: no similar function, offering the {len(most_used)} most used of {len(functions)}",
+              file=sys.stderr, flush=True)
+        return most_used
+    best = ', '.join(f"{function.get('name')} {score:.2f}" for function, score in results[:3])
+    print(f"🔎 FUNCTION INDEX: {len(results)} of {len(functions)} functions offered ({best})", file=sys.stderr, flush=True)
+    return [function for function, _ in results]
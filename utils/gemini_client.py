@@ -0,0 +1,474 @@
+"""
+Shared Gemini client and streaming helpers
+"""
+
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from typing import Any, Callable, Iterator, Optional, Tuple
+
+from google import genai
+
+from utils.config import get_config
+from utils.json_stream import IncrementalJsonArrayParser
+from utils.rate_limiter import get_rate_limiter
+from utils.single_flight import get_single_flight
+from utils.token_budget import estimate_tokens
+from utils.usage_tracker import is_usage_tracking_enabled, record_usage
+
+IMAGE_PART_TOKENS = 258    # Gemini's token charge per image part
+
+_client = None
+_record_lock = threading.Lock()
+
+
+def get_gemini_client():
+    """
+    Get a process-wide Gemini client
+
+    The client talks to ai.baseUrl (or GEMINI_BASE_URL) when set, e.g. the
+    local stand-in in benchmarks/mock_gemini_server.py; no real API key is
+    needed then.
+
+    Returns:
+        genai.Client: Client using GEMINI_API_KEY (or GOOGLE_API_KEY)
+    """
+    global _client
+    if _client is None:
+        api_key = os.environ.get("GEMINI_API_KEY") or os.environ.get("GOOGLE_API_KEY")
+        base_url = get_config('ai.baseUrl')
+        if base_url:
+            print(f"Gemini client using base URL {base_url}", file=sys.stderr, flush=True)
+            _client = genai.Client(api_key=api_key or "local", http_options={"base_url": base_url})
+        else:
+            _client = genai.Client(api_key=api_key)
+    return _client
+
+
+def _prompt_pieces(contents: Any) -> Tuple[list, int]:
+    """Flatten prompt contents into text pieces, with inline data as '<mime:sha256>' markers
+
+    Returns:
+        tuple: (pieces, number of inline data parts)
+    """
+    pieces = []
+    inline_parts = []
+
+    def collect(value):
+        if value is None:
+            return
+        if isinstance(value, str):
+            pieces.append(value)
+        elif isinstance(value, (list, tuple)):
+            for item in value:
+                collect(item)
+        elif isinstance(value, dict):
+            collect(value.get('parts') if 'parts' in value else value.get('text'))
+        elif getattr(value, 'parts', None) is not None:
+            collect(value.parts)
+        else:
+            if getattr(value, 'text', None) is not None:
+                pieces.append(value.text)
+            inline = getattr(value, 'inline_data', None)
+            if inline is not None:
+                pieces.append(f"<{inline.mime_type}:{hashlib.sha256(inline.data or b'').hexdigest()}>")
+                inline_parts.append(inline.mime_type)
+
+    collect(contents)
+    return pieces, len(inline_parts)
+
+
+def prompt_fingerprint(model: str, contents: Any) -> str:
+    """
+    Fingerprint a prompt for recording, replay and de-duplication
+
+    Text parts are joined with newlines; inline data (images, PDFs)
+    contributes its MIME type and SHA-256. Matches request_fingerprint in
+    benchmarks/mock_gemini_server.py for the same request.
+
+    Parameters:
+        model (str): Gemini model name
+        contents: Prompt text, parts or Content objects
+
+    Returns:
+        str: SHA-256 hex digest
+    """
+    return hashlib.sha256("\n".join([model] + _prompt_pieces(contents)[0]).encode('utf-8')).hexdigest()
+
+
+def estimate_request_tokens(contents: Any) -> int:
+    """
+    Estimate the tokens a request will be charged for, before sending it
+
+    Prompt text is estimated with estimate_tokens, each inline part counts
+    as one image, and ai.rateLimits.outputTokenReserve is added for the
+    response. Reservations are corrected from usage metadata afterwards.
+    """
+    pieces, inline_parts = _prompt_pieces(contents)
+    text_tokens = sum(estimate_tokens(piece) for piece in pieces)
+    reserve = int(get_config('ai.rateLimits.outputTokenReserve', 1024))
+    return text_tokens + inline_parts * IMAGE_PART_TOKENS + reserve
+
+
+def _usage_tokens(response) -> Optional[int]:
+    """Total tokens from a response's usage metadata"""
+    usage = getattr(response, 'usage_metadata', None)
+    return getattr(usage, 'total_token_count', None) if usage else None
+
+
+def _finish_reason_name(reason) -> Optional[str]:
+    """'MAX_TOKENS' for FinishReason.MAX_TOKENS or the raw string"""
+    if reason is None:
+        return None
+    return str(getattr(reason, 'name', reason)).split('.')[-1]
+
+
+def is_truncated(finish_reason, usage_metadata=None, config: Any = None) -> bool:
+    """
+    Check whether a response was cut off by the output token limit
+
+    Parameters:
+        finish_reason: Candidate finish reason (enum or string)
+        usage_metadata: Response usage metadata
+        config: GenerateContentConfig the request was sent with
+
+    Returns:
+        bool: True for a MAX_TOKENS finish, or when the output tokens reached
+              the request's max_output_tokens
+    """
+    if _finish_reason_name(finish_reason) == 'MAX_TOKENS':
+        return True
+    limit = getattr(config, 'max_output_tokens', None) if config is not None else None
+    output_tokens = getattr(usage_metadata, 'candidates_token_count', None) if usage_metadata else None
+    return bool(limit and output_tokens and output_tokens >= limit)
+
+
+def response_truncated(response, config: Any = None) -> bool:
+    """True if a generate-content response was cut off by the output token limit"""
+    candidates = getattr(response, 'candidates', None)
+    finish_reason = getattr(candidates[0], 'finish_reason', None) if candidates else None
+    return is_truncated(finish_reason, getattr(response, 'usage_metadata', None), config)
+
+
+def _warn_if_truncated(model: str, truncated: bool, usage_metadata):
+    if truncated:
+        output_tokens = getattr(usage_metadata, 'candidates_token_count', None) if usage_metadata else None
+        print(f"✂️ {model} output hit the token limit ({output_tokens or '?'} output tokens) - response is incomplete",
+              file=sys.stderr, flush=True)
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """True for upstream 429 / RESOURCE_EXHAUSTED errors"""
+    return getattr(error, 'code', None) == 429 or 'RESOURCE_EXHAUSTED' in str(error)
+
+
+def _record_response(model: str, contents: Any, text: str):
+    """Append a response to GEMINI_RECORD_FILE for replay by the mock server"""
+    record_file = os.environ.get("GEMINI_RECORD_FILE")
+    if not record_file or text is None:
+        return
+    entry = {"fingerprint": prompt_fingerprint(model, contents), "model": model, "text": text}
+    try:
+        with _record_lock, open(record_file, 'a') as f:
+            f.write(json.dumps(entry) + "\n")
+    except OSError as e:
+        print(f"⚠️ Could not record Gemini response: {e}", file=sys.stderr, flush=True)
+
+
+def request_key(model: str, contents: Any, config: Any = None) -> str:
+    """
+    Identity of a request for single-flight coalescing
+
+    The prompt fingerprint plus the generation config, so identical prompts
+    with different temperatures or response schemas are not merged.
+    """
+    if config is None:
+        config_text = ""
+    elif hasattr(config, 'model_dump_json'):
+        config_text = config.model_dump_json(exclude_none=True)
+    else:
+        config_text = json.dumps(config, sort_keys=True, default=str)
+    return hashlib.sha256(f"{prompt_fingerprint(model, contents)}\n{config_text}".encode('utf-8')).hexdigest()
+
+
+def _serialize_response(response) -> str:
+    return response.model_dump_json(exclude_none=True)
+
+
+def _deserialize_response(text: str):
+    from google.genai import types
+    return types.GenerateContentResponse.model_validate_json(text)
+
+
+def generate_content(model: str, contents: Any, config: Any = None):
+    """
+    Send a generate-content request through the shared client
+
+    When ai.singleFlight is enabled, concurrent identical requests (same
+    prompt fingerprint and config) share one upstream call. When
+    ai.rateLimits is enabled the call waits its turn for quota, and a 429
+    drains the shared buckets and re-queues the request. Token usage,
+    latency and retries of each upstream call go to utils.usage_tracker.
+
+    Parameters:
+        model (str): Gemini model name
+        contents: Prompt text or list of Content/parts
+        config: Optional GenerateContentConfig
+
+    Returns:
+        GenerateContentResponse: SDK response
+    """
+    flight = get_single_flight()
+    if flight:
+        return flight.do(request_key(model, contents, config),
+                         lambda: _generate_content(model, contents, config),
+                         _serialize_response, _deserialize_response)
+    return _generate_content(model, contents, config)
+
+
+def _generate_content(model: str, contents: Any, config: Any = None):
+    """Upstream call with quota, 429 re-queueing, usage settlement, accounting and recording"""
+    kwargs = {"model": model, "contents": contents}
+    if config is not None:
+        kwargs["config"] = config
+
+    limiter = get_rate_limiter()
+    estimate = estimate_request_tokens(contents) if limiter else 0
+    retries = int(get_config('ai.rateLimits.maxRetries', 3)) if limiter else 0
+
+    queued = 0.0
+    for attempt in range(retries + 1):
+        reservation = limiter.acquire(model, estimate) if limiter else None
+        queued += reservation.waited if reservation else 0
+        started = time.time()
+        try:
+            response = get_gemini_client().models.generate_content(**kwargs)
+        except Exception as e:
+            if reservation:
+                # Nothing was generated: give the estimated tokens back
+                reservation.settle(0)
+            if limiter and attempt < retries and is_rate_limit_error(e):
+                print(f"⏳ RATE LIMIT: {model} returned 429 - re-queueing (attempt {attempt + 1}/{retries})", file=sys.stderr, flush=True)
+                limiter.penalize(model)
+                continue
+            raise
+        record_usage(model, getattr(response, 'usage_metadata', None), (time.time() - started) * 1000,
+                     retries=attempt, queued_ms=queued * 1000)
+        if reservation:
+            reservation.settle(_usage_tokens(response))
+        _warn_if_truncated(model, response_truncated(response, config), getattr(response, 'usage_metadata', None))
+        _record_response(model, contents, response.text)
+        return response
+
+
+def generate_content_stream(model: str, contents: Any, config: Any = None):
+    """
+    Send a streaming generate-content request through the shared client
+
+    Rate limiting, usage accounting and recording work as in generate_content; a 429 is only
+    retried if it arrives before the first chunk. When ai.singleFlight is
+    enabled, concurrent identical streams share one upstream stream: a
+    caller joining mid-stream first gets the chunks already received, and
+    a caller in another process gets the finished response as one chunk.
+
+    Parameters:
+        model (str): Gemini model name
+        contents: Prompt text or list of Content/parts
+        config: Optional GenerateContentConfig
+
+    Returns:
+        Iterator of GenerateContentResponse chunks
+    """
+    flight = get_single_flight()
+    if flight:
+        return flight.stream(request_key(model, contents, config),
+                             lambda: _generate_content_stream(model, contents, config),
+                             _merge_stream_chunks, _serialize_response, _deserialize_response)
+    return _generate_content_stream(model, contents, config)
+
+
+def _generate_content_stream(model: str, contents: Any, config: Any = None):
+    """Upstream stream, managed when quota, usage tracking or recording need to see it"""
+    kwargs = {"model": model, "contents": contents}
+    if config is not None:
+        kwargs["config"] = config
+
+    limiter = get_rate_limiter()
+    if not limiter and not os.environ.get("GEMINI_RECORD_FILE") and not is_usage_tracking_enabled():
+        return get_gemini_client().models.generate_content_stream(**kwargs)
+    return _managed_stream(model, contents, kwargs, limiter)
+
+
+def _merge_stream_chunks(chunks: list):
+    """One response with the text of every chunk and the last chunk's finish reason and usage"""
+    from google.genai import types
+    merged = chunks[-1].model_dump(mode='json', exclude_none=True)
+    candidates = merged.get('candidates') or [{}]
+    candidates[0]['content'] = {"role": "model", "parts": [{"text": "".join(chunk.text or "" for chunk in chunks)}]}
+    merged['candidates'] = candidates
+    return types.GenerateContentResponse.model_validate(merged)
+
+
+def _managed_stream(model: str, contents: Any, kwargs: dict, limiter):
+    """Stream chunks with quota, 429 re-queueing, usage settlement, accounting and recording"""
+    estimate = estimate_request_tokens(contents) if limiter else 0
+    retries = int(get_config('ai.rateLimits.maxRetries', 3)) if limiter else 0
+
+    queued = 0.0
+    for attempt in range(retries + 1):
+        reservation = limiter.acquire(model, estimate) if limiter else None
+        queued += reservation.waited if reservation else 0
+        started = time.time()
+        parts = []
+        usage_metadata = None
+        try:
+            for chunk in get_gemini_client().models.generate_content_stream(**kwargs):
+                usage_metadata = getattr(chunk, 'usage_metadata', None) or usage_metadata
+                parts.append(chunk.text or "")
+                yield chunk
+        except GeneratorExit:
+            # Abandoned by the consumer (e.g. a losing hedge): the tokens so far are still billed
+            record_usage(model, usage_metadata, (time.time() - started) * 1000, retries=attempt,
+                         queued_ms=queued * 1000, streamed=True)
+            if reservation:
+                reservation.settle(getattr(usage_metadata, 'total_token_count', None))
+            raise
+        except Exception as e:
+            if reservation:
+                reservation.settle(getattr(usage_metadata, 'total_token_count', None) or 0)
+            if limiter and not parts and attempt < retries and is_rate_limit_error(e):
+                print(f"⏳ RATE LIMIT: {model} returned 429 - re-queueing (attempt {attempt + 1}/{retries})", file=sys.stderr, flush=True)
+                limiter.penalize(model)
+                continue
+            raise
+        record_usage(model, usage_metadata, (time.time() - started) * 1000, retries=attempt,
+                     queued_ms=queued * 1000, streamed=True)
+        if reservation:
+            reservation.settle(getattr(usage_metadata, 'total_token_count', None))
+        _record_response(model, contents, "".join(parts))
+        return
+
+
+def is_streaming_enabled() -> bool:
+    """
+    Check whether responses should be streamed
+
+    Returns:
+        bool: Value of ai.streaming.enabled in config.json (default True)
+    """
+    return bool(get_config('ai.streaming.enabled', True))
+
+
+class GeminiJsonStream:
+    """
+    Stream a Gemini response and yield JSON array records as they arrive
+
+    Iterating yields (key, record) tuples from IncrementalJsonArrayParser.
+    Until the first record arrives the response text is kept in .text, so
+    callers can fall back to whole-response parsing when the output is not
+    an array of records. Once records flow the text is no longer held.
+
+    Usage:
+        stream = GeminiJsonStream(model, contents)
+        for key, record in stream:
+            ...
+        stream.text, stream.complete, stream.truncated
+
+    .truncated is set once the stream ends if the output token limit cut
+    the response off (see utils.continuation to resume it).
+
+    stream_json_records() drains the stream and fills .records.
+    """
+
+    def __init__(self, model: str, contents: Any, config: Any = None, record_depth: int = 1,
+                 client=None, label: str = "AI", keep_skeleton: bool = False):
+        self.model = model
+        self.contents = contents
+        self.config = config
+        self.client = client
+        self.label = label
+        self.parser = IncrementalJsonArrayParser(record_depth, keep_skeleton)
+        self.records = []
+        self.text = ""
+        self.finish_reason = None
+        self.usage_metadata = None
+        self.truncated = False
+        self.first_record_seconds: Optional[float] = None
+        self.total_seconds: Optional[float] = None
+
+    @property
+    def complete(self) -> bool:
+        """True if the streamed JSON document was closed"""
+        return self.parser.complete
+
+    @property
+    def records_parsed(self) -> int:
+        return self.parser.records_parsed
+
+    def __iter__(self) -> Iterator[Tuple[Optional[str], Any]]:
+        started = time.time()
+        parts = []
+        if self.client is not None:
+            kwargs = {"model": self.model, "contents": self.contents}
+            if self.config is not None:
+                kwargs["config"] = self.config
+            chunks = self.client.models.generate_content_stream(**kwargs)
+        else:
+            chunks = generate_content_stream(self.model, self.contents, self.config)
+
+        for chunk in chunks:
+            if getattr(chunk, 'usage_metadata', None):
+                self.usage_metadata = chunk.usage_metadata
+            candidates = getattr(chunk, 'candidates', None)
+            if candidates and getattr(candidates[0], 'finish_reason', None):
+                self.finish_reason = candidates[0].finish_reason
+
+            fragment = chunk.text or ""
+            if not fragment:
+                continue
+            if self.first_record_seconds is None:
+                parts.append(fragment)
+
+            for key, record in self.parser.feed(fragment):
+                if self.first_record_seconds is None:
+                    self.first_record_seconds = time.time() - started
+                    parts = []
+                    print(f"⚡ {self.label} STREAM: first record after {self.first_record_seconds:.2f}s", file=sys.stderr, flush=True)
+                yield key, record
+
+        self.text = "".join(parts)
+        self.total_seconds = time.time() - started
+        self.truncated = is_truncated(self.finish_reason, self.usage_metadata, self.config)
+        print(f"⚡ {self.label} STREAM: {self.records_parsed} records in {self.total_seconds:.2f}s", file=sys.stderr, flush=True)
+        _warn_if_truncated(self.model, self.truncated, self.usage_metadata)
+
+
+def stream_json_records(model: str, contents: Any, config: Any = None, record_depth: int = 1,
+                        on_record: Optional[Callable[[Any], None]] = None, label: str = "AI",
+                        keep_skeleton: bool = False):
+    """
+    Stream a response and collect its array records, calling on_record for each
+
+    Parameters:
+        model (str): Gemini model name
+        contents: Prompt contents for generate_content_stream
+        config: Optional GenerateContentConfig
+        record_depth (int): Array depth holding the records (1 = top-level array)
+        on_record (callable): Called with each record as soon as it is parsed
+        label (str): Prefix for log lines
+        keep_skeleton (bool): Keep the text around the records (see stream.parser.skeleton())
+
+    Returns:
+        GeminiJsonStream: Exhausted stream; records are in stream.records,
+                          as (key, record) tuples when record_depth > 1
+    """
+    stream = GeminiJsonStream(model, contents, config=config, record_depth=record_depth, label=label,
+                              keep_skeleton=keep_skeleton)
+    for key, record in stream:
+        stream.records.append((key, record) if record_depth > 1 else record)
+        if on_record:
+            on_record(record)
+    return stream
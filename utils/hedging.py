@@ -0,0 +1,428 @@
+"""
+Deadlines, hedged requests and circuit breaking for Gemini calls
+
+hedged_call() runs one model call with:
+
+- a deadline: the caller gets DeadlineExceeded instead of blocking on a
+  stalled request (the stalled thread is abandoned, not killed)
+- hedging: if no answer has arrived after the model's recent latency
+  percentile, a duplicate request is sent and the first good answer wins
+- a circuit breaker per model: when the recent error rate spikes the
+  breaker opens, calls fail fast or go to the fallback model, and after a
+  cool-down one probe request decides whether it closes again
+
+Latency samples and breaker state are shared between service processes
+through a utils.state_store backend. Every call appends a metrics line
+(hedged, which attempt won, fallback, breaker state) to the metrics file;
+summarize_hedging_metrics() aggregates it.
+"""
+
+import contextvars
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+from typing import Any, Callable, Dict, Optional
+
+from utils.config import get_config
+from utils.single_flight import set_single_flight_bypass
+from utils.state_store import build_state_store
+
+DEFAULT_STATE_DIR = 'logs/hedging'
+LATENCY_SAMPLES = 200          # Successful latencies kept per model for the hedge delay
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+_metrics_lock = threading.Lock()
+
+
+class DeadlineExceeded(TimeoutError):
+    """Raised when no attempt answers within the call deadline"""
+
+
+class CircuitOpenError(Exception):
+    """Raised when the model's breaker is open and no fallback is available"""
+
+
+def get_hedging_config() -> dict:
+    """
+    Get the hedging configuration
+
+    Returns:
+        dict: ai.hedging from config.json
+    """
+    return get_config('ai.hedging', {}) or {}
+
+
+class Attempt:
+    """One request inside a hedged call"""
+
+    def __init__(self, index: int, model: str, race: 'Race'):
+        self.index = index
+        self.model = model
+        self.race = race
+
+    @property
+    def is_hedge(self) -> bool:
+        return self.index > 0
+
+    def claim(self) -> bool:
+        """
+        Claim the call before producing side effects (e.g. streaming records to a callback)
+
+        The first attempt to claim becomes the winner; later results of the
+        other attempts are discarded.
+
+        Returns:
+            bool: True if this attempt owns the call
+        """
+        with self.race.lock:
+            if self.race.claimed is None:
+                self.race.claimed = self.index
+            return self.race.claimed == self.index
+
+
+class Race:
+    """Shared state of the attempts of one hedged call"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.claimed: Optional[int] = None
+        self.results = queue.Queue()
+
+
+class CircuitBreaker:
+    """
+    Error-rate circuit breaker for one model, persisted in a state store
+
+    Configured by ai.hedging.circuitBreaker:
+        errorRateThreshold: Open when this share of recent calls failed
+        minRequests:        ...and at least this many calls are in the window
+        windowSeconds:      How far back outcomes count
+        cooldownSeconds:    How long the breaker stays open before a probe
+    """
+
+    def __init__(self, model: str, store, config: Dict = None):
+        config = config or {}
+        self.model = model
+        self.store = store
+        self.threshold = float(config.get('errorRateThreshold', 0.5))
+        self.min_requests = int(config.get('minRequests', 5))
+        self.window = float(config.get('windowSeconds', 120))
+        self.cooldown = float(config.get('cooldownSeconds', 60))
+        self.probe_timeout = float(config.get('probeTimeoutSeconds', 300))
+
+    def _breaker(self, state: dict) -> dict:
+        return state.setdefault('breakers', {}).setdefault(self.model, {"state": CLOSED, "events": []})
+
+    def state(self) -> str:
+        with self.store.transaction() as state:
+            return self._breaker(state)['state']
+
+    def allow(self) -> bool:
+        """Check whether a request may go to this model (half-open admits a single probe)"""
+        with self.store.transaction() as state:
+            breaker = self._breaker(state)
+            now = time.time()
+            if breaker['state'] == CLOSED:
+                return True
+            if breaker['state'] == OPEN and now - breaker.get('opened_at', 0) >= self.cooldown:
+                breaker['state'] = HALF_OPEN
+                breaker['probe_at'] = now
+                print(f"🔌 CIRCUIT BREAKER: {self.model} half-open - sending probe", file=sys.stderr, flush=True)
+                return True
+            if breaker['state'] == HALF_OPEN and now - breaker.get('probe_at', 0) >= self.probe_timeout:
+                # The probe never reported back (its process died); allow another
+                breaker['probe_at'] = now
+                return True
+            return False
+
+    def record(self, ok: bool):
+        """Record the outcome of a request"""
+        with self.store.transaction() as state:
+            breaker = self._breaker(state)
+            now = time.time()
+            if breaker['state'] == HALF_OPEN:
+                if ok:
+                    breaker.update({"state": CLOSED, "events": []})
+                    print(f"🔌 CIRCUIT BREAKER: {self.model} closed", file=sys.stderr, flush=True)
+                else:
+                    breaker.update({"state": OPEN, "opened_at": now})
+                    print(f"🔌 CIRCUIT BREAKER: {self.model} probe failed - open again", file=sys.stderr, flush=True)
+                return
+            if breaker['state'] == OPEN:
+                return
+
+            events = [event for event in breaker['events'] if now - event[0] < self.window]
+            events.append([now, 1 if ok else 0])
+            breaker['events'] = events
+            failures = sum(1 for event in events if not event[1])
+            if len(events) >= self.min_requests and failures / len(events) >= self.threshold:
+                breaker.update({"state": OPEN, "opened_at": now, "events": []})
+                print(f"🔌 CIRCUIT BREAKER: {self.model} open - {failures}/{len(events)} recent calls failed",
+                      file=sys.stderr, flush=True)
+
+
+class Hedger:
+    """
+    Hedged, deadline-bound calls with per-model circuit breakers
+
+    Configured by ai.hedging:
+        deadlineSeconds:          Overall deadline per call
+        hedgePercentile:          Latency percentile after which a hedge is sent
+        minHedgeDelaySeconds:     Never hedge earlier than this
+        defaultHedgeDelaySeconds: Hedge delay until minSamples latencies are known
+        minSamples:               Latencies needed before the percentile is used
+        maxHedges:                Duplicate requests per call
+        fallbacks:                Model -> fallback model when its breaker is open
+    """
+
+    def __init__(self, config: Dict = None, store=None):
+        self.config = config if config is not None else get_hedging_config()
+        self.enabled = bool(self.config.get('enabled', False))
+        self.deadline = float(self.config.get('deadlineSeconds', 300))
+        self.percentile = float(self.config.get('hedgePercentile', 95))
+        self.min_delay = float(self.config.get('minHedgeDelaySeconds', 20))
+        self.default_delay = float(self.config.get('defaultHedgeDelaySeconds', 60))
+        self.min_samples = int(self.config.get('minSamples', 20))
+        self.max_hedges = int(self.config.get('maxHedges', 1))
+        self.fallbacks = self.config.get('fallbacks', {}) or {}
+        self.metrics_file = self.config.get('metricsFile', 'logs/hedging_metrics.jsonl')
+        self.store = store or build_state_store(self.config.get('backend', 'file'),
+                                                self.config.get('stateDir', DEFAULT_STATE_DIR), 'hedging')
+
+    def breaker(self, model: str) -> CircuitBreaker:
+        return CircuitBreaker(model, self.store, self.config.get('circuitBreaker'))
+
+    def hedge_delay(self, model: str) -> float:
+        """Seconds to wait for the first attempt before sending a hedge"""
+        with self.store.transaction() as state:
+            samples = sorted(state.get('latencies', {}).get(model, []))
+        if len(samples) < self.min_samples:
+            return self.default_delay
+        index = min(len(samples) - 1, int(len(samples) * self.percentile / 100))
+        return max(self.min_delay, samples[index])
+
+    def _record_latency(self, model: str, seconds: float):
+        with self.store.transaction() as state:
+            samples = state.setdefault('latencies', {}).setdefault(model, [])
+            samples.append(round(seconds, 3))
+            del samples[:-LATENCY_SAMPLES]
+
+    def call(self, call_site: str, fn: Callable[[str, Attempt], Any], model: str,
+             accept: Callable[[Any], bool] = None) -> Any:
+        """
+        Run fn(model, attempt) with a deadline, hedging and circuit breaking
+
+        Parameters:
+            call_site (str): Name used in metrics
+            fn (callable): Makes the request; returns the answer or raises
+            model (str): Preferred model
+            accept (callable): Decides whether an answer is good (default: truthy)
+
+        Returns:
+            The winning attempt's answer
+
+        Raises:
+            DeadlineExceeded: If no attempt answers within deadlineSeconds
+            CircuitOpenError: If the model and its fallback are both unavailable
+            Exception: The error of the last failing attempt
+        """
+        accept = accept or bool
+        chosen, fallback = self._choose_model(model)
+        race = Race()
+        started = time.time()
+        deadline_at = started + self.deadline
+        hedge_delay = self.hedge_delay(chosen)
+        hedge_at = started + hedge_delay
+        attempts = []
+        pending = 0
+        last_error: Optional[BaseException] = None
+        last_answer = None
+        metrics = {"call_site": call_site, "model": model, "chosen_model": chosen, "fallback": fallback}
+
+        def launch():
+            attempt = Attempt(len(attempts), chosen, race)
+            attempts.append(attempt)
+            context = contextvars.copy_context()
+            thread = threading.Thread(target=context.run, args=(self._run_attempt, fn, attempt, race), daemon=True)
+            thread.start()
+            return attempt
+
+        launch()
+        pending += 1
+
+        while True:
+            now = time.time()
+            can_hedge = len(attempts) <= self.max_hedges and race.claimed is None
+            wake_at = min(deadline_at, hedge_at) if can_hedge else deadline_at
+            try:
+                attempt, ok, value, seconds = race.results.get(timeout=max(0.0, wake_at - now))
+            except queue.Empty:
+                if time.time() >= deadline_at:
+                    break
+                if can_hedge:
+                    print(f"🏁 HEDGE: {call_site} no answer from {chosen} after {time.time() - started:.1f}s - sending duplicate",
+                          file=sys.stderr, flush=True)
+                    launch()
+                    pending += 1
+                    hedge_at = time.time() + hedge_delay
+                continue
+
+            pending -= 1
+            good = ok and accept(value)
+            self.breaker(attempt.model).record(ok)
+            if ok:
+                self._record_latency(attempt.model, seconds)
+
+            owner = race.claimed
+            if good and (owner is None or owner == attempt.index):
+                self._write_metrics(dict(metrics, hedged=len(attempts) > 1, winner=attempt.index,
+                                         latency_ms=round((time.time() - started) * 1000)))
+                if attempt.is_hedge:
+                    print(f"🏁 HEDGE: {call_site} duplicate won after {time.time() - started:.1f}s", file=sys.stderr, flush=True)
+                return value
+
+            if ok:
+                last_answer, last_error = value, None
+            else:
+                last_error = value
+            if owner == attempt.index or pending == 0:
+                # The claiming attempt failed, or nothing else is running: no better answer is coming
+                self._write_metrics(dict(metrics, hedged=len(attempts) > 1, winner=None, failed=True,
+                                         latency_ms=round((time.time() - started) * 1000)))
+                if last_error is not None:
+                    raise last_error
+                return last_answer
+
+        self.breaker(chosen).record(False)
+        self._write_metrics(dict(metrics, hedged=len(attempts) > 1, winner=None, deadline_exceeded=True,
+                                 latency_ms=round((time.time() - started) * 1000)))
+        raise DeadlineExceeded(f"{call_site}: no answer from {chosen} within {self.deadline:.0f}s")
+
+    def _choose_model(self, model: str):
+        """(model to call, True if it is the fallback) based on breaker state"""
+        if self.breaker(model).allow():
+            return model, False
+        fallback = self.fallbacks.get(model)
+        if fallback and self.breaker(fallback).allow():
+            print(f"🔌 CIRCUIT BREAKER: {model} open - using fallback {fallback}", file=sys.stderr, flush=True)
+            return fallback, True
+        self._write_metrics({"model": model, "circuit_open": True})
+        raise CircuitOpenError(f"Circuit open for {model}" + (f" and fallback {fallback}" if fallback else ""))
+
+    @staticmethod
+    def _run_attempt(fn: Callable[[str, Attempt], Any], attempt: Attempt, race: Race):
+        # A duplicate must reach upstream rather than join the first attempt's single-flight call
+        set_single_flight_bypass(attempt.is_hedge)
+        started = time.time()
+        try:
+            race.results.put((attempt, True, fn(attempt.model, attempt), time.time() - started))
+        except BaseException as e:
+            race.results.put((attempt, False, e, time.time() - started))
+
+    def _write_metrics(self, entry: Dict[str, Any]):
+        entry = dict(entry, timestamp=datetime.utcnow().isoformat())
+        model = entry.get('chosen_model') or entry.get('model')
+        try:
+            entry['breaker'] = self.breaker(model).state()
+        except Exception:
+            entry['breaker'] = None
+        try:
+            directory = os.path.dirname(self.metrics_file)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with _metrics_lock, open(self.metrics_file, 'a') as f:
+                f.write(json.dumps(entry) + "\n")
+        except OSError as e:
+            print(f"⚠️ Could not write hedging metrics: {e}", file=sys.stderr, flush=True)
+
+
+_hedger = None
+_hedger_lock = threading.Lock()
+
+
+def get_hedger() -> Hedger:
+    """Get the process-wide hedger"""
+    global _hedger
+    with _hedger_lock:
+        if _hedger is None:
+            _hedger = Hedger()
+    return _hedger
+
+
+def hedged_call(call_site: str, fn: Callable[[str, Attempt], Any], model: str,
+                accept: Callable[[Any], bool] = None) -> Any:
+    """
+    Call fn(model, attempt) through the hedger, or directly when ai.hedging.enabled is off
+
+    See Hedger.call. fn must call attempt.claim() before side effects that
+    cannot be undone if a duplicate wins instead.
+    """
+    hedger = get_hedger()
+    if not hedger.enabled:
+        return fn(model, Attempt(0, model, Race()))
+    return hedger.call(call_site, fn, model, accept)
+
+
+def summarize_hedging_metrics(metrics_file: str = None) -> Dict[str, Dict[str, Any]]:
+    """
+    Summarize hedging metrics per call site
+
+    Parameters:
+        metrics_file (str): JSONL metrics file (defaults to ai.hedging.metricsFile)
+
+    Returns:
+        dict: {"call_sites": call site -> calls, hedge rate, hedge win rate, fallback and deadline counts,
+               "breakers": last seen breaker state per model,
+               "circuit_open_rejections": calls refused with no fallback}
+    """
+    metrics_file = metrics_file or get_hedging_config().get('metricsFile', 'logs/hedging_metrics.jsonl')
+    if not os.path.exists(metrics_file):
+        return {}
+
+    sites = defaultdict(lambda: {"calls": 0, "hedged": 0, "hedge_wins": 0, "fallbacks": 0,
+                                 "deadline_exceeded": 0, "failed": 0, "latency_ms": []})
+    breakers = {}
+    rejections = 0
+    with open(metrics_file, 'r') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            breakers[entry.get('chosen_model') or entry.get('model')] = entry.get('breaker')
+            if entry.get('circuit_open'):
+                rejections += 1
+                continue
+            site = sites[entry.get('call_site')]
+            site["calls"] += 1
+            site["hedged"] += 1 if entry.get('hedged') else 0
+            site["hedge_wins"] += 1 if (entry.get('winner') or 0) > 0 else 0
+            site["fallbacks"] += 1 if entry.get('fallback') else 0
+            site["deadline_exceeded"] += 1 if entry.get('deadline_exceeded') else 0
+            site["failed"] += 1 if entry.get('failed') else 0
+            if entry.get('latency_ms') is not None:
+                site["latency_ms"].append(entry['latency_ms'])
+
+    call_sites = {}
+    for name, site in sites.items():
+        latencies = sorted(site.pop("latency_ms"))
+        call_sites[name] = dict(
+            site,
+            hedge_rate=round(site["hedged"] / site["calls"], 3) if site["calls"] else None,
+            hedge_win_rate=round(site["hedge_wins"] / site["hedged"], 3) if site["hedged"] else None,
+            p50_ms=latencies[len(latencies) // 2] if latencies else None,
+            p99_ms=latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] if latencies else None,
+        )
+    return {"call_sites": call_sites, "breakers": breakers, "circuit_open_rejections": rejections}
+
+
+if __name__ == "__main__":
+    print(json.dumps(summarize_hedging_metrics(sys.argv[1] if len(sys.argv) > 1 else None), indent=2))
@@ -0,0 +1,308 @@
+"""
+Identifier references shared between the fields of an extraction run
+
+Each extracted field contributes one column of values per record
+(record index -> value). Later fields receive the columns they depend on
+as identifier references, in one of two list formats:
+
+    plain:   [{"Member ID": "A1", "Name": "Ann"}, ...]        (indexed by position)
+    indexed: [{"Member ID[0]": "A1", "Name[0]": "Ann"}, ...]  (database loader format)
+
+IdentifierReferenceTable holds them by column (names once, one list of
+values per column, record index implicit); to_references() converts back
+to the list formats at the edges.
+
+IdentifierReferenceStore holds the merged references of one session in
+memory for the length of a run: a completed field appends its column and
+persists only that column, instead of the whole table being re-read and
+re-merged from the database for every field. The database is read once,
+when a run resumes after earlier extractions.
+"""
+
+import re
+import sys
+import threading
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+INDEXED_REFERENCE_KEY = re.compile(r'^(.*)\[(\d+)\]$')   # "Field[3]" keys from load_merged_identifier_references_from_db
+BASE = 'base'   # Column owner for references that existed before the run
+
+
+_MISSING = object()   # Cell with no value (a record the column does not cover)
+
+
+class IdentifierReferenceTable:
+    """
+    Identifier references stored by column
+
+    Column names are held once, each column is a list of values and the
+    record index is the position in that list - instead of one dict per
+    record with a "Field[i]" key per value. to_references() is the adapter
+    to the list-of-dicts format that functions, prompts and the database
+    writer take.
+
+    Columns may be shorter than the table; missing cells have no value.
+    Tables returned by overlay() share column lists with their inputs, so
+    a table is not modified once it has been handed on.
+    """
+
+    __slots__ = ('_columns', 'size')
+
+    def __init__(self, columns: Dict[str, List[Any]] = None, size: int = None):
+        self._columns: Dict[str, List[Any]] = columns or {}
+        self.size = size if size is not None else max((len(values) for values in self._columns.values()), default=0)
+
+    @classmethod
+    def from_references(cls, identifier_references) -> 'IdentifierReferenceTable':
+        """Table from the plain or the indexed ("Field[i]") list format"""
+        table = cls()
+        for position, reference in enumerate(identifier_references or []):
+            if not isinstance(reference, dict):
+                continue
+            for key, value in reference.items():
+                match = INDEXED_REFERENCE_KEY.match(key)
+                if match:
+                    table.set(int(match.group(2)), match.group(1), value)
+                else:
+                    table.set(position, key, value)
+        return table
+
+    @classmethod
+    def from_rows(cls, rows: Dict[int, Dict[str, Any]]) -> 'IdentifierReferenceTable':
+        """Table from {record_index: {field_name: value}}"""
+        table = cls()
+        for record_index, values in (rows or {}).items():
+            for field_name, value in values.items():
+                table.set(record_index, field_name, value)
+        return table
+
+    @classmethod
+    def overlay(cls, *tables: 'IdentifierReferenceTable') -> 'IdentifierReferenceTable':
+        """Merge by record index; later tables win where they have a value"""
+        columns: Dict[str, List[Any]] = {}
+        owned = set()
+        for table in tables:
+            for name, values in table._columns.items():
+                if name not in columns:
+                    columns[name] = values
+                    continue
+                if name not in owned:
+                    columns[name] = list(columns[name])
+                    owned.add(name)
+                merged = columns[name]
+                if len(merged) < len(values):
+                    merged.extend([_MISSING] * (len(values) - len(merged)))
+                for record_index, value in enumerate(values):
+                    if value is not _MISSING:
+                        merged[record_index] = value
+        return cls(columns, max((table.size for table in tables), default=0))
+
+    def set(self, record_index: int, field_name: str, value: Any):
+        values = self._columns.setdefault(field_name, [])
+        if record_index >= len(values):
+            values.extend([_MISSING] * (record_index + 1 - len(values)))
+        values[record_index] = value
+        if record_index >= self.size:
+            self.size = record_index + 1
+
+    @property
+    def columns(self) -> List[str]:
+        return list(self._columns)
+
+    def column(self, field_name: str) -> List[Any]:
+        """A column's values by record index, None where a record has no value"""
+        values = self._columns.get(field_name, [])
+        return [None if value is _MISSING else value for value in values] + [None] * (self.size - len(values))
+
+    def cells(self) -> Iterator[Tuple[int, str, Any]]:
+        """(record_index, field_name, value) for every value, record by record"""
+        columns = list(self._columns.items())
+        for record_index in range(self.size):
+            for field_name, values in columns:
+                if record_index < len(values) and values[record_index] is not _MISSING:
+                    yield record_index, field_name, values[record_index]
+
+    def to_references(self, indexed: bool = False, limit: int = None) -> List[Dict[str, Any]]:
+        """
+        The list format existing functions take; records without any value are left out
+
+        Parameters:
+            indexed (bool): "Field[i]" keys (database loader format) instead of plain names
+            limit (int): Return at most this many records
+        """
+        references = []
+        record: Dict[str, Any] = {}
+        current = None
+        for record_index, field_name, value in self.cells():
+            if record_index != current:
+                if record:
+                    references.append(record)
+                    if limit is not None and len(references) >= limit:
+                        return references
+                record, current = {}, record_index
+            record[f"{field_name}[{record_index}]" if indexed else field_name] = value
+        if record:
+            references.append(record)
+        return references[:limit] if limit is not None else references
+
+    def __len__(self):
+        return self.size
+
+
+class IdentifierReferenceStore:
+    """
+    Merged identifier references of one session, kept in memory during a run
+
+    Tables are stored per owner: BASE for references that existed before
+    the run, otherwise the extraction number of the field that produced
+    them. table(owners) merges only the tables a field depends on, so
+    fields running in parallel see the same input whatever order they
+    complete in.
+    """
+
+    def __init__(self, session_id: str, base: IdentifierReferenceTable = None,
+                 persist: Optional[Callable[[str, int, IdentifierReferenceTable], Any]] = None):
+        """
+        Parameters:
+            session_id (str): Session the references belong to
+            base (IdentifierReferenceTable): References from before the run
+            persist (callable): persist(session_id, extraction_number, table) saves one field's column
+        """
+        self.session_id = session_id
+        self.persist = persist
+        self._tables: Dict[Any, IdentifierReferenceTable] = {}
+        self._lock = threading.Lock()
+        if base is not None and len(base):
+            self._tables[BASE] = base
+
+    @classmethod
+    def resume(cls, session_id: str, up_to_extraction_number: int,
+               load: Callable[[str, int], IdentifierReferenceTable], persist=None) -> 'IdentifierReferenceStore':
+        """Store holding the references saved by extractions 0..up_to_extraction_number"""
+        return cls(session_id, load(session_id, up_to_extraction_number), persist)
+
+    def add_field(self, extraction_number: int, field_table: IdentifierReferenceTable):
+        """Append one field's column and persist it"""
+        with self._lock:
+            self._tables[extraction_number] = field_table
+        if self.persist:
+            self.persist(self.session_id, extraction_number, field_table)
+
+    def table(self, owners: Optional[Iterable[Any]] = None) -> IdentifierReferenceTable:
+        """
+        Merged references
+
+        Parameters:
+            owners (iterable): Extraction numbers whose columns to include, besides BASE (default: all)
+        """
+        with self._lock:
+            selected = list(self._tables)
+            if owners is not None:
+                wanted = set(owners)
+                selected = [owner for owner in selected if owner == BASE or owner in wanted]
+            # Base first, then fields in extraction order, so later fields win
+            selected.sort(key=lambda owner: -1 if owner == BASE else owner)
+            tables = [self._tables[owner] for owner in selected]
+        return IdentifierReferenceTable.overlay(*tables)
+
+    def __len__(self):
+        with self._lock:
+            return max((len(table) for table in self._tables.values()), default=0)
+
+    def log_summary(self):
+        with self._lock:
+            columns = sum(len(table.columns) for table in self._tables.values())
+        print(f"🔗 REFERENCE STORE: {len(self)} records x {columns} columns in memory", file=sys.stderr, flush=True)
+
+
+ID_KEY = 'identifierId'
+
+
+def _result_index_hint(result: Dict[str, Any], field_name: str) -> Optional[int]:
+    """record_index of a result, or the index in a "Field[i]" field name"""
+    record_index = result.get('record_index')
+    if isinstance(record_index, int) and not isinstance(record_index, bool):
+        return record_index
+    if isinstance(record_index, str) and record_index.isdigit():
+        return int(record_index)
+    match = INDEXED_REFERENCE_KEY.match(field_name)
+    return int(match.group(2)) if match else None
+
+
+def key_results(results: Iterable[Dict[str, Any]], input_table: IdentifierReferenceTable = None,
+                key_columns: Iterable[str] = (), extend: bool = False) -> Tuple[IdentifierReferenceTable, Dict[str, int]]:
+    """
+    One field's results as a table aligned with the input records by key
+
+    Each result ({"field_name", "extracted_value", ...}) is placed on the
+    input record it names, in this order of preference:
+
+    1. identifierId, against the input's identifierId column
+    2. the value of an identifier column the result carries (key_columns)
+    3. record_index, or the [i] in "Collection.Field[i]"
+    4. its position among the results (functions that return one row per input record)
+
+    Lookups are hash indexes built once, so the join is O(records + results)
+    and a function that filters or reorders rows still lines up. Results
+    whose key matches no input record are counted as unmatched and left
+    out, except with extend=True (identifier fields, which may add
+    records), where an index or position past the input makes a new
+    record. With no input records every result becomes a record in order.
+
+    Returns:
+        tuple: (IdentifierReferenceTable, {"matched", "unmatched", "duplicates", "positional", "missing"})
+    """
+    table = IdentifierReferenceTable()
+    report = {"matched": 0, "unmatched": 0, "duplicates": 0, "positional": 0, "missing": 0}
+    entries = []
+    for result in results or []:
+        if isinstance(result, dict) and 'extracted_value' in result and 'field_name' in result:
+            name = str(result['field_name']).rpartition('.')[2]
+            match = INDEXED_REFERENCE_KEY.match(name)
+            entries.append((result, match.group(1) if match else name, _result_index_hint(result, name)))
+
+    size = len(input_table) if input_table is not None else 0
+    if not size:
+        for result, name, _ in entries:
+            table.set(len(table), name, result['extracted_value'])
+        report["matched"] = len(entries)
+        return table, report
+
+    columns = set(input_table.columns)
+    id_index = {}
+    if ID_KEY in columns:
+        for record_index, value in enumerate(input_table.column(ID_KEY)):
+            if value is not None:
+                id_index.setdefault(str(value), record_index)
+    value_indexes = {}
+    for column in key_columns:
+        if column in columns and column != ID_KEY:
+            index = {}
+            for record_index, value in enumerate(input_table.column(column)):
+                if value is not None:
+                    index.setdefault(str(value), record_index)
+            value_indexes[column] = index
+
+    for position, (result, name, hint) in enumerate(entries):
+        if result.get(ID_KEY) is not None and id_index:
+            record_index = id_index.get(str(result[ID_KEY]))
+        elif any(column in result for column in value_indexes):
+            column = next(column for column in value_indexes if column in result)
+            record_index = value_indexes[column].get(str(result[column]))
+        elif hint is not None:
+            record_index = hint if 0 <= hint < size or (extend and hint >= 0) else None
+        else:
+            record_index = position if position < size or extend else None
+            report["positional"] += 1
+        if record_index is None:
+            report["unmatched"] += 1
+            continue
+        values = table._columns.get(name)
+        if values is not None and record_index < len(values) and values[record_index] is not _MISSING:
+            report["duplicates"] += 1
+            continue
+        table.set(record_index, name, result['extracted_value'])
+        report["matched"] += 1
+
+    report["missing"] = max(0, size - len({record_index for record_index, _, _ in table.cells()}))
+    return table, report
@@ -0,0 +1,207 @@
+"""
+Incremental JSON array parsing for streamed AI responses
+"""
+
+import json
+from typing import Any, List, Optional, Tuple
+
+# Structural characters the scanner needs to look at
+_OPENERS = '[{'
+_CLOSERS = ']}'
+
+
+class IncrementalJsonArrayParser:
+    """
+    Parse array elements out of a JSON document as it arrives in pieces
+
+    Text is fed in arbitrary fragments. Each element of an array whose
+    nesting depth equals record_depth is returned as soon as its closing
+    character arrives. Top-level arrays have depth 1; arrays inside a
+    top-level object (e.g. {"schema_fields": [...]}) have depth 2.
+
+    The scanner walks each character once. Every element is decoded once
+    with json.loads. Consumed text is dropped from the buffer, so memory
+    stays around one record rather than the whole response. Markdown
+    fences and any text before the first '[' or '{' are skipped.
+
+    With keep_skeleton, the text outside the records is kept as well, so
+    skeleton() returns the document with its record arrays emptied (e.g.
+    top-level scalars such as "main_object_name").
+    """
+
+    def __init__(self, record_depth: int = 1, keep_skeleton: bool = False):
+        self.record_depth = record_depth
+        self.keep_skeleton = keep_skeleton
+        self.records_parsed = 0
+        self.root_type: Optional[str] = None    # '[' or '{' once the document starts
+        self._buffer = ""
+        self._pos = 0
+        self._stack: List[list] = []            # [opener, key, expecting_key] per open container
+        self._in_string = False
+        self._escaped = False
+        self._string_start = -1
+        self._element_start = -1
+        self._element_key: Optional[str] = None
+        self._skeleton_parts: List[str] = []
+        self._skeleton_from: Optional[int] = None   # Start of skeleton text not yet copied
+        self._done = False
+
+    @property
+    def complete(self) -> bool:
+        """True once the root value has been closed"""
+        return self._done
+
+    def feed(self, text: str) -> List[Tuple[Optional[str], Any]]:
+        """
+        Feed the next fragment of response text
+
+        Parameters:
+            text (str): Next piece of the streamed response
+
+        Returns:
+            list: (key, record) tuples for every element completed by this
+                  fragment; key is the object key holding the array, or None
+                  for a top-level array
+        """
+        if self._done or not text:
+            return []
+
+        buffer = self._buffer + text
+        records = []
+        pos = self._pos
+
+        while pos < len(buffer):
+            char = buffer[pos]
+
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == '\\':
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+                    self._on_string_end(buffer, pos)
+                pos += 1
+                continue
+
+            if not self._stack:
+                # Outside the document: skip fences and preamble until it starts
+                if char in _OPENERS:
+                    self.root_type = char
+                    self._skeleton_from = pos
+                    self._stack.append([char, None, char == '{'])
+                pos += 1
+                continue
+
+            depth = len(self._stack)
+            frame = self._stack[-1]
+            in_record_array = depth == self.record_depth and frame[0] == '['
+
+            if char == '"':
+                self._in_string = True
+                self._string_start = pos
+                if in_record_array:
+                    self._start_element(buffer, pos, frame)
+            elif char in _OPENERS:
+                if in_record_array:
+                    self._start_element(buffer, pos, frame)
+                key = frame[1] if frame[0] == '{' else None
+                self._stack.append([char, key, char == '{'])
+            elif char in _CLOSERS:
+                self._stack.pop()
+                if depth == self.record_depth + 1 and self._element_start >= 0:
+                    # A container element of a record array just closed
+                    records.append(self._take_element(buffer, pos + 1))
+                elif in_record_array and self._element_start >= 0:
+                    # Array closing right after a scalar element
+                    records.append(self._take_element(buffer, pos))
+                if not self._stack:
+                    self._copy_skeleton(buffer, pos + 1, None)
+                    self._done = True
+                    pos += 1
+                    break
+            elif char == ',':
+                if in_record_array:
+                    if self._element_start >= 0:
+                        records.append(self._take_element(buffer, pos))
+                    # Leave separators between records out of the skeleton
+                    self._copy_skeleton(buffer, pos, pos + 1)
+                elif frame[0] == '{':
+                    frame[2] = True
+            elif char == ':':
+                frame[2] = False
+            elif in_record_array and not char.isspace():
+                self._start_element(buffer, pos, frame)
+            pos += 1
+
+        # Drop consumed text, keeping any element or string still in progress
+        if self._element_start >= 0:
+            cut = self._element_start
+        elif self._in_string:
+            cut = self._string_start
+        else:
+            cut = pos
+        if self._skeleton_from is not None:
+            self._copy_skeleton(buffer, cut, cut)
+            self._skeleton_from -= cut
+        self._buffer = buffer[cut:]
+        self._pos = pos - cut
+        if self._element_start >= 0:
+            self._element_start -= cut
+        if self._in_string:
+            self._string_start -= cut
+
+        return [record for record in records if record is not None]
+
+    def skeleton(self) -> Any:
+        """
+        Decode the document with its record arrays left empty
+
+        Returns:
+            The root value without records, or None if keep_skeleton is off
+            or the document is not complete
+        """
+        if not self.keep_skeleton or not self._done:
+            return None
+        try:
+            return json.loads("".join(self._skeleton_parts))
+        except ValueError:
+            return None
+
+    def _copy_skeleton(self, buffer: str, end: int, resume: Optional[int]):
+        """Copy pending skeleton text up to end, then continue from resume (None pauses)"""
+        if self._skeleton_from is None:
+            return
+        if self.keep_skeleton and end > self._skeleton_from:
+            self._skeleton_parts.append(buffer[self._skeleton_from:end])
+        self._skeleton_from = resume
+
+    def _start_element(self, buffer: str, pos: int, frame: list):
+        """Remember where an element of a record array begins"""
+        if self._element_start < 0:
+            self._copy_skeleton(buffer, pos, None)
+            self._element_start = pos
+            self._element_key = frame[1]
+
+    def _on_string_end(self, buffer: str, pos: int):
+        """Record object keys so arrays can be reported under their key"""
+        frame = self._stack[-1] if self._stack else None
+        if frame and frame[0] == '{' and frame[2]:
+            try:
+                frame[1] = json.loads(buffer[self._string_start:pos + 1])
+            except ValueError:
+                frame[1] = None
+
+    def _take_element(self, buffer: str, end: int) -> Optional[Tuple[Optional[str], Any]]:
+        """Decode the element in buffer[start:end] and reset element tracking"""
+        raw = buffer[self._element_start:end]
+        key = self._element_key
+        self._element_start = -1
+        self._element_key = None
+        self._skeleton_from = end
+        try:
+            record = json.loads(raw)
+        except ValueError:
+            return None
+        self.records_parsed += 1
+        return key, record
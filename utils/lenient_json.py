@@ -0,0 +1,307 @@
+"""
+Tolerant JSON parsing for model responses
+
+Model output is usually JSON, but not always clean JSON. parse_lenient()
+reads it in one left-to-right pass and accepts the usual deviations:
+
+- markdown code fences and prose before/after the JSON document
+- trailing commas and missing commas between elements
+- unquoted (identifier) or single-quoted object keys and strings
+- raw newlines and control characters inside strings
+- Python literals True/False/None
+- truncated tails: open strings, objects and arrays are closed at the end
+  of the text. Array elements that were cut off are dropped, so a record
+  list keeps only its complete records; the containers around them are kept
+
+Well-formed JSON takes the fast path (json's C decoder); text that fails
+there is scanned once more by the lenient parser, so the cost stays
+linear in the response size.
+
+Every repair is reported with its position, and unrecoverable input raises
+LenientJSONError, a json.JSONDecodeError with position, line and column.
+"""
+
+import json
+import re
+from typing import Any, List, Optional, Tuple
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_NUMBER = re.compile(r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?')
+_WORD = re.compile(r'[A-Za-z_$][\w$\-]*')
+_SINGLE_QUOTED = re.compile(r"'((?:[^'\\]|\\.)*)'", re.DOTALL)
+
+_LITERALS = {'true': True, 'false': False, 'null': None, 'True': True, 'False': False, 'None': None}
+_OPENERS = {dict: '{', list: '['}
+
+_decoder = json.JSONDecoder()
+
+
+class LenientJSONError(json.JSONDecodeError):
+    """Raised when a response cannot be read as JSON even leniently"""
+
+
+class _Truncated(Exception):
+    """The text ended inside a value; partial is the container built so far, if any"""
+
+    def __init__(self, partial: Any = None):
+        super().__init__()
+        self.partial = partial
+
+
+class LenientResult:
+    """
+    Outcome of parse_lenient
+
+    Attributes:
+        value:     Parsed document
+        repairs:   (position, description) for every deviation that was fixed
+        truncated: True if the text ended before the document was closed
+        start:     Position of the document's first character
+        end:       Position after the document
+    """
+
+    __slots__ = ('value', 'repairs', 'truncated', 'start', 'end')
+
+    def __init__(self, value: Any, repairs: List[Tuple[int, str]], truncated: bool, start: int, end: int):
+        self.value = value
+        self.repairs = repairs
+        self.truncated = truncated
+        self.start = start
+        self.end = end
+
+    @property
+    def repaired(self) -> bool:
+        """True if the text was not valid JSON as it stood"""
+        return bool(self.repairs) or self.truncated
+
+    def describe(self, limit: int = 5) -> str:
+        """Short summary of the repairs, for log lines"""
+        notes = [f"{what} at {pos}" for pos, what in self.repairs[:limit]]
+        if len(self.repairs) > limit:
+            notes.append(f"+{len(self.repairs) - limit} more")
+        if self.truncated:
+            notes.append(f"truncated at {self.end}")
+        return "; ".join(notes) or "no repairs"
+
+
+class _Parser:
+    """Recursive-descent reader; each character is visited once"""
+
+    def __init__(self, text: str):
+        self.text = text
+        self.length = len(text)
+        self.repairs: List[Tuple[int, str]] = []
+
+    def error(self, message: str, pos: int):
+        raise LenientJSONError(message, self.text, min(pos, self.length))
+
+    def skip(self, pos: int) -> int:
+        return _WHITESPACE.match(self.text, pos).end()
+
+    def value(self, pos: int) -> Tuple[Any, int]:
+        pos = self.skip(pos)
+        if pos >= self.length:
+            raise _Truncated()
+        char = self.text[pos]
+        if char == '{':
+            return self.object(pos)
+        if char == '[':
+            return self.array(pos)
+        if char == '"':
+            return self.string(pos)
+        if char == "'":
+            return self.single_quoted(pos)
+
+        match = _NUMBER.match(self.text, pos)
+        if match:
+            if match.end() >= self.length:
+                raise _Truncated()      # More digits may have followed
+            literal = match.group()
+            if literal[0] in '+.' or literal[-1] == '.':
+                self.repairs.append((pos, "non-standard number"))
+            number = float(literal) if any(c in literal for c in '.eE') else int(literal)
+            return number, match.end()
+
+        match = _WORD.match(self.text, pos)
+        if match:
+            word = match.group()
+            if word in _LITERALS:
+                if word not in ('true', 'false', 'null'):
+                    self.repairs.append((pos, f"Python literal {word}"))
+                return _LITERALS[word], match.end()
+            if match.end() >= self.length and any(literal.startswith(word) for literal in _LITERALS):
+                raise _Truncated()
+        self.error("Expecting value", pos)
+
+    def string(self, pos: int) -> Tuple[str, int]:
+        try:
+            # strict=False lets raw newlines and tabs through
+            return json.decoder.scanstring(self.text, pos + 1, False)
+        except json.JSONDecodeError as e:
+            if e.msg.startswith('Unterminated string'):
+                raise _Truncated()
+            if e.pos >= self.length - 6:
+                raise _Truncated()      # Cut off inside an escape sequence
+            self.error(e.msg, e.pos)
+
+    def single_quoted(self, pos: int) -> Tuple[str, int]:
+        match = _SINGLE_QUOTED.match(self.text, pos)
+        if not match:
+            raise _Truncated()
+        self.repairs.append((pos, "single-quoted string"))
+        body = match.group(1).replace("\\'", "'").replace('"', '\\"')
+        try:
+            return json.decoder.scanstring(f'"{body}"', 1, False)[0], match.end()
+        except json.JSONDecodeError as e:
+            self.error(e.msg, pos + e.pos)
+
+    def key(self, pos: int) -> Tuple[str, int]:
+        char = self.text[pos]
+        if char == '"':
+            return self.string(pos)
+        if char == "'":
+            return self.single_quoted(pos)
+        match = _WORD.match(self.text, pos)
+        if match:
+            if match.end() >= self.length:
+                raise _Truncated()
+            self.repairs.append((pos, "unquoted key"))
+            return match.group(), match.end()
+        self.error("Expecting property name enclosed in double quotes", pos)
+
+    def separator(self, pos: int, expect_comma: bool) -> Tuple[int, bool]:
+        """Consume commas between elements; returns (position, whether a comma is still owed)"""
+        if self.text[pos] == ',':
+            if not expect_comma:
+                self.repairs.append((pos, "extra comma"))
+            return pos + 1, False
+        if expect_comma:
+            self.repairs.append((pos, "missing comma"))
+        return pos, expect_comma
+
+    def object(self, pos: int) -> Tuple[dict, int]:
+        result = {}
+        pos += 1
+        expect_comma = False
+        while True:
+            pos = self.skip(pos)
+            if pos >= self.length:
+                raise _Truncated(result)
+            char = self.text[pos]
+            if char == '}':
+                if not expect_comma and result:
+                    self.repairs.append((pos, "trailing comma"))
+                return result, pos + 1
+            if char == ']':
+                self.repairs.append((pos, "mismatched ']'"))
+                return result, pos + 1
+            if char == ',' or expect_comma:
+                pos, expect_comma = self.separator(pos, expect_comma)
+                if char == ',':
+                    continue
+            try:
+                name, pos = self.key(pos)
+                pos = self.skip(pos)
+                if pos >= self.length:
+                    raise _Truncated()
+                if self.text[pos] != ':':
+                    self.error("Expecting ':' delimiter", pos)
+                member, pos = self.value(pos + 1)
+            except _Truncated as cut:
+                # A cut-off container member keeps its complete elements; a cut-off scalar is dropped
+                if cut.partial is not None:
+                    result[name] = cut.partial
+                raise _Truncated(result)
+            result[name] = member
+            expect_comma = True
+
+    def array(self, pos: int) -> Tuple[list, int]:
+        result = []
+        pos += 1
+        expect_comma = False
+        while True:
+            pos = self.skip(pos)
+            if pos >= self.length:
+                raise _Truncated(result)
+            char = self.text[pos]
+            if char == ']':
+                if not expect_comma and result:
+                    self.repairs.append((pos, "trailing comma"))
+                return result, pos + 1
+            if char == '}':
+                self.repairs.append((pos, "mismatched '}'"))
+                return result, pos + 1
+            if char == ',' or expect_comma:
+                pos, expect_comma = self.separator(pos, expect_comma)
+                if char == ',':
+                    continue
+            try:
+                element, pos = self.value(pos)
+            except _Truncated:
+                # Drop the element that was cut off; keep the complete ones
+                raise _Truncated(result)
+            result.append(element)
+            expect_comma = True
+
+
+def _document_start(text: str, expect: Optional[type]) -> int:
+    """Position of the first '{' or '[' (only the expected one when expect is dict or list)"""
+    openers = _OPENERS.get(expect, '{[')
+    positions = [pos for pos in (text.find(opener) for opener in openers) if pos >= 0]
+    return min(positions) if positions else -1
+
+
+def parse_lenient(text: str, expect: Optional[type] = None) -> LenientResult:
+    """
+    Parse a model response as JSON, repairing common deviations
+
+    Parameters:
+        text (str): Response text (fences and surrounding prose are skipped)
+        expect (type): dict or list to start at the first '{' or '[' only
+
+    Returns:
+        LenientResult: value, repairs, truncated flag and document span
+
+    Raises:
+        LenientJSONError: No JSON document, or one broken beyond repair
+    """
+    text = text or ""
+    start = _document_start(text, expect)
+    if start < 0:
+        # Bare scalars ("42", "null") are only accepted as the whole response
+        try:
+            stripped = text.strip()
+            return LenientResult(json.loads(stripped), [], False, 0, len(text))
+        except ValueError:
+            raise LenientJSONError("No JSON document found", text, 0) from None
+
+    try:
+        value, end = _decoder.raw_decode(text, start)
+        return LenientResult(value, [], False, start, end)
+    except ValueError:
+        pass
+
+    parser = _Parser(text)
+    try:
+        value, end = parser.value(start)
+        truncated = False
+    except _Truncated as cut:
+        value, end, truncated = cut.partial, len(text), True
+    return LenientResult(value, parser.repairs, truncated, start, end)
+
+
+def loads_lenient(text: str, expect: Optional[type] = None) -> Any:
+    """
+    Parse a model response as JSON, repairing common deviations
+
+    Parameters:
+        text (str): Response text
+        expect (type): dict or list to start at the first '{' or '['
+
+    Returns:
+        The parsed document
+
+    Raises:
+        LenientJSONError: No JSON document, or one broken beyond repair
+    """
+    return parse_lenient(text, expect).value
@@ -0,0 +1,215 @@
+"""
+Tiered model routing: try the fast model first, escalate to the strong model when needed
+"""
+
+import json
+import os
+import sys
+import threading
+from collections import defaultdict
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional
+
+from utils.config import get_config, get_ai_model
+from utils.constants import MIN_CONFIDENCE_SCORE
+
+_stats_lock = threading.Lock()
+
+# Escalation reasons recorded in the routing stats
+REASON_HARD_FIELD = 'hard_field'
+REASON_PARSE_FAILURE = 'parse_failure'
+REASON_LOW_CONFIDENCE = 'low_confidence'
+
+# Confidence scales of the call sites' prompts
+CONFIDENCE_FRACTION = 'fraction'   # 0.0-1.0 (AI_DOCUMENT_EXTRACTION)
+CONFIDENCE_PERCENT = 'percent'     # 0-100 (enhanced processor prompts)
+
+
+def get_routing_config() -> dict:
+    """
+    Get the model routing configuration
+
+    Returns:
+        dict: ai.routing from config.json
+    """
+    return get_config('ai.routing', {}) or {}
+
+
+def normalize_confidence(value: Any, scale: str) -> Optional[float]:
+    """
+    Bring a confidence score onto the 0-100 scale
+
+    The scale comes from the prompt that produced the score, never from
+    the value: a 1 on the 0-100 scale is the least confident answer.
+
+    Parameters:
+        value: Confidence score as returned by the model
+        scale (str): CONFIDENCE_FRACTION or CONFIDENCE_PERCENT
+
+    Returns:
+        float: Confidence on a 0-100 scale, or None if missing or invalid
+    """
+    if scale not in (CONFIDENCE_FRACTION, CONFIDENCE_PERCENT):
+        raise ValueError(f"Unknown confidence scale {scale!r}")
+    try:
+        score = float(value)
+    except (TypeError, ValueError):
+        return None
+    return score * 100 if scale == CONFIDENCE_FRACTION else score
+
+
+def field_label(field: Dict[str, Any]) -> str:
+    """Readable name of a target field for stats"""
+    return field.get('name') or field.get('field_name') or field.get('valueName') or field.get('value_name') \
+        or field.get('field_id') or field.get('id') or 'unknown'
+
+
+class ModelRouter:
+    """
+    Routing policy for one call site
+
+    Fields go to the fast model unless they are marked hard (field flag
+    'is_hard' or listed in ai.routing.hardFields by id or name). Results
+    are escalated to the strong model on parse failure or when a record's
+    confidence is below ai.routing.minConfidenceScore (defaults to
+    extraction.minConfidenceScore). Every model call is recorded per field
+    in the JSONL stats file so thresholds can be tuned later.
+
+    confidence_scale is the scale the call site's prompt asks for
+    (CONFIDENCE_FRACTION or CONFIDENCE_PERCENT).
+    """
+
+    def __init__(self, call_site: str, confidence_scale: str):
+        config = get_routing_config()
+        self.call_site = call_site
+        if confidence_scale not in (CONFIDENCE_FRACTION, CONFIDENCE_PERCENT):
+            raise ValueError(f"Unknown confidence scale {confidence_scale!r}")
+        self.confidence_scale = confidence_scale
+        self.enabled = bool(config.get('enabled', False))
+        self.fast_model = get_ai_model(config.get('fastModel', 'flash'))
+        self.strong_model = get_ai_model(config.get('strongModel', 'extraction'))
+        self.min_confidence = float(config.get('minConfidenceScore',
+                                               get_config('extraction.minConfidenceScore', MIN_CONFIDENCE_SCORE)))
+        self.hard_fields = {str(name) for name in config.get('hardFields', [])}
+        self.stats_file = config.get('statsFile', 'logs/model_routing.jsonl')
+
+    def is_hard_field(self, field: Dict[str, Any]) -> bool:
+        """Check whether a field should skip the fast model"""
+        if field.get('is_hard'):
+            return True
+        keys = (field.get('field_id'), field.get('id'), field.get('name'), field.get('field_name'),
+                field.get('valueName'), field.get('value_name'))
+        return any(key and str(key) in self.hard_fields for key in keys)
+
+    def split_fields(self, fields: List[Dict[str, Any]]):
+        """
+        Split fields by starting model
+
+        Returns:
+            tuple: (fast_fields, hard_fields)
+        """
+        fast_fields = [field for field in fields if not self.is_hard_field(field)]
+        hard_fields = [field for field in fields if self.is_hard_field(field)]
+        return fast_fields, hard_fields
+
+    def is_low_confidence(self, record: Dict[str, Any], confidence_key: str) -> bool:
+        """Check whether a record falls below the escalation threshold"""
+        if not isinstance(record, dict):
+            return True
+        score = normalize_confidence(record.get(confidence_key), self.confidence_scale)
+        return score is None or score < self.min_confidence
+
+    def record_call(self, field: str, model: str, latency: float, records: Optional[Iterable[Dict[str, Any]]],
+                    confidence_key: str, escalated: bool = False, reason: Optional[str] = None):
+        """
+        Append one routing stats line for a field
+
+        Parameters:
+            field (str): Field label
+            model (str): Model that produced the records
+            latency (float): Seconds spent in the model call
+            records (list): Records returned for the field (None on failure)
+            confidence_key (str): Key holding the confidence score
+            escalated (bool): True if this call was an escalation
+            reason (str): Why the call was routed to this model
+        """
+        scores = [normalize_confidence(record.get(confidence_key), self.confidence_scale) for record in records or []
+                  if isinstance(record, dict)]
+        scores = [score for score in scores if score is not None]
+        entry = {
+            "timestamp": datetime.utcnow().isoformat(),
+            "call_site": self.call_site,
+            "field": field,
+            "model": model,
+            "escalated": escalated,
+            "reason": reason,
+            "latency_ms": round(latency * 1000),
+            "records": len(records) if records is not None else None,
+            "low_confidence": sum(1 for score in scores if score < self.min_confidence),
+            "mean_confidence": round(sum(scores) / len(scores), 1) if scores else None,
+            "threshold": self.min_confidence,
+        }
+        try:
+            directory = os.path.dirname(self.stats_file)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with _stats_lock, open(self.stats_file, 'a') as f:
+                f.write(json.dumps(entry) + "\n")
+        except OSError as e:
+            print(f"⚠️ Could not write routing stats: {e}", file=sys.stderr, flush=True)
+
+
+def summarize_routing_stats(stats_file: str = None) -> Dict[str, Dict[str, Any]]:
+    """
+    Summarize routing stats per call site and field
+
+    Parameters:
+        stats_file (str): JSONL stats file (defaults to ai.routing.statsFile)
+
+    Returns:
+        dict: "call_site:field" -> calls, escalation rate and latency/confidence per model
+    """
+    stats_file = stats_file or get_routing_config().get('statsFile', 'logs/model_routing.jsonl')
+    summary = defaultdict(lambda: {"calls": 0, "escalations": 0, "reasons": defaultdict(int), "models": {}})
+
+    if not os.path.exists(stats_file):
+        return {}
+
+    with open(stats_file, 'r') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            field = summary[f"{entry.get('call_site')}:{entry.get('field')}"]
+            model = field["models"].setdefault(entry.get('model'), {"calls": 0, "latency_ms": 0, "confidence": []})
+            model["calls"] += 1
+            model["latency_ms"] += entry.get('latency_ms') or 0
+            if entry.get('mean_confidence') is not None:
+                model["confidence"].append(entry['mean_confidence'])
+            if entry.get('escalated'):
+                field["escalations"] += 1
+                field["reasons"][entry.get('reason')] += 1
+            else:
+                field["calls"] += 1
+
+    result = {}
+    for key, field in summary.items():
+        result[key] = {
+            "calls": field["calls"],
+            "escalation_rate": round(field["escalations"] / field["calls"], 3) if field["calls"] else None,
+            "reasons": dict(field["reasons"]),
+            "models": {
+                name: {
+                    "calls": model["calls"],
+                    "mean_latency_ms": round(model["latency_ms"] / model["calls"]),
+                    "mean_confidence": round(sum(model["confidence"]) / len(model["confidence"]), 1) if model["confidence"] else None,
+                }
+                for name, model in field["models"].items()
+            },
+        }
+    return result
+
+
+if __name__ == "__main__":
+    print(json.dumps(summarize_routing_stats(sys.argv[1] if len(sys.argv) > 1 else None), indent=2))
@@ -0,0 +1,133 @@
+"""
+Compact serialization of structured prompt inputs
+
+Prompt templates embed documents, target fields, rules and identifier
+references as JSON. Styles:
+
+- pretty:    json.dumps(indent=2), the historical format
+- minified:  no whitespace between tokens, non-ASCII kept as-is
+- columnar:  lists of objects become {"columns": [...], "rows": [[...], ...]}
+             with the keys written once; keys carrying a record index such as
+             "Members.Name[12]" are written once as "Members.Name" with the
+             index in a "record_index" column. Anything that is not a list of
+             objects falls back to minified.
+
+The style is chosen per template and section in ai.promptEncoding, e.g.
+{"default": "minified", "templates": {"AI_DOCUMENT_EXTRACTION":
+{"identifier_references": "columnar"}}}.
+"""
+
+import json
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+from utils.config import get_config
+
+PRETTY = 'pretty'
+MINIFIED = 'minified'
+COLUMNAR = 'columnar'
+STYLES = (PRETTY, MINIFIED, COLUMNAR)
+
+INDEX_COLUMN = 'record_index'
+
+_INDEXED_KEY = re.compile(r'^(.*)\[(\d+)\]$')
+
+
+def _split_indexed_key(key: str) -> Tuple[str, Optional[int]]:
+    """'Members.Name[12]' -> ('Members.Name', 12); other keys -> (key, None)"""
+    match = _INDEXED_KEY.match(key)
+    if not match:
+        return key, None
+    return match.group(1), int(match.group(2))
+
+
+def _minify(value: Any) -> str:
+    return json.dumps(value, separators=(',', ':'), ensure_ascii=False, default=str)
+
+
+def to_columnar(records: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """
+    Convert a list of objects into a columns/rows table
+
+    Parameters:
+        records (list): Objects to tabulate
+
+    Returns:
+        dict: {"columns": [...], "rows": [[...]]}, or None if records is not a
+              non-empty list of objects
+    """
+    if not isinstance(records, list) or not records or not all(isinstance(r, dict) for r in records):
+        return None
+
+    # Collapse "Name[i]" keys when every key of a record carries the same index
+    indexed = True
+    split_records = []
+    for record in records:
+        split = [(_split_indexed_key(str(key)), value) for key, value in record.items()]
+        indices = {index for (_, index), _ in split}
+        if len(indices) != 1 or None in indices:
+            indexed = False
+            break
+        split_records.append((indices.pop(), {name: value for (name, _), value in split}))
+
+    if indexed:
+        columns = [INDEX_COLUMN]
+        rows_source = [dict(fields, **{INDEX_COLUMN: index}) for index, fields in split_records]
+    else:
+        columns = []
+        rows_source = records
+    seen = set(columns)
+    for record in rows_source:
+        for key in record:
+            if key not in seen:
+                seen.add(key)
+                columns.append(key)
+
+    return {"columns": columns, "rows": [[record.get(column) for column in columns] for record in rows_source]}
+
+
+def encode_value(value: Any, style: str = PRETTY) -> str:
+    """
+    Serialize a value for a prompt in the given style
+
+    Parameters:
+        value: JSON-serialisable value
+        style (str): pretty, minified or columnar
+
+    Returns:
+        str: Serialized value
+    """
+    if style == COLUMNAR:
+        table = to_columnar(value)
+        return _minify(table if table is not None else value)
+    if style == MINIFIED:
+        return _minify(value)
+    return json.dumps(value, indent=2)
+
+
+def get_encoding_style(template: str, section: str) -> str:
+    """
+    Style configured for a template section
+
+    Looks up ai.promptEncoding.templates.<template>.<section>, then
+    .templates.<template>.default, then ai.promptEncoding.default.
+    """
+    config = get_config('ai.promptEncoding', {}) or {}
+    template_config = (config.get('templates') or {}).get(template) or {}
+    style = template_config.get(section) or template_config.get('default') or config.get('default') or PRETTY
+    return style if style in STYLES else PRETTY
+
+
+def encode_prompt_value(template: str, section: str, value: Any) -> str:
+    """
+    Serialize a prompt section using the style configured for its template
+
+    Parameters:
+        template (str): Template name, e.g. 'AI_DOCUMENT_EXTRACTION'
+        section (str): Placeholder name, e.g. 'identifier_references'
+        value: JSON-serialisable value
+
+    Returns:
+        str: Serialized value
+    """
+    return encode_value(value, get_encoding_style(template, section))
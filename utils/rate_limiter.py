@@ -0,0 +1,274 @@
+"""
+Cross-process Gemini rate limiter with token-bucket quotas and a fair queue
+
+Every Python service is a separate process, so quota state is shared
+through a utils.state_store backend (file, postgres or memory).
+
+Requests/min and tokens/min buckets are kept per model and per
+organization. Callers for a model wait in FIFO ticket order instead of
+failing; a caller held back only by its own organization's quota lets
+callers from other organizations go ahead, so one organization over its
+quota does not stall the rest. A 429 from upstream drains the model's
+buckets so all processes back off together rather than retrying in
+lockstep.
+"""
+
+import contextvars
+import os
+import random
+import socket
+import sys
+import threading
+import time
+from typing import Dict, List, Optional
+
+from utils.config import get_config
+from utils.state_store import build_state_store
+
+DEFAULT_STATE_DIR = 'logs/rate_limiter'
+TICKET_STALE_SECONDS = 30             # Queue entries without a heartbeat for this long are dropped
+POLL_SECONDS = 0.1                    # Wait between checks when not at the head of the queue
+
+_organization = contextvars.ContextVar('rate_limit_organization', default=None)
+
+
+class RateLimitTimeout(Exception):
+    """Raised when a request waits longer than ai.rateLimits.maxWaitSeconds"""
+
+
+def set_rate_limit_organization(organization_id: Optional[str]):
+    """
+    Set the organization the current context's Gemini calls are billed to
+
+    Parameters:
+        organization_id (str): Organization ID (None falls back to ORGANIZATION_ID env or 'default')
+    """
+    _organization.set(str(organization_id) if organization_id else None)
+
+
+def get_rate_limit_organization() -> str:
+    """Organization for the current context"""
+    return _organization.get() or os.environ.get('ORGANIZATION_ID') or 'default'
+
+
+def set_rate_limit_organization_for_project(project_id: Optional[str]):
+    """
+    Bill the current context's Gemini calls to the organization owning a project
+
+    Parameters:
+        project_id (str): Project ID; lookup failures leave the organization unchanged
+    """
+    database_url = os.getenv('DATABASE_URL')
+    if not project_id or not database_url or not get_config('ai.rateLimits.enabled', False):
+        return
+    try:
+        import psycopg2
+        conn = psycopg2.connect(database_url)
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT organization_id FROM projects WHERE id = %s", (project_id,))
+            row = cursor.fetchone()
+            cursor.close()
+        finally:
+            conn.close()
+        if row:
+            set_rate_limit_organization(row[0])
+    except Exception as e:
+        print(f"⚠️ Could not resolve organization for project {project_id}: {e}", file=sys.stderr, flush=True)
+
+
+class Reservation:
+    """Quota taken for one request; settle() corrects the token estimate"""
+
+    def __init__(self, limiter: 'RateLimiter', model: str, organization: str, tokens: int, waited: float):
+        self.limiter = limiter
+        self.model = model
+        self.organization = organization
+        self.tokens = tokens
+        self.waited = waited
+
+    def settle(self, actual_tokens: Optional[int]):
+        """Charge or refund the difference between actual and estimated tokens"""
+        if actual_tokens is None or actual_tokens == self.tokens:
+            return
+        self.limiter.adjust_tokens(self.model, self.organization, actual_tokens - self.tokens)
+        self.tokens = actual_tokens
+
+
+class RateLimiter:
+    """
+    Token-bucket limiter shared across processes
+
+    Limits come from ai.rateLimits:
+        models.<model> / models.default:        {"rpm": ..., "tpm": ...}
+        organizations.<id> / organization:      {"rpm": ..., "tpm": ...}
+    A missing or zero limit is not enforced.
+    """
+
+    def __init__(self, config: Dict = None, store=None):
+        self.config = config if config is not None else (get_config('ai.rateLimits', {}) or {})
+        self.max_wait = float(self.config.get('maxWaitSeconds', 300))
+        self.store = store or self._build_store()
+        self.host = socket.gethostname()
+
+    def _build_store(self):
+        return build_state_store(self.config.get('backend', 'file'),
+                                 self.config.get('stateDir', DEFAULT_STATE_DIR), 'gemini')
+
+    def _limits(self, model: str, organization: str) -> List[tuple]:
+        """(bucket key, capacity per minute, cost kind) for every enforced bucket"""
+        models = self.config.get('models', {})
+        model_limits = models.get(model) or models.get('default') or {}
+        org_limits = (self.config.get('organizations', {}).get(organization)
+                      or self.config.get('organization') or {})
+        buckets = []
+        for scope, limits in ((f"model:{model}", model_limits), (f"org:{organization}", org_limits)):
+            for kind, unit in (('rpm', 'requests'), ('tpm', 'tokens')):
+                if limits.get(kind):
+                    buckets.append((f"{scope}:{kind}", float(limits[kind]), unit))
+        return buckets
+
+    @staticmethod
+    def _refill(bucket: dict, capacity: float, now: float):
+        elapsed = max(0.0, now - bucket.get('updated', now))
+        bucket['tokens'] = min(capacity, bucket.get('tokens', capacity) + elapsed * capacity / 60.0)
+        bucket['updated'] = now
+
+    def _shortfall(self, buckets: dict, limits: List[tuple], tokens: int, now: float, scope: str = '') -> float:
+        """Seconds until the buckets in scope can cover a request (0 when they can now)"""
+        wait = 0.0
+        for key, capacity, unit in limits:
+            if not key.startswith(scope):
+                continue
+            bucket = buckets.setdefault(key, {"tokens": capacity, "updated": now})
+            self._refill(bucket, capacity, now)
+            cost = 1 if unit == 'requests' else min(tokens, capacity)
+            if bucket['tokens'] < cost:
+                wait = max(wait, (cost - bucket['tokens']) * 60.0 / capacity)
+        return wait
+
+    def _held_by_own_organization(self, buckets: dict, model: str, entry: dict, organization: str, now: float) -> bool:
+        """Whether a queued request of another organization waits only for its organization's quota"""
+        entry_organization = entry.get('organization')
+        if entry_organization is None or entry_organization == organization:
+            return False
+        entry_limits = self._limits(model, entry_organization)
+        tokens = entry.get('tokens', 0)
+        return (self._shortfall(buckets, entry_limits, tokens, now, 'model:') == 0.0
+                and self._shortfall(buckets, entry_limits, tokens, now, 'org:') > 0.0)
+
+    def acquire(self, model: str, tokens: int, organization: str = None) -> Reservation:
+        """
+        Wait for quota and take it
+
+        Parameters:
+            model (str): Gemini model name
+            tokens (int): Estimated tokens for the request
+            organization (str): Organization to bill (defaults to the context organization)
+
+        Returns:
+            Reservation: Taken quota; call settle() with the actual token count
+
+        Raises:
+            RateLimitTimeout: If the wait exceeds maxWaitSeconds
+        """
+        organization = organization or get_rate_limit_organization()
+        limits = self._limits(model, organization)
+        if not limits:
+            return Reservation(self, model, organization, tokens, 0.0)
+
+        started = time.time()
+        ticket = None
+        announced = False
+
+        while True:
+            with self.store.transaction() as state:
+                now = time.time()
+                queue = state.setdefault('queues', {}).setdefault(model, [])
+                if ticket is None:
+                    state['next_ticket'] = state.get('next_ticket', 0) + 1
+                    ticket = state['next_ticket']
+                    queue.append({"ticket": ticket, "pid": os.getpid(), "host": self.host, "heartbeat": now,
+                                  "organization": organization, "tokens": tokens})
+
+                # Drop entries whose owners stopped heart-beating (crashed or gave up)
+                queue[:] = [entry for entry in queue
+                            if entry['ticket'] == ticket or now - entry.get('heartbeat', 0) < TICKET_STALE_SECONDS]
+                for entry in queue:
+                    if entry['ticket'] == ticket:
+                        entry['heartbeat'] = now
+
+                position = next(index for index, entry in enumerate(queue) if entry['ticket'] == ticket)
+                wait = min(1.0, POLL_SECONDS * position)
+                buckets = state.setdefault('buckets', {})
+                # Tickets ahead that only wait for their own organization's quota do not hold this one back
+                if all(self._held_by_own_organization(buckets, model, entry, organization, now) for entry in queue[:position]):
+                    wait = self._shortfall(buckets, limits, tokens, now)
+                    if wait == 0.0:
+                        for key, capacity, unit in limits:
+                            buckets[key]['tokens'] -= 1 if unit == 'requests' else tokens
+                        queue.pop(position)
+                        waited = now - started
+                        if waited > 1:
+                            print(f"⏳ RATE LIMIT: {model} request waited {waited:.1f}s for quota", file=sys.stderr, flush=True)
+                        return Reservation(self, model, organization, tokens, waited)
+
+                timed_out = now - started > self.max_wait
+                if timed_out:
+                    queue[:] = [entry for entry in queue if entry['ticket'] != ticket]
+
+            if timed_out:
+                raise RateLimitTimeout(f"Waited {time.time() - started:.0f}s for {model} quota")
+            if not announced and wait > 1:
+                print(f"⏳ RATE LIMIT: {model} quota exhausted, queued at position {position + 1}", file=sys.stderr, flush=True)
+                announced = True
+            # Jitter keeps processes from polling the store in lockstep
+            time.sleep(min(wait, 1.0) * random.uniform(0.8, 1.2) + 0.005)
+
+    def adjust_tokens(self, model: str, organization: str, delta: int):
+        """Charge (positive) or refund (negative) tokens after the fact"""
+        limits = [limit for limit in self._limits(model, organization) if limit[2] == 'tokens']
+        if not limits:
+            return
+        with self.store.transaction() as state:
+            now = time.time()
+            buckets = state.setdefault('buckets', {})
+            for key, capacity, _ in limits:
+                bucket = buckets.setdefault(key, {"tokens": capacity, "updated": now})
+                self._refill(bucket, capacity, now)
+                bucket['tokens'] = min(capacity, bucket['tokens'] - delta)
+
+    def penalize(self, model: str, organization: str = None, seconds: float = None):
+        """
+        Drain a model's buckets after an upstream 429
+
+        All queued callers then wait for the refill together, in ticket order.
+        """
+        organization = organization or get_rate_limit_organization()
+        seconds = seconds if seconds is not None else float(self.config.get('penaltySeconds', 5))
+        limits = [limit for limit in self._limits(model, organization) if limit[0].startswith('model:')]
+        with self.store.transaction() as state:
+            now = time.time()
+            buckets = state.setdefault('buckets', {})
+            for key, capacity, _ in limits:
+                buckets[key] = {"tokens": -capacity * seconds / 60.0, "updated": now}
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter() -> Optional[RateLimiter]:
+    """
+    Get the process-wide limiter
+
+    Returns:
+        RateLimiter: Limiter, or None when ai.rateLimits.enabled is off
+    """
+    global _limiter
+    if not get_config('ai.rateLimits.enabled', False):
+        return None
+    with _limiter_lock:
+        if _limiter is None:
+            _limiter = RateLimiter()
+    return _limiter
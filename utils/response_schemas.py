@@ -0,0 +1,290 @@
+"""
+Response schemas for structured Gemini output
+
+Each extraction call site sends a response schema derived from what it
+asked for (target field ids, the identifierIds of the input items), with
+response_mime_type application/json, so the model can only produce JSON
+of the expected shape. Returned values are checked against the same
+schema: records that do not conform are dropped and counted instead of
+failing the whole response.
+
+Schemas use the Gemini OpenAPI subset (type, properties, required, items,
+enum, nullable, propertyOrdering).
+
+Every parse is logged to ai.structuredOutput.statsFile with the call site,
+whether a schema was sent, the attempt number, and parse/validation
+outcome; summarize_structured_output() reports parse failures, retries and
+dropped records per call site, with and without schemas.
+"""
+
+import json
+import os
+import sys
+import threading
+from collections import defaultdict
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from utils.config import get_config
+
+DEFAULT_STATS_FILE = 'logs/structured_output.jsonl'
+MAX_ENUM_VALUES = 500      # Larger id lists are sent as plain strings to keep the schema small
+
+_stats_lock = threading.Lock()
+
+
+def get_structured_output_config() -> dict:
+    """
+    Get the structured output configuration
+
+    Returns:
+        dict: ai.structuredOutput from config.json
+    """
+    return get_config('ai.structuredOutput', {}) or {}
+
+
+def is_structured_output_enabled() -> bool:
+    """True when ai.structuredOutput.enabled is set (default True)"""
+    return bool(get_structured_output_config().get('enabled', True))
+
+
+def _string(enum: List[str] = None, nullable: bool = False) -> Dict[str, Any]:
+    schema = {"type": "STRING"}
+    values = sorted({value for value in enum or [] if value})
+    if values and len(values) <= MAX_ENUM_VALUES:
+        schema["enum"] = values
+    if nullable:
+        schema["nullable"] = True
+    return schema
+
+
+def _object(properties: Dict[str, Any], required: List[str]) -> Dict[str, Any]:
+    return {"type": "OBJECT", "properties": properties, "required": required,
+            "propertyOrdering": list(properties)}
+
+
+def document_extraction_schema(target_fields: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Schema for AI_DOCUMENT_EXTRACTION records (perform_ai_extraction)
+
+    Parameters:
+        target_fields (list): Target field dicts with field_id and collection_id
+
+    Returns:
+        dict: Array of extraction records whose field_id is one of the targets
+    """
+    record = _object({
+        "validation_type": _string(["collection_property", "schema_field"]),
+        "data_type": {"type": "STRING"},
+        "field_name": {"type": "STRING"},
+        "collection_name": {"type": "STRING", "nullable": True},
+        "collection_id": _string([field.get('collection_id') for field in target_fields], nullable=True),
+        "field_id": _string([field.get('field_id') for field in target_fields]),
+        "extracted_value": {"type": "STRING", "nullable": True},
+        "confidence_score": {"type": "NUMBER"},
+        "validation_status": {"type": "STRING"},
+        "ai_reasoning": {"type": "STRING"},
+        "record_index": {"type": "INTEGER"},
+    }, ["field_name", "field_id", "extracted_value", "confidence_score", "ai_reasoning", "record_index"])
+    return {"type": "ARRAY", "items": record}
+
+
+def enhanced_extraction_schema(is_update: bool, identifier_ids: List[str] = None) -> Dict[str, Any]:
+    """
+    Schema for tool-driven AI extraction items (execute_ai_extraction)
+
+    Parameters:
+        is_update (bool): UPDATE operations map onto existing input items
+        identifier_ids (list): identifierIds of the input items (UPDATE only)
+
+    Returns:
+        dict: Array of items; for UPDATE the identifierId must be one of the inputs
+    """
+    properties = {}
+    required = ["extractedValue", "validationStatus", "aiReasoning", "confidenceScore"]
+    if is_update:
+        properties["identifierId"] = _string(identifier_ids)
+        required.insert(0, "identifierId")
+    properties.update({
+        "extractedValue": {"type": "STRING", "nullable": True},
+        "validationStatus": _string(["valid", "invalid"] if is_update else ["valid", "invalid", "pending"]),
+        "aiReasoning": {"type": "STRING"},
+        "confidenceScore": {"type": "NUMBER"},
+        "documentSource": {"type": "STRING", "nullable": True},
+    })
+    return {"type": "ARRAY", "items": _object(properties, required)}
+
+
+def column_mapping_schema() -> Dict[str, Any]:
+    """Schema for a column standardisation answer (extract_column_mappings)"""
+    return _object({
+        "standardised_name": {"type": "STRING"},
+        "reasoning": {"type": "STRING"},
+    }, ["standardised_name", "reasoning"])
+
+
+def excel_function_schema() -> Dict[str, Any]:
+    """Schema for a generated Excel function (generate_excel_function_with_gemini)"""
+    return _object({
+        "function_name": {"type": "STRING"},
+        "description": {"type": "STRING"},
+        "tags": {"type": "ARRAY", "items": {"type": "STRING"}},
+        "function_code": {"type": "STRING"},
+    }, ["function_name", "description", "function_code"])
+
+
+def structured_config(schema: Dict[str, Any], base_config: Any = None) -> Any:
+    """
+    Generation config requesting JSON that follows a schema
+
+    Parameters:
+        schema (dict): Response schema
+        base_config: Existing GenerateContentConfig to extend (e.g. one referencing a context cache)
+
+    Returns:
+        GenerateContentConfig, or base_config unchanged when structured output is disabled
+    """
+    if not is_structured_output_enabled():
+        return base_config
+    from google.genai import types
+    if base_config is None:
+        return types.GenerateContentConfig(response_mime_type="application/json", response_schema=schema)
+    return base_config.model_copy(update={"response_mime_type": "application/json", "response_schema": schema})
+
+
+_TYPE_CHECKS = {
+    "STRING": lambda value: isinstance(value, str),
+    "NUMBER": lambda value: isinstance(value, (int, float)) and not isinstance(value, bool),
+    "INTEGER": lambda value: isinstance(value, int) and not isinstance(value, bool),
+    "BOOLEAN": lambda value: isinstance(value, bool),
+    "ARRAY": lambda value: isinstance(value, list),
+    "OBJECT": lambda value: isinstance(value, dict),
+}
+
+
+def validate_response(value: Any, schema: Dict[str, Any], path: str = "$") -> List[str]:
+    """
+    Check a value against a response schema
+
+    Extra object keys are allowed; types, required keys, enums and
+    nullability are enforced.
+
+    Parameters:
+        value: Parsed response
+        schema (dict): Response schema
+        path (str): Location of value, for error messages
+
+    Returns:
+        list: Error messages (empty if the value conforms)
+    """
+    if value is None:
+        return [] if schema.get('nullable') else [f"{path}: null is not allowed"]
+    expected = schema.get('type')
+    check = _TYPE_CHECKS.get(expected)
+    if check and not check(value):
+        return [f"{path}: expected {expected.lower()}, got {type(value).__name__}"]
+    if 'enum' in schema and value not in schema['enum']:
+        return [f"{path}: {str(value)[:60]!r} is not one of the allowed values"]
+
+    errors = []
+    if expected == "OBJECT":
+        for key in schema.get('required', []):
+            if key not in value:
+                errors.append(f"{path}.{key}: missing")
+        for key, member_schema in schema.get('properties', {}).items():
+            if key in value:
+                errors.extend(validate_response(value[key], member_schema, f"{path}.{key}"))
+    elif expected == "ARRAY" and 'items' in schema:
+        for index, item in enumerate(value):
+            errors.extend(validate_response(item, schema['items'], f"{path}[{index}]"))
+    return errors
+
+
+def filter_valid_records(records: List[Any], schema: Dict[str, Any]) -> Tuple[List[Any], List[str]]:
+    """
+    Keep the records of an array response that conform to the schema's item schema
+
+    Parameters:
+        records (list): Parsed records
+        schema (dict): ARRAY response schema
+
+    Returns:
+        tuple: (valid records, error messages for the dropped ones)
+    """
+    item_schema = schema.get('items', {})
+    valid, errors = [], []
+    for index, record in enumerate(records):
+        record_errors = validate_response(record, item_schema, f"$[{index}]")
+        if record_errors:
+            errors.extend(record_errors)
+        else:
+            valid.append(record)
+    return valid, errors
+
+
+def record_parse_outcome(call_site: str, structured: bool, parsed: bool, attempt: int = 0,
+                         validation_errors: int = 0, dropped: int = 0, records: Optional[int] = None):
+    """
+    Append one parse outcome to the structured output stats file
+
+    Parameters:
+        call_site (str): e.g. 'perform_ai_extraction'
+        structured (bool): A response schema was sent
+        parsed (bool): The response was usable JSON of the expected shape
+        attempt (int): 0 for the first request, n for the n-th retry
+        validation_errors (int): Schema violations found
+        dropped (int): Records dropped for violating the schema
+        records (int): Records kept, for array responses
+    """
+    stats_file = get_structured_output_config().get('statsFile', DEFAULT_STATS_FILE)
+    entry = {"timestamp": datetime.utcnow().isoformat(), "call_site": call_site, "structured": structured,
+             "parsed": parsed, "attempt": attempt, "validation_errors": validation_errors, "dropped": dropped,
+             "records": records}
+    try:
+        directory = os.path.dirname(stats_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with _stats_lock, open(stats_file, 'a') as f:
+            f.write(json.dumps(entry) + "\n")
+    except OSError as e:
+        print(f"⚠️ Could not write structured output stats: {e}", file=sys.stderr, flush=True)
+
+
+def summarize_structured_output(stats_file: str = None) -> Dict[str, Dict[str, Any]]:
+    """
+    Summarize parse outcomes per call site, split by whether a schema was sent
+
+    Parameters:
+        stats_file (str): JSONL stats file (defaults to ai.structuredOutput.statsFile)
+
+    Returns:
+        dict: "<call site> (schema|no schema)" -> responses, parse failures and rate,
+              retries, validation errors and dropped records
+    """
+    stats_file = stats_file or get_structured_output_config().get('statsFile', DEFAULT_STATS_FILE)
+    if not os.path.exists(stats_file):
+        return {}
+
+    sites = defaultdict(lambda: {"responses": 0, "parse_failures": 0, "retries": 0,
+                                 "validation_errors": 0, "dropped_records": 0})
+    with open(stats_file, 'r') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            site = sites[f"{entry.get('call_site')} ({'schema' if entry.get('structured') else 'no schema'})"]
+            site["responses"] += 1
+            site["parse_failures"] += 0 if entry.get('parsed') else 1
+            site["retries"] += 1 if entry.get('attempt') else 0
+            site["validation_errors"] += entry.get('validation_errors') or 0
+            site["dropped_records"] += entry.get('dropped') or 0
+
+    return {
+        name: dict(site, parse_failure_rate=round(site["parse_failures"] / site["responses"], 3))
+        for name, site in sorted(sites.items())
+    }
+
+
+if __name__ == "__main__":
+    print(json.dumps(summarize_structured_output(sys.argv[1] if len(sys.argv) > 1 else None), indent=2))
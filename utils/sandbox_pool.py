@@ -0,0 +1,584 @@
+"""
+Pre-started worker processes for running stored functions in isolation
+
+User CODE tools and generated Excel functions are arbitrary Python. Run
+in-process, a slow or runaway function blocks the extraction and can
+exhaust its memory. Instead they run in a pool of worker interpreters
+(python -m utils.sandbox_pool), started ahead of use, each with:
+
+- an address-space limit (RLIMIT_AS) per environment; numpy and pandas
+  need far more than the restricted environment
+- a CPU-time limit per task (RLIMIT_CPU, raised by the task's budget
+  before each task; the kernel kills a worker that spends it)
+- a wall-clock limit enforced by the parent, which kills the worker
+
+A killed or crashed worker is replaced, so the pool stays warm. Workers
+keep their own utils.function_cache, so a stored function is compiled
+once per worker rather than once per call.
+
+IPC contract (one request and one reply per task, as length-prefixed
+bytes over a dedicated pipe pair; the worker's stdout goes to stderr):
+
+    request: JSON {"environment", "function_id", "code", "entry_names",
+             "args", "content": {"shm", "size", "encoding"}}
+    reply:   JSON {"ok": true, "result", "entry"} or
+             {"ok": false, "error", "error_type", "recycle"}
+
+The document content - the large argument - is written once into a
+multiprocessing.shared_memory block and read by the worker from there; the
+other arguments are small JSON. Nothing is pickled.
+
+Results come back with the types an in-process call returns: tuples,
+sets, dicts with non-string keys, datetime/date/time/timedelta, Decimal,
+bytes and numpy/pandas values (scalars, arrays, Series, DataFrames) are
+tagged in the reply JSON and rebuilt by the parent. A result of any
+other type fails the task rather than arriving as a string.
+
+Functions run in a named environment (the globals they see):
+    restricted: json, re and a reduced set of builtins (wizardry functions, CODE tools)
+    pandas:     json, pandas and StringIO (generated column extraction functions)
+
+The sandbox is on by default for the restricted environment only. The
+pandas environment stays in-process unless enabled: generated column
+functions can return pandas values the reply does not carry (Categorical,
+Period, Interval and other extension types), which would fail tasks that
+succeed in-process, and every worker that runs one imports pandas under
+the larger pandas memory limit.
+
+Configured by extraction.sandbox:
+    enabled:           Run stored functions in the pool (otherwise in-process), per environment
+                       ({"restricted": true, "pandas": false}) or one boolean
+    workers:           Worker processes
+    cpuSeconds:        CPU time per task
+    memoryMb:          Address space per task, per environment ({"restricted": ..., "pandas": ...}) or one number
+    timeoutSeconds:    Wall-clock time per task
+    maxTasksPerWorker: Tasks before a worker is replaced
+"""
+
+import atexit
+import base64
+import datetime
+import decimal
+import json
+import os
+import queue
+import signal
+import subprocess
+import sys
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+from multiprocessing.connection import Connection
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from utils.config import get_config
+from utils.function_cache import EntryPointNotFound, get_function_cache
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_WORKERS = 4
+DEFAULT_CPU_SECONDS = 60
+DEFAULT_ENABLED = {'restricted': True, 'pandas': False}
+DEFAULT_MEMORY_MB = {'restricted': 1024, 'pandas': 4096}
+DEFAULT_TIMEOUT_SECONDS = 120
+DEFAULT_MAX_TASKS_PER_WORKER = 200
+
+
+class SandboxError(RuntimeError):
+    """A stored function could not be run in the sandbox"""
+
+
+class SandboxTimeout(SandboxError):
+    """A stored function exceeded its wall-clock limit and its worker was killed"""
+
+
+def restricted_globals() -> Dict[str, Any]:
+    """Globals for wizardry functions and CODE tools: json, re and a reduced set of builtins"""
+    import re
+    return {
+        'json': json,
+        're': re,
+        '__builtins__': {
+            'len': len,
+            'str': str,
+            'int': int,
+            'float': float,
+            'list': list,
+            'dict': dict,
+            'range': range,
+            'enumerate': enumerate,
+            'zip': zip,
+            'print': print,
+            '__import__': __import__,  # Allow imports
+            'abs': abs,
+            'any': any,
+            'all': all,
+            'bool': bool,
+            'max': max,
+            'min': min,
+            'sum': sum,
+            'sorted': sorted,
+            'reversed': reversed
+        }
+    }
+
+
+def pandas_globals() -> Dict[str, Any]:
+    """Globals for generated column extraction functions: json, pandas and StringIO"""
+    from io import StringIO
+    import pandas as pd
+    return {'json': json, 'pandas': pd, 'StringIO': StringIO}
+
+
+ENVIRONMENTS: Dict[str, Callable[[], Dict[str, Any]]] = {
+    'restricted': restricted_globals,
+    'pandas': pandas_globals,
+}
+
+
+def get_sandbox_config() -> dict:
+    """
+    Get the sandbox configuration
+
+    Returns:
+        dict: extraction.sandbox from config.json
+    """
+    return get_config('extraction.sandbox', {}) or {}
+
+
+def _call_entry(compiled, content: Any, args: List[Any]) -> Any:
+    """Call an entry point with content plus as many of args as it declares"""
+    values = [content] + list(args)
+    return compiled.entry(*values[:max(1, min(len(values), compiled.parameter_count))])
+
+
+# ---------------------------------------------------------------------------
+# Result encoding
+
+_TAG = '__sandbox__'
+
+
+def _encode_result(value: Any) -> Any:
+    """JSON data for a result, with tagged objects for the types JSON would change"""
+    kind = type(value)
+    if value is None or kind in (str, bool, int, float):
+        return value
+    if kind is list:
+        return [_encode_result(item) for item in value]
+    if kind is dict and _TAG not in value and all(type(key) is str for key in value):
+        return {key: _encode_result(item) for key, item in value.items()}
+    if isinstance(value, dict):
+        return {_TAG: 'dict', 'items': [[_encode_result(key), _encode_result(item)] for key, item in value.items()]}
+    if kind in (tuple, set, frozenset):
+        return {_TAG: kind.__name__, 'items': [_encode_result(item) for item in value]}
+    if kind.__module__.split('.')[0] in ('numpy', 'pandas'):
+        return _encode_array_value(value)
+    if isinstance(value, datetime.datetime):
+        return {_TAG: 'datetime', 'value': value.isoformat()}
+    if isinstance(value, datetime.date):
+        return {_TAG: 'date', 'value': value.isoformat()}
+    if isinstance(value, datetime.time):
+        return {_TAG: 'time', 'value': value.isoformat()}
+    if isinstance(value, datetime.timedelta):
+        return {_TAG: 'timedelta', 'value': [value.days, value.seconds, value.microseconds]}
+    if isinstance(value, decimal.Decimal):
+        return {_TAG: 'Decimal', 'value': str(value)}
+    if isinstance(value, (bytes, bytearray)):
+        return {_TAG: 'bytes', 'value': base64.b64encode(value).decode('ascii')}
+    # Subclasses (enums, named tuples, ...) come back as their base type
+    for base in (bool, int, float, str, list, tuple):
+        if isinstance(value, base):
+            return _encode_result(base(value))
+    raise TypeError(f"Result of type {kind.__name__} cannot be returned from the sandbox")
+
+
+def _encode_array_value(value: Any) -> Any:
+    """numpy and pandas values"""
+    import numpy as np
+    import pandas as pd
+    if value is pd.NaT:
+        return {_TAG: 'NaT'}
+    if value is pd.NA:
+        return {_TAG: 'NA'}
+    if isinstance(value, pd.Timestamp):
+        return {_TAG: 'Timestamp', 'value': value.isoformat()}
+    if isinstance(value, pd.Timedelta):
+        return {_TAG: 'Timedelta', 'value': value.value}
+    if isinstance(value, np.generic):
+        return {_TAG: 'numpy', 'dtype': str(value.dtype), 'value': _encode_result(value.item())}
+    if isinstance(value, np.ndarray):
+        return {_TAG: 'ndarray', 'dtype': str(value.dtype), 'items': _encode_result(value.tolist())}
+    if isinstance(value, pd.Series):
+        return {_TAG: 'Series', 'name': _encode_result(value.name), 'dtype': str(value.dtype),
+                'index': _encode_result(value.index.tolist()), 'items': _encode_result(value.tolist())}
+    if isinstance(value, pd.DataFrame):
+        return {_TAG: 'DataFrame', 'columns': _encode_result(value.columns.tolist()),
+                'index': _encode_result(value.index.tolist()),
+                'dtypes': [str(dtype) for dtype in value.dtypes],
+                'data': [_encode_result(value.iloc[:, position].tolist()) for position in range(value.shape[1])]}
+    raise TypeError(f"Result of type {type(value).__name__} cannot be returned from the sandbox")
+
+
+def _series(items: List[Any], dtype: str, **kwargs):
+    import pandas as pd
+    try:
+        return pd.Series(items, dtype=dtype, **kwargs)
+    except (TypeError, ValueError):
+        return pd.Series(items, **kwargs)
+
+
+def _decode_result(value: Any) -> Any:
+    """Rebuild a result encoded by _encode_result"""
+    if isinstance(value, list):
+        return [_decode_result(item) for item in value]
+    if not isinstance(value, dict):
+        return value
+    tag = value.get(_TAG)
+    if tag is None:
+        return {key: _decode_result(item) for key, item in value.items()}
+    if tag == 'dict':
+        return {_decode_result(key): _decode_result(item) for key, item in value['items']}
+    if tag in ('tuple', 'set', 'frozenset'):
+        return {'tuple': tuple, 'set': set, 'frozenset': frozenset}[tag](_decode_result(item) for item in value['items'])
+    if tag == 'datetime':
+        return datetime.datetime.fromisoformat(value['value'])
+    if tag == 'date':
+        return datetime.date.fromisoformat(value['value'])
+    if tag == 'time':
+        return datetime.time.fromisoformat(value['value'])
+    if tag == 'timedelta':
+        return datetime.timedelta(*value['value'])
+    if tag == 'Decimal':
+        return decimal.Decimal(value['value'])
+    if tag == 'bytes':
+        return base64.b64decode(value['value'])
+
+    import numpy as np
+    import pandas as pd
+    if tag == 'NaT':
+        return pd.NaT
+    if tag == 'NA':
+        return pd.NA
+    if tag == 'Timestamp':
+        return pd.Timestamp(value['value'])
+    if tag == 'Timedelta':
+        return pd.Timedelta(value['value'])
+    if tag == 'numpy':
+        return np.array(_decode_result(value['value']), dtype=value['dtype'])[()]
+    if tag == 'ndarray':
+        return np.array(_decode_result(value['items']), dtype=value['dtype'])
+    if tag == 'Series':
+        return _series(_decode_result(value['items']), value['dtype'], name=_decode_result(value['name']),
+                       index=pd.Index(_decode_result(value['index'])))
+    if tag == 'DataFrame':
+        index = pd.Index(_decode_result(value['index']))
+        frame = pd.DataFrame({position: _series(_decode_result(items), dtype, index=index)
+                              for position, (items, dtype) in enumerate(zip(value['data'], value['dtypes']))},
+                             index=index)
+        frame.columns = pd.Index(_decode_result(value['columns']))
+        return frame
+    raise ValueError(f"Unknown sandbox result tag {tag!r}")
+
+
+# ---------------------------------------------------------------------------
+# Worker side
+
+
+def _set_memory_limit(memory_mb: int, hard_mb: int = None):
+    """Limit the address space to memory_mb (the hard limit, once set, only goes down)"""
+    import resource
+    if not memory_mb:
+        return
+    hard = hard_mb * 1024 * 1024 if hard_mb else resource.getrlimit(resource.RLIMIT_AS)[1]
+    soft = memory_mb * 1024 * 1024
+    if hard != resource.RLIM_INFINITY:
+        soft = min(soft, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (soft, hard))
+
+
+def _set_cpu_budget(cpu_seconds: int):
+    """Allow cpu_seconds more CPU time from now"""
+    import resource
+    if not cpu_seconds:
+        return
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    soft = int(usage.ru_utime + usage.ru_stime) + cpu_seconds
+    hard = resource.getrlimit(resource.RLIMIT_CPU)[1]
+    if hard != resource.RLIM_INFINITY:
+        soft = min(soft, hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+
+def _read_content(spec: Optional[Dict[str, Any]]) -> Any:
+    if not spec:
+        return None
+    try:
+        block = shared_memory.SharedMemory(name=spec['shm'], track=False)
+    except TypeError:
+        # Python < 3.13 registers attached blocks for unlinking at exit; the parent owns this one
+        block = shared_memory.SharedMemory(name=spec['shm'])
+        resource_tracker.unregister(block._name, 'shared_memory')
+    try:
+        text = bytes(block.buf[:spec['size']]).decode('utf-8')
+    finally:
+        block.close()
+    return json.loads(text) if spec.get('encoding') == 'json' else text
+
+
+def _worker_main(requests, replies, memory_mb: int, cpu_seconds: int):
+    """Worker loop: one request in, one reply out, until the request pipe closes"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Output of stored functions goes to stderr, like the rest of the diagnostics
+    os.dup2(2, 1)
+    _set_memory_limit(memory_mb, memory_mb)
+    cache = get_function_cache()
+    while True:
+        try:
+            request = json.loads(requests.recv_bytes())
+        except (EOFError, OSError):
+            return
+        _set_cpu_budget(request.get('cpu_seconds', cpu_seconds))
+        _set_memory_limit(request.get('memory_mb'))
+        try:
+            content = _read_content(request.get('content'))
+            compiled = cache.get(request['environment'], request.get('function_id'), request['code'],
+                                 request['entry_names'], ENVIRONMENTS[request['environment']])
+            result = _call_entry(compiled, content, request.get('args', []))
+            reply = {"ok": True, "result": _encode_result(result), "entry": compiled.entry_name}
+        except MemoryError:
+            reply = {"ok": False, "error": "Memory limit exceeded", "error_type": "MemoryError", "recycle": True}
+        except BaseException as e:
+            reply = {"ok": False, "error": str(e), "error_type": type(e).__name__}
+        try:
+            payload = json.dumps(reply).encode('utf-8')
+        except (TypeError, ValueError) as e:
+            payload = json.dumps({"ok": False, "error": f"Result is not serializable: {e}",
+                                  "error_type": "TypeError"}).encode('utf-8')
+        replies.send_bytes(payload)
+
+
+# ---------------------------------------------------------------------------
+# Parent side
+
+
+class _Worker:
+    """A worker interpreter (python -m utils.sandbox_pool) and its request and reply pipes"""
+
+    def __init__(self, memory_mb: int, cpu_seconds: int):
+        request_read, request_write = os.pipe()
+        reply_read, reply_write = os.pipe()
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [PROJECT_ROOT, env.get('PYTHONPATH')]))
+        # One BLAS thread: per-thread buffers would otherwise take address space under RLIMIT_AS
+        for name in ('OPENBLAS_NUM_THREADS', 'OMP_NUM_THREADS', 'MKL_NUM_THREADS'):
+            env.setdefault(name, '1')
+        try:
+            self.process = subprocess.Popen(
+                [sys.executable, '-m', 'utils.sandbox_pool', str(request_read), str(reply_write),
+                 str(memory_mb), str(cpu_seconds)],
+                pass_fds=(request_read, reply_write), stdin=subprocess.DEVNULL, env=env)
+        finally:
+            os.close(request_read)
+            os.close(reply_write)
+        self.requests = Connection(request_write, readable=False)
+        self.replies = Connection(reply_read, writable=False)
+        self.tasks = 0
+
+    def stop(self, kill: bool = False):
+        for conn in (self.requests, self.replies):
+            try:
+                conn.close()
+            except OSError:
+                pass
+        if kill:
+            self.process.kill()
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait(timeout=5)
+
+
+def _exit_reason(exitcode: Optional[int]) -> str:
+    if exitcode == -signal.SIGXCPU:
+        return "CPU time limit exceeded"
+    if exitcode == -signal.SIGKILL:
+        return "worker was killed (likely out of memory)"
+    return f"worker exited with code {exitcode}"
+
+
+class SandboxPool:
+    """Pool of pre-started, resource-limited worker processes"""
+
+    def __init__(self, config: dict = None):
+        self.config = config if config is not None else get_sandbox_config()
+        self.size = max(1, int(self.config.get('workers', DEFAULT_WORKERS)))
+        self.cpu_seconds = int(self.config.get('cpuSeconds', DEFAULT_CPU_SECONDS))
+        memory_mb = self.config.get('memoryMb', DEFAULT_MEMORY_MB)
+        self.memory_mb = ({name: int(memory_mb) for name in ENVIRONMENTS} if not isinstance(memory_mb, dict)
+                          else {name: int(memory_mb.get(name, DEFAULT_MEMORY_MB[name])) for name in ENVIRONMENTS})
+        self.timeout = float(self.config.get('timeoutSeconds', DEFAULT_TIMEOUT_SECONDS))
+        self.max_tasks = int(self.config.get('maxTasksPerWorker', DEFAULT_MAX_TASKS_PER_WORKER))
+        self._idle: 'queue.Queue[_Worker]' = queue.Queue()
+        self._lock = threading.Lock()
+        self._closed = False
+        self.stats = {"tasks": 0, "timeouts": 0, "crashes": 0, "replaced": 0}
+        started = time.time()
+        for _ in range(self.size):
+            self._idle.put(self._spawn())
+        print(f"🧪 SANDBOX: {self.size} workers started in {time.time() - started:.1f}s "
+              f"(cpu {self.cpu_seconds}s, memory {', '.join(f'{name} {mb}MB' for name, mb in self.memory_mb.items())}, "
+              f"wall clock {self.timeout:.0f}s)",
+              file=sys.stderr, flush=True)
+
+    def _spawn(self) -> _Worker:
+        return _Worker(max(self.memory_mb.values()), self.cpu_seconds)
+
+    def _replace(self, worker: _Worker, kill: bool):
+        worker.stop(kill=kill)
+        with self._lock:
+            self.stats["replaced"] += 1
+            if self._closed:
+                return
+        self._idle.put(self._spawn())
+
+    def run(self, environment: str, function_id: Optional[str], code: str, entry_names: Sequence[str],
+            content: Any = None, args: Sequence[Any] = (), timeout: float = None) -> Any:
+        """
+        Run a stored function in a worker
+
+        Parameters:
+            environment (str): Environment name (see ENVIRONMENTS)
+            function_id (str): Stored function id, if any (worker-side compile cache key)
+            code (str): Function source
+            entry_names (sequence): Accepted entry point names
+            content: First argument (document text or JSON-serializable data), passed through shared memory
+            args (sequence): Further JSON-serializable arguments; the entry point gets as many as it declares
+            timeout (float): Wall-clock limit (default extraction.sandbox.timeoutSeconds)
+
+        Returns:
+            The function's result, with its Python types (see "Result encoding")
+
+        Raises:
+            EntryPointNotFound: The code defines none of entry_names
+            SandboxTimeout: The wall-clock limit was exceeded
+            SandboxError: The function raised, or its worker died
+        """
+        if self._closed:
+            raise SandboxError("Sandbox pool is shut down")
+        block = None
+        request = {"environment": environment, "function_id": function_id, "code": code,
+                   "entry_names": list(entry_names), "args": list(args), "content": None,
+                   "cpu_seconds": self.cpu_seconds, "memory_mb": self.memory_mb[environment]}
+        if content is not None:
+            encoding = 'text' if isinstance(content, str) else 'json'
+            data = (content if encoding == 'text' else json.dumps(content, default=str)).encode('utf-8')
+            block = shared_memory.SharedMemory(create=True, size=max(1, len(data)))
+            block.buf[:len(data)] = data
+            request["content"] = {"shm": block.name, "size": len(data), "encoding": encoding}
+
+        worker = self._idle.get()
+        try:
+            try:
+                worker.requests.send_bytes(json.dumps(request, default=str).encode('utf-8'))
+                if not worker.replies.poll(timeout or self.timeout):
+                    with self._lock:
+                        self.stats["timeouts"] += 1
+                    self._replace(worker, kill=True)
+                    worker = None
+                    raise SandboxTimeout(f"Function exceeded {timeout or self.timeout:.0f}s and was stopped")
+                reply = json.loads(worker.replies.recv_bytes())
+            except (EOFError, OSError, BrokenPipeError):
+                try:
+                    worker.process.wait(timeout=1)
+                except subprocess.TimeoutExpired:
+                    pass
+                reason = _exit_reason(worker.process.returncode)
+                with self._lock:
+                    self.stats["crashes"] += 1
+                self._replace(worker, kill=True)
+                worker = None
+                raise SandboxError(f"Function failed: {reason}")
+
+            worker.tasks += 1
+            with self._lock:
+                self.stats["tasks"] += 1
+            if reply.get('recycle') or worker.tasks >= self.max_tasks:
+                self._replace(worker, kill=False)
+                worker = None
+        finally:
+            if worker is not None:
+                self._idle.put(worker)
+            if block is not None:
+                block.close()
+                block.unlink()
+
+        if reply.get('ok'):
+            return _decode_result(reply.get('result'))
+        if reply.get('error_type') == 'EntryPointNotFound':
+            raise EntryPointNotFound(reply.get('error'))
+        raise SandboxError(f"{reply.get('error_type')}: {reply.get('error')}")
+
+    def shutdown(self):
+        """Stop every worker"""
+        with self._lock:
+            self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().stop()
+            except queue.Empty:
+                break
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def is_sandbox_enabled(environment: str) -> bool:
+    """
+    Check whether stored functions of an environment run in the sandbox
+
+    Parameters:
+        environment (str): Environment name (see ENVIRONMENTS)
+
+    Returns:
+        bool: extraction.sandbox.enabled for the environment (default: restricted only)
+    """
+    enabled = get_sandbox_config().get('enabled', DEFAULT_ENABLED)
+    if isinstance(enabled, dict):
+        return bool(enabled.get(environment, DEFAULT_ENABLED.get(environment, False)))
+    return bool(enabled)
+
+
+def get_sandbox_pool() -> SandboxPool:
+    """Get the process-wide sandbox pool, starting its workers on first use"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = SandboxPool()
+            atexit.register(_pool.shutdown)
+    return _pool
+
+
+def run_stored_function(environment: str, function_id: Optional[str], code: str, entry_names: Sequence[str],
+                        content: Any = None, args: Sequence[Any] = ()) -> Any:
+    """
+    Run a stored function in the sandbox pool, or in-process when the sandbox is disabled for its environment
+
+    The entry point gets content followed by as many of args as it declares.
+    Both paths compile through utils.function_cache.
+
+    Raises:
+        EntryPointNotFound: The code defines none of entry_names
+        SyntaxError: The code does not compile (in-process only; the sandbox raises SandboxError)
+        SandboxError: The function failed or exceeded a limit in the sandbox
+    """
+    if is_sandbox_enabled(environment):
+        return get_sandbox_pool().run(environment, function_id, code, entry_names, content, args)
+    compiled = get_function_cache().get(environment, function_id, code, entry_names, ENVIRONMENTS[environment])
+    return _call_entry(compiled, content, args)
+
+
+if __name__ == "__main__":
+    # Worker entry point: request fd, reply fd, memory limit (MB), CPU seconds per task
+    _worker_main(Connection(int(sys.argv[1]), writable=False), Connection(int(sys.argv[2]), readable=False),
+                 int(sys.argv[3]), int(sys.argv[4]))
@@ -0,0 +1,353 @@
+"""
+Single-flight coalescing of identical in-flight Gemini requests
+
+Concurrent calls with the same key share one upstream call:
+
+- within a process, followers wait on the leader's threading.Event and
+  receive its result (or its exception)
+- across processes, the leader holds an flock on a per-key lock file and
+  writes a short-lived result file; followers block on the lock and read
+  the result once it is released
+
+Streams are shared too (SingleFlight.stream): one pump thread reads the
+upstream stream and buffers its chunks, and every caller with the same
+key - including one that joins mid-stream - reads all chunks from that
+buffer. Across processes the pump holds the same per-key lock; a process
+that finds it held waits and receives the finished response as a single
+merged chunk.
+
+Results are only shared with callers that were waiting while the call was
+in flight (plus a resultTtlSeconds hand-off window across processes), so
+this does not behave like a cache.
+"""
+
+import contextvars
+import fcntl
+import hashlib
+import os
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from utils.config import get_config
+
+DEFAULT_STATE_DIR = 'logs/single_flight'
+LOCK_POLL_SECONDS = 0.05
+SWEEP_INTERVAL_SECONDS = 600      # How often a process cleans up old lock/result files
+SWEEP_AGE_SECONDS = 3600
+
+_bypass = contextvars.ContextVar('single_flight_bypass', default=False)
+
+
+def set_single_flight_bypass(bypass: bool):
+    """
+    Make the current context's calls skip coalescing
+
+    Used for hedged duplicates, which must reach upstream rather than
+    wait on the request they are hedging.
+    """
+    _bypass.set(bool(bypass))
+
+
+class _Call:
+    """One in-flight call and the callers waiting on it"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: Optional[BaseException] = None
+        self.followers = 0
+
+
+class _StreamCall:
+    """One in-flight upstream stream, its buffered chunks and the callers reading them"""
+
+    def __init__(self):
+        self.changed = threading.Condition()
+        self.chunks: List[Any] = []
+        self.finished = False
+        self.error: Optional[BaseException] = None
+        self.consumers = 0
+        self.followers = 0
+
+
+class _Abandoned(Exception):
+    """Every caller stopped reading a shared stream"""
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls that share a key
+
+    Configured by ai.singleFlight:
+        crossProcess:        Also coalesce across processes via lock files
+        stateDir:            Directory for lock and result files
+        resultTtlSeconds:    How long a finished result may be handed to a waiting process
+        waitTimeoutSeconds:  Followers give up waiting and call upstream themselves
+    """
+
+    def __init__(self, config: Dict = None):
+        self.config = config if config is not None else (get_config('ai.singleFlight', {}) or {})
+        self.cross_process = bool(self.config.get('crossProcess', True))
+        self.state_dir = self.config.get('stateDir', DEFAULT_STATE_DIR)
+        self.result_ttl = float(self.config.get('resultTtlSeconds', 10))
+        self.wait_timeout = float(self.config.get('waitTimeoutSeconds', 600))
+        self.stats = {"leaders": 0, "followers": 0, "cross_process_hits": 0, "timeouts": 0}
+        self._calls: Dict[str, _Call] = {}
+        self._streams: Dict[str, _StreamCall] = {}
+        self._lock = threading.Lock()
+        self._last_sweep = 0.0
+
+    def do(self, key: str, fn: Callable[[], Any], serialize: Callable[[Any], str] = None,
+           deserialize: Callable[[str], Any] = None) -> Any:
+        """
+        Run fn once for all concurrent callers with the same key
+
+        Parameters:
+            key (str): Request identity, e.g. a prompt fingerprint
+            fn (callable): Upstream call
+            serialize (callable): Result -> str for cross-process sharing
+            deserialize (callable): str -> result; both are required for crossProcess
+
+        Returns:
+            The result of fn (the leader's result for followers)
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = _Call()
+                self._calls[key] = call
+                leader = True
+                self.stats["leaders"] += 1
+            else:
+                call.followers += 1
+                leader = False
+                self.stats["followers"] += 1
+
+        if not leader:
+            print(f"🔗 SINGLE FLIGHT: joined in-flight request {key[:12]}", file=sys.stderr, flush=True)
+            if not call.done.wait(self.wait_timeout):
+                self.stats["timeouts"] += 1
+                print(f"⚠️ SINGLE FLIGHT: gave up waiting for {key[:12]} - calling upstream", file=sys.stderr, flush=True)
+                return fn()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            if self.cross_process and serialize and deserialize:
+                call.result = self._do_cross_process(key, fn, serialize, deserialize)
+            else:
+                call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+            if call.followers:
+                print(f"🔗 SINGLE FLIGHT: {call.followers} caller(s) shared request {key[:12]}", file=sys.stderr, flush=True)
+        return call.result
+
+    def stream(self, key: str, open_stream: Callable[[], Iterator[Any]], merge: Callable[[List[Any]], Any] = None,
+               serialize: Callable[[Any], str] = None, deserialize: Callable[[str], Any] = None) -> Iterator[Any]:
+        """
+        Read one upstream stream for all concurrent callers with the same key
+
+        Parameters:
+            key (str): Request identity, e.g. a prompt fingerprint
+            open_stream (callable): Opens the upstream stream (an iterator of chunks)
+            merge (callable): Chunks -> one response, shared with other processes
+            serialize (callable): Response -> str for cross-process sharing
+            deserialize (callable): str -> response; merge, serialize and deserialize are required for crossProcess
+
+        Returns:
+            Iterator over every chunk of the shared stream, from the first one
+        """
+        with self._lock:
+            call = self._streams.get(key)
+            leader = call is None
+            if leader:
+                call = _StreamCall()
+                self._streams[key] = call
+                self.stats["leaders"] += 1
+            else:
+                call.followers += 1
+                self.stats["followers"] += 1
+            with call.changed:
+                call.consumers += 1
+
+        if leader:
+            # The pump keeps the leader's context (rate limit organization, usage tags)
+            pump = threading.Thread(target=contextvars.copy_context().run,
+                                    args=(self._pump, key, call, open_stream, merge, serialize, deserialize),
+                                    name=f"single-flight-stream-{key[:12]}", daemon=True)
+            pump.start()
+        else:
+            print(f"🔗 SINGLE FLIGHT: joined in-flight stream {key[:12]} at chunk {len(call.chunks)}",
+                  file=sys.stderr, flush=True)
+        return self._read_stream(key, call)
+
+    def _read_stream(self, key: str, call: _StreamCall) -> Iterator[Any]:
+        position = 0
+        try:
+            while True:
+                with call.changed:
+                    while position >= len(call.chunks) and not call.finished:
+                        if not call.changed.wait(self.wait_timeout):
+                            self.stats["timeouts"] += 1
+                            raise TimeoutError(f"No stream chunk for {key[:12]} in {self.wait_timeout:.0f}s")
+                    if position >= len(call.chunks):
+                        if call.error is not None:
+                            raise call.error
+                        return
+                    chunk = call.chunks[position]
+                position += 1
+                yield chunk
+        finally:
+            with call.changed:
+                call.consumers -= 1
+
+    def _pump(self, key: str, call: _StreamCall, open_stream, merge, serialize, deserialize):
+        """Read the upstream stream into the shared buffer"""
+        def run_upstream():
+            upstream = open_stream()
+            try:
+                for chunk in upstream:
+                    with call.changed:
+                        call.chunks.append(chunk)
+                        call.changed.notify_all()
+                        if not call.consumers:
+                            raise _Abandoned()
+            finally:
+                close = getattr(upstream, 'close', None)
+                if close:
+                    close()
+            return merge(call.chunks) if merge and call.chunks else None
+
+        try:
+            if self.cross_process and merge and serialize and deserialize:
+                shared = self._do_cross_process(key, run_upstream, serialize, deserialize)
+                if not call.chunks and shared is not None:
+                    # Another process streamed it: hand the finished response over as one chunk
+                    with call.changed:
+                        call.chunks.append(shared)
+            else:
+                run_upstream()
+        except _Abandoned:
+            pass
+        except BaseException as e:
+            call.error = e
+        finally:
+            with self._lock:
+                self._streams.pop(key, None)
+            with call.changed:
+                call.finished = True
+                call.changed.notify_all()
+            if call.followers:
+                print(f"🔗 SINGLE FLIGHT: {call.followers} caller(s) shared stream {key[:12]}", file=sys.stderr, flush=True)
+
+    def _paths(self, key: str):
+        name = hashlib.sha256(key.encode('utf-8')).hexdigest()[:40]
+        return os.path.join(self.state_dir, f"{name}.lock"), os.path.join(self.state_dir, f"{name}.result")
+
+    def _read_fresh_result(self, result_path: str) -> Optional[str]:
+        try:
+            if time.time() - os.path.getmtime(result_path) > self.result_ttl:
+                return None
+            with open(result_path, 'r') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _do_cross_process(self, key: str, fn: Callable[[], Any], serialize, deserialize) -> Any:
+        """Hold the key's file lock while calling upstream; reuse a result another process just wrote"""
+        try:
+            os.makedirs(self.state_dir, exist_ok=True)
+            lock_file = open(self._paths(key)[0], 'a')
+        except OSError as e:
+            print(f"⚠️ SINGLE FLIGHT: lock file unavailable ({e}) - in-process only", file=sys.stderr, flush=True)
+            return fn()
+        lock_path, result_path = self._paths(key)
+
+        try:
+            started = time.time()
+            waited = False
+            while True:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if not waited:
+                        print(f"🔗 SINGLE FLIGHT: waiting on another process for {key[:12]}", file=sys.stderr, flush=True)
+                        waited = True
+                    if time.time() - started > self.wait_timeout:
+                        self.stats["timeouts"] += 1
+                        return fn()
+                    time.sleep(LOCK_POLL_SECONDS)
+
+            try:
+                if waited:
+                    shared = self._read_fresh_result(result_path)
+                    if shared is not None:
+                        try:
+                            result = deserialize(shared)
+                            self.stats["cross_process_hits"] += 1
+                            return result
+                        except Exception as e:
+                            print(f"⚠️ SINGLE FLIGHT: unreadable shared result ({e})", file=sys.stderr, flush=True)
+
+                result = fn()
+                try:
+                    tmp_path = f"{result_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                    with open(tmp_path, 'w') as f:
+                        f.write(serialize(result))
+                    os.replace(tmp_path, result_path)
+                except Exception as e:
+                    print(f"⚠️ SINGLE FLIGHT: could not share result ({e})", file=sys.stderr, flush=True)
+                return result
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        finally:
+            lock_file.close()
+            self._sweep()
+
+    def _sweep(self):
+        """Remove lock and result files nobody has touched for an hour"""
+        now = time.time()
+        if now - self._last_sweep < SWEEP_INTERVAL_SECONDS:
+            return
+        self._last_sweep = now
+        try:
+            for name in os.listdir(self.state_dir):
+                path = os.path.join(self.state_dir, name)
+                try:
+                    if now - os.path.getmtime(path) > SWEEP_AGE_SECONDS:
+                        os.remove(path)
+                except OSError:
+                    continue
+        except OSError:
+            pass
+
+
+_single_flight = None
+_single_flight_lock = threading.Lock()
+
+
+def get_single_flight() -> Optional[SingleFlight]:
+    """
+    Get the process-wide single-flight group
+
+    Returns:
+        SingleFlight: Group, or None when ai.singleFlight.enabled is off or
+                      the context bypasses coalescing
+    """
+    global _single_flight
+    if _bypass.get() or not get_config('ai.singleFlight.enabled', False):
+        return None
+    with _single_flight_lock:
+        if _single_flight is None:
+            _single_flight = SingleFlight()
+    return _single_flight
@@ -0,0 +1,114 @@
+"""
+Small JSON state stores shared between service processes
+
+Each store exposes transaction(), a context manager yielding a dict that is
+persisted when the block exits without an exception. Used for state that
+must be shared by the separately spawned Python services (rate limiter
+buckets, circuit breakers).
+
+- file:     JSON file guarded by fcntl.flock (processes on one host)
+- postgres: llm_rate_limit_state row guarded by pg_advisory_xact_lock
+- memory:   in-process only (local stand-in for tests and benchmarks)
+"""
+
+import fcntl
+import json
+import os
+import threading
+import zlib
+from contextlib import contextmanager
+
+
+class MemoryStateStore:
+    """In-process state store"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._state = {}
+
+    @contextmanager
+    def transaction(self):
+        with self._lock:
+            yield self._state
+
+
+class FileStateStore:
+    """JSON state file guarded by an exclusive flock"""
+
+    def __init__(self, state_dir: str, name: str = 'state'):
+        os.makedirs(state_dir, exist_ok=True)
+        self.path = os.path.join(state_dir, f'{name}.json')
+        self.lock_path = os.path.join(state_dir, f'{name}.lock')
+        self._thread_lock = threading.Lock()
+
+    @contextmanager
+    def transaction(self):
+        with self._thread_lock, open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                try:
+                    with open(self.path, 'r') as f:
+                        state = json.load(f)
+                except (OSError, ValueError):
+                    state = {}
+                yield state
+                tmp_path = f"{self.path}.{os.getpid()}.tmp"
+                with open(tmp_path, 'w') as f:
+                    json.dump(state, f)
+                os.replace(tmp_path, self.path)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class PostgresStateStore:
+    """llm_rate_limit_state row guarded by a transaction-level advisory lock"""
+
+    def __init__(self, database_url: str, key: str):
+        import psycopg2
+        self._connect = lambda: psycopg2.connect(database_url)
+        self._conn = None
+        self._key = key
+        self._lock_key = zlib.crc32(key.encode('utf-8'))
+        self._thread_lock = threading.Lock()
+
+    @contextmanager
+    def transaction(self):
+        with self._thread_lock:
+            if self._conn is None or self._conn.closed:
+                self._conn = self._connect()
+            cursor = self._conn.cursor()
+            try:
+                cursor.execute("SELECT pg_advisory_xact_lock(%s)", (self._lock_key,))
+                cursor.execute("SELECT state FROM llm_rate_limit_state WHERE key = %s", (self._key,))
+                row = cursor.fetchone()
+                state = row[0] if row and row[0] else {}
+                yield state
+                cursor.execute("""
+                    INSERT INTO llm_rate_limit_state (key, state, updated_at) VALUES (%s, %s, NOW())
+                    ON CONFLICT (key) DO UPDATE SET state = EXCLUDED.state, updated_at = NOW()
+                """, (self._key, json.dumps(state)))
+                self._conn.commit()
+            except Exception:
+                self._conn.rollback()
+                raise
+            finally:
+                cursor.close()
+
+
+def build_state_store(backend: str, state_dir: str, key: str):
+    """
+    Create a state store
+
+    Parameters:
+        backend (str): 'file', 'postgres' or 'memory' ('postgres' needs DATABASE_URL, else file)
+        state_dir (str): Directory for the file backend
+        key (str): Row key for the postgres backend
+
+    Returns:
+        A store with a transaction() context manager
+    """
+    if backend == 'postgres' and os.getenv('DATABASE_URL'):
+        return PostgresStateStore(os.getenv('DATABASE_URL'), key)
+    if backend == 'memory':
+        return MemoryStateStore()
+    return FileStateStore(state_dir)
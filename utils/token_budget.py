@@ -0,0 +1,255 @@
+"""
+Token estimation and budgeting for AI prompts
+"""
+
+import json
+import re
+from typing import Any, Callable, Dict, List, Optional
+
+from utils.config import get_config
+from utils.constants import MAX_TOKEN_LIMIT, CHARS_PER_TOKEN
+
+# Natural document boundaries, strongest first
+SECTION_BOUNDARIES = [
+    re.compile(r'(?<=\f)'),                # PDF page breaks
+    re.compile(r'(?m)(?=^=== Sheet: )'),    # Excel sheet markers
+    re.compile(r'(?<=\n\n)'),              # Paragraph / section breaks
+]
+
+
+def get_token_limit() -> int:
+    """
+    Get the configured per-section token budget
+
+    Returns:
+        int: Token budget from config.json (extraction.tokenLimit) or MAX_TOKEN_LIMIT
+    """
+    try:
+        return int(get_config('extraction.tokenLimit', MAX_TOKEN_LIMIT))
+    except (TypeError, ValueError):
+        return MAX_TOKEN_LIMIT
+
+
+def estimate_tokens(value: Any) -> int:
+    """
+    Estimate the number of tokens a value will use in a prompt
+
+    Parameters:
+        value: Text or JSON-serialisable value
+
+    Returns:
+        int: Estimated token count (ceil of characters / CHARS_PER_TOKEN)
+    """
+    if value is None:
+        return 0
+    if not isinstance(value, str):
+        value = json.dumps(value, default=str)
+    return (len(value) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def measure_prompt_sections(sections: Dict[str, Any]) -> Dict[str, int]:
+    """
+    Measure each prompt section before sending
+
+    Parameters:
+        sections (dict): Section name -> text or JSON-serialisable value
+
+    Returns:
+        dict: Section name -> estimated tokens, plus a 'total' entry
+    """
+    measurements = {name: estimate_tokens(value) for name, value in sections.items()}
+    measurements['total'] = sum(measurements.values())
+    return measurements
+
+
+def format_prompt_budget(measurements: Dict[str, int], budget: Optional[int] = None) -> str:
+    """
+    Format section measurements as a single log line
+
+    Parameters:
+        measurements (dict): Output of measure_prompt_sections
+        budget (int): Token budget to flag sections against (defaults to get_token_limit())
+
+    Returns:
+        str: Human readable summary, oversized sections marked with '!'
+    """
+    budget = budget or get_token_limit()
+    parts = []
+    for name, tokens in measurements.items():
+        if name == 'total':
+            continue
+        marker = "!" if tokens > budget else ""
+        parts.append(f"{name}={tokens}{marker}")
+    return f"~{measurements.get('total', 0)} tokens (budget {budget}/section): " + ", ".join(parts)
+
+
+def split_text_by_tokens(text: str, max_tokens: Optional[int] = None) -> List[str]:
+    """
+    Split text into chunks that each fit within a token budget
+
+    Chunks end on line boundaries where possible; a single line longer than
+    the budget is cut at the character limit. Joining the chunks gives back
+    the original text.
+
+    Parameters:
+        text (str): Text to split
+        max_tokens (int): Token budget per chunk (defaults to get_token_limit())
+
+    Returns:
+        list: Text chunks
+    """
+    if not text:
+        return [text or ""]
+
+    max_chars = (max_tokens or get_token_limit()) * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return [text]
+
+    chunks = []
+    current = []
+    current_len = 0
+    for line in text.splitlines(keepends=True):
+        # Oversized single line: flush and hard-cut it
+        while len(line) > max_chars:
+            if current:
+                chunks.append("".join(current))
+                current, current_len = [], 0
+            chunks.append(line[:max_chars])
+            line = line[max_chars:]
+
+        if current_len + len(line) > max_chars and current:
+            chunks.append("".join(current))
+            current, current_len = [], 0
+
+        current.append(line)
+        current_len += len(line)
+
+    if current:
+        chunks.append("".join(current))
+
+    return chunks
+
+
+def split_text_on_boundaries(text: str, max_tokens: Optional[int] = None) -> List[str]:
+    """
+    Split text into token-sized chunks on page or section boundaries
+
+    Pages, sheets and paragraphs are kept whole and packed together while
+    they fit; only a section larger than the budget is split further, down
+    to line level. Joining the chunks gives back the original text.
+
+    Parameters:
+        text (str): Text to split
+        max_tokens (int): Token budget per chunk (defaults to get_token_limit())
+
+    Returns:
+        list: Text chunks
+    """
+    return _split_at_level(text or "", max_tokens or get_token_limit(), 0)
+
+
+def _split_at_level(text: str, max_tokens: int, level: int) -> List[str]:
+    """Split text using SECTION_BOUNDARIES[level], recursing into oversized pieces"""
+    if estimate_tokens(text) <= max_tokens:
+        return [text]
+    if level >= len(SECTION_BOUNDARIES):
+        return split_text_by_tokens(text, max_tokens)
+
+    pieces = [piece for piece in SECTION_BOUNDARIES[level].split(text) if piece]
+    if len(pieces) <= 1:
+        return _split_at_level(text, max_tokens, level + 1)
+
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    chunks = []
+    current = []
+    current_len = 0
+    for piece in pieces:
+        if len(piece) > max_chars:
+            if current:
+                chunks.append("".join(current))
+                current, current_len = [], 0
+            chunks.extend(_split_at_level(piece, max_tokens, level + 1))
+            continue
+
+        if current and current_len + len(piece) > max_chars:
+            chunks.append("".join(current))
+            current, current_len = [], 0
+        current.append(piece)
+        current_len += len(piece)
+
+    if current:
+        chunks.append("".join(current))
+
+    return chunks
+
+
+def chunk_documents(documents: List[Dict[str, Any]], max_tokens: Optional[int] = None,
+                    content_key: str = 'content') -> List[Dict[str, Any]]:
+    """
+    Split oversized documents into token-sized chunks
+
+    Documents within budget are returned unchanged. Oversized documents are
+    split on page or section boundaries and replaced by one entry per chunk
+    carrying 'chunk_index' and 'chunk_count' so the model can tell the parts
+    belong together.
+
+    Parameters:
+        documents (list): Document dictionaries
+        max_tokens (int): Token budget per chunk (defaults to get_token_limit())
+        content_key (str): Key holding the document text
+
+    Returns:
+        list: Document dictionaries, each within the budget
+    """
+    max_tokens = max_tokens or get_token_limit()
+    chunked = []
+
+    for doc in documents:
+        content = doc.get(content_key) or ""
+        if estimate_tokens(content) <= max_tokens:
+            chunked.append(doc)
+            continue
+
+        parts = split_text_on_boundaries(content, max_tokens)
+        for index, part in enumerate(parts):
+            chunk = dict(doc)
+            chunk[content_key] = part
+            chunk['chunk_index'] = index
+            chunk['chunk_count'] = len(parts)
+            chunked.append(chunk)
+
+    return chunked
+
+
+def pack_by_token_budget(items: List[Any], max_tokens: Optional[int] = None,
+                         measure: Callable[[Any], int] = estimate_tokens) -> List[List[Any]]:
+    """
+    Group items into consecutive batches that each fit within a token budget
+
+    An item that is larger than the budget on its own gets a batch to itself.
+
+    Parameters:
+        items (list): Items to pack, order is preserved
+        max_tokens (int): Token budget per batch (defaults to get_token_limit())
+        measure (callable): Function returning the token size of an item
+
+    Returns:
+        list: List of batches
+    """
+    max_tokens = max_tokens or get_token_limit()
+    batches = []
+    current = []
+    current_tokens = 0
+
+    for item in items:
+        tokens = measure(item)
+        if current and current_tokens + tokens > max_tokens:
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(item)
+        current_tokens += tokens
+
+    if current:
+        batches.append(current)
+
+    return batches
@@ -0,0 +1,275 @@
+"""
+Routing decisions between Excel wizardry functions and AI extraction
+
+The DOCUMENT_FORMAT_ANALYSIS call only answers "Excel Wizardry Function|<id
+or CREATE_NEW>" or "AI Extraction", and for the same document layout,
+field definition and function catalogue the answer does not change. Before
+asking the model:
+
+1. Local rules settle the cases the prompt's own decision logic makes
+   unambiguous (no documents, no spreadsheets, knowledge-document fields,
+   purely computational fields with an empty catalogue).
+2. Earlier decisions are looked up by document fingerprint (document types
+   and spreadsheet sheet/header layout), field definition hash, catalogue
+   version, extraction stage and model.
+
+Only what the model is asked afterwards costs a call; its answer is stored
+in normalized form. Decisions are kept in a utils.state_store backend
+shared by the service processes.
+
+Configured by extraction.toolRouting:
+    enabled:      Use local rules and cached decisions
+    localRules:   Apply the local rules
+    ttlSeconds:   Lifetime of a cached decision
+    maxEntries:   Cached decisions kept (oldest dropped first)
+    backend / stateDir: Decision store (see utils.state_store)
+"""
+
+import hashlib
+import json
+import re
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from utils.config import get_config
+from utils.state_store import build_state_store
+
+DEFAULT_STATE_DIR = 'logs/tool_routing'
+EXCEL_FUNCTION = "Excel Wizardry Function"
+AI_EXTRACTION = "AI Extraction"
+CREATE_NEW = "CREATE_NEW"
+NO_DOCUMENTS = "NO DOCUMENTS SELECTED"
+SPREADSHEET_MIME_TYPES = ('application/vnd.ms-excel', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'text/csv')
+HEADER_SCAN_LIMIT = 50      # Sheets whose header line goes into the document fingerprint
+
+# Indicators from DOCUMENT_FORMAT_ANALYSIS's decision logic
+_KNOWLEDGE_NAME = re.compile(r'standard|mapping|reasoning', re.IGNORECASE)
+_KNOWLEDGE_DESCRIPTION = re.compile(
+    r'knowledge document|standard|comparison|mapping|most relevant|reasoning|explanation|justif', re.IGNORECASE)
+_COMPUTATION_DESCRIPTION = re.compile(
+    r'\b(calculat\w*|comput\w*|sum|sums|total|totals|average|mean|count|counts|aggregat\w*)\b', re.IGNORECASE)
+
+
+def get_tool_routing_config() -> dict:
+    """
+    Get the tool routing configuration
+
+    Returns:
+        dict: extraction.toolRouting from config.json
+    """
+    return get_config('extraction.toolRouting', {}) or {}
+
+
+def _digest(value: Any) -> str:
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:16]
+
+
+def _is_spreadsheet(document: Dict[str, Any]) -> bool:
+    return (document.get('type') or '').lower() in SPREADSHEET_MIME_TYPES
+
+
+def sheet_headers(content: str) -> List[str]:
+    """Sheet marker and header line of each sheet in extracted workbook text"""
+    headers = []
+    position = content.find('=== Sheet: ')
+    while position >= 0 and len(headers) < HEADER_SCAN_LIMIT:
+        marker_end = content.find('\n', position)
+        if marker_end < 0:
+            headers.append(content[position:])
+            break
+        header_end = content.find('\n', marker_end + 1)
+        headers.append(content[position:header_end if header_end >= 0 else len(content)])
+        position = content.find('=== Sheet: ', marker_end)
+    return headers
+
+
+def document_fingerprint(documents: Any) -> str:
+    """
+    Hash of what the routing decision depends on in the documents
+
+    Document types, plus the sheet names and header rows of spreadsheets.
+    Names, ids and cell values are left out, so the same workbook layout
+    uploaded to another session gets the same fingerprint.
+    """
+    if documents == NO_DOCUMENTS or not documents:
+        return _digest(NO_DOCUMENTS)
+    layout = []
+    for document in documents:
+        entry = {"type": (document.get('type') or 'unknown').lower()}
+        if _is_spreadsheet(document):
+            entry["sheets"] = sheet_headers(document.get('contentPreview') or '')
+        layout.append(entry)
+    return _digest(sorted(layout, key=lambda entry: json.dumps(entry, sort_keys=True)))
+
+
+def field_signature(target_fields: List[Dict[str, Any]]) -> str:
+    """Hash of the field definitions the prompt shows (ids left out)"""
+    return _digest([{
+        "name": field.get('name'),
+        "description": field.get('description'),
+        "property_type": field.get('property_type'),
+        "choice_options": field.get('choice_options'),
+        "is_identifier": field.get('is_identifier'),
+        "type": field.get('type'),
+    } for field in target_fields or []])
+
+
+def catalogue_version(functions: List[Dict[str, Any]]) -> str:
+    """Hash of the function catalogue as the prompt shows it (usage counts left out)"""
+    return _digest(sorted(
+        [[function.get('id'), function.get('name'), function.get('description'), function.get('tags')]
+         for function in functions or []],
+        key=lambda entry: str(entry[0])))
+
+
+def local_route(documents: Any, target_fields: List[Dict[str, Any]],
+                functions: List[Dict[str, Any]]) -> Optional[Tuple[str, str]]:
+    """
+    Decide without the model when the prompt's decision logic leaves no choice
+
+    Returns:
+        tuple: (decision, rule name), or None when the model has to decide
+    """
+    if documents == NO_DOCUMENTS or not documents:
+        return f"{EXCEL_FUNCTION}|{CREATE_NEW}", "no_documents"
+    if not any(_is_spreadsheet(document) for document in documents):
+        return AI_EXTRACTION, "no_spreadsheets"
+    for field in target_fields or []:
+        if _KNOWLEDGE_NAME.search(field.get('name') or '') or _KNOWLEDGE_DESCRIPTION.search(field.get('description') or ''):
+            return AI_EXTRACTION, "knowledge_field"
+    if (all(_is_spreadsheet(document) for document in documents) and not functions and target_fields
+            and all(_COMPUTATION_DESCRIPTION.search(field.get('description') or '') for field in target_fields)):
+        return f"{EXCEL_FUNCTION}|{CREATE_NEW}", "computation_without_functions"
+    return None
+
+
+def normalize_decision(response: str, functions: List[Dict[str, Any]]) -> Optional[str]:
+    """
+    Canonical form of a model answer, or None if it is not a usable decision
+
+    Mirrors how the caller reads the answer: the text after the last "|"
+    is the function id (CREATE_NEW when there is none). A function id that
+    is not in the catalogue is not a reusable decision.
+    """
+    if not response or response.startswith("ERROR"):
+        return None
+    if EXCEL_FUNCTION in response:
+        instruction = response.split("|")[-1].strip() if "|" in response else CREATE_NEW
+        if instruction == CREATE_NEW:
+            return f"{EXCEL_FUNCTION}|{CREATE_NEW}"
+        if any(str(function.get('id')) == instruction for function in functions or []):
+            return f"{EXCEL_FUNCTION}|{instruction}"
+        return None
+    if AI_EXTRACTION in response:
+        return AI_EXTRACTION
+    return None
+
+
+class ToolRoutingCache:
+    """Cached routing decisions, shared by the service processes"""
+
+    def __init__(self, config: dict = None, store=None):
+        self.config = config if config is not None else get_tool_routing_config()
+        self.enabled = bool(self.config.get('enabled', True))
+        self.local_rules = bool(self.config.get('localRules', True))
+        self.ttl = int(self.config.get('ttlSeconds', 86400))
+        self.max_entries = int(self.config.get('maxEntries', 5000))
+        self.store = store or build_state_store(self.config.get('backend', 'file'),
+                                                self.config.get('stateDir', DEFAULT_STATE_DIR), 'tool_routing')
+        self.stats = {"rules": 0, "hits": 0, "misses": 0, "stored": 0}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(documents: Any, target_fields: List[Dict[str, Any]], functions: List[Dict[str, Any]],
+            has_references: bool, model: str) -> str:
+        stage = 'subsequent' if has_references else 'first'
+        return "|".join([document_fingerprint(documents), field_signature(target_fields),
+                         catalogue_version(functions), stage, model or ''])
+
+    def lookup(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self.store.transaction() as state:
+            entry = state.setdefault('decisions', {}).get(key)
+            if entry and entry['expires_at'] <= now:
+                del state['decisions'][key]
+                entry = None
+        return entry['decision'] if entry else None
+
+    def store_decision(self, key: str, decision: str):
+        now = time.time()
+        with self.store.transaction() as state:
+            decisions = state.setdefault('decisions', {})
+            decisions[key] = {"decision": decision, "stored_at": now, "expires_at": now + self.ttl}
+            if len(decisions) > self.max_entries:
+                for stale in sorted(decisions, key=lambda k: decisions[k]['stored_at'])[:len(decisions) - self.max_entries]:
+                    del decisions[stale]
+
+    def _count(self, stat: str):
+        with self._lock:
+            self.stats[stat] += 1
+
+    def route(self, documents: Any, target_fields: List[Dict[str, Any]], functions: List[Dict[str, Any]],
+              identifier_references: Any, model: str, analyze: Callable[[], str],
+              candidates: Optional[List[Dict[str, Any]]] = None) -> str:
+        """
+        Routing decision for one field, asking the model only when needed
+
+        Parameters:
+            documents: Document dicts (id, name, type, contentPreview) or "NO DOCUMENTS SELECTED"
+            target_fields (list): Target field data
+            functions (list): Excel function catalogue (the local rules look at all of it)
+            identifier_references: References passed to the analysis
+            model (str): Model the analysis would use
+            analyze (callable): Runs the DOCUMENT_FORMAT_ANALYSIS call and returns its text
+            candidates (list): Functions the analysis is shown, when narrowed from the catalogue
+
+        Returns:
+            str: Decision text in the format of the analysis response
+        """
+        if not self.enabled:
+            return analyze()
+        candidates = functions if candidates is None else candidates
+
+        if self.local_rules:
+            routed = local_route(documents, target_fields, functions)
+            if routed:
+                self._count("rules")
+                print(f"🧭 TOOL ROUTING: {routed[0]} (rule: {routed[1]})", file=sys.stderr, flush=True)
+                return routed[0]
+
+        key = self.key(documents, target_fields, candidates, bool(identifier_references), model)
+        try:
+            cached = self.lookup(key)
+        except Exception as e:
+            print(f"⚠️ TOOL ROUTING: decision cache unavailable ({e})", file=sys.stderr, flush=True)
+            return analyze()
+        if cached:
+            self._count("hits")
+            print(f"🧭 TOOL ROUTING: {cached} (cached)", file=sys.stderr, flush=True)
+            return cached
+
+        self._count("misses")
+        response = analyze()
+        decision = normalize_decision(response, candidates)
+        if decision:
+            try:
+                self.store_decision(key, decision)
+                self._count("stored")
+            except Exception as e:
+                print(f"⚠️ TOOL ROUTING: could not store decision ({e})", file=sys.stderr, flush=True)
+        return response
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_tool_routing_cache() -> ToolRoutingCache:
+    """Get the process-wide tool routing cache"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ToolRoutingCache()
+    return _cache
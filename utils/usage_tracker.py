@@ -0,0 +1,315 @@
+"""
+Token, latency and cost accounting for Gemini calls
+
+Every upstream call made through utils.gemini_client is recorded with its
+usage_metadata (input, output, cached and thinking tokens), the model,
+latency, time spent queued for quota, the number of 429 retries and an
+estimated cost from ai.usageTracking.pricing.
+
+Records are tagged from context variables so the call sites do not have
+to pass anything down to the client:
+
+    with usage_context(session_id=session_id, project_id=project_id):
+        ...
+    with usage_context(field=value_name, call_site='execute_ai_extraction'):
+        ...
+
+Without a call_site tag the first function outside utils/ on the stack is
+used. Tags set in a context are inherited by threads started with
+contextvars.copy_context().
+
+Records are buffered per process and written in bulk (every flushSize
+records, after flushIntervalSeconds, and at exit), either to the
+llm_usage_records table (backend "postgres") or to a JSONL file (backend
+"file"). summarize_session() reports calls, tokens, cost, latency and
+retries per call site, field and model for one session.
+
+Configured by ai.usageTracking:
+    enabled:              Record usage (default True)
+    backend:              "file" or "postgres"
+    file:                 JSONL file for the file backend
+    flushSize:            Buffered records that trigger a write
+    flushIntervalSeconds: Oldest buffered record age that triggers a write
+    pricing:              USD per 1M tokens per model: input, output, cached
+"""
+
+import atexit
+import contextlib
+import contextvars
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional
+
+from utils.config import get_config
+
+DEFAULT_FILE = 'logs/llm_usage.jsonl'
+DEFAULT_FLUSH_SIZE = 50
+DEFAULT_FLUSH_INTERVAL_SECONDS = 30
+TAGS = ('session_id', 'project_id', 'field', 'call_site')
+COLUMNS = ('session_id', 'project_id', 'field', 'call_site', 'model', 'input_tokens', 'output_tokens',
+           'cached_tokens', 'thinking_tokens', 'latency_ms', 'queued_ms', 'retries', 'streamed', 'cost_usd',
+           'created_at')
+
+_UTILS_DIR = os.path.dirname(os.path.abspath(__file__))
+_tags = contextvars.ContextVar('usage_tags', default={})
+
+_buffer: List[Dict[str, Any]] = []
+_buffer_started: Optional[float] = None
+_buffer_lock = threading.Lock()
+_write_lock = threading.Lock()
+
+
+def get_usage_tracking_config() -> dict:
+    """
+    Get the usage tracking configuration
+
+    Returns:
+        dict: ai.usageTracking from config.json
+    """
+    return get_config('ai.usageTracking', {}) or {}
+
+
+def is_usage_tracking_enabled() -> bool:
+    """True when ai.usageTracking.enabled is set (default True)"""
+    return bool(get_usage_tracking_config().get('enabled', True))
+
+
+def set_usage_tags(**tags):
+    """
+    Tag the current context's Gemini calls
+
+    Parameters:
+        session_id, project_id, field, call_site (str): Tags to set (None clears one)
+    """
+    unknown = set(tags) - set(TAGS)
+    if unknown:
+        raise ValueError(f"Unknown usage tags: {', '.join(sorted(unknown))}")
+    merged = dict(_tags.get())
+    merged.update({key: str(value) if value is not None else None for key, value in tags.items()})
+    _tags.set(merged)
+
+
+def get_usage_tags() -> Dict[str, Optional[str]]:
+    """Tags for the current context"""
+    return dict(_tags.get())
+
+
+@contextlib.contextmanager
+def usage_context(**tags) -> Iterator[None]:
+    """Tag the Gemini calls made inside the block; the previous tags are restored afterwards"""
+    token = _tags.set(dict(_tags.get()))
+    try:
+        set_usage_tags(**tags)
+        yield
+    finally:
+        _tags.reset(token)
+
+
+def _caller_call_site() -> Optional[str]:
+    """Innermost function on the stack that is not in utils/ (the enclosing function for closures)"""
+    frame = sys._getframe(1)
+    while frame is not None:
+        code = frame.f_code
+        if not os.path.abspath(code.co_filename).startswith(_UTILS_DIR) and not code.co_name.startswith('<'):
+            return getattr(code, 'co_qualname', code.co_name).split('.<locals>')[0]
+        frame = frame.f_back
+    return None
+
+
+def _token_count(usage_metadata, name: str) -> int:
+    return int(getattr(usage_metadata, name, None) or 0) if usage_metadata is not None else 0
+
+
+def estimate_cost(model: str, input_tokens: int, output_tokens: int, cached_tokens: int = 0) -> Optional[float]:
+    """
+    Estimated USD cost of one call from ai.usageTracking.pricing
+
+    Cached prompt tokens are charged at the cached rate instead of the input
+    rate; output includes thinking tokens.
+
+    Returns:
+        float: Cost, or None when the model has no pricing entry
+    """
+    pricing = get_usage_tracking_config().get('pricing', {})
+    rates = pricing.get(model) or next((rates for name, rates in pricing.items() if model and model.startswith(name)), None)
+    if not rates:
+        return None
+    cached_rate = rates.get('cached', rates.get('input', 0))
+    cost = ((input_tokens - cached_tokens) * rates.get('input', 0) + cached_tokens * cached_rate
+            + output_tokens * rates.get('output', 0)) / 1_000_000
+    return round(cost, 8)
+
+
+def record_usage(model: str, usage_metadata, latency_ms: float, retries: int = 0, queued_ms: float = 0,
+                 streamed: bool = False):
+    """
+    Buffer the usage of one upstream call
+
+    Parameters:
+        model (str): Gemini model name
+        usage_metadata: Response usage_metadata (None if the response had none)
+        latency_ms (float): Time from sending the request to the last chunk
+        retries (int): 429 retries before this call succeeded
+        queued_ms (float): Time spent waiting for rate limit quota
+        streamed (bool): The call was a streaming request
+    """
+    if not is_usage_tracking_enabled():
+        return
+    tags = _tags.get()
+    input_tokens = _token_count(usage_metadata, 'prompt_token_count')
+    cached_tokens = _token_count(usage_metadata, 'cached_content_token_count')
+    thinking_tokens = _token_count(usage_metadata, 'thoughts_token_count')
+    output_tokens = _token_count(usage_metadata, 'candidates_token_count') + thinking_tokens
+
+    record = {
+        "session_id": tags.get('session_id'),
+        "project_id": tags.get('project_id'),
+        "field": tags.get('field'),
+        "call_site": tags.get('call_site') or _caller_call_site(),
+        "model": model,
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+        "cached_tokens": cached_tokens,
+        "thinking_tokens": thinking_tokens,
+        "latency_ms": round(latency_ms),
+        "queued_ms": round(queued_ms),
+        "retries": retries,
+        "streamed": streamed,
+        "cost_usd": estimate_cost(model, input_tokens, output_tokens, cached_tokens),
+        "created_at": datetime.utcnow().isoformat(),
+    }
+
+    global _buffer_started
+    config = get_usage_tracking_config()
+    with _buffer_lock:
+        if not _buffer:
+            _buffer_started = time.time()
+        _buffer.append(record)
+        due = (len(_buffer) >= int(config.get('flushSize', DEFAULT_FLUSH_SIZE))
+               or time.time() - _buffer_started >= float(config.get('flushIntervalSeconds', DEFAULT_FLUSH_INTERVAL_SECONDS)))
+    if due:
+        flush_usage()
+
+
+def flush_usage():
+    """Write all buffered records in one batch"""
+    global _buffer, _buffer_started
+    with _write_lock:
+        with _buffer_lock:
+            batch, _buffer, _buffer_started = _buffer, [], None
+        if not batch:
+            return
+        config = get_usage_tracking_config()
+        try:
+            if config.get('backend', 'file') == 'postgres' and os.getenv('DATABASE_URL'):
+                _write_postgres(batch)
+            else:
+                _write_file(batch, config.get('file', DEFAULT_FILE))
+        except Exception as e:
+            print(f"⚠️ Could not write {len(batch)} LLM usage records: {e}", file=sys.stderr, flush=True)
+
+
+def _write_file(batch: List[Dict[str, Any]], path: str):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, 'a') as f:
+        f.write("".join(json.dumps(record) + "\n" for record in batch))
+
+
+def _write_postgres(batch: List[Dict[str, Any]]):
+    import psycopg2
+    from psycopg2.extras import execute_values
+    conn = psycopg2.connect(os.getenv('DATABASE_URL'))
+    try:
+        with conn, conn.cursor() as cursor:
+            execute_values(
+                cursor,
+                f"INSERT INTO llm_usage_records ({', '.join(COLUMNS)}) VALUES %s",
+                [tuple(record[column] for column in COLUMNS) for record in batch],
+            )
+    finally:
+        conn.close()
+
+
+atexit.register(flush_usage)
+
+
+def _load_session(session_id: str) -> List[Dict[str, Any]]:
+    config = get_usage_tracking_config()
+    if config.get('backend', 'file') == 'postgres' and os.getenv('DATABASE_URL'):
+        import psycopg2
+        from psycopg2.extras import RealDictCursor
+        conn = psycopg2.connect(os.getenv('DATABASE_URL'))
+        try:
+            with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                cursor.execute(f"SELECT {', '.join(COLUMNS)} FROM llm_usage_records WHERE session_id = %s",
+                               (session_id,))
+                return [dict(row) for row in cursor.fetchall()]
+        finally:
+            conn.close()
+
+    path = config.get('file', DEFAULT_FILE)
+    if not os.path.exists(path):
+        return []
+    records = []
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get('session_id') == session_id:
+                records.append(record)
+    return records
+
+
+def _aggregate(records: List[Dict[str, Any]], key: str) -> Dict[str, Dict[str, Any]]:
+    groups = defaultdict(lambda: {"calls": 0, "input_tokens": 0, "output_tokens": 0, "cached_tokens": 0,
+                                  "cost_usd": 0.0, "latency_ms": 0, "queued_ms": 0, "retries": 0})
+    for record in records:
+        group = groups[record.get(key) or '(untagged)']
+        group["calls"] += 1
+        for column in ("input_tokens", "output_tokens", "cached_tokens", "latency_ms", "queued_ms", "retries"):
+            group[column] += record.get(column) or 0
+        group["cost_usd"] += float(record.get('cost_usd') or 0)
+    for group in groups.values():
+        group["cost_usd"] = round(group["cost_usd"], 6)
+        group["avg_latency_ms"] = round(group["latency_ms"] / group["calls"])
+    return dict(sorted(groups.items(), key=lambda item: -item[1]["latency_ms"]))
+
+
+def summarize_session(session_id: str) -> Dict[str, Any]:
+    """
+    Summarize the recorded Gemini usage of one session
+
+    Buffered records of this process are written first.
+
+    Parameters:
+        session_id (str): Session ID
+
+    Returns:
+        dict: "total" plus "by_call_site", "by_field" and "by_model" -> calls, tokens,
+              cost, total and average latency, queue time and retries (slowest first)
+    """
+    flush_usage()
+    records = _load_session(session_id)
+    return {
+        "session_id": session_id,
+        "total": _aggregate(records, 'session_id').get(session_id, {}),
+        "by_call_site": _aggregate(records, 'call_site'),
+        "by_field": _aggregate(records, 'field'),
+        "by_model": _aggregate(records, 'model'),
+    }
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python -m utils.usage_tracker <session_id>", file=sys.stderr)
+        sys.exit(1)
+    print(json.dumps(summarize_session(sys.argv[1]), indent=2, default=str))
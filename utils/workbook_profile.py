@@ -0,0 +1,250 @@
+"""
+Structure profiling for extracted workbook text
+
+Extracted spreadsheets are plain text: a "=== Sheet: Name ===" line per
+sheet followed by tab-separated rows, with empty cells written as "blank".
+For function generation the model only needs the layout, so a workbook is
+reduced to, per sheet:
+
+- row and column counts and the header row
+- a type profile per column (inferred type, fill rate, distinct count,
+  examples, min/max)
+- a stratified sample of rows: rows are grouped by their shape (which
+  cells are empty, numeric, dates or text) so subtotal lines, section
+  headings and sparse rows are represented, not just the first N rows
+
+The sample is rendered back in the original sheet text format, so a
+function written against it also parses the full workbook. The profile
+size depends on the column count and sample size, not on the row count.
+"""
+
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+from utils.config import get_config
+
+SHEET_MARKER = re.compile(r'^=== Sheet: (.*) ===$')
+BLANK = 'blank'
+
+DEFAULT_SAMPLE_ROWS = 20
+MAX_EXAMPLES = 3
+MAX_TRACKED_DISTINCT = 1000      # Distinct counts are reported as ">1000" beyond this
+
+_INTEGER = re.compile(r'^[-+]?\d{1,3}(,\d{3})*$|^[-+]?\d+$')
+_NUMBER = re.compile(r'^[-+]?(\d{1,3}(,\d{3})*|\d*)\.\d+([eE][-+]?\d+)?$|^[-+]?\d+[eE][-+]?\d+$')
+_DATE = re.compile(r'^(\d{4}-\d{2}-\d{2}([ T]\d{2}:\d{2}(:\d{2})?)?|\d{1,2}[/.-]\d{1,2}[/.-]\d{2,4})$')
+_BOOLEAN = {'true', 'false', 'yes', 'no', 'y', 'n'}
+
+
+def cell_kind(value: str) -> str:
+    """Classify one cell: empty, integer, number, date, boolean or text"""
+    value = value.strip()
+    if not value or value == BLANK:
+        return 'empty'
+    if _INTEGER.match(value):
+        return 'integer'
+    if _NUMBER.match(value):
+        return 'number'
+    if _DATE.match(value):
+        return 'date'
+    if value.lower() in _BOOLEAN:
+        return 'boolean'
+    return 'text'
+
+
+def parse_sheets(content: str) -> Optional[List[Tuple[str, List[List[str]]]]]:
+    """
+    Split extracted workbook text into sheets
+
+    Parameters:
+        content (str): Text with "=== Sheet: Name ===" markers
+
+    Returns:
+        list: (sheet name, rows) with trailing empty cells trimmed, or None
+              if the text has no sheet markers
+    """
+    if not content or '=== Sheet: ' not in content:
+        return None
+    sheets = []
+    rows = None
+    for line in content.split('\n'):
+        match = SHEET_MARKER.match(line.rstrip('\r'))
+        if match:
+            rows = []
+            sheets.append((match.group(1), rows))
+            continue
+        if rows is None or not line.strip():
+            continue
+        cells = line.rstrip('\r').split('\t')
+        while cells and cells[-1].strip() in ('', BLANK):
+            cells.pop()
+        if cells:
+            rows.append(cells)
+    return sheets
+
+
+def _column_profile(name: str, values: List[str]) -> Dict[str, Any]:
+    kinds: Dict[str, int] = {}
+    distinct = set()
+    examples = []
+    numeric = []
+    for value in values:
+        kind = cell_kind(value)
+        kinds[kind] = kinds.get(kind, 0) + 1
+        if kind == 'empty':
+            continue
+        value = value.strip()
+        if len(distinct) <= MAX_TRACKED_DISTINCT:
+            distinct.add(value)
+        if len(examples) < MAX_EXAMPLES and value not in examples:
+            examples.append(value[:80])
+        if kind in ('integer', 'number'):
+            try:
+                numeric.append(float(value.replace(',', '')))
+            except ValueError:
+                pass
+
+    filled = {kind: count for kind, count in kinds.items() if kind != 'empty'}
+    if not filled:
+        inferred = 'empty'
+    elif len(filled) == 1:
+        inferred = next(iter(filled))
+    elif set(filled) == {'integer', 'number'}:
+        inferred = 'number'
+    else:
+        dominant = max(filled, key=filled.get)
+        inferred = f"mixed ({dominant} {filled[dominant]}/{sum(filled.values())})"
+
+    profile = {
+        "name": name,
+        "type": inferred,
+        "filled": sum(filled.values()),
+        "empty": kinds.get('empty', 0),
+        "distinct": len(distinct) if len(distinct) <= MAX_TRACKED_DISTINCT else f">{MAX_TRACKED_DISTINCT}",
+        "examples": examples,
+    }
+    if numeric:
+        profile["min"] = min(numeric)
+        profile["max"] = max(numeric)
+    return profile
+
+
+def stratified_sample(rows: List[List[str]], sample_size: int) -> List[int]:
+    """
+    Pick row positions covering every row shape, spread across the sheet
+
+    Rows are grouped by the kinds of their cells. Every group gets at least
+    one row (first occurrence) while room remains, and the rest of the
+    sample is spread evenly over the sheet. The first and last rows are
+    always included.
+
+    Returns:
+        list: Sorted row positions
+    """
+    if len(rows) <= sample_size:
+        return list(range(len(rows)))
+
+    strata: Dict[tuple, List[int]] = {}
+    for position, row in enumerate(rows):
+        strata.setdefault(tuple(cell_kind(cell) for cell in row), []).append(position)
+
+    chosen = {0, len(rows) - 1}
+    # Rarest shapes first - they are the ones an evenly spaced sample misses
+    for positions in sorted(strata.values(), key=len):
+        if len(chosen) >= sample_size:
+            break
+        chosen.add(positions[0])
+
+    remaining = sample_size - len(chosen)
+    if remaining > 0:
+        step = len(rows) / (remaining + 1)
+        for index in range(1, remaining + 1):
+            chosen.add(min(len(rows) - 1, int(index * step)))
+    return sorted(chosen)
+
+
+def profile_sheet(name: str, rows: List[List[str]], sample_rows: int = DEFAULT_SAMPLE_ROWS) -> Dict[str, Any]:
+    """
+    Profile one sheet
+
+    The first row is treated as the header (extraction already merges
+    multi-row headers).
+
+    Returns:
+        dict: name, row_count, column_count, header, columns (profiles) and
+              sample (row number + cells, numbered from 1 like the sheet)
+    """
+    if not rows:
+        return {"name": name, "row_count": 0, "column_count": 0, "header": [], "columns": [], "sample": []}
+
+    header = rows[0]
+    body = rows[1:]
+    width = max(len(row) for row in rows)
+    names = [header[index] if index < len(header) and header[index] != BLANK else f"column_{index + 1}"
+             for index in range(width)]
+    columns = [_column_profile(names[index], [row[index] if index < len(row) else '' for row in body])
+               for index in range(width)]
+    sample = [{"row": position + 2, "cells": body[position]} for position in stratified_sample(body, sample_rows)]
+
+    return {
+        "name": name,
+        "row_count": len(body),
+        "column_count": width,
+        "header": header,
+        "columns": columns,
+        "sample": sample,
+    }
+
+
+def profile_workbook(content: str, sample_rows: int = None) -> Optional[Dict[str, Any]]:
+    """
+    Profile every sheet of extracted workbook text
+
+    Parameters:
+        content (str): Extracted workbook text
+        sample_rows (int): Rows sampled per sheet (default extraction.workbookProfile.sampleRows)
+
+    Returns:
+        dict: {"sheets": [...]} or None if the text is not a workbook
+    """
+    sheets = parse_sheets(content)
+    if sheets is None:
+        return None
+    if sample_rows is None:
+        sample_rows = int(get_config('extraction.workbookProfile.sampleRows', DEFAULT_SAMPLE_ROWS))
+    return {"sheets": [profile_sheet(name, rows, sample_rows) for name, rows in sheets]}
+
+
+def render_sample(profile: Dict[str, Any]) -> str:
+    """
+    Render the header and sampled rows in the extracted sheet text format
+
+    Trailing "blank" padding cells are left out.
+
+    Parameters:
+        profile (dict): Result of profile_workbook
+
+    Returns:
+        str: "=== Sheet: Name ===" sections with tab-separated rows
+    """
+    parts = []
+    for sheet in profile["sheets"]:
+        parts.append(f"=== Sheet: {sheet['name']} ===")
+        if sheet["header"]:
+            parts.append("\t".join(sheet["header"]))
+        parts.extend("\t".join(row["cells"]) for row in sheet["sample"])
+    return "\n".join(parts)
+
+
+def summarize_profile(profile: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Per-sheet structure without the sampled rows, for the prompt next to the sample"""
+    return [
+        {
+            "sheet": sheet["name"],
+            "row_count": sheet["row_count"],
+            "column_count": sheet["column_count"],
+            "sampled_rows": [row["row"] for row in sheet["sample"]],
+            "columns": sheet["columns"],
+        }
+        for sheet in profile["sheets"]
+    ]